@@ -1,11 +1,17 @@
 import os
+import re
 import json
+import asyncio
+import inspect
 import threading
-import queue
 import requests
-import websockets.sync.server
-from common.rabbitmq.connect import connect_to_rabbitmq, init_queues
-from common.rabbitmq.constants import RESULT_QUEUE
+import pika
+import websockets.asyncio.server
+from pika.adapters.asyncio_connection import AsyncioConnection
+from common.models.envelope import decode_message
+from common.rabbitmq.connect import RABBITMQ_PASS, RABBITMQ_USER
+from common.rabbitmq.constants import BATCH_QUEUE, JOB_QUEUE, RESULT_QUEUE, STATUS_QUEUE
+from common.redis.connect import connect_to_redis_async
 import time
 from common.models import (
     AggregatorMessage,
@@ -16,9 +22,20 @@ from common.models import (
     LegislationList,
 )
 from metrics.models import MetricValue, WorkerResults, MetricsPackageExceptionModel
-from report_generation.utils import get_legislation_extracts, add_llm_insights
+from metrics.sufficient_statistics import (
+    metric_to_sufficient_statistics,
+    merge_sufficient_statistics,
+    finalize_metric,
+)
+from report_generation.utils import (
+    get_legislation_extracts,
+    add_llm_insights,
+    warm_up_legislation_cache,
+)
 from worker.worker import USER_METRIC_SERVER_URL
 from aggregator.connection_manager import ConnectionManager
+from aggregator.push_policy import MetricsPusher
+from aggregator.state_store import AggregatorStateStore
 from fastapi import FastAPI
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
@@ -30,6 +47,9 @@ from .utils import (
 )
 
 
+# Maximum number of results being aggregated by each aggregator at once
+AGGREGATOR_PREFETCH_COUNT = int(os.environ.get("AGGREGATOR_PREFETCH_COUNT", "32"))
+
 manager = ConnectionManager()
 app = FastAPI()
 app.add_middleware(
@@ -96,25 +116,107 @@ def aggregator_final_report_log(report):
     )
 
 
-def aggregator_intermediate_metrics_log(metrics):
+def aggregator_intermediate_metrics_log(metrics, progress=None, delta=False):
+    """
+    Intermediate metrics, with the user's progress. If delta is set, the metrics contain
+    only those which changed since the previous intermediate metrics.
+    """
     return AggregatorMessage(
         messageType=MessageType.METRICS_INTERMEDIATE,
         message="Batch successfully processed - intermediate metrics successfully generated",
         statusCode=202,
-        content={"metrics_results": metrics},
+        content={"metrics_results": metrics, **(progress or {}), "delta": delta},
     )
 
 
+pusher = MetricsPusher(
+    lambda user_id, message: manager.send_to_user(user_id, message),
+    aggregator_intermediate_metrics_log,
+)
+
+
 class MetricsAggregator:
     def __init__(self):
         self.metrics = {}
+        self.batches_processed = 0
         self.samples_processed = 0
         self.total_sample_size = 0
+        # Sufficient statistics merged over all batches, and the metrics which cannot be
+        # derived from them as a batch was received without their statistics
+        self.statistics = {}
+        self.metrics_without_statistics = set()
+        # Batches already aggregated, so that redelivered results are not counted twice
+        self.processed_batches = set()
+
+    def to_dict(self):
+        """Returns the aggregator's state as a JSON-serialisable dictionary"""
+        return {
+            "metrics": self.metrics,
+            "batches_processed": self.batches_processed,
+            "samples_processed": self.samples_processed,
+            "total_sample_size": self.total_sample_size,
+            "statistics": self.statistics,
+            "metrics_without_statistics": sorted(self.metrics_without_statistics),
+            "processed_batches": sorted(self.processed_batches),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Creates an aggregator from a state returned by to_dict"""
+        aggregator = cls()
+        aggregator.metrics = state["metrics"]
+        aggregator.batches_processed = state["batches_processed"]
+        aggregator.samples_processed = state["samples_processed"]
+        aggregator.total_sample_size = state["total_sample_size"]
+        aggregator.statistics = state["statistics"]
+        aggregator.metrics_without_statistics = set(state["metrics_without_statistics"])
+        aggregator.processed_batches = set(state["processed_batches"])
+        return aggregator
 
     def set_total_sample_size(self, total_sample_size):
         self.total_sample_size = total_sample_size
 
-    def aggregate_new_batch(self, batch_metrics_results, batch_size):
+    def _merge_batch_statistics(self, batch_statistics):
+        for name, statistics in batch_statistics.items():
+            if name in self.statistics:
+                self.statistics[name] = merge_sufficient_statistics(
+                    name, self.statistics[name], statistics
+                )
+            else:
+                self.statistics[name] = statistics
+
+    def _value_from_statistics(self, metric, batch_statistics):
+        """
+        Derive the metric from the statistics merged over all batches so far, or return None
+        if it cannot be, in which case the metric is averaged over batches from now on
+        """
+        properties = metric_to_sufficient_statistics.get(metric)
+        # Statistics missing from any batch would leave its samples out of the value
+        if (
+            metric in self.metrics_without_statistics
+            or properties is None
+            or properties["statistics"] not in batch_statistics
+        ):
+            self.metrics_without_statistics.add(metric)
+            return None
+        try:
+            return finalize_metric(metric, self.statistics)
+        except Exception as e:
+            print(f"Failed to derive {metric} from sufficient statistics: {e}")
+            self.metrics_without_statistics.add(metric)
+            return None
+
+    def aggregate_new_batch(self, batch_metrics_results, batch_size, batch_statistics=None, batch_id=None):
+        """
+        Combine a batch's metric results with those of previous batches. Metrics with
+        sufficient statistics are derived exactly from the statistics merged over every
+        batch; other metrics are averaged over batches, weighted by batch size.
+        """
+        if batch_id is not None:
+            self.processed_batches.add(batch_id)
+        batch_statistics = batch_statistics or {}
+        self._merge_batch_statistics(batch_statistics)
+
         for metric, metric_value_obj in batch_metrics_results.items():
             if metric not in self.metrics:
                 # First time encountering this metric, initialize with the first batch value
@@ -129,8 +231,11 @@ class MetricsAggregator:
                     }
                     continue
                 # otherwise of type MetricValue
+                exact_value = self._value_from_statistics(metric, batch_statistics)
                 self.metrics[metric] = {
-                    "value": metric_value_obj.computed_value,
+                    "value": (
+                        metric_value_obj.computed_value if exact_value is None else exact_value
+                    ),
                     "ideal_value": metric_value_obj.ideal_value,
                     "range": metric_value_obj.range,
                     "count": batch_size,
@@ -152,21 +257,31 @@ class MetricsAggregator:
                     }
                     continue
 
-                # Update the running average incrementally
                 prev_value = self.metrics[metric]["value"]
                 prev_count = self.metrics[metric]["count"]
-
-                # Compute new weighted average
                 new_count = prev_count + batch_size
-                new_value = (
-                    prev_value * prev_count
-                    + metric_value_obj.computed_value * batch_size
-                ) / new_count
+
+                new_value = self._value_from_statistics(metric, batch_statistics)
+                if new_value is None:
+                    # Update the running average incrementally
+                    new_value = (
+                        prev_value * prev_count
+                        + metric_value_obj.computed_value * batch_size
+                    ) / new_count
                 self.metrics[metric]["value"] = new_value
                 self.metrics[metric]["count"] = new_count  # Update the total count
 
+        self.batches_processed += 1
         self.samples_processed += batch_size
 
+    def get_progress(self):
+        """Returns the number of batches and samples processed so far, and the total sample size"""
+        return {
+            "batches_processed": self.batches_processed,
+            "samples_processed": self.samples_processed,
+            "total_sample_size": self.total_sample_size,
+        }
+
     def get_aggregated_metrics(self):
         """
         Returns the aggregated metrics as a dictionary.
@@ -198,46 +313,121 @@ class MetricsAggregator:
 
 
 class ResultsConsumer:
+    """
+    Consumes results from RabbitMQ on the running event loop, with pika's asyncio adapter,
+    so that results are received on the same loop as the websocket and HTTP servers.
+    Reconnects if the connection to RabbitMQ is lost.
+    """
 
-    def __init__(self, host="localhost"):
+    def __init__(self, host="localhost", retries: int = 20, prefetch_count: int = AGGREGATOR_PREFETCH_COUNT):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         """
 
         self._host = host
+        self._retries = retries
+        self._prefetch_count = prefetch_count
         self._connection = None
         self._channel = None
+        self._closed = None
+        self._stopping = False
+        # Messages received but not yet processed, with the channel they were received on
+        self._messages: asyncio.Queue = None
+
+    async def connect(self):
+        """Connect to RabbitMQ and open a channel, retrying up to `retries` times"""
+        loop = asyncio.get_running_loop()
+        parameters = pika.ConnectionParameters(
+            host=self._host,
+            heartbeat=600,
+            credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
+        )
+        for i in range(self._retries):
+            print(f"Connecting to RabbitMQ at {self._host}")
+            opened = loop.create_future()
+            self._closed = loop.create_future()
+            self._connection = AsyncioConnection(
+                parameters,
+                on_open_callback=lambda _: _resolve(opened, None),
+                on_open_error_callback=lambda _, error: _resolve(opened, error=error),
+                on_close_callback=lambda _, reason: _resolve(self._closed, reason),
+                custom_ioloop=loop,
+            )
+            try:
+                await opened
+                break
+            except Exception as e:
+                print(f"Connection failed due to {e}. Retrying {i+1}/{self._retries}...")
+                await asyncio.sleep(3)
+        else:
+            raise Exception(f"Could not connect to RabbitMQ after {self._retries} attempts.")
+
+        channel_opened = loop.create_future()
+        self._connection.channel(on_open_callback=lambda channel: _resolve(channel_opened, channel))
+        self._channel = await channel_opened
+        # Results are acknowledged once aggregated, so bound how many are unacknowledged
+        qos_set = loop.create_future()
+        self._channel.basic_qos(
+            prefetch_count=self._prefetch_count, callback=lambda _: _resolve(qos_set, None)
+        )
+        await qos_set
+        for queue_name in (JOB_QUEUE, RESULT_QUEUE, BATCH_QUEUE, STATUS_QUEUE):
+            declared = loop.create_future()
+            self._channel.queue_declare(
+                queue=queue_name, durable=True, callback=lambda _, f=declared: _resolve(f, None)
+            )
+            await declared
 
-    def connect(self):
-        """Connect to RabbitMQ, returning the connection handle.
-
-        When the connection is established, the on_connection_open method
-        will be invoked by pika.
-
-        :rtype: pika.SelectConnection
-
+    async def run(self, on_message_callback=None):
         """
-        self._connection = connect_to_rabbitmq(host=self._host)
-        self._channel = self._connection.channel()
-        init_queues(self._channel)
+        Run the consumer until stopped. The callback is run on the event loop, one message at
+        a time in the order they were received, and may be a coroutine function, e.g. to wait
+        for Redis without blocking the loop. Errors it raises are logged rather than stopping
+        the consumer. Messages are acknowledged once the callback returns, so messages being
+        processed when the aggregator stops are redelivered.
 
-    def run(self, on_message_callback=None):
         """
-        Run the consumer loop.
+        self._messages = asyncio.Queue()
 
-        """
-        self.connect()
+        def on_message(channel, method, properties, body):
+            self._messages.put_nowait((channel, method, properties, body))
+
+        processing = asyncio.create_task(self._process_messages(on_message_callback))
         try:
-            self._channel.basic_consume(
-                queue=RESULT_QUEUE,
-                on_message_callback=on_message_callback,
-                auto_ack=True,
-            )
-            print("Waiting for messages...")
-            self._channel.start_consuming()  # Blocking call, waits for messages
-        except KeyboardInterrupt:
-            self.stop()
+            while not self._stopping:
+                await self.connect()
+                self._channel.basic_consume(
+                    queue=RESULT_QUEUE,
+                    on_message_callback=on_message,
+                    auto_ack=False,
+                )
+                print("Waiting for messages...")
+                reason = await self._closed
+                if not self._stopping:
+                    print(f"Connection to RabbitMQ closed: {reason}. Reconnecting...")
+                    await asyncio.sleep(3)
+            # Finish processing the messages already received
+            await self._messages.join()
+        finally:
+            processing.cancel()
+
+    async def _process_messages(self, on_message_callback):
+        while True:
+            channel, method, properties, body = await self._messages.get()
+            try:
+                result = on_message_callback(channel, method, properties, body)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Error processing message: {e}")
+            try:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+            except Exception as e:
+                # The message was received on a connection which has since closed, so it is redelivered
+                print(f"Failed to acknowledge message: {e}")
+            finally:
+                self._messages.task_done()
 
     def stop(self):
         """
@@ -245,18 +435,31 @@ class ResultsConsumer:
 
         """
         print("Closing connection...")
-        self._channel.close()
-        self._connection.close()
+        self._stopping = True
+        if self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+
+def _resolve(future: asyncio.Future, result=None, error=None):
+    """Complete a future from a pika callback, unless it is already done"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error if isinstance(error, BaseException) else Exception(error))
+    else:
+        future.set_result(result)
 
 
 RABBIT_MQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
-# Store messages until a client connects
-message_queue = queue.Queue()
+# Redis to keep aggregation state and users' replay buffers in, shared by all aggregator
+# replicas - if unset, they are kept in memory and only one aggregator may consume results
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = os.environ.get("REDIS_PORT", "6379")
 # user_id -> MetricsAggregator
-user_aggregators: dict = {}
+state_store = AggregatorStateStore(MetricsAggregator)
 
 
-def process_batch_result(worker_results: WorkerResults, user_id: str):
+async def process_batch_result(worker_results: WorkerResults, user_id: str):
     """Handles batch results from worker i.e. aggregating intermediate metric results"""
     print(f"Received result for user {user_id}: {worker_results}")
 
@@ -265,15 +468,6 @@ def process_batch_result(worker_results: WorkerResults, user_id: str):
             f"User-defined metrics received for user {user_id}: {worker_results.user_defined_metrics}"
         )
 
-    # ensure a metricsaffregator exists for the user
-    if user_id not in user_aggregators:
-        user_aggregators[user_id] = MetricsAggregator()
-
-    aggregator: MetricsAggregator = user_aggregators[user_id]
-
-    if aggregator.total_sample_size == 0:
-        aggregator.set_total_sample_size(worker_results.total_sample_size)
-
     batch_metrics = worker_results.metric_values
     if worker_results.user_defined_metrics is not None:
         for metric, metric_value in worker_results.user_defined_metrics.items():
@@ -288,31 +482,43 @@ def process_batch_result(worker_results: WorkerResults, user_id: str):
             )
             batch_metrics[metric] = metric_value_obj
 
-    aggregator.aggregate_new_batch(
-        worker_results.metric_values, worker_results.batch_size
-    )
+    def aggregate(aggregator: MetricsAggregator):
+        if worker_results.batch_id in aggregator.processed_batches:
+            return None
+        if aggregator.total_sample_size == 0:
+            aggregator.set_total_sample_size(worker_results.total_sample_size)
+        aggregator.aggregate_new_batch(
+            worker_results.metric_values,
+            worker_results.batch_size,
+            worker_results.sufficient_statistics,
+            worker_results.batch_id,
+        )
+        return aggregator
+
+    # the user's aggregator is created on their first batch
+    aggregator: MetricsAggregator = await state_store.update(user_id, aggregate)
+    if aggregator is None:
+        print(f"Batch {worker_results.batch_id} was already aggregated for user {user_id}, skipping")
+        return
 
     aggregates = aggregator.get_aggregated_metrics()
-    # send the intermediate metrics to the user
-    manager.send_to_user(user_id, aggregator_intermediate_metrics_log(aggregates))
     print(
         f"{aggregator.samples_processed} / {aggregator.total_sample_size} Processed for user {user_id}"
     )
+    finished = aggregator.samples_processed == aggregator.total_sample_size
+
+    # send the intermediate metrics to the user, as often as the push policy allows
+    pusher.push(user_id, aggregates, aggregator.get_progress(), final=finished)
 
     # if all batches have been processed, send final result
 
-    if aggregator.samples_processed == aggregator.total_sample_size:
+    if finished:
         print(f"Finished processing all batches for user {user_id}")
 
-        # clear the user metric server :
-        try:
-            clear_response = requests.delete(
-                f"{USER_METRIC_SERVER_URL}/clear-user-data/{worker_results.user_id}"
-            )
-            clear_response.raise_for_status()
-            print(f"Clear response: {clear_response}")
-        except Exception as e:
-            print(f"Error clearing user data: {e}")
+        # clear the user metric server, without blocking the consumer
+        threading.Thread(
+            target=clear_user_data, args=(user_id,), daemon=True
+        ).start()
 
         print("Creating and sending final report")
         manager.send_to_user(
@@ -335,7 +541,19 @@ def process_batch_result(worker_results: WorkerResults, user_id: str):
         report_thread.start()
 
         # cleanup completed aggregator
-        del user_aggregators[user_id]
+        await state_store.delete(user_id)
+
+
+def clear_user_data(user_id: str):
+    """Clears the user's uploaded metrics from the user metric server"""
+    try:
+        clear_response = requests.delete(
+            f"{USER_METRIC_SERVER_URL}/clear-user-data/{user_id}"
+        )
+        clear_response.raise_for_status()
+        print(f"Clear response: {clear_response}")
+    except Exception as e:
+        print(f"Error clearing user data: {e}")
 
 
 def process_error_result(error_data: WorkerError, user_id: str):
@@ -415,48 +633,78 @@ def generate_and_send_report(user_id, aggregates, aggregator):
         manager.send_to_user(user_id, aggregator_error_log(str(e)))
 
 
-def on_result_fetched(ch, method, properties, body):
-    body = json.loads(body)
-    job = AggregatorJob(**body)
+async def on_result_fetched(ch, method, properties, body):
+    job = decode_message(AggregatorJob, body, properties)
 
     print(f"Received job of type {job.job_type}: {job}")
 
     if job.job_type == JobType.RESULT:
-        process_batch_result(worker_results=job.content, user_id=job.user_id)
+        await process_batch_result(worker_results=job.content, user_id=job.user_id)
     elif job.job_type == JobType.ERROR:
         process_error_result(error_data=job.content, user_id=job.user_id)
     else:
         raise ValueError(f"Invalid job type: {job.job_type}")
 
 
-def websocket_handler(websocket):
+def parse_connect_message(message: str):
+    """
+    Parses the first message of a websocket connection - either the user id, or a JSON object
+    with the user id and the cursor of the last message the user received, if reconnecting.
+    Returns the user id and the cursor, which is None if missing or invalid.
+    """
+    if not message.startswith("{"):
+        return message, None
+    connect_message = json.loads(message)
+    cursor = connect_message.get("cursor")
+    if not isinstance(cursor, str) or not re.fullmatch(r"\d+-\d+", cursor):
+        cursor = None
+    return connect_message["user_id"], cursor
+
+
+async def websocket_handler(websocket):
     """Handles incoming WebSocket connections."""
+    user_id = None
     try:
-        user_id = websocket.recv()
-        print(f"User {user_id} connected via websocket")
+        user_id, cursor = parse_connect_message(await websocket.recv())
+        print(f"User {user_id} connected via websocket from cursor {cursor}")
 
-        # register this user
-        manager.connect(user_id, websocket)
+        # register this user, sending them the messages they missed
+        manager.connect(user_id, websocket, cursor)
 
-        for _ in websocket:
+        async for _ in websocket:
             # keep connection open
             pass
     except Exception as e:
         print(f"Websocket connection closed: {e}")
     finally:
         print(f"User {user_id} disconnected")
-        manager.disconnect(user_id)
-
+        manager.disconnect(user_id, websocket)
 
-def start_websocket_server():
-    server = websockets.sync.server.serve(websocket_handler, "0.0.0.0", 5005)
-    print("WebSocket server started on ws://0.0.0.0:5005")
-    server.serve_forever()  # Blocking call
 
-
-def start_http_server():
-    uvicorn.run(app, host="0.0.0.0", port=8005)
-    print("HTTP server started on ws://0.0.0.0:8005")
+async def main():
+    """
+    Run the WebSocket server, the HTTP server and the RabbitMQ consumer on one event loop
+    """
+    if REDIS_HOST:
+        redis_client = await connect_to_redis_async(f"redis://{REDIS_HOST}:{REDIS_PORT}", decode_responses=True)
+        state_store.redis_client = redis_client
+        manager.use_redis(redis_client)
+    # Cache the legislation articles in reports in the background, so reports need not fetch them
+    warm_up = asyncio.create_task(asyncio.to_thread(warm_up_legislation_cache, LEGISLATION_INFORMATION))
+    http_server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=8005))
+    consumer = ResultsConsumer(RABBIT_MQ_HOST)
+    async with websockets.asyncio.server.serve(websocket_handler, "0.0.0.0", 5005):
+        print("WebSocket server started on ws://0.0.0.0:5005")
+        consumer_task = asyncio.create_task(consumer.run(on_result_fetched))
+        # Results can no longer be received if the consumer fails, so shut down with it
+        consumer_task.add_done_callback(lambda _: setattr(http_server, "should_exit", True))
+        try:
+            # Returns once the HTTP server is shut down, e.g. on Ctrl+C
+            await http_server.serve()
+        finally:
+            consumer.stop()
+            consumer_task.cancel()
+            warm_up.cancel()
 
 
 if __name__ == "__main__":
@@ -466,12 +714,4 @@ if __name__ == "__main__":
 
     load_dotenv()
 
-    # Start WebSocket server in a separate thread
-    threading.Thread(target=start_websocket_server, daemon=True).start()
-
-    # Start HTTPs server in a separate thread
-    threading.Thread(target=start_http_server, daemon=True).start()
-
-    # Start RabbitMQ consumer (blocking)
-    consumer = ResultsConsumer(RABBIT_MQ_HOST)
-    consumer.run(on_result_fetched)
+    asyncio.run(main())
@@ -1,32 +1,261 @@
+import os
 import json
-from common.models import AggregatorMessage
+import asyncio
+from collections import deque
+from typing import Optional
+from common.models import AggregatorMessage, MessageType
+from aggregator.replay_buffer import LocalReplayBuffer, RedisReplayBuffer
+
+# Maximum number of messages waiting to be sent to each user
+AGGREGATOR_SEND_QUEUE_SIZE = int(os.environ.get("AGGREGATOR_SEND_QUEUE_SIZE", "256"))
+# What happens when a user's queue is full - "drop" disconnects the user, and "coalesce"
+# first discards their queued intermediate metrics, as each one supersedes the last
+SLOW_CLIENT_POLICIES = ("drop", "coalesce")
+AGGREGATOR_SLOW_CLIENT_POLICY = os.environ.get("AGGREGATOR_SLOW_CLIENT_POLICY", "drop")
+# Websocket close code telling slow clients to reconnect later
+CLOSE_CODE_TRY_AGAIN_LATER = 1013
+# Milliseconds the relay of buffered messages waits for new messages before checking for
+# new connections, and the most messages it relays to a user at once
+RELAY_BLOCK_MS = 250
+RELAY_READ_COUNT = 100
+
+
+def with_cursor(payload: str, cursor: str) -> str:
+    """Add a message's cursor to its JSON payload, without serialising the message again"""
+    return f'{{"cursor": "{cursor}", {payload[1:]}'
+
+
+class UserConnection:
+    """
+    A user's websocket, with a bounded queue of messages which its own task sends in order,
+    after any backlog of messages the user missed. Must be created on the event loop serving
+    the websocket.
+    """
+
+    def __init__(self, user_id, websocket, queue_size: int = AGGREGATOR_SEND_QUEUE_SIZE, backlog=()):
+        self.user_id = user_id
+        self.websocket = websocket
+        # Cursor of the last message queued for the user
+        self.cursor: Optional[str] = None
+        self._queue_size = queue_size
+        self._backlog = list(backlog)
+        self._pending: deque[tuple[MessageType, str]] = deque()
+        self._ready = asyncio.Event()
+        self.sender = asyncio.get_running_loop().create_task(self._send_forever())
+
+    def offer(self, message_type: MessageType, payload: str, coalesce: bool = False) -> bool:
+        """
+        Queue a message to be sent, returning False if the queue is full. If coalesce is set,
+        queued intermediate metrics are discarded to make room for newer intermediate metrics.
+        """
+        if len(self._pending) >= self._queue_size and coalesce and message_type == MessageType.METRICS_INTERMEDIATE:
+            self._pending = deque(m for m in self._pending if m[0] != MessageType.METRICS_INTERMEDIATE)
+        if len(self._pending) >= self._queue_size:
+            return False
+        self._pending.append((message_type, payload))
+        self._ready.set()
+        return True
+
+    @property
+    def room(self) -> int:
+        """Number of messages which can be queued before the queue is full"""
+        return self._queue_size - len(self._pending)
+
+    async def _send_forever(self):
+        for payload in self._backlog:
+            await self.websocket.send(payload)
+        self._backlog.clear()
+        while True:
+            await self._ready.wait()
+            while self._pending:
+                _, payload = self._pending.popleft()
+                await self.websocket.send(payload)
+            self._ready.clear()
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.sender.cancel()
+        try:
+            await self.websocket.close(code, reason)
+        except Exception as e:
+            print(f"Error closing websocket for user {self.user_id}: {e}")
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections = {}
+    """
+    Websocket connections of each user. Messages are queued per user and sent by each
+    connection's own task, so a slow client never delays other users or the caller.
 
-    def connect(self, user_id, websocket):
-        """Stores a Websocket connection for a specific user"""
-        self.active_connections[user_id] = websocket
+    Every message is also kept in a replay buffer, so users who reconnect receive the
+    messages sent after the last one they received. Once use_redis is called, buffers are
+    kept in Redis and messages are delivered by relaying them from Redis to the users
+    connected to this aggregator, so users receive messages sent by any aggregator replica.
+    """
 
-    def disconnect(self, user_id):
-        """Removes a Websocket connection for a specific user"""
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+    def __init__(
+        self,
+        queue_size: int = AGGREGATOR_SEND_QUEUE_SIZE,
+        slow_client_policy: str = AGGREGATOR_SLOW_CLIENT_POLICY,
+        replay_buffer: Optional[LocalReplayBuffer] = None,
+    ):
+        if slow_client_policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f"Unknown slow client policy: {slow_client_policy}")
+        self.active_connections: dict[str, UserConnection] = {}
+        self._queue_size = queue_size
+        self._slow_client_policy = slow_client_policy
+        self._replay_buffer = replay_buffer if replay_buffer is not None else LocalReplayBuffer()
+        self._redis_buffer: Optional[RedisReplayBuffer] = None
+        self._append_lock: Optional[asyncio.Lock] = None
+        self._relay: Optional[asyncio.Task] = None
+        self._loop = None
 
-    def send_to_user(self, user_id, message: AggregatorMessage):
-        """Sends a message to the correct user."""
+    def use_redis(self, redis_client):
+        """
+        Buffer messages in Redis, and relay them to this aggregator's users.
+        Must be called on the event loop.
 
-        if user_id in self.active_connections:
-            print(f"Sending message to user {user_id}")
-            websocket = self.active_connections[user_id]
-            try:
-                websocket.send(json.dumps(message.dict()))
-                print(f"Sent message to user {user_id}: {json.dumps(message.dict())}")
-            except Exception as e:
-                print(f"Error sending message to user {user_id}: {e}")
-                self.disconnect(user_id)
+        :param redis_client: redis.asyncio.Redis - created with decode_responses=True
+        """
+        self._loop = asyncio.get_running_loop()
+        self._redis_buffer = RedisReplayBuffer(redis_client)
+        self._append_lock = asyncio.Lock()
+        self._relay = self._loop.create_task(self._relay_forever())
+
+    def connect(self, user_id, websocket, cursor: Optional[str] = None) -> UserConnection:
+        """
+        Stores a Websocket connection for a specific user, who is then sent the buffered
+        messages after the cursor, or all of them if it is None. Must be called on the event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        previous = self.active_connections.get(user_id)
+        if previous is not None:
+            previous.sender.cancel()
+
+        backlog = []
+        if self._redis_buffer is None:
+            backlog = [
+                with_cursor(payload, message_cursor)
+                for message_cursor, _, payload in self._replay_buffer.read(user_id, cursor)
+            ]
+        # Otherwise the relay sends the messages after the connection's cursor
+        connection = UserConnection(user_id, websocket, self._queue_size, backlog)
+        connection.cursor = cursor
+        connection.sender.add_done_callback(
+            lambda task: self._on_sender_done(connection, task)
+        )
+        self.active_connections[user_id] = connection
+        return connection
+
+    def disconnect(self, user_id, websocket=None):
+        """Removes a Websocket connection for a specific user, if it is the given websocket"""
+        connection = self.active_connections.get(user_id)
+        if connection is None or (websocket is not None and connection.websocket is not websocket):
+            return
+        del self.active_connections[user_id]
+        connection.sender.cancel()
+
+    def send_to_user(self, user_id, message: AggregatorMessage):
+        """
+        Queues a message for the correct user without waiting for it to be sent.
+        Safe to call from any thread.
+        """
+        loop = self._loop
+        if loop is not None and loop.is_closed():
+            # The connections were served by the loop, so they closed with it, e.g. on shutdown
+            self._reset()
+            loop = None
+        if loop is not None and not _is_running_on(loop):
+            loop.call_soon_threadsafe(self._enqueue, user_id, message)
         else:
+            self._enqueue(user_id, message)
+
+    def _reset(self):
+        """Forget the event loop, and the connections and relay running on it"""
+        self.active_connections = {}
+        self._redis_buffer = None
+        self._append_lock = None
+        self._relay = None
+        self._loop = None
+
+    def _enqueue(self, user_id, message: AggregatorMessage):
+        payload = json.dumps(message.dict())
+        if self._redis_buffer is not None:
+            # Appended in the order sent, and delivered by the relay of whichever replica
+            # the user is connected to
+            self._loop.create_task(self._append(user_id, message.messageType, payload))
+            return
+
+        cursor = self._replay_buffer.append(user_id, message.messageType, payload)
+        connection = self.active_connections.get(user_id)
+        if connection is None:
             print(f"User not connected: {user_id}")
             print(f"Active connections {self.active_connections}")
+            return
+        connection.cursor = cursor
+        self._offer(connection, message.messageType, with_cursor(payload, cursor))
+
+    def _offer(self, connection: UserConnection, message_type: MessageType, payload: str) -> bool:
+        coalesce = self._slow_client_policy == "coalesce"
+        if connection.offer(message_type, payload, coalesce=coalesce):
+            print(f"Queued message for user {connection.user_id}: {payload}")
+            return True
+
+        # The client is not keeping up - drop it rather than holding back other users.
+        # It can reconnect later to receive the messages after the last one it received.
+        print(f"Send queue full for user {connection.user_id}, disconnecting")
+        self.disconnect(connection.user_id, connection.websocket)
+        self._loop.create_task(
+            connection.close(CLOSE_CODE_TRY_AGAIN_LATER, "Client too slow")
+        )
+        return False
+
+    async def _append(self, user_id, message_type: MessageType, payload: str):
+        async with self._append_lock:
+            try:
+                await self._redis_buffer.append(user_id, message_type, payload)
+            except Exception as e:
+                print(f"Error buffering message for user {user_id}: {e}")
+
+    async def _relay_forever(self):
+        """Relay messages from Redis to connected users, as their queues have room for them"""
+        while True:
+            connections = {
+                user_id: connection
+                for user_id, connection in self.active_connections.items()
+                if connection.room > 0
+            }
+            if not connections:
+                await asyncio.sleep(RELAY_BLOCK_MS / 1000)
+                continue
+
+            try:
+                messages = await self._redis_buffer.read(
+                    {user_id: connection.cursor for user_id, connection in connections.items()},
+                    block_ms=RELAY_BLOCK_MS,
+                    count=min(RELAY_READ_COUNT, *(c.room for c in connections.values())),
+                )
+            except Exception as e:
+                print(f"Error reading buffered messages: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for user_id, user_messages in messages.items():
+                connection = connections[user_id]
+                # The user may have disconnected or reconnected while waiting
+                if self.active_connections.get(user_id) is not connection:
+                    continue
+                for cursor, message_type, payload in user_messages:
+                    connection.cursor = cursor
+                    if not self._offer(connection, message_type, with_cursor(payload, cursor)):
+                        break
+
+    def _on_sender_done(self, connection: UserConnection, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error sending message to user {connection.user_id}: {task.exception()}")
+        self.disconnect(connection.user_id, connection.websocket)
+
+
+def _is_running_on(loop: asyncio.AbstractEventLoop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
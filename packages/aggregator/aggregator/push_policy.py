@@ -0,0 +1,128 @@
+"""
+Policy for pushing intermediate metrics to users as their batches are aggregated.
+
+By default every batch pushes a snapshot of all of the user's aggregated metrics. Jobs with
+many small batches can instead:
+- push at most once every AGGREGATOR_PUSH_MIN_INTERVAL seconds per user, coalescing the
+  batches aggregated in between into a single push of the latest metrics, and
+- push deltas (AGGREGATOR_PUSH_DELTAS=true), containing only the metrics which changed since
+  the last push, to be merged into the previous metrics by the frontend.
+
+Each push also carries the user's progress, so batches are counted correctly however many
+of them are coalesced. The metrics of a job's last batch are always pushed immediately.
+"""
+
+import os
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import Callable, Optional
+from common.models import AggregatorMessage
+
+# Minimum number of seconds between pushes of intermediate metrics to each user
+AGGREGATOR_PUSH_MIN_INTERVAL = float(os.environ.get("AGGREGATOR_PUSH_MIN_INTERVAL", "0"))
+# Whether to push only the metrics which changed since the last push
+AGGREGATOR_PUSH_DELTAS = os.environ.get("AGGREGATOR_PUSH_DELTAS", "false").lower() == "true"
+
+
+@dataclass
+class _UserPushState:
+    last_pushed_at: float = float("-inf")
+    # Metrics as of the last push, to compute deltas against
+    last_pushed_metrics: Optional[dict] = None
+    # The latest metrics and progress not pushed yet
+    pending: Optional[tuple[dict, dict]] = None
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class MetricsPusher:
+    """
+    Pushes each user's intermediate metrics according to the push policy
+
+    Usage:
+    pusher = MetricsPusher(manager.send_to_user, make_message=aggregator_intermediate_metrics_log)
+    pusher.push(user_id, aggregates, progress)
+    ...
+    pusher.push(user_id, aggregates, progress, final=True)  # after the job's last batch
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, AggregatorMessage], None],
+        make_message: Callable[..., AggregatorMessage],
+        min_interval: float = AGGREGATOR_PUSH_MIN_INTERVAL,
+        deltas: bool = AGGREGATOR_PUSH_DELTAS,
+    ):
+        """
+        :param send: Callable - sends a message to a user, e.g. ConnectionManager.send_to_user
+        :param make_message: Callable - builds the message from the metrics, progress and
+            whether the metrics are a delta
+        :param min_interval: float - minimum number of seconds between pushes to each user
+        :param deltas: bool - whether to push only the metrics which changed
+        """
+        self._send = send
+        self._make_message = make_message
+        self._min_interval = min_interval
+        self._deltas = deltas
+        self._users: dict[str, _UserPushState] = {}
+
+    def push(self, user_id: str, metrics: dict, progress: dict, final: bool = False):
+        """
+        Push the user's latest metrics now if the policy allows, otherwise once the minimum
+        interval has passed, replacing any metrics still waiting to be pushed
+
+        :param user_id: str - the user to push to
+        :param metrics: dict - all of the user's aggregated metrics
+        :param progress: dict - the user's progress, e.g. the number of batches processed
+        :param final: bool - whether these are the job's final metrics, which are pushed
+            immediately, after which the user's state is discarded
+        """
+        state = self._users.setdefault(user_id, _UserPushState())
+        # Metrics are updated in place as batches are aggregated, so keep a copy
+        state.pending = ({name: dict(value) for name, value in metrics.items()}, dict(progress))
+
+        wait = state.last_pushed_at + self._min_interval - time.monotonic()
+        loop = _running_loop()
+        if final or wait <= 0 or loop is None:
+            self._flush(user_id)
+        elif state.timer is None:
+            state.timer = loop.call_later(wait, self._flush, user_id)
+
+        if final:
+            self._users.pop(user_id, None)
+
+    def _flush(self, user_id: str):
+        state = self._users.get(user_id)
+        if state is None or state.pending is None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+
+        metrics, progress = state.pending
+        state.pending = None
+        delta = self._deltas and state.last_pushed_metrics is not None
+        if delta:
+            content = {
+                name: value
+                for name, value in metrics.items()
+                if state.last_pushed_metrics.get(name) != value
+            }
+        else:
+            content = metrics
+        state.last_pushed_metrics = metrics
+        state.last_pushed_at = time.monotonic()
+        self._send(user_id, self._make_message(content, progress, delta))
+
+    def discard(self, user_id: str):
+        """Forget the user's state, without pushing any metrics still waiting to be pushed"""
+        state = self._users.pop(user_id, None)
+        if state is not None and state.timer is not None:
+            state.timer.cancel()
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
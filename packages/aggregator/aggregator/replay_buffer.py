@@ -0,0 +1,151 @@
+"""
+Per-user buffers of the messages sent to each user, so that a user who reconnects receives the
+messages they missed while disconnected, rather than having to re-run their job.
+
+Each message is given a cursor, which clients send back when they reconnect to receive only
+the messages after it. Buffers are bounded both in number of messages and in age.
+
+LocalReplayBuffer keeps messages in memory, for a single aggregator. RedisReplayBuffer keeps
+them in a Redis Stream per user, so that every aggregator replica can replay and deliver any
+user's messages, whichever replica sent them.
+"""
+
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+from common.models import MessageType
+from common.redis.keys import redis_key
+
+# Maximum number of messages buffered for each user
+AGGREGATOR_REPLAY_BUFFER_SIZE = int(os.environ.get("AGGREGATOR_REPLAY_BUFFER_SIZE", "1000"))
+# Seconds for which messages are buffered
+AGGREGATOR_REPLAY_BUFFER_MAX_AGE = int(os.environ.get("AGGREGATOR_REPLAY_BUFFER_MAX_AGE", "3600"))
+# Redis namespace of the buffers
+REPLAY_BUFFER_NAMESPACE = "replay"
+
+# A buffered message - its cursor, type and JSON payload
+BufferedMessage = tuple[str, MessageType, str]
+
+
+def _parse_cursor(cursor: str) -> tuple[int, int]:
+    """Cursors are Redis Stream entry IDs - a millisecond timestamp and a sequence number"""
+    milliseconds, _, sequence = cursor.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class LocalReplayBuffer:
+    """Buffers of each user's messages, held in memory"""
+
+    def __init__(
+        self,
+        size: int = AGGREGATOR_REPLAY_BUFFER_SIZE,
+        max_age: float = AGGREGATOR_REPLAY_BUFFER_MAX_AGE,
+    ):
+        """
+        :param size: int - maximum number of messages buffered for each user
+        :param max_age: float - seconds for which messages are buffered
+        """
+        self._size = size
+        self._max_age = max_age
+        # Ordered by when each user was last sent a message, so idle users are found first
+        self._buffers: OrderedDict[str, deque[tuple[tuple[int, int], BufferedMessage]]] = OrderedDict()
+        self._last_id = (0, 0)
+
+    def append(self, user_id: str, message_type: MessageType, payload: str) -> str:
+        """Buffer a message, returning its cursor"""
+        now_ms = int(time.time() * 1000)
+        # Cursors increase, even if the clock does not
+        if now_ms > self._last_id[0]:
+            self._last_id = (now_ms, 0)
+        else:
+            self._last_id = (self._last_id[0], self._last_id[1] + 1)
+        cursor = f"{self._last_id[0]}-{self._last_id[1]}"
+
+        buffer = self._buffers.pop(user_id, None)
+        if buffer is None:
+            buffer = deque(maxlen=self._size)
+        buffer.append((self._last_id, (cursor, MessageType(message_type), payload)))
+        self._buffers[user_id] = buffer
+        self._expire(now_ms)
+        return cursor
+
+    def read(self, user_id: str, cursor: Optional[str] = None) -> list[BufferedMessage]:
+        """Returns the user's buffered messages after the cursor, or all of them if it is None"""
+        self._expire(int(time.time() * 1000))
+        after = _parse_cursor(cursor) if cursor else (-1, -1)
+        return [message for message_id, message in self._buffers.get(user_id, ()) if message_id > after]
+
+    def _expire(self, now_ms: int):
+        oldest = (now_ms - int(self._max_age * 1000), 0)
+        for user_id in list(self._buffers):
+            buffer = self._buffers[user_id]
+            while buffer and buffer[0][0] < oldest:
+                buffer.popleft()
+            if buffer:
+                # Users after this one were sent messages more recently
+                break
+            del self._buffers[user_id]
+
+
+class RedisReplayBuffer:
+    """Buffers of each user's messages, held in Redis Streams shared by all aggregator replicas"""
+
+    def __init__(
+        self,
+        redis_client,
+        size: int = AGGREGATOR_REPLAY_BUFFER_SIZE,
+        max_age: float = AGGREGATOR_REPLAY_BUFFER_MAX_AGE,
+    ):
+        """
+        :param redis_client: redis.asyncio.Redis - the client to store the buffers with,
+            created with decode_responses=True
+        :param size: int - maximum number of messages buffered for each user
+        :param max_age: float - seconds for which messages are buffered
+        """
+        self._redis = redis_client
+        self._size = size
+        self._max_age = max_age
+
+    async def append(self, user_id: str, message_type: MessageType, payload: str) -> str:
+        """Buffer a message, returning its cursor"""
+        key = redis_key(REPLAY_BUFFER_NAMESPACE, user_id)
+        oldest_ms = int((time.time() - self._max_age) * 1000)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(
+                key,
+                {"type": MessageType(message_type).value, "payload": payload},
+                maxlen=self._size,
+                approximate=True,
+            )
+            pipe.xtrim(key, minid=oldest_ms, approximate=True)
+            # Buffers of users who are no longer sent messages are removed altogether
+            pipe.expire(key, int(self._max_age))
+            cursor, *_ = await pipe.execute()
+        return cursor
+
+    async def read(
+        self, cursors: dict[str, Optional[str]], block_ms: Optional[int] = None, count: int = 100
+    ) -> dict[str, list[BufferedMessage]]:
+        """
+        Returns each user's buffered messages after their cursor, or all of them if it is None,
+        waiting up to block_ms for any message if there are none yet
+
+        :param cursors: dict[str, Optional[str]] - the cursor of each user to read messages for
+        :param block_ms: Optional[int] - milliseconds to wait for messages, or None not to wait
+        :param count: int - maximum number of messages to return for each user
+        """
+        streams = {
+            redis_key(REPLAY_BUFFER_NAMESPACE, user_id): cursor or "0"
+            for user_id, cursor in cursors.items()
+        }
+        users = {redis_key(REPLAY_BUFFER_NAMESPACE, user_id): user_id for user_id in cursors}
+        replies = await self._redis.xread(streams, count=count, block=block_ms)
+
+        return {
+            users[key]: [
+                (entry_id, MessageType(fields["type"]), fields["payload"])
+                for entry_id, fields in entries
+            ]
+            for key, entries in replies or ()
+        }
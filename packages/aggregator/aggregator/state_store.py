@@ -0,0 +1,95 @@
+"""
+Storage of each user's aggregation state, i.e. their MetricsAggregator.
+
+With a Redis client, the state lives in Redis, so several aggregator replicas can consume
+the same results queue and a restarted aggregator carries on with in-flight jobs. Each
+update runs in an optimistic transaction, so concurrent updates of the same user's state
+by different replicas are retried rather than lost. Without Redis, state is kept in memory.
+
+The store is used on the aggregator's event loop, so it uses Redis' asyncio client, never
+blocking the loop while waiting for Redis.
+"""
+
+import os
+import json
+from typing import Any, Callable, Optional
+from redis import WatchError
+from common.redis.keys import redis_key
+
+# Seconds the state of a job which receives no results is kept in Redis
+AGGREGATOR_STATE_TTL = int(os.environ.get("AGGREGATOR_STATE_TTL", "86400"))
+# Redis namespace of the aggregation state
+AGGREGATOR_STATE_NAMESPACE = "aggregator"
+
+
+class AggregatorStateStore:
+    """
+    Usage:
+    store = AggregatorStateStore(MetricsAggregator, redis_client)
+    progress = await store.update(user_id, lambda aggregator: aggregator.aggregate_new_batch(...))
+    ...
+    await store.delete(user_id)  # once the job is complete
+    """
+
+    def __init__(self, aggregator_class: type, redis_client=None, ttl: int = AGGREGATOR_STATE_TTL):
+        """
+        :param aggregator_class: type - the class of the state, with to_dict and from_dict methods
+            to store it as JSON
+        :param redis_client: redis.asyncio.Redis - the client to store the state in, or None to
+            keep it in memory
+        :param ttl: int - seconds the state of a user is kept after it was last updated
+        """
+        self._aggregator_class = aggregator_class
+        self.redis_client = redis_client
+        self._ttl = ttl
+        self._local: dict = {}
+
+    async def update(self, user_id: str, update: Callable[[Any], Any]):
+        """
+        Apply an update to the user's state, creating the state if it does not exist,
+        and return the update's result. With Redis, the update may be retried if the state
+        was updated concurrently, so it must not have side effects other than on the state.
+
+        :param user_id: str - the user whose state to update
+        :param update: Callable - modifies the state in place
+        """
+        if self.redis_client is None:
+            # Nothing is awaited, so updates on the event loop are never interleaved
+            aggregator = self._local.get(user_id)
+            if aggregator is None:
+                aggregator = self._local[user_id] = self._aggregator_class()
+            return update(aggregator)
+
+        key = redis_key(AGGREGATOR_STATE_NAMESPACE, user_id)
+        async with self.redis_client.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    state = await pipe.get(key)
+                    aggregator = (
+                        self._aggregator_class()
+                        if state is None
+                        else self._aggregator_class.from_dict(json.loads(state))
+                    )
+                    result = update(aggregator)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(aggregator.to_dict()), ex=self._ttl)
+                    await pipe.execute()
+                    return result
+                except WatchError:
+                    # Another replica updated the state first - apply the update to its state
+                    continue
+
+    async def get(self, user_id: str) -> Optional[Any]:
+        """Returns the user's state, or None if they have none"""
+        if self.redis_client is None:
+            return self._local.get(user_id)
+        state = await self.redis_client.get(redis_key(AGGREGATOR_STATE_NAMESPACE, user_id))
+        return None if state is None else self._aggregator_class.from_dict(json.loads(state))
+
+    async def delete(self, user_id: str):
+        """Removes the user's state"""
+        if self.redis_client is None:
+            self._local.pop(user_id, None)
+        else:
+            await self.redis_client.delete(redis_key(AGGREGATOR_STATE_NAMESPACE, user_id))
@@ -1,4 +1,6 @@
 import time
+import asyncio
+import pika
 import pytest
 from unittest.mock import MagicMock, mock_open, patch
 from aggregator.aggregator import (
@@ -13,10 +15,11 @@ from aggregator.aggregator import (
     on_result_fetched,
     aggregator_intermediate_metrics_log,
     aggregator_metrics_completion_log,
-    message_queue,
     websocket_handler,
-    user_aggregators,
+    parse_connect_message,
+    state_store,
     manager,
+    pusher,
     process_batch_result,
 )
 import json
@@ -35,11 +38,14 @@ metrics_aggregator = MetricsAggregator()
 @pytest.fixture(autouse=True)
 def reset_state():
     metrics_aggregator.metrics = {}
+    metrics_aggregator.batches_processed = 0
+    metrics_aggregator.processed_batches = set()
     metrics_aggregator.samples_processed = 0
     metrics_aggregator.total_sample_size = 0
-    user_aggregators.clear()
-    while not message_queue.empty():
-        message_queue.get()
+    state_store._local.clear()
+    # Tests with an event loop leave the manager bound to it once it is closed
+    manager._reset()
+    pusher._users.clear()
 
 
 def test_init(consumer):
@@ -48,92 +54,109 @@ def test_init(consumer):
     assert consumer._channel is None
 
 
-@patch("aggregator.aggregator.connect_to_rabbitmq")
-@patch("aggregator.aggregator.init_queues")
-def test_connect(mock_init_queues, mock_connect_to_rabbitmq, consumer):
-    mock_connection = MagicMock()
-    mock_channel = MagicMock()
-    mock_connect_to_rabbitmq.return_value = mock_connection
-    mock_connection.channel.return_value = mock_channel
-
-    consumer.connect()
-
-    mock_connect_to_rabbitmq.assert_called_once_with(host="test_host")
-    mock_connection.channel.assert_called_once()
-    mock_init_queues.assert_called_once_with(mock_channel)
-    assert consumer._connection == mock_connection
-    assert consumer._channel == mock_channel
-
-    # Add these print statements for debugging
-    print(f"mock_connect_to_rabbitmq called: {mock_connect_to_rabbitmq.called}")
-    print(f"mock_init_queues called: {mock_init_queues.called}")
+class FakeAsyncioConnection:
+    """Opens immediately on the event loop, with a channel whose operations complete immediately"""
 
+    def __init__(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, custom_ioloop):
+        self.parameters = parameters
+        self.channel_mock = MagicMock()
+        self.channel_mock.queue_declare.side_effect = lambda queue, durable, callback: custom_ioloop.call_soon(
+            callback, None
+        )
+        self.channel_mock.basic_qos.side_effect = lambda prefetch_count, callback: custom_ioloop.call_soon(
+            callback, None
+        )
+        custom_ioloop.call_soon(on_open_callback, self)
 
-@patch("aggregator.aggregator.init_queues")
-@patch("aggregator.aggregator.connect_to_rabbitmq")
-def test_run(mock_init_queues, mock_connect_to_rabbitmq, consumer):
-    mock_connection = MagicMock()
-    mock_channel = MagicMock()
-    mock_connect_to_rabbitmq.return_value = mock_connection
-    mock_connection.channel.return_value = mock_channel
+    def channel(self, on_open_callback):
+        on_open_callback(self.channel_mock)
 
-    consumer.connect = MagicMock()
-    consumer._connection = mock_connection
-    consumer._channel = mock_channel
 
-    mock_callback = MagicMock()
-    mock_channel.start_consuming = MagicMock()
+@pytest.mark.asyncio
+@patch("aggregator.aggregator.AsyncioConnection", FakeAsyncioConnection)
+async def test_connect():
+    consumer = ResultsConsumer(host="test_host")
+    await consumer.connect()
 
-    consumer.run(on_message_callback=mock_callback)
+    assert consumer._connection.parameters.host == "test_host"
+    assert consumer._channel is consumer._connection.channel_mock
+    declared = [call.kwargs["queue"] for call in consumer._channel.queue_declare.call_args_list]
+    assert RESULT_QUEUE in declared
+    assert all(call.kwargs["durable"] for call in consumer._channel.queue_declare.call_args_list)
+    consumer._channel.basic_qos.assert_called_once()
 
-    mock_channel.basic_consume.assert_called_once_with(
-        queue=RESULT_QUEUE, on_message_callback=mock_callback, auto_ack=True
-    )
-    mock_channel.start_consuming.assert_called_once()
 
-
-@patch("aggregator.aggregator.connect_to_rabbitmq")
-@patch("aggregator.aggregator.init_queues")
-def test_stop(mock_init_queues, mock_connect_to_rabbitmq, consumer):
-    mock_connection = MagicMock()
+@pytest.mark.asyncio
+async def test_run():
+    consumer = ResultsConsumer(host="test_host")
     mock_channel = MagicMock()
-    consumer._connection = mock_connection
-    consumer._channel = mock_channel
-
-    consumer.stop()
+    mock_callback = MagicMock(side_effect=Exception("Invalid message"))
+    mock_method = MagicMock(delivery_tag=1)
+
+    def basic_consume(queue, on_message_callback, auto_ack):
+        # Errors processing a message do not stop the consumer
+        on_message_callback(mock_channel, mock_method, None, b"message")
+        consumer.stop()
+
+    async def connect():
+        consumer._channel = mock_channel
+        consumer._closed = asyncio.get_running_loop().create_future()
+        consumer._closed.set_result("Closed by test")
+
+    mock_channel.basic_consume.side_effect = basic_consume
+    consumer.connect = connect
+    await consumer.run(on_message_callback=mock_callback)
+
+    mock_channel.basic_consume.assert_called_once()
+    assert mock_channel.basic_consume.call_args.kwargs["queue"] == RESULT_QUEUE
+    assert mock_channel.basic_consume.call_args.kwargs["auto_ack"] is False
+    mock_callback.assert_called_once_with(mock_channel, mock_method, None, b"message")
+    # Messages are acknowledged once processed
+    mock_channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+
+@pytest.mark.asyncio
+async def test_run_processes_messages_in_order_with_coroutine_callbacks():
+    consumer = ResultsConsumer(host="test_host")
+    mock_channel = MagicMock()
+    processed = []
 
-    mock_channel.close.assert_called_once()
-    mock_connection.close.assert_called_once()
+    async def callback(channel, method, properties, body):
+        # Waiting, e.g. for Redis, does not let the next message overtake this one
+        await asyncio.sleep(0.01 if body == b"first" else 0)
+        processed.append(body)
+        # A message is only acknowledged once processed
+        assert mock_channel.basic_ack.call_count == len(processed) - 1
 
+    def basic_consume(queue, on_message_callback, auto_ack):
+        on_message_callback(mock_channel, MagicMock(delivery_tag=1), None, b"first")
+        on_message_callback(mock_channel, MagicMock(delivery_tag=2), None, b"second")
+        consumer.stop()
 
-@patch("aggregator.aggregator.connect_to_rabbitmq")
-@patch("aggregator.aggregator.init_queues")
-@patch.object(ResultsConsumer, "stop")  # Mock stop to prevent real shutdown
-def test_run_keyboard_interrupt(
-    mock_stop, mock_init_queues, mock_connect_to_rabbitmq, consumer
-):
-    mock_connection = MagicMock()
-    mock_channel = MagicMock()
+    async def connect():
+        consumer._channel = mock_channel
+        consumer._closed = asyncio.get_running_loop().create_future()
+        consumer._closed.set_result("Closed by test")
 
-    mock_connect_to_rabbitmq.return_value = mock_connection
-    mock_connection.channel.return_value = mock_channel
+    mock_channel.basic_consume.side_effect = basic_consume
+    consumer.connect = connect
+    await consumer.run(on_message_callback=callback)
 
-    consumer.connect = MagicMock()  # Prevent real connection logic
-    consumer._connection = mock_connection
-    consumer._channel = mock_channel
+    assert processed == [b"first", b"second"]
+    assert [call.kwargs["delivery_tag"] for call in mock_channel.basic_ack.call_args_list] == [1, 2]
 
-    mock_callback = MagicMock()
 
-    # Simulate `start_consuming` raising a KeyboardInterrupt
-    mock_channel.start_consuming.side_effect = KeyboardInterrupt
+def test_stop(consumer):
+    mock_connection = MagicMock(is_closing=False, is_closed=False)
+    consumer._connection = mock_connection
 
-    consumer.run(on_message_callback=mock_callback)
+    consumer.stop()
 
-    # Ensure that stop() is called when KeyboardInterrupt occurs
-    mock_stop.assert_called_once()
+    mock_connection.close.assert_called_once()
 
 
-def test_process_batch_results_handles_user_added_metrics():
+@pytest.mark.asyncio
+async def test_process_batch_results_handles_user_added_metrics():
     worker_results = WorkerResults(
         metric_values={
             "accuracy": {
@@ -157,8 +180,8 @@ def test_process_batch_results_handles_user_added_metrics():
         }
     )
     metrics_aggregator = MagicMock()
-    user_aggregators["user123"] = metrics_aggregator
-    process_batch_result(worker_results, "user123")
+    state_store._local["user123"] = metrics_aggregator
+    await process_batch_result(worker_results, "user123")
     assert metrics_aggregator.aggregate_new_batch.call_count == 1
     assert metrics_aggregator.aggregate_new_batch.call_args[0][0] == {
         "accuracy": MetricValue(
@@ -178,7 +201,28 @@ def test_process_batch_results_handles_user_added_metrics():
     }
 
 
-def test_on_result_fetched_for_error():
+@pytest.mark.asyncio
+@patch('aggregator.aggregator.manager.send_to_user')
+async def test_process_batch_result_skips_redelivered_batches(mock_send_to_user):
+    worker_results = WorkerResults(
+        metric_values={
+            "accuracy": {"computed_value": 0.85, "ideal_value": 1.0, "range": [0.0, 1.0]},
+        },
+        batch_size=10,
+        total_sample_size=30,
+        batch_id="batch1",
+    )
+    await process_batch_result(worker_results, "user123")
+    await process_batch_result(worker_results, "user123")
+
+    aggregator = await state_store.get("user123")
+    assert aggregator.batches_processed == 1
+    assert aggregator.samples_processed == 10
+    assert mock_send_to_user.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_on_result_fetched_for_error():
     body = AggregatorJob(
         job_type=JobType.ERROR,
         user_id="user123",
@@ -189,17 +233,19 @@ def test_on_result_fetched_for_error():
     )
     bodyJson = body.model_dump_json()
     with patch("aggregator.aggregator.process_error_result", new_callable=MagicMock) as mock_process_error_result:
-        on_result_fetched(None, None, None, bodyJson)
+        await on_result_fetched(None, None, None, bodyJson)
         mock_process_error_result.assert_called_once_with(error_data=body.content, user_id=body.user_id)
 
 
+@pytest.mark.asyncio
 @patch('aggregator.aggregator.manager.send_to_user')
 @patch('aggregator.aggregator.generate_and_send_report')
-def test_on_result_fetched(mock_generate_report, mock_send_to_user):
+async def test_on_result_fetched(mock_generate_report, mock_send_to_user):
     # Create dummy RabbitMQ parameters (not used in logic).
     mock_channel = MagicMock()
     mock_method = MagicMock()
-    mock_properties = MagicMock()
+    # Messages without a content type are read as JSON
+    mock_properties = pika.BasicProperties()
 
     # Define sample incoming message with a user_id.
     sample_message = {
@@ -231,20 +277,22 @@ def test_on_result_fetched(mock_generate_report, mock_send_to_user):
     mock_generate_report.return_value = mock_report
 
     # Call on_result_fetched for the first batch.
-    on_result_fetched(mock_channel, mock_method, mock_properties, message_body)
+    await on_result_fetched(mock_channel, mock_method, mock_properties, message_body)
 
     # After first call, a per-user aggregator should be created.
-    aggregator = user_aggregators.get("user123")
+    aggregator = await state_store.get("user123")
     assert aggregator is not None, "Aggregator for user123 should be initialized."
     assert aggregator.total_sample_size == 20, "Total sample size should be set to 20."
     assert aggregator.samples_processed == 10, "Samples processed should be 10 after first batch."
     intermediate_metrics = aggregator.get_aggregated_metrics()
 
     # Verify that an intermediate metrics message was sent.
-    mock_send_to_user.assert_any_call("user123", aggregator_intermediate_metrics_log(intermediate_metrics))
+    mock_send_to_user.assert_any_call(
+        "user123", aggregator_intermediate_metrics_log(intermediate_metrics, aggregator.get_progress())
+    )
 
     # Simulate processing the second (final) batch.
-    on_result_fetched(mock_channel, mock_method, mock_properties, message_body)
+    await on_result_fetched(mock_channel, mock_method, mock_properties, message_body)
 
     # Allow the reporting thread a moment to start.
     time.sleep(0.1)
@@ -256,7 +304,7 @@ def test_on_result_fetched(mock_generate_report, mock_send_to_user):
     assert completion_called, "Completion log was not sent."
     # assert final_called, "Final report log was not sent."
     # Ensure the per-user aggregator is cleaned up after completion.
-    assert "user123" not in user_aggregators, "Aggregator for user123 should be removed after processing."
+    assert await state_store.get("user123") is None, "Aggregator for user123 should be removed after processing."
 
 
 def test_erroring_generate_and_send_report():
@@ -272,38 +320,45 @@ def test_erroring_generate_and_send_report():
         mock_send_to_user.assert_called_once_with(user_id, aggregator_error_log("Test error"))
 
 
-@patch('aggregator.aggregator.manager.send_to_user')
-def test_websocket_handler(mock_send_to_user):
-    # Create a dummy websocket that returns a user_id and supports iteration.
+@pytest.mark.asyncio
+async def test_websocket_handler():
+    # Create a dummy websocket that returns a user_id and supports async iteration.
     class DummyWebsocket:
         def __init__(self, user_id):
             self.user_id = user_id
             self.sent_messages = []
-            self.iterated = False
 
-        def recv(self):
+        async def recv(self):
             return self.user_id
 
-        def send(self, message):
+        async def send(self, message):
             self.sent_messages.append(message)
 
-        def __iter__(self):
-            if not self.iterated:
-                self.iterated = True
-                yield "dummy"
-            else:
-                return iter([])
+        async def __aiter__(self):
+            assert self.user_id in manager.active_connections
+            yield "dummy"
 
     user_id = "user456"
     dummy_ws = DummyWebsocket(user_id)
 
     # Call the websocket handler.
-    websocket_handler(dummy_ws)
+    await websocket_handler(dummy_ws)
 
     # After the handler finishes, the user should be disconnected.
     assert user_id not in manager.active_connections
 
 
+def test_parse_connect_message():
+    assert parse_connect_message("user456") == ("user456", None)
+    assert parse_connect_message('{"user_id": "user456", "cursor": "1700000000000-3"}') == (
+        "user456",
+        "1700000000000-3",
+    )
+    # Invalid cursors are ignored, replaying every buffered message
+    assert parse_connect_message('{"user_id": "user456", "cursor": "$"}') == ("user456", None)
+    assert parse_connect_message('{"user_id": "user456"}') == ("user456", None)
+
+
 # @patch("aggregator.aggregator.aggregator_generate_report")
 # def test_aggregate_report(mock_generate_report):
 #     # Mock metrics data
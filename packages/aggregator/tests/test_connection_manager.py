@@ -1,67 +1,212 @@
+import asyncio
+import threading
 import unittest
-from unittest.mock import Mock, patch
-from aggregator.connection_manager import ConnectionManager
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+from aggregator.connection_manager import ConnectionManager, CLOSE_CODE_TRY_AGAIN_LATER
 from common.models import AggregatorMessage, MessageType
 
 
-class TestConnectionManager(unittest.TestCase):
+def log_message(message="test message"):
+    return AggregatorMessage(
+        messageType=MessageType.LOG,
+        message=message,
+        statusCode=200,
+        content=None,
+    )
+
+
+def intermediate_message(value):
+    return AggregatorMessage(
+        messageType=MessageType.METRICS_INTERMEDIATE,
+        message="intermediate",
+        statusCode=202,
+        content={"metrics_results": value},
+    )
+
+
+class TestConnectionManager(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         self.manager = ConnectionManager()
         self.user_id = "user1"
-        self.websocket = Mock()
+        self.websocket = AsyncMock()
 
-    def test_connect(self):
+    async def test_connect(self):
         self.manager.connect(self.user_id, self.websocket)
         self.assertIn(self.user_id, self.manager.active_connections)
-        self.assertEqual(self.manager.active_connections[self.user_id], self.websocket)
+        self.assertEqual(self.manager.active_connections[self.user_id].websocket, self.websocket)
 
-    def test_disconnect(self):
-        self.manager.connect(self.user_id, self.websocket)
+    async def test_disconnect(self):
+        connection = self.manager.connect(self.user_id, self.websocket)
         self.manager.disconnect(self.user_id)
         self.assertNotIn(self.user_id, self.manager.active_connections)
+        await asyncio.sleep(0)
+        self.assertTrue(connection.sender.cancelled())
+
+    async def test_disconnect_ignores_replaced_connection(self):
+        self.manager.connect(self.user_id, self.websocket)
+        new_websocket = AsyncMock()
+        self.manager.connect(self.user_id, new_websocket)
+        self.manager.disconnect(self.user_id, self.websocket)
+        self.assertEqual(self.manager.active_connections[self.user_id].websocket, new_websocket)
 
     @patch('aggregator.connection_manager.json.dumps')
-    def test_send_to_user_success(self, mock_json_dumps):
+    async def test_send_to_user_success(self, mock_json_dumps):
         self.manager.connect(self.user_id, self.websocket)
-        message = AggregatorMessage(
-            messageType=MessageType.LOG,
-            message="test message",
-            statusCode=200,
-            content=None,
-        )
         mock_json_dumps.return_value = '{"content": "test message"}'
 
-        self.manager.send_to_user(self.user_id, message)
-        self.websocket.send.assert_called_once_with('{"content": "test message"}')
+        self.manager.send_to_user(self.user_id, log_message())
+        # Messages are sent by the connection's own task
+        self.websocket.send.assert_not_called()
+        await asyncio.sleep(0)
+        self.websocket.send.assert_called_once()
+        # Each message is sent with its cursor
+        payload = self.websocket.send.call_args.args[0]
+        self.assertRegex(payload, r'^\{"cursor": "\d+-\d+", "content": "test message"\}$')
 
-    @patch('aggregator.connection_manager.json.dumps')
-    def test_send_to_user_failure(self, mock_json_dumps):
+    async def test_send_to_user_failure(self):
         self.manager.connect(self.user_id, self.websocket)
-        message = AggregatorMessage(
-            messageType=MessageType.LOG,
-            message="test message",
-            statusCode=200,
-            content=None,
-        )
-        mock_json_dumps.return_value = '{"content": "test message"}'
         self.websocket.send.side_effect = Exception("send error")
 
-        self.manager.send_to_user(self.user_id, message)
-        self.websocket.send.assert_called_once_with('{"content": "test message"}')
+        self.manager.send_to_user(self.user_id, log_message())
+        for _ in range(2):
+            await asyncio.sleep(0)
+        self.websocket.send.assert_called_once()
         self.assertNotIn(self.user_id, self.manager.active_connections)
 
-    def test_send_to_user_not_connected(self):
-        message = AggregatorMessage(
-            messageType=MessageType.LOG,
-            message="test message",
-            statusCode=200,
-            content=None,
-        )
+    async def test_send_to_user_not_connected(self):
         with patch('builtins.print') as mock_print:
-            self.manager.send_to_user(self.user_id, message)
+            self.manager.send_to_user(self.user_id, log_message())
             mock_print.assert_any_call(f"User not connected: {self.user_id}")
             mock_print.assert_any_call(f"Active connections {self.manager.active_connections}")
 
+    async def test_slow_user_does_not_block_other_users(self):
+        manager = ConnectionManager(queue_size=2)
+        blocked = asyncio.Event()
+
+        async def send_blocked(_):
+            await blocked.wait()
+
+        slow_websocket = AsyncMock()
+        slow_websocket.send.side_effect = send_blocked
+        fast_websocket = AsyncMock()
+        manager.connect("slow", slow_websocket)
+        manager.connect("fast", fast_websocket)
+
+        for i in range(4):
+            manager.send_to_user("slow", log_message(str(i)))
+            manager.send_to_user("fast", log_message(str(i)))
+            await asyncio.sleep(0)
+
+        self.assertEqual(fast_websocket.send.call_count, 4)
+        # The slow user's queue overflowed, so it was dropped
+        self.assertNotIn("slow", manager.active_connections)
+        await asyncio.sleep(0)
+        slow_websocket.close.assert_called_once_with(CLOSE_CODE_TRY_AGAIN_LATER, "Client too slow")
+
+    async def test_coalesce_policy_keeps_latest_intermediate_metrics(self):
+        manager = ConnectionManager(queue_size=2, slow_client_policy="coalesce")
+        websocket = AsyncMock()
+        # Messages stay queued until the sender task first runs
+        connection = manager.connect(self.user_id, websocket)
+        manager.send_to_user(self.user_id, log_message())
+        for i in range(5):
+            manager.send_to_user(self.user_id, intermediate_message(i))
+
+        self.assertEqual(
+            [message_type for message_type, _ in connection._pending],
+            [MessageType.LOG, MessageType.METRICS_INTERMEDIATE],
+        )
+        self.assertIn('"metrics_results": 4', connection._pending[-1][1])
+
+    async def test_send_to_user_from_another_thread(self):
+        self.manager.connect(self.user_id, self.websocket)
+        thread = threading.Thread(target=self.manager.send_to_user, args=(self.user_id, log_message()))
+        thread.start()
+        thread.join()
+
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.websocket.send.assert_called_once()
+
+    async def test_reconnecting_user_receives_missed_messages(self):
+        connection = self.manager.connect(self.user_id, self.websocket)
+        self.manager.send_to_user(self.user_id, log_message("received"))
+        await asyncio.sleep(0)
+        cursor = json.loads(self.websocket.send.call_args.args[0])["cursor"]
+        self.assertEqual(connection.cursor, cursor)
+
+        self.manager.disconnect(self.user_id)
+        self.manager.send_to_user(self.user_id, log_message("missed 1"))
+        self.manager.send_to_user(self.user_id, log_message("missed 2"))
+
+        websocket = AsyncMock()
+        self.manager.connect(self.user_id, websocket, cursor)
+        self.manager.send_to_user(self.user_id, log_message("live"))
+        for _ in range(4):
+            await asyncio.sleep(0)
+        self.assertEqual(
+            [json.loads(call.args[0])["message"] for call in websocket.send.call_args_list],
+            ["missed 1", "missed 2", "live"],
+        )
+
+        # Without a cursor, every buffered message is replayed
+        websocket = AsyncMock()
+        self.manager.connect(self.user_id, websocket)
+        for _ in range(4):
+            await asyncio.sleep(0)
+        self.assertEqual(websocket.send.call_count, 4)
+
+    async def test_messages_are_relayed_from_redis(self):
+        redis_buffer = MagicMock()
+        redis_buffer.append = AsyncMock()
+        read = asyncio.Event()
+
+        async def read_messages(cursors, block_ms, count):
+            if read.is_set():
+                await asyncio.sleep(1)
+                return {}
+            read.set()
+            self.assertEqual(cursors, {self.user_id: "1-0"})
+            return {self.user_id: [("2-0", MessageType.LOG, json.dumps(log_message("relayed").dict()))]}
+
+        redis_buffer.read.side_effect = read_messages
+        with patch("aggregator.connection_manager.RedisReplayBuffer", return_value=redis_buffer):
+            self.manager.use_redis(MagicMock())
+        connection = self.manager.connect(self.user_id, self.websocket, "1-0")
+
+        # Messages are appended to Redis, rather than sent directly
+        self.manager.send_to_user(self.user_id, log_message("sent"))
+        await read.wait()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        redis_buffer.append.assert_awaited_once()
+        self.assertEqual(redis_buffer.append.call_args.args[:2], (self.user_id, MessageType.LOG))
+
+        self.websocket.send.assert_called_once()
+        self.assertEqual(json.loads(self.websocket.send.call_args.args[0])["message"], "relayed")
+        self.assertEqual(connection.cursor, "2-0")
+        self.manager._relay.cancel()
+
+    def test_send_to_user_after_loop_closed(self):
+        manager = ConnectionManager()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(self._connect(manager))
+        loop.close()
+
+        # Sent directly rather than to the closed loop, and buffered for when the user reconnects
+        manager.send_to_user(self.user_id, log_message())
+        self.assertEqual(manager.active_connections, {})
+        self.assertEqual(len(manager._replay_buffer.read(self.user_id)), 1)
+
+    async def _connect(self, manager):
+        connection = manager.connect(self.user_id, self.websocket)
+        connection.sender.cancel()
+
+    def test_unknown_slow_client_policy(self):
+        with self.assertRaises(ValueError):
+            ConnectionManager(slow_client_policy="block")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,5 @@
+import json
+import pytest
 from aggregator.aggregator import MetricsAggregator
 from common.models import MetricValue, MetricsPackageExceptionModel
 
@@ -268,3 +270,74 @@ def test_aggregate_multiple_batches():
     assert abs(aggregator.metrics["accuracy"]["value"] - expected_metrics["accuracy"]["value"]) < 1e-5
     assert abs(aggregator.metrics["loss"]["value"] - expected_metrics["loss"]["value"]) < 1e-5
     assert aggregator.samples_processed == 30
+
+
+def test_aggregate_batches_with_sufficient_statistics():
+    """Test that metrics with sufficient statistics are derived from the merged statistics."""
+    aggregator = MetricsAggregator()
+    # Batch 1: 1 of 1 predictions of class 1 correct; batch 2: 1 of 3 predictions correct
+    batch1_statistics = {"confusion_matrix": {"labels": [0, 1], "shape": [2, 2], "cells": [[0, 0, 9], [1, 1, 1]]}}
+    batch2_statistics = {
+        "confusion_matrix": {"labels": [0, 1], "shape": [2, 2], "cells": [[0, 0, 7], [0, 1, 2], [1, 1, 1]]}
+    }
+
+    aggregator.aggregate_new_batch(
+        {"precision": MetricValue(computed_value=1.0, ideal_value=0.8, range=(0, 1))},
+        10,
+        batch1_statistics,
+    )
+    aggregator.aggregate_new_batch(
+        {"precision": MetricValue(computed_value=(1.0 + 1 / 3) / 2, ideal_value=0.8, range=(0, 1))},
+        10,
+        batch2_statistics,
+    )
+
+    # Precision over both batches: class 0 - 16 / 16, class 1 - 2 / 4
+    assert aggregator.metrics["precision"]["value"] == (1.0 + 0.5) / 2
+    assert aggregator.metrics["precision"]["count"] == 20
+    assert aggregator.statistics["confusion_matrix"]["cells"] == [[0, 0, 16], [0, 1, 2], [1, 1, 2]]
+
+
+def test_aggregate_falls_back_to_average_when_statistics_missing():
+    """Test that a metric is averaged once a batch without its statistics is received."""
+    aggregator = MetricsAggregator()
+    aggregator.aggregate_new_batch(
+        {"accuracy": MetricValue(computed_value=0.5, ideal_value=1.0, range=(0, 1))},
+        10,
+        {"accuracy": {"correct": 5, "total": 10}},
+    )
+    aggregator.aggregate_new_batch(
+        {"accuracy": MetricValue(computed_value=1.0, ideal_value=1.0, range=(0, 1))},
+        30,
+    )
+    aggregator.aggregate_new_batch(
+        {"accuracy": MetricValue(computed_value=0.0, ideal_value=1.0, range=(0, 1))},
+        10,
+        {"accuracy": {"correct": 0, "total": 10}},
+    )
+
+    assert aggregator.metrics["accuracy"]["value"] == pytest.approx((0.5 * 10 + 1.0 * 30) / 50)
+    assert "accuracy" in aggregator.metrics_without_statistics
+
+
+def test_state_round_trips_through_json():
+    """Test that an aggregator restored from its state carries on aggregating identically."""
+    aggregator = MetricsAggregator()
+    aggregator.set_total_sample_size(30)
+    batch = {
+        "precision": MetricValue(computed_value=1.0, ideal_value=0.8, range=(0, 1)),
+        "loss": MetricValue(computed_value=0.5, ideal_value=0.0, range=(0, 1)),
+    }
+    statistics = {"confusion_matrix": {"labels": [0, 1], "shape": [2, 2], "cells": [[0, 0, 9], [1, 1, 1]]}}
+    aggregator.aggregate_new_batch(batch, 10, statistics, batch_id="batch1")
+
+    restored = MetricsAggregator.from_dict(json.loads(json.dumps(aggregator.to_dict())))
+    for a in (aggregator, restored):
+        a.aggregate_new_batch(batch, 20, statistics, batch_id="batch2")
+
+    assert restored.metrics["precision"]["value"] == aggregator.metrics["precision"]["value"]
+    assert restored.metrics["loss"]["value"] == pytest.approx(aggregator.metrics["loss"]["value"])
+    assert restored.statistics == aggregator.statistics
+    assert restored.metrics_without_statistics == aggregator.metrics_without_statistics == {"loss"}
+    assert restored.processed_batches == {"batch1", "batch2"}
+    assert (restored.batches_processed, restored.samples_processed, restored.total_sample_size) == (2, 30, 30)
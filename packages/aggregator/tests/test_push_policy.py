@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+from aggregator.push_policy import MetricsPusher
+
+
+def make_message(metrics, progress, delta):
+    return {"metrics": metrics, "progress": progress, "delta": delta}
+
+
+def metric(value):
+    return {"value": value, "ideal_value": 1.0, "range": [0.0, 1.0], "count": 10, "error": None}
+
+
+class TestMetricsPusher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.send = MagicMock()
+        self.user_id = "user1"
+
+    def sent(self):
+        return [call.args[1] for call in self.send.call_args_list]
+
+    async def test_pushes_every_batch_by_default(self):
+        pusher = MetricsPusher(self.send, make_message, min_interval=0, deltas=False)
+        for i in range(3):
+            pusher.push(self.user_id, {"accuracy": metric(i)}, {"batches_processed": i + 1})
+
+        self.assertEqual(
+            self.sent(),
+            [make_message({"accuracy": metric(i)}, {"batches_processed": i + 1}, False) for i in range(3)],
+        )
+
+    async def test_coalesces_batches_within_the_interval(self):
+        pusher = MetricsPusher(self.send, make_message, min_interval=0.05, deltas=False)
+        for i in range(5):
+            pusher.push(self.user_id, {"accuracy": metric(i)}, {"batches_processed": i + 1})
+        # The first batch is pushed immediately, the rest once the interval has passed
+        self.assertEqual(self.send.call_count, 1)
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(
+            self.sent()[-1], make_message({"accuracy": metric(4)}, {"batches_processed": 5}, False)
+        )
+        self.assertEqual(self.send.call_count, 2)
+
+    async def test_final_metrics_are_pushed_immediately(self):
+        pusher = MetricsPusher(self.send, make_message, min_interval=60, deltas=False)
+        pusher.push(self.user_id, {"accuracy": metric(0)}, {"batches_processed": 1})
+        pusher.push(self.user_id, {"accuracy": metric(1)}, {"batches_processed": 2})
+        pusher.push(self.user_id, {"accuracy": metric(2)}, {"batches_processed": 3}, final=True)
+
+        self.assertEqual(self.send.call_count, 2)
+        self.assertEqual(self.sent()[-1]["progress"], {"batches_processed": 3})
+        self.assertNotIn(self.user_id, pusher._users)
+
+    async def test_pushes_only_changed_metrics_as_deltas(self):
+        pusher = MetricsPusher(self.send, make_message, min_interval=0, deltas=True)
+        metrics = {"accuracy": metric(0.5), "precision": metric(0.5)}
+        pusher.push(self.user_id, metrics, {})
+        # Metrics are updated in place between batches
+        metrics["precision"]["value"] = 0.75
+        pusher.push(self.user_id, metrics, {})
+
+        first, second = self.sent()
+        self.assertEqual(first["metrics"], {"accuracy": metric(0.5), "precision": metric(0.5)})
+        self.assertFalse(first["delta"])
+        self.assertEqual(second["metrics"], {"precision": metric(0.75)})
+        self.assertTrue(second["delta"])
+
+    async def test_discard_cancels_pending_push(self):
+        pusher = MetricsPusher(self.send, make_message, min_interval=0.05, deltas=False)
+        pusher.push(self.user_id, {"accuracy": metric(0)}, {})
+        pusher.push(self.user_id, {"accuracy": metric(1)}, {})
+        pusher.discard(self.user_id)
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.send.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from aggregator.replay_buffer import LocalReplayBuffer, RedisReplayBuffer
+from common.models import MessageType
+from common.redis.keys import redis_key
+
+
+class TestLocalReplayBuffer(unittest.TestCase):
+    def test_reads_messages_after_cursor(self):
+        buffer = LocalReplayBuffer()
+        cursors = [buffer.append("user1", MessageType.LOG, f'{{"message": {i}}}') for i in range(3)]
+        buffer.append("user2", MessageType.LOG, "{}")
+
+        # Cursors increase even when messages are buffered within the same millisecond
+        self.assertEqual(len(set(cursors)), 3)
+        self.assertEqual(
+            buffer.read("user1", cursors[0]),
+            [(cursor, MessageType.LOG, f'{{"message": {i}}}') for i, cursor in enumerate(cursors) if i > 0],
+        )
+        self.assertEqual(len(buffer.read("user1")), 3)
+        self.assertEqual(buffer.read("user3"), [])
+
+    def test_keeps_at_most_size_messages(self):
+        buffer = LocalReplayBuffer(size=2)
+        for i in range(5):
+            buffer.append("user1", MessageType.LOG, str(i))
+        self.assertEqual([payload for _, _, payload in buffer.read("user1")], ["3", "4"])
+
+    def test_discards_old_messages(self):
+        buffer = LocalReplayBuffer(max_age=10)
+        with patch("aggregator.replay_buffer.time.time", return_value=1000):
+            buffer.append("user1", MessageType.LOG, "old")
+        with patch("aggregator.replay_buffer.time.time", return_value=1005):
+            buffer.append("user2", MessageType.LOG, "recent")
+        with patch("aggregator.replay_buffer.time.time", return_value=1012):
+            self.assertEqual(buffer.read("user1"), [])
+            self.assertEqual(len(buffer.read("user2")), 1)
+        # Users without messages are forgotten
+        self.assertNotIn("user1", buffer._buffers)
+
+
+class TestRedisReplayBuffer(unittest.IsolatedAsyncioTestCase):
+    async def test_append_adds_to_bounded_stream(self):
+        redis_client = MagicMock()
+        # Commands are queued on the pipeline synchronously, and executed together
+        pipe = MagicMock()
+        redis_client.pipeline.return_value.__aenter__.return_value = pipe
+        pipe.execute = AsyncMock(return_value=["1000-0", 0, True])
+        buffer = RedisReplayBuffer(redis_client, size=10, max_age=60)
+
+        with patch("aggregator.replay_buffer.time.time", return_value=1000):
+            cursor = await buffer.append("user1", MessageType.LOG, "{}")
+
+        key = redis_key("replay", "user1")
+        self.assertEqual(cursor, "1000-0")
+        pipe.xadd.assert_called_once_with(
+            key, {"type": "LOG", "payload": "{}"}, maxlen=10, approximate=True
+        )
+        pipe.xtrim.assert_called_once_with(key, minid=(1000 - 60) * 1000, approximate=True)
+        pipe.expire.assert_called_once_with(key, 60)
+
+    async def test_read_returns_messages_of_each_user(self):
+        redis_client = MagicMock()
+        redis_client.xread = AsyncMock(
+            return_value=[[redis_key("replay", "user1"), [("2-0", {"type": "REPORT", "payload": "{}"})]]]
+        )
+        buffer = RedisReplayBuffer(redis_client)
+
+        messages = await buffer.read({"user1": "1-0", "user2": None}, block_ms=100, count=5)
+
+        self.assertEqual(messages, {"user1": [("2-0", MessageType.REPORT, "{}")]})
+        redis_client.xread.assert_awaited_once_with(
+            {redis_key("replay", "user1"): "1-0", redis_key("replay", "user2"): "0"}, count=5, block=100
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
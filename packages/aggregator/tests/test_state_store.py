@@ -0,0 +1,81 @@
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from redis import WatchError
+from aggregator.aggregator import MetricsAggregator
+from aggregator.state_store import AggregatorStateStore
+from common.redis.keys import redis_key
+
+
+def add_batch(aggregator):
+    aggregator.samples_processed += 10
+    return aggregator.samples_processed
+
+
+@pytest.mark.asyncio
+async def test_local_state_is_created_updated_and_deleted():
+    store = AggregatorStateStore(MetricsAggregator)
+    assert await store.get("user1") is None
+
+    assert await store.update("user1", add_batch) == 10
+    assert await store.update("user1", add_batch) == 20
+    assert (await store.get("user1")).samples_processed == 20
+
+    await store.delete("user1")
+    assert await store.get("user1") is None
+
+
+def mock_redis(state=None):
+    redis_client = MagicMock()
+    redis_client.get = AsyncMock()
+    redis_client.delete = AsyncMock()
+    # Commands are awaited, except those queued after multi()
+    pipe = MagicMock()
+    pipe.watch = AsyncMock()
+    pipe.get = AsyncMock(return_value=None if state is None else json.dumps(state.to_dict()))
+    pipe.execute = AsyncMock()
+    redis_client.pipeline.return_value.__aenter__.return_value = pipe
+    return redis_client, pipe
+
+
+@pytest.mark.asyncio
+async def test_redis_state_is_updated_in_a_transaction():
+    existing = MetricsAggregator()
+    existing.samples_processed = 10
+    redis_client, pipe = mock_redis(existing)
+    store = AggregatorStateStore(MetricsAggregator, redis_client, ttl=60)
+
+    assert await store.update("user1", add_batch) == 20
+
+    key = redis_key("aggregator", "user1")
+    pipe.watch.assert_awaited_once_with(key)
+    pipe.multi.assert_called_once()
+    saved = pipe.set.call_args.args[1]
+    assert json.loads(saved)["samples_processed"] == 20
+    assert pipe.set.call_args.kwargs == {"ex": 60}
+    pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_redis_update_is_retried_on_concurrent_update():
+    redis_client, pipe = mock_redis()
+    pipe.execute.side_effect = [WatchError(), None]
+    store = AggregatorStateStore(MetricsAggregator, redis_client)
+
+    # The update is applied afresh to the state as another replica left it
+    assert await store.update("user1", add_batch) == 10
+    assert pipe.watch.await_count == 2
+    assert pipe.execute.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_redis_state_is_read_and_deleted():
+    redis_client, _ = mock_redis()
+    state = MetricsAggregator()
+    state.samples_processed = 10
+    redis_client.get.return_value = json.dumps(state.to_dict())
+    store = AggregatorStateStore(MetricsAggregator, redis_client)
+
+    assert (await store.get("user1")).samples_processed == 10
+    await store.delete("user1")
+    redis_client.delete.assert_awaited_once_with(redis_key("aggregator", "user1"))
@@ -2,6 +2,7 @@ from api.router.rabbitmq import get_jobs_publisher
 from common.rabbitmq.publisher import Publisher
 from pydantic import BaseModel, HttpUrl
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from metrics.metrics import task_type_to_metric
 from metrics.models import MetricsInfo, TaskType
@@ -58,7 +59,9 @@ async def generate_metrics_from_info(
     - metrics: list of metrics that should be applied
     """
     try:
-        dispatch_job(
+        # Publishing blocks while RabbitMQ has not confirmed earlier jobs, so it is kept off the event loop
+        await run_in_threadpool(
+            dispatch_job,
             metrics=MetricCalculationJob(
                 data_url=request.dataset_url,
                 model_url=request.model_url,
@@ -88,7 +91,7 @@ async def stop_job(request: StopJobRequest, publisher=Depends(get_jobs_publisher
         message = JobFromAPI(
             job_type=PipelineJobType.HALT_JOB, job=PipelineHalt(job_id=request.job_id)
         ).model_dump_json()
-        _ = publisher.publish(message)
+        _ = await run_in_threadpool(publisher.publish, message)
         return JSONResponse({"message": "Job stopped"}, status_code=202)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during handling of request to /stop-job - {e}")
@@ -1,8 +1,26 @@
 from abc import ABC
 from enum import Enum
 from metrics.models import WorkerResults
-from pydantic import BaseModel  # , field_validator
+from pydantic import BaseModel, field_serializer, field_validator
 from typing import Any, Optional, Union
+import numpy as np
+from common.utils import validate_column_dtypes
+
+
+def _validate_array(value, handler, ndim: int):
+    """
+    Keep NumPy arrays (e.g. decoded from an npz archive) as they are, rather than
+    validating every element as a nested list. Anything else is validated as usual.
+    """
+    if isinstance(value, np.ndarray):
+        if value.ndim != ndim:
+            raise ValueError(f"Expected a {ndim} dimensional array, got {value.ndim} dimensions")
+        return value
+    return handler(value)
+
+
+def _serialize_array(value):
+    return value.tolist() if isinstance(value, np.ndarray) else value
 
 
 class DatasetResponse(BaseModel):  # pragma: no cover
@@ -12,10 +30,37 @@ class DatasetResponse(BaseModel):  # pragma: no cover
         features: list[list] - the features of the dataset
         labels: list[list] - the labels of the dataset
         group_id: list[int] - the group IDs for the dataset
+        column_dtypes: Optional[list[str]] - the dtype of each feature column, e.g. "float32",
+            "int64" or "category". Must be sent with every batch of a job, as any batch may be
+            processed first.
+    Each array field may also be given as a NumPy array, which is kept as is.
     """
     features: list[list]
     labels: list[list]
     group_ids: Optional[list[int]]
+    column_dtypes: Optional[list[str]] = None
+
+    @field_validator("features", "labels", mode="wrap")
+    @classmethod
+    def accept_2d_arrays(cls, value, handler):
+        return _validate_array(value, handler, ndim=2)
+
+    @field_validator("group_ids", mode="wrap")
+    @classmethod
+    def accept_1d_arrays(cls, value, handler):
+        return _validate_array(value, handler, ndim=1)
+
+    @field_validator("column_dtypes", mode="before")
+    @classmethod
+    def check_column_dtypes(cls, value):
+        if isinstance(value, np.ndarray):
+            # e.g. decoded from an npz archive
+            value = value.tolist()
+        return validate_column_dtypes(value) if value is not None else value
+
+    @field_serializer("features", "labels", "group_ids")
+    def serialize_arrays(self, value):
+        return _serialize_array(value)
 
     # @field_validator('features', 'labels', mode='after')
     # def convert_to_np_array(cls, v):
@@ -28,10 +73,20 @@ class ModelResponse(BaseModel):  # pragma: no cover
     Attributes:
         predictions: list[list] - the predictions from the model
         confidence_scores: Optional[list[list]] - the confidence scores from the model (default is None)
+    Each field may also be given as a NumPy array, which is kept as is.
     """
     predictions: list[list]
     confidence_scores: Optional[list[list]] = None
 
+    @field_validator("predictions", "confidence_scores", mode="wrap")
+    @classmethod
+    def accept_2d_arrays(cls, value, handler):
+        return _validate_array(value, handler, ndim=2)
+
+    @field_serializer("predictions", "confidence_scores")
+    def serialize_arrays(self, value):
+        return _serialize_array(value)
+
 
 class LegislationList(BaseModel):
     legislation: list[str]
@@ -107,3 +162,13 @@ class ComputeUserMetricRequest(BaseModel):  # pragma: no cover
     user_id: str
     function_name: str
     params: dict
+
+
+class ComputeUserMetricsRequest(BaseModel):  # pragma: no cover
+    """
+    Request to compute several of a user's metrics with the same parameters. All of the
+    user's metric functions are computed if function_names is not given.
+    """
+    user_id: str
+    params: dict
+    function_names: Optional[list[str]] = None
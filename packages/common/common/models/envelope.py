@@ -0,0 +1,117 @@
+"""
+Versioned envelope for the messages services send each other over RabbitMQ.
+
+Messages are encoded as JSON by default. With MESSAGE_CODEC=msgpack they are encoded with
+MessagePack instead, and compressed with zstd once they are larger than
+MESSAGE_COMPRESSION_THRESHOLD bytes. The codec is advertised in the AMQP content type and
+content encoding of each message, so consumers decode every message by its own properties,
+and messages without them (e.g. from older publishers) are read as JSON.
+
+Usage:
+body, properties = encode_message(batch)
+channel.basic_publish(exchange="", routing_key=BATCH_QUEUE, body=body, properties=properties)
+...
+batch = decode_message(Batch, body, properties)
+"""
+
+import os
+from typing import Optional, Type, TypeVar, Union
+import msgpack
+import zstandard
+from pika import BasicProperties
+from pydantic import BaseModel
+
+ENVELOPE_VERSION = 1
+ENVELOPE_VERSION_HEADER = "x-envelope-version"
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+ZSTD_CONTENT_ENCODING = "zstd"
+
+# Codec used to encode outgoing messages - "json" or "msgpack"
+MESSAGE_CODEC = os.getenv("MESSAGE_CODEC", "json")
+# Size in bytes above which msgpack encoded messages are compressed
+MESSAGE_COMPRESSION_THRESHOLD = int(os.getenv("MESSAGE_COMPRESSION_THRESHOLD", "65536"))
+# zstd compression level, favouring speed over ratio by default
+MESSAGE_COMPRESSION_LEVEL = int(os.getenv("MESSAGE_COMPRESSION_LEVEL", "3"))
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+class MessageDecodeError(ValueError):
+    """Raised when a message cannot be decoded from its advertised encoding"""
+
+
+def encode_message(
+    model: BaseModel,
+    codec: str = MESSAGE_CODEC,
+    compression_threshold: int = MESSAGE_COMPRESSION_THRESHOLD,
+) -> tuple[bytes, BasicProperties]:
+    """
+    Encode a model as the body of a message, with the properties describing its encoding
+
+    :param model: BaseModel - the message to encode
+    :param codec: str - "json" or "msgpack"
+    :param compression_threshold: int - size in bytes above which msgpack bodies are compressed
+    :return: tuple[bytes, BasicProperties] - the body and properties to publish
+    """
+    headers = {ENVELOPE_VERSION_HEADER: ENVELOPE_VERSION}
+    if codec == "json":
+        # JSON is never compressed, so that consumers which ignore the properties can read it
+        return model.model_dump_json().encode(), BasicProperties(
+            content_type=JSON_CONTENT_TYPE, headers=headers
+        )
+    if codec != "msgpack":
+        raise ValueError(f"Unsupported message codec: {codec}")
+
+    body = msgpack.packb(model.model_dump(mode="json"))
+    content_encoding = None
+    if len(body) > compression_threshold:
+        body = zstandard.compress(body, MESSAGE_COMPRESSION_LEVEL)
+        content_encoding = ZSTD_CONTENT_ENCODING
+    return body, BasicProperties(
+        content_type=MSGPACK_CONTENT_TYPE,
+        content_encoding=content_encoding,
+        headers=headers,
+    )
+
+
+def decode_message(
+    model_type: Type[Model],
+    body: Union[bytes, str],
+    properties: Optional[BasicProperties] = None,
+) -> Model:
+    """
+    Decode the body of a message into a model, using the encoding given by its properties
+
+    :param model_type: Type[BaseModel] - the model to decode the message as
+    :param body: bytes | str - the body of the message
+    :param properties: BasicProperties, optional - the message's properties, read as JSON if missing
+    :return: BaseModel - the decoded message
+    :raises ValueError: if the message cannot be decoded or is not a valid model
+    """
+    content_type = properties.content_type if properties is not None else None
+    content_encoding = properties.content_encoding if properties is not None else None
+    headers = (properties.headers if properties is not None else None) or {}
+
+    version = headers.get(ENVELOPE_VERSION_HEADER, ENVELOPE_VERSION)
+    if version > ENVELOPE_VERSION:
+        raise MessageDecodeError(f"Unsupported message envelope version: {version}")
+
+    if content_encoding == ZSTD_CONTENT_ENCODING:
+        try:
+            body = zstandard.decompress(body)
+        except zstandard.ZstdError as e:
+            raise MessageDecodeError(f"Invalid zstd compressed message: {e}")
+    elif content_encoding is not None:
+        raise MessageDecodeError(f"Unsupported message content encoding: {content_encoding}")
+
+    if content_type is None or content_type == JSON_CONTENT_TYPE:
+        return model_type.model_validate_json(body)
+    if content_type == MSGPACK_CONTENT_TYPE:
+        try:
+            data = msgpack.unpackb(body)
+        except Exception as e:
+            raise MessageDecodeError(f"Invalid msgpack message: {e}")
+        return model_type.model_validate(data)
+    raise MessageDecodeError(f"Unsupported message content type: {content_type}")
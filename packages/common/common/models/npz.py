@@ -0,0 +1,112 @@
+"""
+Binary exchange format for datasets and model inputs/outputs, as an alternative to JSON.
+
+Dataset and model servers may send and receive `.npz` archives (see numpy.savez) with
+the content type NPZ_CONTENT_TYPE, holding one array per field of the model being sent
+(e.g. features, labels and group_ids for a DatasetResponse). Archives are written
+uncompressed, so decoding one wraps each array around its bytes in the body, without
+parsing, validating or copying it element by element.
+
+Clients ask for the format with the NPZ_ACCEPT header, which servers that do not
+support it ignore, and only send archives to servers that have replied with one.
+"""
+
+import io
+import struct
+import zipfile
+from typing import Optional, Type, TypeVar
+import numpy as np
+from numpy.lib import format as npy_format
+from pydantic import BaseModel
+
+NPZ_CONTENT_TYPE = "application/x-npz"
+# Accept header preferring archives, falling back to JSON
+NPZ_ACCEPT = f"{NPZ_CONTENT_TYPE}, application/json;q=0.9"
+
+Model = TypeVar("Model", bound=BaseModel)
+
+# Readers of the .npy headers of archive members, by format version
+_NPY_HEADER_READERS = {
+    (1, 0): npy_format.read_array_header_1_0,
+    (2, 0): npy_format.read_array_header_2_0,
+}
+# Size of a zip local file header, and the offset of its name and extra field lengths
+_ZIP_LOCAL_HEADER_SIZE = 30
+_ZIP_LOCAL_HEADER_LENGTHS_OFFSET = 26
+
+
+def is_npz(content_type: Optional[str]) -> bool:
+    """
+    Whether a Content-Type or Accept header value includes the NPZ content type
+    """
+    return content_type is not None and NPZ_CONTENT_TYPE in content_type
+
+
+def encode_npz(model: BaseModel) -> bytes:
+    """
+    Encode the array fields of a model as an uncompressed .npz archive. Fields set to None
+    are omitted.
+
+    :param model: BaseModel - a model whose fields are all arrays or nested lists
+    :return: bytes - the archive
+    :raises ValueError: if a field is not a numeric, boolean or string array, e.g. it is
+        ragged or contains None, as these cannot be loaded without pickle
+    """
+    arrays = {}
+    for name, value in model:
+        if value is None:
+            continue
+        array = np.asarray(value)
+        if array.dtype.kind not in "biufU":
+            raise ValueError(f"Field {name} cannot be encoded as an array of type {array.dtype}")
+        arrays[name] = array
+
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _read_member(body: bytes, archive: zipfile.ZipFile, member: zipfile.ZipInfo) -> np.ndarray:
+    """
+    Read an array from an archive member. Uncompressed members are read without copying,
+    as read-only views of the body; others, e.g. compressed by numpy.savez_compressed, are
+    read into new arrays.
+    """
+    with archive.open(member) as stream:
+        version = npy_format.read_magic(stream)
+        read_header = _NPY_HEADER_READERS.get(version)
+        if member.compress_type != zipfile.ZIP_STORED or read_header is None:
+            return np.load(archive.open(member), allow_pickle=False)
+        shape, fortran_order, dtype = read_header(stream)
+        header_size = stream.tell()
+
+    if dtype.hasobject:
+        raise ValueError(f"Member {member.filename} holds objects, which cannot be loaded without pickle")
+    name_length, extra_length = struct.unpack_from(
+        "<HH", body, member.header_offset + _ZIP_LOCAL_HEADER_LENGTHS_OFFSET
+    )
+    offset = member.header_offset + _ZIP_LOCAL_HEADER_SIZE + name_length + extra_length + header_size
+    array = np.frombuffer(body, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def decode_npz(model_type: Type[Model], body: bytes) -> Model:
+    """
+    Decode an .npz archive into a model, with its fields held as NumPy arrays. Arrays of
+    uncompressed members, as written by encode_npz, are read-only views of the body rather
+    than copies of it.
+
+    :param model_type: Type[BaseModel] - the model to decode the archive as
+    :param body: bytes - the archive
+    :return: BaseModel - the decoded model
+    :raises ValueError: if the body is not a valid archive of the model's fields
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            arrays = {
+                member.filename.removesuffix(".npy"): _read_member(body, archive, member)
+                for member in archive.infolist()
+            }
+    except Exception as e:
+        raise ValueError(f"Invalid npz archive: {e}")
+    return model_type(**arrays)
@@ -2,6 +2,7 @@ import os
 import pika
 import socket
 import time
+from typing import Optional
 import pika.exceptions
 from pika.adapters.blocking_connection import BlockingChannel
 from .constants import BATCH_QUEUE, JOB_QUEUE, RESULT_QUEUE, STATUS_QUEUE
@@ -40,10 +41,15 @@ def init_queues(channel: BlockingChannel):
     channel.queue_declare(queue=STATUS_QUEUE, durable=True)
 
 
-def publish_to_queue(channel: BlockingChannel, queue: str, message: str):
+def publish_to_queue(
+    channel: BlockingChannel,
+    queue: str,
+    message: str | bytes,
+    properties: Optional[pika.BasicProperties] = None,
+):
     try:
         # Publish the message
-        channel.basic_publish(exchange="", routing_key=queue, body=message)
+        channel.basic_publish(exchange="", routing_key=queue, body=message, properties=properties)
     except pika.exceptions.AMQPConnectionError as e:
         # If there was some connection error
         # Restablish the connection and publish the message
@@ -53,7 +59,7 @@ def publish_to_queue(channel: BlockingChannel, queue: str, message: str):
         channel = connection.channel()
         init_queues(channel)
         print("Reconnected to RabbitMQ")
-        channel.basic_publish(exchange="", routing_key=queue, body=message)
+        channel.basic_publish(exchange="", routing_key=queue, body=message, properties=properties)
     except Exception as e:
         # Some unknown error occurred
         print(f"Error publishing to channel: {e}")
@@ -63,7 +69,42 @@ def publish_to_queue(channel: BlockingChannel, queue: str, message: str):
             channel = connection.channel()
             init_queues(channel)
             print("Reconnected to RabbitMQ")
-            channel.basic_publish(exchange="", routing_key=queue, body=message)
+            channel.basic_publish(exchange="", routing_key=queue, body=message, properties=properties)
         raise e
 
     return channel
+
+
+def publish_many_to_queue(
+    channel: BlockingChannel,
+    queue: str,
+    messages: list[str | bytes],
+    properties: Optional[list[pika.BasicProperties]] = None,
+):
+    """
+    Publish several messages to a queue in one burst. Messages are written to the channel
+    back to back, without waiting on the broker between them. If the connection is lost,
+    reconnects once and publishes the messages which were not yet published.
+    If given, properties holds the properties of each message in turn.
+    """
+    properties = properties or [None] * len(messages)
+    published = 0
+    try:
+        for message, message_properties in zip(messages, properties):
+            channel.basic_publish(
+                exchange="", routing_key=queue, body=message, properties=message_properties
+            )
+            published += 1
+    except pika.exceptions.AMQPConnectionError as e:
+        print(f"Error publishing to channel after {published}/{len(messages)} messages: {e}")
+        print("Attempting to reconnect to RabbitMQ once...")
+        connection = connect_to_rabbitmq(retries=1)
+        channel = connection.channel()
+        init_queues(channel)
+        print("Reconnected to RabbitMQ")
+        for message, message_properties in zip(messages[published:], properties[published:]):
+            channel.basic_publish(
+                exchange="", routing_key=queue, body=message, properties=message_properties
+            )
+
+    return channel
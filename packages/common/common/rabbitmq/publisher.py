@@ -2,30 +2,64 @@
 # pylint: disable=C0111,C0103,R0205
 
 import os
+import time
 import threading
-from common.rabbitmq.connect import connect_to_rabbitmq
-from pika import BlockingConnection, PlainCredentials
-from pika.adapters.blocking_connection import BlockingChannel
+from collections import deque
+from concurrent.futures import Future, wait
+from typing import Optional
+import pika
+import pika.frame
+import pika.spec
+from pika import BasicProperties, PlainCredentials, SelectConnection
+from pika.channel import Channel
 
 
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
 RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "guest")
 
+# Maximum number of messages published but not yet confirmed by the broker. Publishing
+# blocks once the window is full, until the broker confirms earlier messages.
+PUBLISHER_CONFIRM_WINDOW = int(os.getenv("PUBLISHER_CONFIRM_WINDOW", "256"))
+# Seconds to wait before reconnecting after the connection to RabbitMQ is lost
+PUBLISHER_RECONNECT_DELAY = float(os.getenv("PUBLISHER_RECONNECT_DELAY", "3"))
+# Seconds publish waits for room in the confirm window before failing the message
+PUBLISHER_PUBLISH_TIMEOUT = float(os.getenv("PUBLISHER_PUBLISH_TIMEOUT", "30"))
+
+
+class PublishNackedException(Exception):
+    """Raised (through the message's future) when the broker rejects a published message"""
+
+
+class PublisherStoppedException(Exception):
+    """Raised (through the message's future) when the publisher stops before a message is confirmed"""
+
+
+class PublishTimeoutException(Exception):
+    """Raised (through the message's future) when the confirm window stays full for too long"""
+
 
 class Publisher(threading.Thread):
     """
-    Long lived publisher that publishes messages to a RabbitMQ queue from
-    https://github.com/pika/pika/blob/main/examples/long_running_publisher.py.
-    Uses its own thread so it can respond to rabbitmq heartbeats and other
-    events while the main thread is doing other things.
+    Long lived publisher that publishes messages to RabbitMQ queues with publisher confirms,
+    based on https://github.com/pika/pika/blob/main/examples/asynchronous_publisher_example.py.
+    Uses its own thread and an asynchronous connection, so publishing never waits on the
+    broker: messages are pipelined and the broker's confirms are tracked as they arrive.
+
+    Each call to publish returns a Future which completes once the broker has confirmed
+    the message, or fails if the broker rejects it. At most `confirm_window` messages are
+    unconfirmed at once; publish blocks when the window is full, applying backpressure, and
+    fails the message if the window stays full for `publish_timeout` seconds. As publish may
+    block, call it from a thread rather than an event loop, e.g. with run_in_threadpool.
+    Messages not confirmed when the connection is lost are published again on reconnection.
 
     Usage:
     publisher = Publisher(queue="my_queue")
     publisher.start()
     try:
-        publisher.publish("Hello, World!")
-        // publisher.stop()
+        future = publisher.publish("Hello, World!")
+        future.result()  # optionally wait for the broker to confirm the message
     finally:
+        publisher.stop()
         publisher.join()
     """
 
@@ -33,78 +67,254 @@ class Publisher(threading.Thread):
     is_running = True
     name = "Publisher"
 
-    queue: str
-    connection: BlockingConnection
-    channel: BlockingChannel
+    queue: Optional[str]
+    connection: Optional[SelectConnection]
+    channel: Optional[Channel]
 
     def __init__(
         self,
-        queue: str,
+        queue: Optional[str] = None,
         name: str = "Publisher",
         host: str = os.getenv("RABBITMQ_HOST", "rabbitmq"),
         credentials: PlainCredentials = PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
         retries: int = 10,
+        confirm_window: int = PUBLISHER_CONFIRM_WINDOW,
+        queues: Optional[list[str]] = None,
+        publish_timeout: float = PUBLISHER_PUBLISH_TIMEOUT,
         *args,
         **kwargs,
     ):
-        """Create a publisher for a channel that lives on its own thread and publishes messages to a RabbitMQ queue
+        """Create a publisher that lives on its own thread and publishes messages to RabbitMQ queues
 
         Args:
-            queue (str): Queue name to publish to (will be declared durable if it doesn't exist)
+            queue (str, optional): Default queue to publish to (will be declared durable if it doesn't exist)
             name (str, optional): Name of this publisher.
                 Defaults to "Publisher".
             host (str, optional): Hostname to connect to.
             Defaults to os.getenv("RABBITMQ_HOST", "rabbitmq").
             credentials (PlainCredentials, optional): Creds to connect with.
             Defaults to PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS).
-            retries (int, optional): Number of times to retry connecting
-                to RabbitMQ. Defaults to 10.
+            retries (int, optional): Number of consecutive times to retry connecting
+                to RabbitMQ before giving up. Defaults to 10.
+            confirm_window (int, optional): Maximum number of unconfirmed messages.
+                Defaults to PUBLISHER_CONFIRM_WINDOW.
+            queues (list[str], optional): Other queues messages may be published to
+                (will be declared durable if they don't exist)
+            publish_timeout (float, optional): Seconds to wait for room in the confirm window.
+                Defaults to PUBLISHER_PUBLISH_TIMEOUT.
         """
         super().__init__(*args, **kwargs)
         self.daemon = True
         self.is_running = True
         self.name = name
         self.queue = queue
+        self.queues = list(dict.fromkeys(q for q in [queue, *(queues or [])] if q))
 
-        self.connection = connect_to_rabbitmq(
-            host=host, credentials=credentials, retries=retries
+        self._parameters = pika.ConnectionParameters(
+            host=host, heartbeat=600, credentials=credentials
         )
-        self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=self.queue, durable=True)
+        self._retries = retries
+        self._failed_attempts = 0
+        self._window = threading.BoundedSemaphore(confirm_window)
+        self._publish_timeout = publish_timeout
 
-    def on_tick(self):
-        self.connection.process_data_events(time_limit=1)
+        # Messages waiting to be published, and published messages waiting for a
+        # confirm by delivery tag. Both are only modified while holding the lock.
+        self._lock = threading.Lock()
+        self._buffer: deque[tuple[str, bytes, Optional[BasicProperties], Future]] = deque()
+        self._unconfirmed: dict[int, tuple[str, bytes, Optional[BasicProperties], Future]] = {}
+        self._delivery_tag = 0
+        self._ready = threading.Event()
+
+        self.connection = None
+        self.channel = None
 
     def run(self):
         while self.is_running:
-            self.on_tick()
+            self.connection = SelectConnection(
+                self._parameters,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            # Blocks until the connection is closed
+            self.connection.ioloop.start()
 
-    def _publish(self, message):
-        self.channel.basic_publish("", self.queue, body=message.encode())
+            if self._failed_attempts >= self._retries:
+                print(f"Could not connect to RabbitMQ after {self._retries} attempts.")
+                self.is_running = False
+            elif self.is_running:
+                time.sleep(PUBLISHER_RECONNECT_DELAY)
 
-    def publish(self, message):
-        self.connection.add_callback_threadsafe(lambda: self._publish(message))
+        self._fail_outstanding(PublisherStoppedException("Publisher stopped before message was confirmed"))
 
-    def stop(self):
+    def publish(
+        self, message, queue: Optional[str] = None, properties: Optional[BasicProperties] = None
+    ) -> Future:
+        """
+        Publish a message, blocking only if the confirm window is full. Safe to call from
+        any thread, including the publisher's own (e.g. from a done callback of a message's
+        future), where it never blocks as that would stop confirms from freeing the window.
+
+        :param message: str | bytes - the message to publish
+        :param queue: str, optional - queue to publish to, defaulting to the publisher's queue
+        :param properties: BasicProperties, optional - properties of the message, e.g. its content type
+        :return: Future - completes once the broker confirms the message
+        """
+        queue = queue or self.queue
+        body = message.encode() if isinstance(message, str) else message
+        future = Future()
+        if not self.is_running:
+            future.set_exception(PublisherStoppedException("Publisher has been stopped"))
+            return future
+
+        if threading.current_thread() is self:
+            acquired = self._window.acquire(blocking=False)
+        else:
+            acquired = self._window.acquire(timeout=self._publish_timeout)
+        if not acquired:
+            future.set_exception(
+                PublishTimeoutException(f"Too many unconfirmed messages to publish to {queue}")
+            )
+            return future
+
+        with self._lock:
+            # Checked again under the lock, as run fails outstanding messages under the
+            # lock once it has stopped
+            if not self.is_running:
+                self._window.release()
+                future.set_exception(PublisherStoppedException("Publisher has been stopped"))
+                return future
+            self._buffer.append((queue, body, properties, future))
+
+        connection = self.connection
+        if connection is not None and self._ready.is_set():
+            connection.ioloop.add_callback_threadsafe(self._flush)
+        return future
+
+    def wait_for_confirms(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every message published so far has been confirmed (or rejected)
+
+        :return: bool - whether all messages were confirmed within the timeout
+        """
+        with self._lock:
+            futures = [future for *_, future in self._buffer]
+            futures += [future for *_, future in self._unconfirmed.values()]
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+    def stop(self, timeout: float = 10):
         print("Stopping...")
+        # Give outstanding messages a chance to be confirmed
+        if self._ready.is_set():
+            self.wait_for_confirms(timeout)
         self.is_running = False
-        # Wait until all the data events have been processed
-        self.connection.process_data_events(time_limit=1)
-        if self.connection.is_open:
-            self.connection.close()
+        if self.connection is not None:
+            self.connection.ioloop.add_callback_threadsafe(self._close)
         print("Stopped")
 
+    # Connection callbacks - these all run on the publisher's thread
+
+    def _on_connection_open(self, connection: SelectConnection):
+        self._failed_attempts = 0
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection: SelectConnection, error: Exception):
+        self._failed_attempts += 1
+        print(f"Connection failed due to {error}. Retrying {self._failed_attempts}/{self._retries}...")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection: SelectConnection, reason: Exception):
+        self._ready.clear()
+        self.channel = None
+        # Publish unconfirmed messages again, in order, once reconnected
+        with self._lock:
+            for tag in sorted(self._unconfirmed, reverse=True):
+                self._buffer.appendleft(self._unconfirmed.pop(tag))
+        if self.is_running:
+            print(f"Connection to RabbitMQ closed: {reason}. Reconnecting...")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel: Channel):
+        self.channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        # Delivery tags are numbered per channel
+        self._delivery_tag = 0
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_delivery_confirmation,
+            callback=lambda _: self._declare_queues(),
+        )
+
+    def _on_channel_closed(self, channel: Channel, reason: Exception):
+        # Reconnect, as the channel is only closed unexpectedly
+        print(f"Channel closed: {reason}")
+        if self.connection is not None and not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+
+    def _declare_queues(self):
+        remaining = set(self.queues)
+        if not remaining:
+            self._on_ready()
+            return
+
+        def on_declared(queue):
+            remaining.discard(queue)
+            if not remaining:
+                self._on_ready()
+
+        for queue in self.queues:
+            self.channel.queue_declare(
+                queue=queue, durable=True, callback=lambda _, queue=queue: on_declared(queue)
+            )
+
+    def _on_ready(self):
+        self._ready.set()
+        self._flush()
+
+    def _flush(self):
+        """Publish every buffered message without waiting for confirms"""
+        with self._lock:
+            while self._buffer and self._ready.is_set() and self.channel is not None and self.channel.is_open:
+                queue, body, properties, future = self._buffer.popleft()
+                self.channel.basic_publish(
+                    exchange="", routing_key=queue, body=body, properties=properties
+                )
+                self._delivery_tag += 1
+                self._unconfirmed[self._delivery_tag] = (queue, body, properties, future)
+
+    def _on_delivery_confirmation(self, frame: pika.frame.Method):
+        confirmation = frame.method
+        if confirmation.multiple:
+            with self._lock:
+                tags = [tag for tag in self._unconfirmed if tag <= confirmation.delivery_tag]
+        else:
+            tags = [confirmation.delivery_tag]
+
+        for tag in tags:
+            with self._lock:
+                message = self._unconfirmed.pop(tag, None)
+            if message is None:
+                continue
+            queue, *_, future = message
+            if isinstance(confirmation, pika.spec.Basic.Ack):
+                future.set_result(True)
+            else:
+                future.set_exception(PublishNackedException(f"Message to {queue} was rejected by RabbitMQ"))
+            self._window.release()
+
+    def _close(self):
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+        elif self.connection is not None:
+            self.connection.ioloop.stop()
 
-# if __name__ == "__main__":
-#     publisher = Publisher()
-#     publisher.start()
-#     try:
-#         for i in range(9999):
-#             msg = f"Message {i}"
-#             print(f"Publishing: {msg!r}")
-#             publisher.publish(msg)
-#             sleep(1)
-#     except KeyboardInterrupt:
-#         publisher.stop()
-#     finally:
-#         publisher.join()
+    def _fail_outstanding(self, error: Exception):
+        with self._lock:
+            messages = list(self._buffer) + list(self._unconfirmed.values())
+            self._buffer.clear()
+            self._unconfirmed.clear()
+        for *_, future in messages:
+            if not future.done():
+                future.set_exception(error)
+                self._window.release()
@@ -1,5 +1,7 @@
+import asyncio
 from time import sleep
 import redis as redis
+import redis.asyncio
 
 
 def connect_to_redis(url: str, retries: int = 20):
@@ -14,3 +16,18 @@ def connect_to_redis(url: str, retries: int = 20):
             print(f"Connection failed due to {e}. Retrying {i+1}/{retries}...")
             sleep(3)
     raise Exception(f"Could not connect to Redis after {retries} attempts.")
+
+
+async def connect_to_redis_async(url: str, retries: int = 20, **kwargs):
+    """connect_to_redis for Redis' asyncio client, waiting without blocking the event loop"""
+    for i in range(retries):
+        print(f"Connecting to Redis at {url}")
+        try:
+            redis_client = redis.asyncio.Redis.from_url(url, **kwargs)
+            # Attempt to connect to Redis
+            await redis_client.ping()
+            return redis_client
+        except redis.ConnectionError as e:
+            print(f"Connection failed due to {e}. Retrying {i+1}/{retries}...")
+            await asyncio.sleep(3)
+    raise Exception(f"Could not connect to Redis after {retries} attempts.")
@@ -1,7 +1,108 @@
 import numpy as np
+from typing import Callable, Optional
 
 
 def nested_list_to_np(value: list[list]) -> np.array:
     if value:
         return np.array(value)
     return value
+
+
+# Declared dtype of categorical feature columns, whose values are replaced by integer codes
+CATEGORY_DTYPE = "category"
+
+
+def validate_column_dtypes(column_dtypes: list[str]) -> list[str]:
+    """
+    Check that every declared column dtype is a NumPy dtype name (e.g. "float32") or "category"
+    """
+    for dtype in column_dtypes:
+        if dtype != CATEGORY_DTYPE:
+            try:
+                np.dtype(dtype)
+            except TypeError:
+                raise ValueError(f"Unknown column dtype: {dtype}")
+    return column_dtypes
+
+
+def _factorize(column: np.ndarray) -> tuple[np.ndarray, list]:
+    """
+    Replace the values of a column by integer codes, in order of first appearance
+    """
+    index = {}
+    codes = np.fromiter(
+        (index.setdefault(value, len(index)) for value in column), dtype=np.int32, count=len(column)
+    )
+    return codes, list(index)
+
+
+def typed_features_to_np(
+    features: list[list] | np.ndarray,
+    column_dtypes: list[str],
+    encode_categories: Optional[Callable[[int, list], tuple[np.ndarray, list]]] = None,
+) -> tuple[np.ndarray, dict[int, list]]:
+    """
+    Materialise 2D features into one contiguous array, typed by the declared dtype of each
+    column rather than inferred from the values (which gives an object array for mixed columns).
+    Categorical columns are replaced by integer codes, so that the array stays numeric.
+
+    :param features: list[list] | np.ndarray - rows of feature values
+    :param column_dtypes: list[str] - dtype of each column, e.g. "float32", "int64" or "category"
+    :param encode_categories: Optional[Callable] - given a categorical column's index and its
+        categories in this array, returns the code of each category and every category by code,
+        e.g. to give categories the same codes in every batch of a job. By default, categories
+        are numbered in order of first appearance in this array.
+    :return: tuple[np.ndarray, dict[int, list]] - the array, and the categories of each
+        categorical column by column index, which its codes index into
+    """
+    categorical = [i for i, dtype in enumerate(column_dtypes) if dtype == CATEGORY_DTYPE]
+    dtypes = [np.dtype(dtype) for dtype in column_dtypes if dtype != CATEGORY_DTYPE]
+    dtype = np.result_type(*dtypes) if dtypes else np.dtype(np.int32)
+    if categorical:
+        # Codes are held exactly by float32 and wider, so only widen to fit them if needed
+        dtype = np.result_type(dtype, np.float32 if dtype.kind == "f" else np.int32)
+
+    if not categorical:
+        # Converted once, straight into the target dtype
+        array = np.asarray(features, dtype=dtype, order="C")
+        if array.ndim != 2 or array.shape[1] != len(column_dtypes):
+            raise ValueError(
+                f"Expected {len(column_dtypes)} feature columns, got array of shape {array.shape}"
+            )
+        return array, {}
+
+    values = np.asarray(features, dtype=object)
+    if values.ndim != 2 or values.shape[1] != len(column_dtypes):
+        raise ValueError(
+            f"Expected {len(column_dtypes)} feature columns, got array of shape {values.shape}"
+        )
+    array = np.empty(values.shape, dtype=dtype)
+    categories = {}
+    for column in range(values.shape[1]):
+        if column in categorical:
+            codes, categories[column] = _factorize(values[:, column])
+            if encode_categories is not None:
+                category_codes, categories[column] = encode_categories(column, categories[column])
+                codes = np.asarray(category_codes)[codes]
+            array[:, column] = codes
+        else:
+            array[:, column] = values[:, column].astype(column_dtypes[column])
+    return array, categories
+
+
+def decode_categories(features: np.ndarray, categories: dict[int, list]) -> np.ndarray:
+    """
+    Replace the codes of categorical columns by their categories, e.g. to send features to a
+    model. Codes which are no longer integers (e.g. after perturbation) map to the nearest category.
+
+    :param features: np.ndarray - 2D array of features, as given by typed_features_to_np
+    :param categories: dict[int, list] - categories of each categorical column by column index
+    :return: np.ndarray - the features with their original values
+    """
+    if not categories:
+        return features
+    decoded = np.asarray(features).astype(object)
+    for column, values in categories.items():
+        codes = np.clip(np.rint(decoded[:, column].astype(float)).astype(int), 0, len(values) - 1)
+        decoded[:, column] = np.asarray(values, dtype=object)[codes]
+    return decoded
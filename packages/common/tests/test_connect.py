@@ -1,11 +1,16 @@
 import redis
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import pika
 import pika.exceptions
 from pika.adapters.blocking_connection import BlockingChannel
-from common.rabbitmq.connect import connect_to_rabbitmq, init_queues, publish_to_queue
-from common.redis.connect import connect_to_redis
+from common.rabbitmq.connect import (
+    connect_to_rabbitmq,
+    init_queues,
+    publish_to_queue,
+    publish_many_to_queue,
+)
+from common.redis.connect import connect_to_redis, connect_to_redis_async
 
 # Tests created with copilot
 
@@ -87,6 +92,31 @@ def test_connect_to_redis_exhaust_retries(mock_sleep, mock_redis_from_url):
     assert mock_sleep.call_count == 10
 
 
+@patch("common.redis.connect.redis.asyncio.Redis.from_url")
+@patch("common.redis.connect.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_connect_to_redis_async_retries_until_connected(mock_sleep, mock_redis_from_url):
+    mock_redis_client = MagicMock()
+    mock_redis_client.ping = AsyncMock(side_effect=[redis.ConnectionError, True])
+    mock_redis_from_url.return_value = mock_redis_client
+
+    redis_client = await connect_to_redis_async(url="redis://localhost", retries=3, decode_responses=True)
+    assert redis_client is mock_redis_client
+    mock_redis_from_url.assert_called_with("redis://localhost", decode_responses=True)
+    assert mock_redis_client.ping.call_count == 2
+    assert mock_sleep.call_count == 1
+
+
+@patch("common.redis.connect.redis.asyncio.Redis.from_url", side_effect=redis.ConnectionError)
+@patch("common.redis.connect.asyncio.sleep", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_connect_to_redis_async_exhaust_retries(mock_sleep, mock_redis_from_url):
+    with pytest.raises(Exception, match="Could not connect to Redis after 3 attempts."):
+        await connect_to_redis_async(url="redis://localhost", retries=3)
+    assert mock_redis_from_url.call_count == 3
+    assert mock_sleep.call_count == 3
+
+
 @patch("common.rabbitmq.connect.connect_to_rabbitmq")
 def test_publish_to_channel_success(mock_connect_to_rabbitmq):
     """Test successful message publishing"""
@@ -96,7 +126,7 @@ def test_publish_to_channel_success(mock_connect_to_rabbitmq):
         publish_to_queue(mock_channel, "test_queue", "test_message")
 
     mock_basic_publish.assert_called_once_with(
-        exchange="", routing_key="test_queue", body="test_message"
+        exchange="", routing_key="test_queue", body="test_message", properties=None
     )
 
 
@@ -117,9 +147,38 @@ def test_publish_to_channel_reconnect(mock_connect_to_rabbitmq):
 
         # First attempt failed, so it should retry
         mock_basic_publish.assert_called_once_with(
-            exchange="", routing_key="test_queue", body="test_message"
+            exchange="", routing_key="test_queue", body="test_message", properties=None
         )
         mock_connect_to_rabbitmq.assert_called_once()
         mock_new_basic_publish.assert_called_once_with(
-            exchange="", routing_key="test_queue", body="test_message"
+            exchange="", routing_key="test_queue", body="test_message", properties=None
         )
+
+
+@patch("common.rabbitmq.connect.connect_to_rabbitmq")
+def test_publish_many_to_queue_publishes_all_messages(mock_connect_to_rabbitmq):
+    """Test that every message is published in order on the same channel"""
+    mock_channel = MagicMock(spec=BlockingChannel)
+
+    with patch.object(mock_channel, "basic_publish") as mock_basic_publish:
+        channel = publish_many_to_queue(mock_channel, "test_queue", ["a", "b", "c"])
+
+    assert channel is mock_channel
+    assert [call.kwargs["body"] for call in mock_basic_publish.call_args_list] == ["a", "b", "c"]
+    mock_connect_to_rabbitmq.assert_not_called()
+
+
+@patch("common.rabbitmq.connect.connect_to_rabbitmq")
+def test_publish_many_to_queue_reconnects_and_publishes_remaining(mock_connect_to_rabbitmq):
+    """Test that only the messages not yet published are published after reconnecting"""
+    mock_channel = MagicMock(spec=BlockingChannel)
+    mock_new_channel = MagicMock(spec=BlockingChannel)
+    mock_connect_to_rabbitmq.return_value.channel.return_value = mock_new_channel
+
+    with patch.object(
+        mock_channel, "basic_publish", side_effect=[None, pika.exceptions.AMQPConnectionError]
+    ), patch.object(mock_new_channel, "basic_publish") as mock_new_basic_publish:
+        channel = publish_many_to_queue(mock_channel, "test_queue", ["a", "b", "c"])
+
+    assert channel is mock_new_channel
+    assert [call.kwargs["body"] for call in mock_new_basic_publish.call_args_list] == ["b", "c"]
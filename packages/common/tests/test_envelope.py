@@ -0,0 +1,80 @@
+import pika
+import pytest
+from common.models.envelope import (
+    ENVELOPE_VERSION_HEADER,
+    JSON_CONTENT_TYPE,
+    MSGPACK_CONTENT_TYPE,
+    ZSTD_CONTENT_ENCODING,
+    MessageDecodeError,
+    decode_message,
+    encode_message,
+)
+from common.models.pipeline import JobStatus, JobStatusMessage
+
+
+@pytest.fixture
+def message():
+    return JobStatusMessage(
+        job_id="1234", batch_id="ABCD", status=JobStatus.ERRORED, errorMessage="x" * 200
+    )
+
+
+def test_json_encoding_is_readable_without_properties(message):
+    body, properties = encode_message(message, codec="json")
+    assert properties.content_type == JSON_CONTENT_TYPE
+    assert properties.content_encoding is None
+    assert body == message.model_dump_json().encode()
+    # Consumers which ignore the properties still read JSON
+    assert JobStatusMessage.model_validate_json(body) == message
+    assert decode_message(JobStatusMessage, body) == message
+
+
+@pytest.mark.parametrize("compression_threshold", [0, 1 << 20])
+def test_msgpack_round_trips(message, compression_threshold):
+    body, properties = encode_message(
+        message, codec="msgpack", compression_threshold=compression_threshold
+    )
+    assert properties.content_type == MSGPACK_CONTENT_TYPE
+    assert properties.headers == {ENVELOPE_VERSION_HEADER: 1}
+    if compression_threshold == 0:
+        assert properties.content_encoding == ZSTD_CONTENT_ENCODING
+    else:
+        assert properties.content_encoding is None
+    assert decode_message(JobStatusMessage, body, properties) == message
+
+
+def test_msgpack_is_more_compact_than_json(message):
+    json_body, _ = encode_message(message, codec="json")
+    msgpack_body, _ = encode_message(message, codec="msgpack", compression_threshold=0)
+    assert len(msgpack_body) < len(json_body)
+
+
+def test_plain_json_messages_are_decoded(message):
+    assert decode_message(JobStatusMessage, message.model_dump_json()) == message
+    assert decode_message(
+        JobStatusMessage, message.model_dump_json(), pika.BasicProperties()
+    ) == message
+
+
+def test_unsupported_encoding_is_rejected(message):
+    with pytest.raises(ValueError):
+        encode_message(message, codec="xml")
+    with pytest.raises(MessageDecodeError):
+        decode_message(JobStatusMessage, b"<xml/>", pika.BasicProperties(content_type="application/xml"))
+    with pytest.raises(MessageDecodeError):
+        decode_message(
+            JobStatusMessage,
+            message.model_dump_json(),
+            pika.BasicProperties(headers={ENVELOPE_VERSION_HEADER: 2}),
+        )
+
+
+def test_invalid_messages_raise_value_error():
+    with pytest.raises(ValueError):
+        decode_message(JobStatusMessage, "jinvalidjsonkdqw{}}")
+    with pytest.raises(ValueError):
+        decode_message(
+            JobStatusMessage,
+            b"\xc1",
+            pika.BasicProperties(content_type=MSGPACK_CONTENT_TYPE),
+        )
@@ -0,0 +1,73 @@
+import io
+import numpy as np
+import pytest
+from common.models import DatasetResponse, ModelResponse
+from common.models.npz import NPZ_ACCEPT, NPZ_CONTENT_TYPE, decode_npz, encode_npz, is_npz
+
+
+def test_dataset_round_trips_as_arrays():
+    dataset = DatasetResponse(
+        features=[[1.5, 2.0], [3.0, 4.5]], labels=[[True], [False]], group_ids=[0, 1]
+    )
+    decoded = decode_npz(DatasetResponse, encode_npz(dataset))
+
+    assert isinstance(decoded.features, np.ndarray)
+    np.testing.assert_array_equal(decoded.features, dataset.features)
+    np.testing.assert_array_equal(decoded.labels, dataset.labels)
+    assert decoded.labels.dtype == np.bool_
+    np.testing.assert_array_equal(decoded.group_ids, dataset.group_ids)
+
+
+def test_arrays_are_read_as_views_of_the_body():
+    body = encode_npz(ModelResponse(predictions=np.arange(6).reshape(3, 2), confidence_scores=[[0.5]] * 3))
+    decoded = decode_npz(ModelResponse, body)
+
+    assert np.shares_memory(decoded.predictions, np.frombuffer(body, dtype=np.uint8))
+    assert not decoded.predictions.flags.writeable
+    np.testing.assert_array_equal(decoded.predictions, [[0, 1], [2, 3], [4, 5]])
+    np.testing.assert_array_equal(decoded.confidence_scores, [[0.5]] * 3)
+
+
+@pytest.mark.parametrize("save", [np.savez, np.savez_compressed])
+def test_archives_from_other_writers_are_decoded(save):
+    features = np.asfortranarray(np.arange(6, dtype=np.float32).reshape(2, 3))
+    buffer = io.BytesIO()
+    save(buffer, features=features, labels=np.array([["a"], ["b"]]), group_ids=np.array([0, 1]))
+    decoded = decode_npz(DatasetResponse, buffer.getvalue())
+
+    np.testing.assert_array_equal(decoded.features, features)
+    np.testing.assert_array_equal(decoded.labels, [["a"], ["b"]])
+
+
+def test_missing_fields_are_omitted():
+    response = ModelResponse(predictions=np.array([["a"], ["b"]]))
+    decoded = decode_npz(ModelResponse, encode_npz(response))
+    np.testing.assert_array_equal(decoded.predictions, [["a"], ["b"]])
+    assert decoded.confidence_scores is None
+
+
+def test_array_models_serialise_to_lists():
+    response = ModelResponse(predictions=np.array([[1], [0]]), confidence_scores=np.array([[0.2], [0.9]]))
+    assert response.model_dump() == {"predictions": [[1], [0]], "confidence_scores": [[0.2], [0.9]]}
+    assert ModelResponse.model_validate_json(response.model_dump_json()).predictions == [[1], [0]]
+
+
+def test_arrays_must_have_expected_dimensions():
+    with pytest.raises(ValueError):
+        DatasetResponse(features=np.array([1, 2]), labels=[[0], [1]], group_ids=None)
+    with pytest.raises(ValueError):
+        DatasetResponse(features=[[1], [2]], labels=[[0], [1]], group_ids=np.array([[0], [1]]))
+
+
+def test_values_only_representable_in_json_are_rejected():
+    with pytest.raises(ValueError):
+        encode_npz(DatasetResponse(features=[[1, None]], labels=[[0]], group_ids=[0]))
+    with pytest.raises(ValueError):
+        decode_npz(DatasetResponse, b"not an archive")
+
+
+def test_is_npz():
+    assert is_npz(NPZ_CONTENT_TYPE)
+    assert is_npz(NPZ_ACCEPT)
+    assert not is_npz("application/json")
+    assert not is_npz(None)
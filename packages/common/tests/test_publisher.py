@@ -1,49 +1,183 @@
+import threading
 import pytest
-from unittest.mock import patch
-from common.rabbitmq.publisher import Publisher
+import pika.spec
+from unittest.mock import MagicMock
+from common.rabbitmq.publisher import (
+    Publisher,
+    PublishNackedException,
+    PublisherStoppedException,
+    PublishTimeoutException,
+)
 
 
 @pytest.fixture
 def publisher():
-    with patch("common.rabbitmq.publisher.connect_to_rabbitmq"):
-        return Publisher(queue="test_queue")
+    return Publisher(queue="test_queue")
+
+
+def ready(publisher: Publisher, window: int = None) -> Publisher:
+    """Give the publisher an open connection and channel without a broker"""
+    if window is not None:
+        publisher._window = threading.BoundedSemaphore(window)
+    publisher.connection = MagicMock()
+    publisher.channel = MagicMock()
+    publisher.channel.is_open = True
+    publisher._ready.set()
+    return publisher
+
+
+def confirmation(method, delivery_tag: int, multiple: bool = False):
+    return MagicMock(method=method(delivery_tag=delivery_tag, multiple=multiple))
 
 
 def test_publisher_initialization(publisher):
     assert publisher.queue == "test_queue"
+    assert publisher.queues == ["test_queue"]
     assert publisher.name == "Publisher"
     assert publisher.is_running is True
 
 
-def test_publisher_publish(publisher):
-    with patch.object(publisher, "channel") as mock_channel:
-        publisher._publish("test message")
-        mock_channel.basic_publish.assert_called_once_with(
-            "", "test_queue", body=b"test message"
-        )
-        # And check we add _publish to the connection
-        publisher.publish("test message")
-        publisher.connection.add_callback_threadsafe.assert_called_once()
+def test_publisher_declares_every_queue():
+    publisher = Publisher(queue="a", queues=["b", "a", "c"])
+    assert publisher.queues == ["a", "b", "c"]
+
+
+def test_publisher_publish_is_handed_to_connection_thread(publisher):
+    ready(publisher)
+    future = publisher.publish("test message")
+
+    # Nothing is published until the connection thread flushes the buffer
+    publisher.channel.basic_publish.assert_not_called()
+    publisher.connection.ioloop.add_callback_threadsafe.assert_called_once_with(publisher._flush)
+    assert not future.done()
+
+    publisher._flush()
+    publisher.channel.basic_publish.assert_called_once_with(
+        exchange="", routing_key="test_queue", body=b"test message", properties=None
+    )
+
+
+def test_publisher_buffers_messages_until_ready(publisher):
+    properties = pika.BasicProperties(content_type="application/json")
+    future = publisher.publish("test message", queue="other_queue", properties=properties)
+    assert not future.done()
+    assert len(publisher._buffer) == 1
+
+    ready(publisher)
+    publisher._on_ready()
+    publisher.channel.basic_publish.assert_called_once_with(
+        exchange="", routing_key="other_queue", body=b"test message", properties=properties
+    )
+
+
+def test_publisher_completes_futures_on_confirms(publisher):
+    ready(publisher)
+    futures = [publisher.publish(f"message {i}") for i in range(3)]
+    publisher._flush()
+
+    publisher._on_delivery_confirmation(confirmation(pika.spec.Basic.Ack, 2, multiple=True))
+    assert futures[0].result() is True
+    assert futures[1].result() is True
+    assert not futures[2].done()
+
+    publisher._on_delivery_confirmation(confirmation(pika.spec.Basic.Nack, 3))
+    with pytest.raises(PublishNackedException):
+        futures[2].result()
+    assert publisher.wait_for_confirms(timeout=0)
+
+
+def test_publisher_blocks_when_confirm_window_full(publisher):
+    ready(publisher, window=1)
+    publisher.publish("first")
+    publisher._flush()
+
+    second_published = threading.Event()
+
+    def publish_second():
+        publisher.publish("second")
+        second_published.set()
+
+    thread = threading.Thread(target=publish_second)
+    thread.start()
+    assert not second_published.wait(timeout=0.2)
+
+    # Confirming the first message makes room for the second
+    publisher._on_delivery_confirmation(confirmation(pika.spec.Basic.Ack, 1))
+    assert second_published.wait(timeout=1)
+    thread.join()
+
+
+def test_publisher_fails_message_when_confirm_window_stays_full():
+    publisher = ready(Publisher(queue="test_queue", publish_timeout=0.05), window=1)
+    publisher.publish("first")
+
+    with pytest.raises(PublishTimeoutException):
+        publisher.publish("second").result(timeout=1)
+    assert len(publisher._buffer) == 1
+
+
+def test_publisher_never_blocks_its_own_thread(publisher):
+    ready(publisher, window=1)
+    publisher.publish("first")
+    futures = []
+    # e.g. publishing from a done callback of a message's future, run by the publisher's thread
+    publisher.run = lambda: futures.append(publisher.publish("second"))
+    publisher.start()
+    publisher.join(timeout=1)
+
+    assert not publisher.is_alive()
+    with pytest.raises(PublishTimeoutException):
+        futures[0].result()
+
+
+def test_publisher_fails_message_when_stopped_while_publishing(publisher):
+    ready(publisher)
+    acquire = publisher._window.acquire
+
+    def stop_while_acquiring(*args, **kwargs):
+        # run() stops between the is_running check and the message being buffered
+        publisher.is_running = False
+        return acquire(*args, **kwargs)
+
+    publisher._window.acquire = stop_while_acquiring
+    with pytest.raises(PublisherStoppedException):
+        publisher.publish("too late").result(timeout=1)
+    assert not publisher._buffer
+
+
+def test_publisher_republishes_unconfirmed_messages_after_reconnect(publisher):
+    ready(publisher)
+    futures = [publisher.publish(f"message {i}") for i in range(2)]
+    publisher._flush()
+    publisher.publish("message 2")
+
+    publisher._on_connection_closed(publisher.connection, Exception("Connection lost"))
+    assert [body for _, body, _, _ in publisher._buffer] == [b"message 0", b"message 1", b"message 2"]
+    assert not futures[0].done()
+
+    # Delivery tags restart on the new channel
+    ready(publisher)
+    publisher._delivery_tag = 0
+    publisher._flush()
+    publisher._on_delivery_confirmation(confirmation(pika.spec.Basic.Ack, 3, multiple=True))
+    assert all(future.result() for future in futures)
 
 
 def test_publisher_stop(publisher):
-    with patch.object(publisher.connection, "close") as mock_close:
-        publisher.stop()
-        assert publisher.is_running is False
-        mock_close.assert_called_once()
-
-
-def test_publisher_tick(publisher):
-    with patch.object(publisher.connection, "process_data_events") as mock_process:
-        publisher.on_tick()
-        mock_process.assert_called()
-
-
-def test_publisher_run(publisher):
-    # Make on_tick immediately throw an exception, expect that to happen and check it was called
-    with patch(
-        "common.rabbitmq.publisher.Publisher.on_tick", side_effect=Exception
-    ) as mock_on_tick:
-        with pytest.raises(Exception):
-            publisher.run()
-        mock_on_tick.assert_called()
+    ready(publisher)
+    publisher.stop()
+    assert publisher.is_running is False
+
+    publisher.connection.ioloop.add_callback_threadsafe.assert_called_once_with(publisher._close)
+    publisher._close()
+    publisher.connection.close.assert_called_once()
+
+    with pytest.raises(PublisherStoppedException):
+        publisher.publish("too late").result()
+
+
+def test_publisher_fails_outstanding_messages_when_stopped(publisher):
+    future = publisher.publish("never sent")
+    publisher._fail_outstanding(PublisherStoppedException("stopped"))
+    with pytest.raises(PublisherStoppedException):
+        future.result()
@@ -1,4 +1,4 @@
-from dispatcher.utils import redis_key
+from common.redis.keys import redis_key
 
 
 def test_redis_key_gives_expected_format():
@@ -1,5 +1,11 @@
 import numpy as np
-from common.utils import nested_list_to_np
+import pytest
+from common.utils import (
+    decode_categories,
+    nested_list_to_np,
+    typed_features_to_np,
+    validate_column_dtypes,
+)
 
 
 def test_nested_list_to_np_with_nested_list():
@@ -21,3 +27,58 @@ def test_nested_list_to_np_with_none():
     expected_output = None
     result = nested_list_to_np(input_value)
     assert result == expected_output
+
+
+def test_typed_features_to_np_uses_declared_dtypes():
+    features, categories = typed_features_to_np([[1, 2.5], [3, 4.0]], ["float32", "float32"])
+    assert features.dtype == np.float32
+    assert features.flags["C_CONTIGUOUS"]
+    assert np.array_equal(features, [[1, 2.5], [3, 4.0]])
+    assert categories == {}
+
+
+def test_typed_features_to_np_encodes_categorical_columns():
+    rows = [[1.5, "red", 3], [2.5, "blue", 4], [3.5, "red", 5]]
+    features, categories = typed_features_to_np(rows, ["float32", "category", "int64"])
+
+    # Mixed columns give one numeric array rather than an object array
+    assert features.dtype == np.float64
+    assert np.array_equal(features[:, 1], [0, 1, 0])
+    assert categories == {1: ["red", "blue"]}
+    assert decode_categories(features, categories).tolist() == [
+        [1.5, "red", 3], [2.5, "blue", 4], [3.5, "red", 5]
+    ]
+
+
+def test_typed_features_to_np_uses_given_category_codes():
+    job_categories = ["blue", "green", "red"]
+
+    def encode_categories(column, categories):
+        assert column == 1
+        return [job_categories.index(category) for category in categories], job_categories
+
+    features, categories = typed_features_to_np(
+        [[1.5, "red"], [2.5, "blue"], [3.5, "red"]], ["float32", "category"], encode_categories
+    )
+    assert np.array_equal(features[:, 1], [2, 0, 2])
+    assert categories == {1: job_categories}
+
+
+def test_decode_categories_maps_perturbed_codes_to_nearest_category():
+    features = np.array([[0.1, 1.0], [1.4, 2.0], [7.0, 3.0]])
+    decoded = decode_categories(features, {0: ["a", "b"]})
+    assert decoded[:, 0].tolist() == ["a", "b", "b"]
+    assert decode_categories(features, {}) is features
+
+
+def test_typed_features_to_np_rejects_wrong_number_of_columns():
+    with pytest.raises(ValueError):
+        typed_features_to_np([[1, 2, 3]], ["float32", "float32"])
+    with pytest.raises(ValueError):
+        typed_features_to_np([[1, "a", 3]], ["float32", "category"])
+
+
+def test_validate_column_dtypes():
+    assert validate_column_dtypes(["float32", "int64", "bool", "category"])
+    with pytest.raises(ValueError):
+        validate_column_dtypes(["float32", "not-a-dtype"])
@@ -11,6 +11,8 @@ from worker.worker import RABBIT_MQ_HOST
 import redis as redis
 
 from common.rabbitmq.connect import connect_to_rabbitmq
+from common.rabbitmq.constants import BATCH_QUEUE
+from common.rabbitmq.publisher import Publisher
 from dispatcher.logging.configure_logging import configure_logging
 
 logger = logging.getLogger("dispatcher")
@@ -58,8 +60,15 @@ def main():
     """Main entry point"""
     logger.warning("Starting dispatcher...")
     connection, redis = startup()
-    dispatcher = Dispatcher(connection, redis)
-    dispatcher.run()
+    # Batches are published from their own connection, with confirms handled asynchronously
+    publisher = Publisher(queue=BATCH_QUEUE, name="DispatcherPublisher", host=RABBIT_MQ_HOST)
+    publisher.start()
+    dispatcher = Dispatcher(connection, redis, publisher)
+    try:
+        dispatcher.run()
+    finally:
+        publisher.stop()
+        publisher.join()
 
 
 atexit.register(cleanup)
@@ -1,5 +1,5 @@
-import json
 import logging
+from concurrent.futures import Future
 from typing import Optional
 import uuid
 
@@ -11,13 +11,16 @@ from common.models.pipeline import (
     JobFromAPI,
     PipelineJobType,
 )
+from common.models.envelope import decode_message, encode_message
 from common.rabbitmq.constants import BATCH_QUEUE, JOB_QUEUE, STATUS_QUEUE
-from common.rabbitmq.connect import publish_to_queue
+from common.rabbitmq.connect import publish_to_queue, publish_many_to_queue
+from common.rabbitmq.publisher import Publisher
 from dispatcher.models import RunningJob
-from dispatcher.utils import redis_key
+from common.redis.keys import redis_key
+from dispatcher import redis_scripts
 from worker.worker import WorkerException
 
-from pika import BlockingConnection
+from pika import BasicProperties, BlockingConnection
 from pika.adapters.blocking_connection import BlockingChannel
 import redis as redis
 
@@ -44,12 +47,22 @@ class Dispatcher:
     _connection: BlockingConnection
     _redis_client: redis.Redis
     _channel: BlockingChannel
+    _publisher: Optional[Publisher]
 
-    def __init__(self, connection, redis_client):
+    def __init__(self, connection, redis_client, publisher: Optional[Publisher] = None):
         self._connection = connection
         self._redis_client = redis_client
+        # Batches are published with asynchronous confirms when given a publisher,
+        # otherwise on the consuming channel
+        self._publisher = publisher
         self._channel = self._connection.channel()
         init_queues(self._channel)
+        # Job state is updated by atomic scripts so that several dispatchers can run at once
+        self._reserve_batches = self._redis_client.register_script(redis_scripts.RESERVE_BATCHES)
+        self._record_batch_result = self._redis_client.register_script(
+            redis_scripts.RECORD_BATCH_RESULT
+        )
+        self._cancel_job = self._redis_client.register_script(redis_scripts.CANCEL_JOB)
         logger.info("Dispatcher initialized.")
 
     def propogate_error(self, job_id: Optional[str], e: Exception):
@@ -75,13 +88,13 @@ class Dispatcher:
         """
         Function to fetch a job from the job queue
         """
-        method_frame, _, body = self._channel.basic_get(queue=JOB_QUEUE, auto_ack=True)
+        method_frame, properties, body = self._channel.basic_get(queue=JOB_QUEUE, auto_ack=True)
         if method_frame:
             try:
-                job_data = json.loads(body)
-                logger.info(f"Received job: {job_data}")
                 logger.debug("Unpacking job data")
-                return JobFromAPI(**job_data)
+                job = decode_message(JobFromAPI, body, properties)
+                logger.info(f"Received job: {job}")
+                return job
             except ValueError as e:
                 self.handle_job_unpack_error(e)
         return None
@@ -92,73 +105,80 @@ class Dispatcher:
         """Dispatch a single batch for the given job id"""
         try:
             logger.info(f"Dispatching batch for job {job_id}")
-            self._channel = publish_to_queue(
-                self._channel, BATCH_QUEUE, job_data.model_dump_json()
-            )
+            body, properties = encode_message(job_data)
+            if self._publisher is not None:
+                self._publish_confirmed(job_id, body, properties)
+            else:
+                self._channel = publish_to_queue(self._channel, BATCH_QUEUE, body, properties)
             logger.info(f"Batch dispatched for job {job_id}")
         except Exception as e:
             self.propogate_error(job_id, e)
             # raise DispatcherException(f"Error dispatching batch: {e}")
 
+    def dispatch_batches(self, job_id: str, batches: list[Batch]):
+        """Dispatch several batches for the given job id in one publish burst"""
+        try:
+            logger.info(f"Dispatching {len(batches)} batches for job {job_id}")
+            bodies, properties = zip(*(encode_message(batch) for batch in batches))
+            if self._publisher is not None:
+                for body, batch_properties in zip(bodies, properties):
+                    self._publish_confirmed(job_id, body, batch_properties)
+            else:
+                self._channel = publish_many_to_queue(
+                    self._channel, BATCH_QUEUE, list(bodies), list(properties)
+                )
+            logger.info(f"{len(batches)} batches dispatched for job {job_id}")
+        except Exception as e:
+            self.propogate_error(job_id, e)
+
+    def _publish_confirmed(self, job_id: str, body: bytes, properties: BasicProperties):
+        """Publish a batch without waiting for the broker, reporting it if the broker rejects it"""
+        def on_confirmed(future: Future):
+            if future.exception() is not None:
+                self.propogate_error(job_id, future.exception())
+
+        self._publisher.publish(body, BATCH_QUEUE, properties).add_done_callback(on_confirmed)
+
     def dispatch_as_required(self, job_id: str):
         """Given a job id, lookup currently running jobs and dispatch until pending batches == max batches"""
         logger.info(f"Dispatching as required for job {job_id}")
-        # Get the running job
-        running_job = self.get_job(job_id)
-        if not running_job:
+        # Reserve as many batches as we can run, atomically, so that other dispatchers
+        # handling the same job do not dispatch the same batches
+        reservation = self._reserve_batches(
+            keys=[self._get_job_redis_key(job_id)],
+            args=[JobStatus.CANCELLED.value, JobStatus.RUNNING.value],
+        )
+        if not reservation:
             logger.error(f"Job {job_id} not found in Redis!")
             # TODO: Handle error finding jon
             self.propogate_error(job_id, ValueError("Job not found in Redis!"))
             logger.warning(f"This error for {job_id} is unhandled!")
             return
 
-        logger.debug(f"Running job: {running_job}")
-
-        # Stop dispatching if the job is cancelled
-        if running_job.job_data == JobStatus.CANCELLED:
-            logger.info(f"Job {job_id} has been CANCELLED. No batches will be dispatched.")
-            return
-
-        # How many batches can we run?
-        left_batches = running_job.pending_batches
-        if left_batches == 0:
+        batches_to_dispatch, pending, running, completed, errored, job_data = reservation
+        if batches_to_dispatch == 0:
             logger.info(
-                f"No batches left to run for job {job_id}. All batches complete={running_job.completed_batches}, errored={running_job.errored_batches}, pending={running_job.currently_running_batches}"  # noqa
+                f"No batches to dispatch for job {job_id} (cancelled, finished or at max concurrency). complete={completed}, errored={errored}, pending={pending}, running={running}"  # noqa
             )
             return
 
-        # If we can run more batches, do so
-        # We can dispatch up to (no. batches we can run - batches currently running), but if we have fewer than
-        # that batches left, dispatch that
-        batches_to_dispatch = min(
-            max(
-                running_job.job_data.max_concurrent_batches
-                - running_job.currently_running_batches,
-                0,
-            ),
-            left_batches,
-        )
-        logger.info(f"Dispatching {batches_to_dispatch} new batches for job {job_id}")
-        for i in range(batches_to_dispatch):
-            logger.debug(f"Dispatching batch {i+1} for job {job_id}")
-            batch = Batch(
+        # Build every batch up front, then publish them together
+        job = PipelineJob.model_validate_json(job_data)
+        batches = [
+            Batch(
                 job_id=job_id,
                 batch_id=str(uuid.uuid4()),
-                batch_size=running_job.job_data.batch_size,
-                metrics=running_job.job_data.metrics,
-                total_sample_size=running_job.job_data.total_sample_size,
-            )
-            self.dispatch_batch(job_id, batch)
-            logger.debug(f"Updating Redis for job {job_id}")
-            running_job.currently_running_batches += 1
-            running_job.pending_batches = max(0, running_job.pending_batches - 1)
-            running_job.status = JobStatus.RUNNING
-            self.update_job(job_id, running_job)
-            logger.info(
-                f"Updated running job in Redis for job {job_id}, pending={running_job.pending_batches}, running={running_job.currently_running_batches}, completed={running_job.completed_batches}, errored={running_job.errored_batches}"  # noqa
+                batch_size=job.batch_size,
+                metrics=job.metrics,
+                total_sample_size=job.total_sample_size,
             )
+            for _ in range(batches_to_dispatch)
+        ]
+        self.dispatch_batches(job_id, batches)
 
-        logger.info(f"Dispatched {batches_to_dispatch} new batches for job {job_id}.")
+        logger.info(
+            f"Dispatched {batches_to_dispatch} new batches for job {job_id}, pending={pending}, running={running}, completed={completed}, errored={errored}"  # noqa
+        )
 
     def process_new_job(self, job: PipelineJob):
         """Called when a new job is received to setup the job in redis and start processing"""
@@ -182,26 +202,14 @@ class Dispatcher:
     def handle_job_completion(self, msg: JobStatusMessage):
         """Handle a job completion message"""
         logger.info(f"Handling job completion: {msg}")
-        # Get the running job
-        running_job = self.get_job(msg.job_id)
-        if running_job is None:
-            logger.error(f"Job {msg.job_id} not found in Redis!")
-            logger.warning(f"This error for {msg.job_id} is unhandled!")
-            # TODO: Handle error
-            return
         # Success or error?
         match msg.status:
             case JobStatus.COMPLETED:
-                running_job.completed_batches += 1
-                running_job.currently_running_batches -= 1
+                counter = "completed_batches"
                 logger.info(f"Batch {msg.batch_id} completed!")
-                # Update
-                self.update_job(msg.job_id, running_job)
-                # Dispatch more if required
 
             case JobStatus.ERRORED:
-                running_job.errored_batches += 1
-                running_job.currently_running_batches -= 1
+                counter = "errored_batches"
                 logger.error(f"Error in batch {msg.batch_id}: {msg.errorMessage}!")
                 self.propogate_error(
                     msg.job_id,
@@ -216,52 +224,73 @@ class Dispatcher:
                 logger.warning(
                     f"Error in batch {msg.batch_id} is unhandled! Job will not be dispatched."
                 )
-                # Update
-                self.update_job(msg.job_id, running_job)
 
-        # If no more pending batches, and none in progress, job is complete
-        if (
-            running_job.pending_batches == 0
-            and running_job.currently_running_batches == 0
-        ):
+            case _:
+                logger.warning(f"Unexpected status {msg.status} for batch {msg.batch_id}")
+                self.dispatch_as_required(msg.job_id)
+                return
+
+        # Update the counters, deleting the job if no more pending batches and none in progress
+        result = self._record_batch_result(
+            keys=[self._get_job_redis_key(msg.job_id), self._get_recorded_batches_redis_key(msg.job_id)],
+            args=[counter, msg.batch_id],
+        )
+        if result is None:
+            logger.error(f"Job {msg.job_id} not found in Redis!")
+            logger.warning(f"This error for {msg.job_id} is unhandled!")
+            # TODO: Handle error
+            return
+
+        recorded, finished, pending, running, completed, errored = result
+        if not recorded:
+            logger.info(f"Batch {msg.batch_id} of job {msg.job_id} was already recorded, ignoring it")
+            return
+        if finished:
             logger.info(
-                f"Job {msg.job_id} is complete! Finished with {running_job.errored_batches} errored batches, {running_job.completed_batches} completed batches"  # noqa
+                f"Job {msg.job_id} is complete! Finished with {errored} errored batches, {completed} completed batches"  # noqa
             )
-            # Delete key
-            self._redis_client.delete(self._get_job_redis_key(msg.job_id))
             logger.info(f"Job {msg.job_id} marked as complete & deleted")
             logger.warning(
                 f"Job {msg.job_id} is complete but this is unhandled! Errored batches are not reported"
             )
         else:
-            logger.info(f"Dispatching more batches for job {msg.job_id}...")
+            logger.info(
+                f"Dispatching more batches for job {msg.job_id} (pending={pending}, running={running})..."
+            )
             self.dispatch_as_required(msg.job_id)
 
     def _get_job_redis_key(self, job_id: str) -> str:
         """Return the key to reference a job in redis"""
         return redis_key("jobs", job_id)
 
+    def _get_recorded_batches_redis_key(self, job_id: str) -> str:
+        """Return the key of the set of a job's batches whose status has been recorded"""
+        return redis_key("job_batches", job_id)
+
     def update_job(self, job_id: str, running_job: RunningJob, ttl: Optional[int] = None):
-        """Update a job in redis"""
-        self._redis_client.set(
-            self._get_job_redis_key(job_id), running_job.model_dump_json(), ex=ttl
-        )
+        """Store the whole of a job in redis, replacing any existing state"""
+        key = self._get_job_redis_key(job_id)
+        pipeline = self._redis_client.pipeline(transaction=True)
+        pipeline.delete(key)
+        pipeline.hset(key, mapping=running_job.to_redis_hash())
+        if ttl is not None:
+            pipeline.expire(key, ttl)
+        pipeline.execute()
 
     def get_job(self, job_id: str) -> RunningJob | None:
         """Get a job from redis"""
-        job = self._redis_client.get(self._get_job_redis_key(job_id))
+        job = self._redis_client.hgetall(self._get_job_redis_key(job_id))
         if job:
-            return RunningJob(**json.loads(job))
+            return RunningJob.from_redis_hash(job)
         return None
 
     # COnnection related logic
     def got_job(self, channel, method, properties, body: str):
         """Callback for when we get a new job"""
         try:
-            job_data = json.loads(body)
-            logger.info(f"Received job: {job_data}")
             logger.debug("Unpacking job data")
-            job = JobFromAPI(**job_data)
+            job = decode_message(JobFromAPI, body, properties)
+            logger.info(f"Received job: {job}")
             if (job.job_type == PipelineJobType.HALT_JOB):
                 self.stop_job(job.job.job_id)
                 return
@@ -274,10 +303,9 @@ class Dispatcher:
 
     def got_status(self, channel, method, properties, body: str):
         try:
-            job_data = json.loads(body)
-            logger.info(f"Received status update: {job_data}")
             logger.debug("Unpacking status update")
-            msg = JobStatusMessage(**job_data)
+            msg = decode_message(JobStatusMessage, body, properties)
+            logger.info(f"Received status update: {msg}")
             self.handle_job_completion(msg)
         except ValueError as e:
             self.handle_status_unpack_error(e)
@@ -286,18 +314,15 @@ class Dispatcher:
         """Stops a job by removing its pending batches from Redis"""
         logger.info(f"Stopping job {job_id}...")
 
-        running_job = self.get_job(job_id)
-        if not running_job:
+        # Mark as stopped and clear pending batches, keeping the job for 10 mins so that
+        # batches still running can report back
+        if not self._cancel_job(
+            keys=[self._get_job_redis_key(job_id), self._get_recorded_batches_redis_key(job_id)],
+            args=[JobStatus.CANCELLED.value, 600],
+        ):
             logger.error(f"Job {job_id} not found in Redis!")
             return
 
-        # Mark as stopped
-        running_job.status = JobStatus.CANCELLED
-        # Clear pending batches
-        running_job.pending_batches = 0
-        self.update_job(job_id, running_job, ttl=600)
-        # Store updated job in Redis with TTL, 10 mins
-
         logger.info(f"Job {job_id} stopped. Pending batches removed.")
 
     def run(self):
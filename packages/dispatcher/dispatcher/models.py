@@ -17,3 +17,37 @@ class RunningJob(BaseModel):
     """Number of batches that have errored"""
     pending_batches: int
     """Number of batches that are pending"""
+
+    def to_redis_hash(self) -> dict[str, str | int]:
+        """
+        Fields of the Redis hash storing the job. The job definition is stored once as JSON,
+        and the counters as separate fields so that they can be updated atomically
+        (e.g. with HINCRBY) without rewriting the whole job.
+        """
+        return {
+            "job_data": self.job_data.model_dump_json(),
+            "max_concurrent_batches": self.job_data.max_concurrent_batches,
+            "status": self.status.value,
+            "currently_running_batches": self.currently_running_batches,
+            "completed_batches": self.completed_batches,
+            "errored_batches": self.errored_batches,
+            "pending_batches": self.pending_batches,
+        }
+
+    @classmethod
+    def from_redis_hash(cls, fields: dict) -> "RunningJob":
+        """Build a RunningJob from the fields of its Redis hash (see to_redis_hash)"""
+        fields = {
+            (key.decode() if isinstance(key, bytes) else key): value
+            for key, value in fields.items()
+        }
+        return cls(
+            job_data=PipelineJob.model_validate_json(fields["job_data"]),
+            status=JobStatus(
+                fields["status"].decode() if isinstance(fields["status"], bytes) else fields["status"]
+            ),
+            currently_running_batches=int(fields["currently_running_batches"]),
+            completed_batches=int(fields["completed_batches"]),
+            errored_batches=int(fields["errored_batches"]),
+            pending_batches=int(fields["pending_batches"]),
+        )
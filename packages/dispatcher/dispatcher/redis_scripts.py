@@ -0,0 +1,79 @@
+"""Lua scripts updating the state of a running job in Redis.
+
+Each job is stored as a Redis hash (see RunningJob.to_redis_hash). Redis runs a script
+atomically, so several dispatchers can update the same job concurrently without losing
+updates, and each update costs a single round trip.
+"""
+
+RESERVE_BATCHES = """
+-- KEYS[1]: the job's hash
+-- ARGV[1]: status of cancelled jobs, ARGV[2]: status of running jobs
+-- Reserve as many batches as the job's concurrency limit allows, moving them from pending
+-- to running. Returns nil if the job does not exist, otherwise
+-- {reserved, pending, running, completed, errored, job_data}
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return nil
+end
+local job = redis.call(
+    "HMGET", KEYS[1], "status", "pending_batches", "currently_running_batches",
+    "max_concurrent_batches", "completed_batches", "errored_batches", "job_data"
+)
+local pending = tonumber(job[2])
+local running = tonumber(job[3])
+local reserved = 0
+if job[1] ~= ARGV[1] then
+    reserved = math.min(math.max(tonumber(job[4]) - running, 0), pending)
+end
+if reserved > 0 then
+    pending = redis.call("HINCRBY", KEYS[1], "pending_batches", -reserved)
+    running = redis.call("HINCRBY", KEYS[1], "currently_running_batches", reserved)
+    redis.call("HSET", KEYS[1], "status", ARGV[2])
+end
+return {reserved, pending, running, tonumber(job[5]), tonumber(job[6]), job[7]}
+"""
+
+RECORD_BATCH_RESULT = """
+-- KEYS[1]: the job's hash, KEYS[2]: the set of the job's recorded batches
+-- ARGV[1]: counter to increment for the batch (completed_batches or errored_batches),
+-- ARGV[2]: the batch's ID
+-- Record a finished batch, deleting the job once no batches are pending or running. A batch
+-- is only recorded once, however many times its status is delivered (e.g. when it is
+-- processed again after its status was sent but not confirmed). Returns nil if the job does
+-- not exist, otherwise {recorded, finished, pending, running, completed, errored}
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return nil
+end
+local recorded = redis.call("SADD", KEYS[2], ARGV[2])
+local running
+if recorded == 1 then
+    redis.call("HINCRBY", KEYS[1], ARGV[1], 1)
+    running = redis.call("HINCRBY", KEYS[1], "currently_running_batches", -1)
+    local ttl = redis.call("TTL", KEYS[1])
+    if ttl > 0 then
+        redis.call("EXPIRE", KEYS[2], ttl)
+    end
+else
+    running = tonumber(redis.call("HGET", KEYS[1], "currently_running_batches"))
+end
+local job = redis.call("HMGET", KEYS[1], "pending_batches", "completed_batches", "errored_batches")
+local pending = tonumber(job[1])
+local finished = 0
+if recorded == 1 and pending == 0 and running <= 0 then
+    redis.call("DEL", KEYS[1], KEYS[2])
+    finished = 1
+end
+return {recorded, finished, pending, running, tonumber(job[2]), tonumber(job[3])}
+"""
+
+CANCEL_JOB = """
+-- KEYS[1]: the job's hash, KEYS[2]: the set of the job's recorded batches
+-- ARGV[1]: status of cancelled jobs, ARGV[2]: seconds until the job expires
+-- Cancel the job by clearing its pending batches. Returns 0 if the job does not exist.
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[1], "status", ARGV[1], "pending_batches", 0)
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+return 1
+"""
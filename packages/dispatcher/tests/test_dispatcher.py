@@ -1,4 +1,4 @@
-import json
+from concurrent.futures import Future
 from typing import List
 import uuid
 
@@ -9,7 +9,9 @@ from common.models.pipeline import (
     MetricCalculationJob,
     PipelineJob,
 )
-from common.rabbitmq.constants import JOB_QUEUE, STATUS_QUEUE
+from common.models.envelope import decode_message
+from common.rabbitmq.constants import BATCH_QUEUE, JOB_QUEUE, STATUS_QUEUE
+import fakeredis
 import pytest
 from unittest.mock import MagicMock
 from dispatcher.dispatcher import Dispatcher, DispatcherException, JobFromAPI, PipelineJobType
@@ -37,6 +39,33 @@ def dispatcher(mock_connection, mock_redis_client):
     return Dispatcher(mock_connection, mock_redis_client)
 
 
+@pytest.fixture
+def redis_dispatcher(mock_connection):
+    """Fixture for creating a Dispatcher whose Lua scripts run against an in-memory Redis."""
+    return Dispatcher(mock_connection, fakeredis.FakeRedis())
+
+
+def store_job(dispatcher, sample_job, pending: int, max_batches: int, running: int) -> str:
+    """Store the sample job in the dispatcher's Redis with the given counters, returning its ID"""
+    sample_job.job.max_concurrent_batches = max_batches
+    dispatcher.update_job(
+        sample_job.job.job_id,
+        RunningJob(
+            job_data=sample_job.job,
+            status=JobStatus.RUNNING,
+            currently_running_batches=running,
+            completed_batches=0,
+            errored_batches=0,
+            pending_batches=pending,
+        ),
+    )
+    return sample_job.job.job_id
+
+
+def batch_completed(job_id: str, batch_id: str) -> JobStatusMessage:
+    return JobStatusMessage(job_id=job_id, batch_id=batch_id, status=JobStatus.COMPLETED)
+
+
 @pytest.fixture
 def sample_job():
     """Fixture for creating a sample PipelineJob."""
@@ -115,9 +144,10 @@ def test_should_load_job_to_redis_and_dispatch(
     # Call process_new_job with the sample job
     dispatcher.process_new_job(sample_job.job)
 
-    # Check if the job was added to Redis
-    mock_redis_client.set.assert_called_once()
-    args, kwargs = mock_redis_client.set.call_args
+    # Check if the job was added to Redis as a hash, in a single transaction
+    pipeline = mock_redis_client.pipeline.return_value
+    pipeline.hset.assert_called_once()
+    args, kwargs = pipeline.hset.call_args
     args: List[str]
 
     running_job = RunningJob(
@@ -129,11 +159,29 @@ def test_should_load_job_to_redis_and_dispatch(
         pending_batches=10,
     )
     assert str(sample_job.job.job_id) in args[0]
-    assert args[1] == running_job.model_dump_json()
+    assert kwargs["mapping"] == running_job.to_redis_hash()
+    assert pipeline.execute.called
     assert dispatcher.dispatch_as_required.called
 
 
-def test_dispatch_batch_dispatches(mock_connection, sample_job):
+def test_running_job_round_trips_through_redis_hash(sample_job):
+    """Should rebuild a running job from its Redis hash, as returned by Redis (bytes)"""
+    running_job = RunningJob(
+        job_data=sample_job.job,
+        status=JobStatus.RUNNING,
+        currently_running_batches=3,
+        completed_batches=2,
+        errored_batches=1,
+        pending_batches=4,
+    )
+    stored = {
+        key.encode(): str(value).encode()
+        for key, value in running_job.to_redis_hash().items()
+    }
+    assert RunningJob.from_redis_hash(stored) == running_job
+
+
+def test_dispatch_batch_dispatches(mock_connection, mock_redis_client, sample_job):
     """Should dispatch a single batch"""
     channel_mock = MagicMock()
     mock_connection.channel.return_value = channel_mock
@@ -156,7 +204,44 @@ def test_dispatch_batch_dispatches(mock_connection, sample_job):
     # Verify that a batch was published
     assert channel_mock.basic_publish.called
     args, kwargs = channel_mock.basic_publish.call_args
-    assert kwargs["body"] == batch.model_dump_json()
+    assert decode_message(Batch, kwargs["body"], kwargs["properties"]) == batch
+
+
+@pytest.mark.parametrize("reserved_batches", [0, 1, 5])
+def test_should_dispatch_reserved_batches(
+    dispatcher, reserved_batches, mock_redis_client, sample_job
+):
+    """Should dispatch as many batches as were reserved in Redis"""
+    dispatcher._reserve_batches = MagicMock()
+    dispatcher._reserve_batches.return_value = [
+        reserved_batches, 10 - reserved_batches, reserved_batches, 0, 0, sample_job.job.model_dump_json()
+    ]
+    dispatcher.dispatch_batches = MagicMock()
+
+    # Call dispatch_as_required
+    dispatcher.dispatch_as_required(sample_job.job.job_id)
+
+    # Check the reservation is made on the job's key
+    dispatcher._reserve_batches.assert_called_once_with(
+        keys=[dispatcher._get_job_redis_key(sample_job.job.job_id)],
+        args=[JobStatus.CANCELLED.value, JobStatus.RUNNING.value],
+    )
+    if reserved_batches == 0:
+        assert not dispatcher.dispatch_batches.called
+        return
+
+    # All reserved batches should be dispatched at once
+    dispatcher.dispatch_batches.assert_called_once()
+    args, kwargs = dispatcher.dispatch_batches.call_args
+    assert args[0] == sample_job.job.job_id
+    assert len(args[1]) == reserved_batches
+    assert len({batch.batch_id for batch in args[1]}) == reserved_batches
+    for batch in args[1]:
+        assert batch.batch_size == sample_job.job.batch_size
+        assert batch.total_sample_size == sample_job.job.total_sample_size
+
+    # Job should not be deleted by the dispatcher if there are still pending batches
+    assert not mock_redis_client.delete.called
 
 
 @pytest.mark.parametrize(
@@ -172,72 +257,100 @@ def test_dispatch_batch_dispatches(mock_connection, sample_job):
     ],
 )
 def test_should_dispatch_new_batches_as_needed(
-    dispatcher, pending_jobs, max_jobs, running_jobs, mock_redis_client, sample_job
+    redis_dispatcher, pending_jobs, max_jobs, running_jobs, sample_job
 ):
-    """Should dispatch new batches as required - until pending == max"""
-    job_spaces = max(0, max_jobs - running_jobs)
-    expected_dispatched_batches = min(pending_jobs, job_spaces)
+    """Should dispatch new batches as required - until running == max"""
+    expected_dispatched_batches = min(pending_jobs, max(0, max_jobs - running_jobs))
+    job_id = store_job(redis_dispatcher, sample_job, pending_jobs, max_jobs, running_jobs)
+    redis_dispatcher.dispatch_batches = MagicMock()
 
-    # Modify sample_job for testing concurrency
-    sample_job.job.max_concurrent_batches = max_jobs
-    sample_job.job.batches = 10  # should be ignored by dispatcher in favor of pending_jobs
+    redis_dispatcher.dispatch_as_required(job_id)
 
-    # Create a sample running job
-    running_job = RunningJob(
-        job_data=sample_job.job,
-        status=JobStatus.RUNNING,
-        currently_running_batches=running_jobs,
-        completed_batches=0,
-        errored_batches=0,
-        pending_batches=pending_jobs,
-    )
+    dispatched = redis_dispatcher.dispatch_batches.call_args.args[1] if expected_dispatched_batches else []
+    assert redis_dispatcher.dispatch_batches.called == (expected_dispatched_batches > 0)
+    assert len(dispatched) == expected_dispatched_batches
+    running_job = redis_dispatcher.get_job(job_id)
+    assert running_job.pending_batches == pending_jobs - expected_dispatched_batches
+    assert running_job.currently_running_batches == running_jobs + expected_dispatched_batches
 
-    # Mock dispatcher methods
-    dispatcher.get_job = MagicMock()
-    dispatcher.get_job.return_value = running_job
-    dispatcher.dispatch_batch = MagicMock()
-    dispatcher.update_job = MagicMock()
 
-    # Call dispatch_as_required
-    dispatcher.dispatch_as_required(sample_job.job.job_id)
+def test_should_not_dispatch_batches_of_cancelled_job(redis_dispatcher, sample_job):
+    """A cancelled job dispatches nothing more, and is deleted once its running batches report back"""
+    job_id = store_job(redis_dispatcher, sample_job, pending=10, max_batches=5, running=2)
+    redis_dispatcher.dispatch_batches = MagicMock()
 
-    # Check calls
-    dispatcher.get_job.assert_called_once_with(sample_job.job.job_id)
-    assert dispatcher.dispatch_batch.call_count == expected_dispatched_batches
-    assert dispatcher.update_job.call_count == expected_dispatched_batches
+    redis_dispatcher.stop_job(job_id)
+    redis_dispatcher.dispatch_as_required(job_id)
 
-    if expected_dispatched_batches == 0:
-        assert not dispatcher.update_job.called
-        return
+    assert not redis_dispatcher.dispatch_batches.called
+    running_job = redis_dispatcher.get_job(job_id)
+    assert running_job.status == JobStatus.CANCELLED
+    assert running_job.pending_batches == 0
+    assert redis_dispatcher._redis_client.ttl(redis_dispatcher._get_job_redis_key(job_id)) > 0
 
-    args, kwargs = dispatcher.update_job.call_args
-    assert args[0] == sample_job.job.job_id
-    updated_running_job = args[1]
-    assert (
-        updated_running_job.pending_batches
-        == pending_jobs - expected_dispatched_batches
-    )
-    assert (
-        updated_running_job.currently_running_batches
-        == running_jobs + expected_dispatched_batches
-    )
+    redis_dispatcher.handle_job_completion(batch_completed(job_id, "first"))
+    assert not redis_dispatcher.dispatch_batches.called
+    assert redis_dispatcher.get_job(job_id).currently_running_batches == 1
+    # The batches recorded for the job expire with it
+    assert redis_dispatcher._redis_client.ttl(redis_dispatcher._get_recorded_batches_redis_key(job_id)) > 0
+
+    redis_dispatcher.handle_job_completion(batch_completed(job_id, "second"))
+    assert redis_dispatcher.get_job(job_id) is None
+
+
+def test_should_delete_job_after_final_batch(redis_dispatcher, sample_job):
+    """Recording the last running batch of a job with no pending batches deletes the job"""
+    job_id = store_job(redis_dispatcher, sample_job, pending=1, max_batches=1, running=1)
+    redis_dispatcher.dispatch_batches = MagicMock()
+
+    # The first batch to finish makes room for the last pending one
+    redis_dispatcher.handle_job_completion(batch_completed(job_id, "first"))
+    assert len(redis_dispatcher.dispatch_batches.call_args.args[1]) == 1
+    running_job = redis_dispatcher.get_job(job_id)
+    assert (running_job.pending_batches, running_job.currently_running_batches) == (0, 1)
+    assert running_job.completed_batches == 1
+
+    redis_dispatcher.handle_job_completion(batch_completed(job_id, "last"))
+    assert redis_dispatcher.dispatch_batches.call_count == 1
+    assert redis_dispatcher.get_job(job_id) is None
+    assert not redis_dispatcher._redis_client.exists(redis_dispatcher._get_recorded_batches_redis_key(job_id))
 
-    # Job should not be deleted by the dispatcher if there are still pending batches
-    assert not mock_redis_client.delete.called
+
+def test_should_record_each_batch_once(redis_dispatcher, sample_job):
+    """A batch whose status is delivered twice is only counted once, so the job is not deleted early"""
+    job_id = store_job(redis_dispatcher, sample_job, pending=0, max_batches=5, running=2)
+
+    redis_dispatcher.handle_job_completion(batch_completed(job_id, "first"))
+    redis_dispatcher.handle_job_completion(batch_completed(job_id, "first"))
+
+    running_job = redis_dispatcher.get_job(job_id)
+    assert running_job.currently_running_batches == 1
+    assert running_job.completed_batches == 1
+
+
+def test_should_not_record_batch_of_unknown_job(redis_dispatcher):
+    """Scripts do nothing for jobs which are not in Redis"""
+    redis_dispatcher.dispatch_batches = MagicMock()
+    redis_dispatcher.handle_job_completion(batch_completed("unknown", "batch"))
+    redis_dispatcher.stop_job("unknown")
+    assert not redis_dispatcher.dispatch_batches.called
+    assert not redis_dispatcher._redis_client.keys()
 
 
 def test_should_stop_if_job_not_found(dispatcher):
     """Should stop if job not found"""
-    dispatcher.dispatch_batch = MagicMock()
-    dispatcher.get_job = MagicMock()
-    dispatcher.get_job.return_value = None
+    dispatcher.dispatch_batches = MagicMock()
+    dispatcher.propogate_error = MagicMock()
+    dispatcher._reserve_batches = MagicMock()
+    dispatcher._reserve_batches.return_value = None
 
     # Call dispatch_as_required
     dispatcher.dispatch_as_required("job_id")
 
-    # Verify we tried to fetch the job, but found none
-    dispatcher.get_job.assert_called_once_with("job_id")
-    assert not dispatcher.dispatch_batch.called
+    # Verify we tried to reserve batches for the job, but found none
+    dispatcher._reserve_batches.assert_called_once()
+    assert not dispatcher.dispatch_batches.called
+    dispatcher.propogate_error.assert_called_once()
 
 
 def test_get_job_should_get_job(dispatcher, mock_redis_client, sample_job):
@@ -252,13 +365,13 @@ def test_get_job_should_get_job(dispatcher, mock_redis_client, sample_job):
         pending_batches=10,
     )
 
-    mock_redis_client.get.return_value = running_job.model_dump_json()
+    mock_redis_client.hgetall.return_value = running_job.to_redis_hash()
 
     # Call get_job
     res = dispatcher.get_job("job_id")
 
     # Verify that the job was fetched from Redis
-    mock_redis_client.get.assert_called_once_with(
+    mock_redis_client.hgetall.assert_called_once_with(
         dispatcher._get_job_redis_key("job_id")
     )
     assert res == running_job
@@ -267,13 +380,13 @@ def test_get_job_should_get_job(dispatcher, mock_redis_client, sample_job):
 def test_should_return_none_if_no_job_get_job(dispatcher, mock_redis_client):
     """Should return None if no job found in Redis"""
 
-    mock_redis_client.get.return_value = None
+    mock_redis_client.hgetall.return_value = {}
 
     # Call get_job
     res = dispatcher.get_job("job_id")
 
     # Verify that the job was fetched from Redis
-    mock_redis_client.get.assert_called_once_with(
+    mock_redis_client.hgetall.assert_called_once_with(
         dispatcher._get_job_redis_key("job_id")
     )
     assert res is None
@@ -282,8 +395,9 @@ def test_should_return_none_if_no_job_get_job(dispatcher, mock_redis_client):
 # Handle job complete
 def test_job_complete_bad_input(dispatcher, mock_redis_client):
     """If the job is not found, should log an error and return"""
-    dispatcher.get_job = MagicMock()
-    dispatcher.get_job.return_value = None
+    dispatcher._record_batch_result = MagicMock()
+    dispatcher._record_batch_result.return_value = None
+    dispatcher.dispatch_as_required = MagicMock()
 
     # Call handle_job_completion
     dispatcher.handle_job_completion(
@@ -294,24 +408,16 @@ def test_job_complete_bad_input(dispatcher, mock_redis_client):
         )
     )
 
-    # Verify that the job was fetched from Redis
-    dispatcher.get_job.assert_called_once_with("job_id")
-    assert not mock_redis_client.delete.called
+    # Verify that the job was looked up in Redis
+    dispatcher._record_batch_result.assert_called_once()
+    assert not dispatcher.dispatch_as_required.called
 
 
 # If completed job, should update the job to inc complete, dec pending and dispatch more
-def test_job_complete_completed(dispatcher, mock_redis_client, sample_job):
+def test_job_complete_completed(dispatcher, sample_job):
     """If the job is completed, should update the job to inc complete, dec running and dispatch more"""
-    dispatcher.get_job = MagicMock()
-    dispatcher.get_job.return_value = RunningJob(
-        job_data=sample_job.job,
-        status=JobStatus.RUNNING,
-        currently_running_batches=1,
-        completed_batches=0,
-        errored_batches=0,
-        pending_batches=10,
-    )
-
+    dispatcher._record_batch_result = MagicMock()
+    dispatcher._record_batch_result.return_value = [1, 0, 10, 0, 1, 0]
     dispatcher.dispatch_as_required = MagicMock()
 
     # Call handle_job_completion
@@ -323,35 +429,25 @@ def test_job_complete_completed(dispatcher, mock_redis_client, sample_job):
         )
     )
 
-    # Verify that the job was fetched from Redis
-    dispatcher.get_job.assert_called_once_with(str(sample_job.job.job_id))
-
-    # Verify that the job was updated correctly - one less currently running, one more completed
-    mock_redis_client.set.assert_called_once()
-    args, kwargs = mock_redis_client.set.call_args
-    assert args[0] == dispatcher._get_job_redis_key(str(sample_job.job.job_id))
-    updated_running_job = RunningJob(**json.loads(args[1]))
-    assert updated_running_job.completed_batches == 1
-    assert updated_running_job.pending_batches == 10
-    assert updated_running_job.currently_running_batches == 0
+    # Verify that the completed counter of the job was incremented in Redis
+    dispatcher._record_batch_result.assert_called_once_with(
+        keys=[
+            dispatcher._get_job_redis_key(str(sample_job.job.job_id)),
+            dispatcher._get_recorded_batches_redis_key(str(sample_job.job.job_id)),
+        ],
+        args=["completed_batches", "batch_id"],
+    )
 
     # Verify that more batches were dispatched
     dispatcher.dispatch_as_required.assert_called_once_with(str(sample_job.job.job_id))
 
 
-def test_job_error_handled(dispatcher, mock_redis_client, sample_job):
+def test_job_error_handled(dispatcher, sample_job):
     """If the job is errored, should update the job to inc errored and log an error"""
-    dispatcher.get_job = MagicMock()
-    dispatcher.get_job.return_value = RunningJob(
-        job_data=sample_job.job,
-        status=JobStatus.RUNNING,
-        currently_running_batches=1,
-        completed_batches=0,
-        errored_batches=0,
-        pending_batches=10,
-    )
-
+    dispatcher._record_batch_result = MagicMock()
+    dispatcher._record_batch_result.return_value = [1, 0, 10, 0, 0, 1]
     dispatcher.dispatch_as_required = MagicMock()
+    dispatcher.propogate_error = MagicMock()
 
     # Call handle_job_completion
     dispatcher.handle_job_completion(
@@ -363,52 +459,46 @@ def test_job_error_handled(dispatcher, mock_redis_client, sample_job):
         )
     )
 
-    # Verify that the job was fetched from Redis
-    dispatcher.get_job.assert_called_once_with(str(sample_job.job.job_id))
-
-    # Verify that the job was updated correctly - one more errored
-    mock_redis_client.set.assert_called_once()
-    args, kwargs = mock_redis_client.set.call_args
-    assert args[0] == dispatcher._get_job_redis_key(str(sample_job.job.job_id))
-    updated_running_job = RunningJob(**json.loads(args[1]))
-    assert updated_running_job.errored_batches == 1
-    assert updated_running_job.pending_batches == 10
-    assert updated_running_job.currently_running_batches == 0
-
-    # Verify that no more batches were dispatched
+    # Verify that the errored counter of the job was incremented in Redis
+    dispatcher._record_batch_result.assert_called_once_with(
+        keys=[
+            dispatcher._get_job_redis_key(str(sample_job.job.job_id)),
+            dispatcher._get_recorded_batches_redis_key(str(sample_job.job.job_id)),
+        ],
+        args=["errored_batches", "batch_id"],
+    )
+    dispatcher.propogate_error.assert_called_once()
+
+    # Verify that more batches were dispatched
     dispatcher.dispatch_as_required.assert_called_once_with(str(sample_job.job.job_id))
-    assert not mock_redis_client.delete.called
 
 
-def test_should_delete_on_last_batch(dispatcher, mock_redis_client, sample_job):
+def test_should_not_dispatch_on_last_batch(dispatcher, sample_job):
     """If no more pending batches, and none in progress, job is complete"""
-    dispatcher.get_job = MagicMock()
-    dispatcher.get_job.return_value = RunningJob(
-        job_data=sample_job.job,
-        status=JobStatus.RUNNING,
-        currently_running_batches=2,  # 2: Only the second one should cause completion
-        completed_batches=9,
-        errored_batches=1,
-        pending_batches=0,
-    )
+    dispatcher._record_batch_result = MagicMock()
+    # The first batch leaves one running, the second finishes the job (which Redis deletes)
+    dispatcher._record_batch_result.side_effect = [[1, 0, 0, 1, 9, 1], [1, 1, 0, 0, 10, 1]]
     dispatcher.dispatch_as_required = MagicMock()
 
-    # Call handle_job_completion
-    dispatcher.handle_job_completion(
-        JobStatusMessage(
-            job_id=str(sample_job.job.job_id),
-            batch_id="batch_id",
-            status=JobStatus.COMPLETED,
+    for _ in range(2):
+        dispatcher.handle_job_completion(
+            JobStatusMessage(
+                job_id=str(sample_job.job.job_id),
+                batch_id="batch_id",
+                status=JobStatus.COMPLETED,
+            )
         )
-    )
 
-    # Verify that the job was fetched from Redis
-    dispatcher.get_job.assert_called_with(str(sample_job.job.job_id))
+    # Verify that more batches were only dispatched after the first
+    dispatcher.dispatch_as_required.assert_called_once()
 
-    # Verify not deleted yet
-    assert not mock_redis_client.delete.called
 
-    # Call again
+def test_repeated_batch_status_is_ignored(dispatcher, sample_job):
+    """A batch whose status is delivered again is not recorded again, and dispatches nothing"""
+    dispatcher._record_batch_result = MagicMock()
+    dispatcher._record_batch_result.return_value = [0, 0, 0, 1, 9, 0]
+    dispatcher.dispatch_as_required = MagicMock()
+
     dispatcher.handle_job_completion(
         JobStatusMessage(
             job_id=str(sample_job.job.job_id),
@@ -417,16 +507,82 @@ def test_should_delete_on_last_batch(dispatcher, mock_redis_client, sample_job):
         )
     )
 
-    # Verify that the job was fetched from Redis
-    dispatcher.get_job.assert_called_with(str(sample_job.job.job_id))
+    assert not dispatcher.dispatch_as_required.called
+
+
+def test_stop_job_cancels_job(dispatcher, sample_job):
+    """Should cancel the job in Redis, keeping it for 10 minutes"""
+    dispatcher._cancel_job = MagicMock()
+    dispatcher._cancel_job.return_value = 1
+
+    dispatcher.stop_job(sample_job.job.job_id)
 
-    # Verify that the job was deleted
-    mock_redis_client.delete.assert_called_once_with(
-        dispatcher._get_job_redis_key(str(sample_job.job.job_id))
+    dispatcher._cancel_job.assert_called_once_with(
+        keys=[
+            dispatcher._get_job_redis_key(sample_job.job.job_id),
+            dispatcher._get_recorded_batches_redis_key(sample_job.job.job_id),
+        ],
+        args=[JobStatus.CANCELLED.value, 600],
     )
 
-    # Verify that only one job was dispatched
-    dispatcher.dispatch_as_required.assert_called_once()
+
+def test_dispatch_batches_publishes_in_one_burst(mock_connection, mock_redis_client, sample_job):
+    """Should publish every batch on the channel back to back"""
+    channel_mock = MagicMock()
+    mock_connection.channel.return_value = channel_mock
+    dispatcher = Dispatcher(mock_connection, mock_redis_client)
+
+    batches = [
+        Batch(
+            job_id=str(sample_job.job.job_id),
+            batch_id=str(uuid.uuid4()),
+            batch_size=10,
+            metrics=sample_job.job.metrics,
+            total_sample_size=100,
+        )
+        for _ in range(3)
+    ]
+    dispatcher.dispatch_batches(sample_job.job.job_id, batches)
+
+    assert [
+        decode_message(Batch, call.kwargs["body"], call.kwargs["properties"])
+        for call in channel_mock.basic_publish.call_args_list
+    ] == batches
+
+
+def test_dispatch_batches_uses_publisher_when_given(mock_connection, mock_redis_client, sample_job):
+    """Should publish batches through the publisher, reporting rejected batches"""
+    channel_mock = MagicMock()
+    mock_connection.channel.return_value = channel_mock
+    publisher = MagicMock()
+    futures = [Future(), Future()]
+    publisher.publish.side_effect = futures
+    dispatcher = Dispatcher(mock_connection, mock_redis_client, publisher)
+    dispatcher.propogate_error = MagicMock()
+
+    batches = [
+        Batch(
+            job_id=str(sample_job.job.job_id),
+            batch_id=str(uuid.uuid4()),
+            batch_size=10,
+            metrics=sample_job.job.metrics,
+            total_sample_size=100,
+        )
+        for _ in range(2)
+    ]
+    dispatcher.dispatch_batches(sample_job.job.job_id, batches)
+
+    channel_mock.basic_publish.assert_not_called()
+    assert [call.args[1] for call in publisher.publish.call_args_list] == [BATCH_QUEUE] * 2
+    assert [
+        decode_message(Batch, body, properties)
+        for body, _, properties in (call.args for call in publisher.publish.call_args_list)
+    ] == batches
+
+    futures[0].set_result(True)
+    dispatcher.propogate_error.assert_not_called()
+    futures[1].set_exception(Exception("Nacked"))
+    dispatcher.propogate_error.assert_called_once()
 
 
 def test_should_propogate_error_if_dispatch_fails(
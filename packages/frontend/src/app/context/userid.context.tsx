@@ -33,6 +33,9 @@ export function UserIdSocketProvider({
   const [userID, setUserID] = useState(uuidv4());
   const [socket, setSocket] = useState(() => new WebSocket(WEBSOCKET_URL));
   const disconnectRef = useRef(false);
+  // Cursor of the last message received, so that after reconnecting
+  // only the messages missed in the meantime are received
+  const cursorRef = useRef<string | null>(null);
 
   const refreshUserId = useCallback(() => {
     const id = uuidv4();
@@ -58,8 +61,20 @@ export function UserIdSocketProvider({
       // Connection logic
       sock.onopen = function () {
         console.log('WebSocket connection established');
-        this.send(userID.toString());
+        this.send(
+          cursorRef.current
+            ? JSON.stringify({ user_id: userID, cursor: cursorRef.current })
+            : userID.toString()
+        );
       };
+      // Listen alongside any onmessage handler set by the page using the socket.
+      // The cursor leads each message, so it is read without parsing the message.
+      sock.addEventListener('message', (event) => {
+        const match = /^\{"cursor": "([^"]+)"/.exec(event.data);
+        if (match) {
+          cursorRef.current = match[1];
+        }
+      });
       sock.onmessage = (event) => {
         const data = JSON.parse(event.data);
         console.log('Received message:', data);
@@ -80,6 +95,7 @@ export function UserIdSocketProvider({
 
   // On boot create socket
   useEffect(() => {
+    cursorRef.current = null;
     initSocket(userID);
   }, [initSocket, userID]);
 
@@ -22,10 +22,10 @@ interface DashboardProps {
   expectedItems: number;
 }
 
-// Each item from the websocket is an array of Metric objects.
 const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
-  // 'items' holds each item (which is an array of Metric objects) received from the socket.
-  const [items, setItems] = useState<Metric[]>([]);
+  // The latest intermediate metrics received from the socket, and the number of batches they cover.
+  const [metrics, setMetrics] = useState<Metric | null>(null);
+  const [batchesProcessed, setBatchesProcessed] = useState<number>(0);
   const [log, setLog] = useState<string>('Log: Processing metrics...');
   const [error, setError] = useState<{ header: string; text: string }>({
     header: '',
@@ -92,14 +92,23 @@ const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
             break;
           case 'METRICS_INTERMEDIATE':
             try {
-              // Assume each intermediate message contains one item with multiple metrics.
-              const newItem: Metric = data.content.metrics_results;
+              // Each message contains every metric, or with 'delta' set, only
+              // those which changed since the previous message.
+              const newMetrics: Metric = data.content.metrics_results;
+              const delta: boolean = data.content.delta ?? false;
 
-              console.log('New item:', newItem);
-              // Append the new item to our list of items.
-              setItems((prevItems) => {
-                const updatedItems = [...prevItems, newItem];
-                if (updatedItems.length >= expectedItems) {
+              console.log('New metrics:', newMetrics);
+              setMetrics((prevMetrics) =>
+                delta && prevMetrics
+                  ? { ...prevMetrics, ...newMetrics }
+                  : newMetrics
+              );
+              // Several batches may be coalesced into one message, so use the
+              // batch count it carries when present.
+              setBatchesProcessed((prevBatches) => {
+                const updatedBatches =
+                  data.content.batches_processed ?? prevBatches + 1;
+                if (updatedBatches >= expectedItems) {
                   setTimeout(onComplete, 0);
                   setShowError(true);
                   setError({
@@ -107,7 +116,7 @@ const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
                     text: 'This may take a few seconds',
                   });
                 }
-                return updatedItems;
+                return updatedBatches;
               });
             } catch (e: any) {
               setShowError(true);
@@ -175,8 +184,8 @@ const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
     }
   }, [onComplete, socket]);
 
-  // Calculate overall progress as the number of items received divided by the expected total.
-  const overallProgress = Math.min(items.length / expectedItems, 1);
+  // Calculate overall progress as the number of batches processed divided by the expected total.
+  const overallProgress = Math.min(batchesProcessed / expectedItems, 1);
 
   // Styling (using CSS variables for theme colors, adjust as needed)
   const metricCardStyle: React.CSSProperties = {
@@ -239,7 +248,8 @@ const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
             <Button
               onClick={async () => {
                 await earlyStop();
-                setItems([]);
+                setMetrics(null);
+                setBatchesProcessed(0);
                 setLog('Log: Evaluation pipeline cancelled. Reload page?');
                 setRetryButton(buttonRetry);
                 setStopped(true);
@@ -255,7 +265,7 @@ const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
             value={overallProgress * 100}
           />
           <p>
-            {items.length} / {expectedItems} batches processed
+            {batchesProcessed} / {expectedItems} batches processed
           </p>
         </>
       ) : (
@@ -282,8 +292,8 @@ const Dashboard: React.FC<DashboardProps> = ({ onComplete, expectedItems }) => {
           marginTop: '16px',
         }}
       >
-        {items.length > 0 ? (
-          items.slice(-1).map((item, itemIndex) => {
+        {metrics !== null ? (
+          [metrics].map((item, itemIndex) => {
             return (
               <div
                 key={itemIndex}
@@ -163,6 +163,44 @@ describe('Dashboard Component', () => {
     ).toBeInTheDocument();
   });
 
+  test('merges delta METRICS_INTERMEDIATE messages and counts coalesced batches', async () => {
+    render(<Dashboard onComplete={onCompleteMock} expectedItems={10} />);
+
+    const metric = (value: number) => ({
+      value,
+      ideal_value: 1,
+      range: [0, 1],
+      error: null,
+    });
+    const sendIntermediate = async (content: object) => {
+      await act(async () => {
+        (mockWebSocket.onmessage as any)({
+          data: JSON.stringify({
+            messageType: 'METRICS_INTERMEDIATE',
+            content,
+          }),
+        });
+      });
+    };
+
+    await sendIntermediate({
+      metrics_results: { accuracy: metric(0.5), precision: metric(0.5) },
+      batches_processed: 3,
+      delta: false,
+    });
+    expect(screen.getByText('3 / 10 batches processed')).toBeInTheDocument();
+
+    // Only the metrics which changed are sent in a delta
+    await sendIntermediate({
+      metrics_results: { precision: metric(0.75) },
+      batches_processed: 10,
+      delta: true,
+    });
+    expect(screen.getByText('10 / 10 batches processed')).toBeInTheDocument();
+    expect(screen.getByText('Accuracy')).toBeInTheDocument();
+    expect(screen.getByText('Precision')).toBeInTheDocument();
+  });
+
   test('generates and downloads the report on REPORT message', async () => {
     render(<Dashboard onComplete={onCompleteMock} expectedItems={10} />);
 
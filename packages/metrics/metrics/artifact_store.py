@@ -0,0 +1,54 @@
+"""
+Storage for intermediate artifacts (e.g. LIME surrogates, gradients) shared between the
+metrics calculated for one CalculateRequest.
+"""
+import threading
+from typing import Any, Callable
+from metrics.exceptions import MetricCancelledException
+
+
+class ArtifactStore:
+    """
+    Thread-safe store computing each named artifact at most once.
+
+    If computing an artifact raises an exception, the exception is stored and re-raised
+    to every caller that requests the artifact, so each metric depending on it fails
+    in the same way it would have when computing the artifact itself. Artifacts whose
+    computation was cancelled, with the metric computing them, are not stored.
+    """
+
+    def __init__(self):
+        self._results: dict[str, tuple[bool, Any]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, name: str, compute: Callable[[], Any]) -> Any:
+        """
+        Return the artifact called `name`, computing it with `compute` if required.
+
+        :param name: str - Name of the artifact
+        :param compute: Callable[[], Any] - Function computing the artifact
+        :return: Any - The artifact
+        """
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        # Only hold the artifact's own lock so that other artifacts (including this
+        # artifact's dependencies) can be computed concurrently
+        with lock:
+            if name not in self._results:
+                try:
+                    self._results[name] = (True, compute())
+                except MetricCancelledException:
+                    # Another metric may still compute the artifact
+                    raise
+                except Exception as e:
+                    self._results[name] = (False, e)
+
+        succeeded, result = self._results[name]
+        if not succeeded:
+            raise result
+        return result
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._results
@@ -0,0 +1,161 @@
+"""
+Intermediate artifacts shared between metrics.
+
+Several metrics depend on the same expensive intermediate results, e.g. the explanation
+metrics all fit LIME surrogates and query the model on perturbed inputs. Metrics declare
+the artifacts they need in `metric_to_fn_and_requirements` (under "artifacts"), and
+calculate_metrics computes each artifact once per request, in dependency order, before
+running the metrics.
+"""
+from typing import Any
+import numpy as np
+from common.models import ModelResponse
+from metrics.models import CalculateRequest, TaskType
+from metrics.utils import (
+    _query_model,
+    _lime_perturbations,
+    _lime_explanation,
+    _confusion_matrix,
+    _group_confusion_counts,
+    _finite_difference_gradient_predictions,
+    _finite_difference_gradient_confidence_scores
+)
+from metrics.ntg_metric_utils import text_input_lime, generate_random_strings
+
+# Number of out-of-distribution samples generated for OOD metrics
+NUM_OOD_SAMPLES = 1000
+# Hard limit for text inputs due to size constraints
+NUM_OOD_TEXT_SAMPLES = 100
+
+
+def _ood_confidence_scores(info: CalculateRequest) -> np.ndarray:
+    """
+    Generate out-of-distribution samples and query the model on them.
+
+    :param info: CalculateRequest - requires input_features, model_url and model_api_key.
+    :return: np.ndarray - the maximum confidence score of the model for each OOD sample
+    """
+    if info.task_name == TaskType.TEXT_CLASSIFICATION:
+        # Generate OOD samples via random strings of length 10
+        # (TODO: Update to more sophisticated method)
+        ood_data: np.array = generate_random_strings(NUM_OOD_TEXT_SAMPLES).reshape(-1, 1)
+    else:
+        id_data: np.array = np.array(info.input_features)   # In-distribution dataset (N x d array).
+        d: int = id_data.shape[1]                           # Feature dimensionality
+
+        # Generate OOD samples uniformly within the bounds of the ID data
+        id_min, id_max = id_data.min(axis=0), id_data.max(axis=0)
+        ood_data = np.random.uniform(id_min, id_max, size=(NUM_OOD_SAMPLES, d))
+
+    # Call model endpoint to get confidence scores
+    response: ModelResponse = _query_model(ood_data, info)
+
+    # Take the maximum confidence per sample
+    return np.max(response.confidence_scores, axis=1)
+
+
+def _gradients(info: CalculateRequest) -> np.ndarray:
+    """
+    Finite difference gradients of the model's predictions (regression) or of the
+    confidence score of the predicted class (classification)
+    """
+    return (
+        _finite_difference_gradient_predictions(info, 0.01)
+        if info.regression_flag
+        else _finite_difference_gradient_confidence_scores(info, 0.01)
+    )
+
+
+intermediate_artifacts = {
+    "confusion_matrix": {
+        "function": lambda info: _confusion_matrix(info.true_labels, info.predicted_labels),
+        "depends_on": [],
+    },
+    "fairness_counts": {
+        "function": lambda info: _group_confusion_counts(
+            info.true_labels, info.predicted_labels, info.protected_attr
+        ),
+        "depends_on": [],
+    },
+    "lime_perturbations": {
+        "function": _lime_perturbations,
+        "depends_on": [],
+    },
+    "lime": {
+        "function": lambda info: _lime_explanation(
+            info, perturbations=get_artifact(info, "lime_perturbations")
+        ),
+        "depends_on": ["lime_perturbations"],
+    },
+    "lime_predictions": {
+        "function": lambda info: _lime_explanation(
+            info, esp=True, perturbations=get_artifact(info, "lime_perturbations")
+        ),
+        "depends_on": ["lime_perturbations"],
+    },
+    "gradients": {
+        "function": _gradients,
+        "depends_on": [],
+    },
+    "text_input_lime": {
+        "function": text_input_lime,
+        "depends_on": [],
+    },
+    "ood_scores": {
+        "function": _ood_confidence_scores,
+        "depends_on": [],
+    },
+}
+"""
+    Mapping of artifact names to the function computing them and the artifacts they
+    depend on. Artifacts are computed at most once per CalculateRequest.
+"""
+
+
+def get_artifact(info: CalculateRequest, name: str) -> Any:
+    """
+    Return the artifact `name` for the request, computing it if it has not been already.
+
+    :param info: CalculateRequest - the request the artifact is computed for
+    :param name: str - name of the artifact in `intermediate_artifacts`
+    :return: Any - the artifact
+    """
+    return info.artifacts.get_or_compute(
+        name, lambda: intermediate_artifacts[name]["function"](info)
+    )
+
+
+def plan_artifacts(names: set[str]) -> list[str]:
+    """
+    Order the given artifacts and all of their dependencies so that every artifact
+    appears after the artifacts it depends on.
+
+    :param names: set[str] - names of the artifacts required
+    :return: list[str] - the artifacts to compute, in order
+    """
+    plan = []
+    visited = set()
+
+    def visit(name: str):
+        if name in visited:
+            return
+        visited.add(name)
+        for dependency in intermediate_artifacts[name]["depends_on"]:
+            visit(dependency)
+        plan.append(name)
+
+    for name in sorted(names):
+        visit(name)
+    return plan
+
+
+def compute_artifacts(info: CalculateRequest, plan: list[str]):
+    """
+    Compute the artifacts in `plan` for the request. Failures are stored and re-raised
+    by every metric that requires the failed artifact.
+    """
+    for name in plan:
+        try:
+            get_artifact(info, name)
+        except Exception as e:
+            print(f"Failed to compute artifact {name}: {e}")
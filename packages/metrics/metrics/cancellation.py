@@ -0,0 +1,48 @@
+"""
+Cooperative cancellation of metrics which have timed out.
+
+Threads cannot be interrupted, so a metric which times out in parallel mode is cancelled by
+setting its event. The metric's thread then stops at its next model query, by raising
+MetricCancelledException, rather than querying the model for a result which is discarded.
+"""
+import threading
+import contextvars
+from typing import Any, Callable, Optional
+from metrics.exceptions import MetricCancelledException
+
+# Cancellation event of the metric computed by the current thread, if any
+_cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar(
+    "metric_cancel_event", default=None
+)
+
+
+def run_cancellable(event: threading.Event, function: Callable[..., Any], *args) -> Any:
+    """
+    Run a function, which stops at its next model query once the event is set
+
+    :param event: threading.Event - set to cancel the function
+    :param function: Callable - the function to run, e.g. computing a metric
+    """
+    token = _cancel_event.set(event)
+    try:
+        return function(*args)
+    finally:
+        _cancel_event.reset(token)
+
+
+def current_cancel_event() -> Optional[threading.Event]:
+    """
+    The cancellation event of the current thread, to be checked by threads it starts, which
+    do not inherit it
+    """
+    return _cancel_event.get()
+
+
+def check_cancelled(event: Optional[threading.Event] = None):
+    """
+    Raise MetricCancelledException if the given event, or by default the current thread's,
+    has been set
+    """
+    event = event or _cancel_event.get()
+    if event is not None and event.is_set():
+        raise MetricCancelledException(detail="the metric timed out")
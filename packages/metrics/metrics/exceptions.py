@@ -107,3 +107,16 @@ class InvalidParameterException(_MetricsPackageException):
         if detail:
             err_msg += f": {detail}"
         super().__init__(err_msg, status_code)
+
+
+class MetricCancelledException(_MetricsPackageException):
+    """
+    Raised in the thread of a metric which has timed out (see metrics.cancellation), to stop
+    it querying the model for a result which will be discarded.
+    """
+
+    def __init__(self, detail=None, status_code=504):
+        err_msg = "Metric calculation was cancelled"
+        if detail:
+            err_msg += f": {detail}"
+        super().__init__(err_msg, status_code)
@@ -7,6 +7,15 @@
 
 # TODO: Update pydocs for regression tasks
 
+import os
+import time
+import threading
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError
+)
+from typing import Union
 from metrics.models import (
     CalculateRequest,
     MetricValue,
@@ -35,10 +44,13 @@ from metrics.numerical_metrics import (
     explanation_sparsity_score,
     explanation_stability_score,
     ood_auroc,
-    create_fairness_metric_fn,
+    fairness_metric_fn,
     equalized_odds_difference,
     hello_score
 )
+from metrics.artifacts import plan_artifacts, compute_artifacts, get_artifact
+from metrics.cancellation import run_cancellable
+from metrics.sufficient_statistics import compute_sufficient_statistics
 from metrics.textual_input_metrics import (
     expl_stability_text_input,
     expl_sparsity_text_input,
@@ -113,7 +125,7 @@ task_type_to_metric = {
     When adding new metrics, ensure that they are added to the appropriate model type.
 """
 
-# Define metric properties for aif360 fairness metrics
+# Define metric properties for fairness metrics (as defined by aif360)
 aif360_metric_properties = {
     "statistical_parity_difference": {"range": (-1, 1), "ideal_value": 0},
     "equal_opportunity_difference": {"range": (-1, 1), "ideal_value": 0},
@@ -124,36 +136,52 @@ aif360_metric_properties = {
     "true_positive_rate_difference": {"range": (-1, 1), "ideal_value": 0}
 }
 
-""" Mapping of metric names to their corresponding functions and required inputs"""
+# How calculate_metrics runs metrics: "sequential" runs them one after another, "parallel"
+# runs them in a thread pool
+METRICS_EXECUTION_MODE = os.environ.get("METRICS_EXECUTION_MODE", "sequential")
+METRICS_MAX_THREADS = int(os.environ.get("METRICS_MAX_THREADS", "16"))
+# Default time limit for computing a single metric in parallel mode, in seconds, counted from
+# when the metric starts running. A metric which times out is reported as failed and cancelled:
+# its thread cannot be interrupted, so it runs until its next model query (see metrics.cancellation)
+METRICS_TIMEOUT_SECONDS = float(os.environ.get("METRICS_TIMEOUT_SECONDS", "300"))
+
+""" Mapping of metric names to their corresponding functions and required inputs, as well as
+    any intermediate artifacts (see metrics.artifacts) shared with other metrics.
+    Metrics may also set "timeout" to override METRICS_TIMEOUT_SECONDS."""
 metric_to_fn_and_requirements = {
     # Performance metrics
     "accuracy": {
         "function": accuracy,
         "required_inputs": ["true_labels", "predicted_labels"],
+        "artifacts": ["confusion_matrix"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
     "class_precision": {
         "function": class_precision,
         "required_inputs": ["true_labels", "predicted_labels", "target_class"],
+        "artifacts": ["confusion_matrix"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
     "precision": {
         "function": macro_precision,
         "required_inputs": ["true_labels", "predicted_labels"],
+        "artifacts": ["confusion_matrix"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
     "class_recall": {
         "function": class_recall,
         "required_inputs": ["true_labels", "predicted_labels", "target_class"],
+        "artifacts": ["confusion_matrix"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
     "recall": {
         "function": macro_recall,
         "required_inputs": ["true_labels", "predicted_labels"],
+        "artifacts": ["confusion_matrix"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
@@ -166,6 +194,7 @@ metric_to_fn_and_requirements = {
     "f1_score": {
         "function": macro_f1,
         "required_inputs": ["true_labels", "predicted_labels"],
+        "artifacts": ["confusion_matrix"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
@@ -202,9 +231,7 @@ metric_to_fn_and_requirements = {
     # Fairness metrics
     **{
         metric_name: {
-            "function": create_fairness_metric_fn(
-                lambda metric, name=metric_name: getattr(metric, name)()
-            ),
+            "function": fairness_metric_fn(metric_name),
             "required_inputs": [
                 "true_labels",
                 "predicted_labels",
@@ -212,6 +239,7 @@ metric_to_fn_and_requirements = {
                 "privileged_groups",
                 "unprivileged_groups"
             ],
+            "artifacts": ["fairness_counts"],
             "range": aif360_metric_properties[metric_name]["range"],
             "ideal_value": aif360_metric_properties[metric_name]["ideal_value"]
         }
@@ -220,6 +248,7 @@ metric_to_fn_and_requirements = {
     "equalized_odds_difference": {
         "function": equalized_odds_difference,
         "required_inputs": ["true_labels", "predicted_labels", "protected_attr"],
+        "artifacts": ["fairness_counts"],
         "range": (-1, 1),
         "ideal_value": 0
     },
@@ -230,18 +259,21 @@ metric_to_fn_and_requirements = {
         "function": explanation_stability_score,
         # TODO: Refactor to nested dict for task to metric map for more fine grained checks
         "required_inputs": ["input_features", "model_url", "model_api_key"],
+        "artifacts": ["lime", "gradients"],
         "range": (0, 1),
         "ideal_value": 0.8
     },
     "explanation_sparsity_score": {
         "function": explanation_sparsity_score,
         "required_inputs": ["input_features", "model_url", "model_api_key"],
+        "artifacts": ["lime_predictions"],
         "range": (0, 1),
         "ideal_value": 0.7
     },
     "explanation_fidelity_score": {
         "function": explanation_fidelity_score,
         "required_inputs": ["input_features", "model_url", "model_api_key"],
+        "artifacts": ["lime"],
         "range": (0, 1),
         "ideal_value": 0.85
     },
@@ -249,6 +281,7 @@ metric_to_fn_and_requirements = {
     "expl_stability_text_input": {
         "function": expl_stability_text_input,
         "required_inputs": ["input_features", "model_url", "model_api_key"],
+        "artifacts": ["text_input_lime"],
         "range": (0, 1),
         "ideal_value": 0.7
     },
@@ -269,6 +302,7 @@ metric_to_fn_and_requirements = {
     "ood_auroc": {
         "function": ood_auroc,
         "required_inputs": ["input_features", "confidence_scores", "model_url", "model_api_key"],
+        "artifacts": ["ood_scores"],
         "range": (0, 1),
         "ideal_value": 0.85
     },
@@ -330,6 +364,101 @@ def check_metrics_are_supported_for_task(info: CalculateRequest):
     return metrics_to_exceptions
 
 
+def _compute_metric(
+    metric: str, info: CalculateRequest
+) -> Union[MetricValue, _MetricsPackageException]:
+    """
+    Compute a single metric, returning the exception in place of the result if the
+    calculation fails so that other metrics can still be calculated.
+
+    :param metric: str - name of the metric in metric_to_fn_and_requirements
+    :param info: CalculateRequest - data required for calculation of the metric
+    :return: MetricValue | _MetricsPackageException - the result or the exception raised
+    """
+    try:
+        # Call the function for the metric and store the result
+        metric_result = metric_to_fn_and_requirements[metric]["function"](info)
+
+        return MetricValue(
+            computed_value=metric_result,
+            ideal_value=metric_to_fn_and_requirements[metric]["ideal_value"],
+            range=metric_to_fn_and_requirements[metric]["range"]
+        )
+
+    # Return an exception in place of the metric result if applicable
+    # Approach allows valid metrics to still be calculated
+    except _MetricsPackageException as e:
+        print(e)
+        return e
+    except Exception as e:
+        print(e)
+        return MetricsComputationException(metric, detail=str(e))
+
+
+def _compute_metrics_in_parallel(
+    metrics: list[str], artifact_plan: list[str], info: CalculateRequest
+) -> dict:
+    """
+    Compute metrics concurrently in a thread pool. Artifacts are submitted first so that they
+    are computed before the metrics waiting on them. Each metric has its own time limit counted
+    from when it starts running, so metrics waiting for a thread never time out. Threads cannot
+    be interrupted, so a metric which times out is cancelled: its thread stops at its next model
+    query, and its result is discarded.
+
+    :param metrics: list[str] - the metrics to compute
+    :param artifact_plan: list[str] - the artifacts required by the metrics, in order
+    :param info: CalculateRequest - data required for calculation of the metrics
+    :return: dict - mapping of each metric to its MetricValue or exception
+    """
+    results = {}
+    futures: dict[str, Future] = {}
+    timeouts: dict[str, float] = {}
+    started_at: dict[str, float] = {}
+    started = {metric: threading.Event() for metric in metrics}
+    cancelled = {metric: threading.Event() for metric in metrics}
+
+    def compute(metric: str):
+        started_at[metric] = time.monotonic()
+        started[metric].set()
+        return run_cancellable(cancelled[metric], _compute_metric, metric, info)
+
+    thread_pool = ThreadPoolExecutor(
+        max_workers=max(1, min(METRICS_MAX_THREADS, len(metrics) + len(artifact_plan)))
+    )
+    try:
+        for artifact in artifact_plan:
+            thread_pool.submit(get_artifact, info, artifact)
+
+        for metric in metrics:
+            properties = metric_to_fn_and_requirements.get(metric, {})
+            futures[metric] = thread_pool.submit(compute, metric)
+            timeouts[metric] = properties.get("timeout", METRICS_TIMEOUT_SECONDS)
+
+        for metric, future in futures.items():
+            # The metric's time limit starts once it has a thread
+            started[metric].wait()
+            deadline = started_at[metric] + timeouts[metric]
+            try:
+                results[metric] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                cancelled[metric].set()
+                results[metric] = MetricsComputationException(
+                    metric,
+                    detail=f"Metric calculation timed out after {timeouts[metric]}s",
+                    status_code=504
+                )
+                print(results[metric])
+            except Exception as e:
+                results[metric] = MetricsComputationException(metric, detail=str(e))
+                print(results[metric])
+    finally:
+        # Do not wait for metrics that timed out - their threads stop at their next model
+        # query, and their results are discarded
+        thread_pool.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
 def calculate_metrics(info: CalculateRequest) -> MetricConfig:
     """
     calculate_metrics, given a request for calculation of certain metrics and information
@@ -340,7 +469,6 @@ def calculate_metrics(info: CalculateRequest) -> MetricConfig:
     data required for calculation of these metrics.
     :return: MetricConfig - contains the calculated metrics and their scores
     """
-    current_metric = "calculate_metrics"
     info.metrics = list(map(lambda metric: metric.replace(" ", "_"), info.metrics))
     # Input validation
     if info.confidence_scores is not None:
@@ -361,36 +489,32 @@ def calculate_metrics(info: CalculateRequest) -> MetricConfig:
             info
         )
 
-    for metric in info.metrics:
-        # Replace spaces with underscores in metric names to map to function names
-        try:
-            # Skip the metric if it is known to throw an error
-            if metric in results:
-                continue
+    # Compute the intermediate artifacts required by the metrics once, in dependency order
+    artifact_plan = plan_artifacts({
+        artifact
+        for metric in info.metrics
+        if metric not in results and metric in metric_to_fn_and_requirements
+        for artifact in metric_to_fn_and_requirements[metric].get("artifacts", [])
+    })
+    metrics_to_compute = [metric for metric in dict.fromkeys(info.metrics) if metric not in results]
 
-            # Store the current metric name for error handling
-            current_metric = metric
+    if METRICS_EXECUTION_MODE == "sequential":
+        compute_artifacts(info, artifact_plan)
+        for metric in metrics_to_compute:
+            results[metric] = _compute_metric(metric, info)
+    else:
+        results = results | _compute_metrics_in_parallel(metrics_to_compute, artifact_plan, info)
 
-            # Call the function for the metric and store the result
-            metric_result = metric_to_fn_and_requirements[metric]["function"](info)
-
-            # Store the result in the results object
-            results[metric] = MetricValue(
-                computed_value=metric_result,
-                ideal_value=metric_to_fn_and_requirements[metric]["ideal_value"],
-                range=metric_to_fn_and_requirements[metric]["range"]
-            )
+    # Statistics allowing the aggregator to combine metrics across batches exactly
+    sufficient_statistics = compute_sufficient_statistics(
+        info, [metric for metric, result in results.items() if isinstance(result, MetricValue)]
+    )
 
-        # Return an exception in place of the metric result if applicable
-        # Approach allows valid metrics to still be calculated
-        except _MetricsPackageException as e:
-            results[metric] = e
-            print(e)
-        except Exception as e:
-            print(e)
-            results[metric] = MetricsComputationException(current_metric, detail=str(e))
+    cache_stats = info.model_response_cache.stats()
+    print(f"Model response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
     return MetricConfig(
         metric_values=results,
         batch_size=info.batch_size,
-        total_sample_size=info.total_sample_size
+        total_sample_size=info.total_sample_size,
+        sufficient_statistics=sufficient_statistics
     )
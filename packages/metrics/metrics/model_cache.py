@@ -0,0 +1,91 @@
+"""
+Request-scoped cache of model responses.
+
+Several metrics computed for the same CalculateRequest query the model endpoint with
+identical inputs. Since model queries are the most expensive part of metric calculation,
+responses are cached per request, keyed by the model URL and a hash of the input rows.
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    from common.models import ModelResponse
+
+# Maximum number of model responses cached per request (0 disables caching)
+MODEL_RESPONSE_CACHE_SIZE = int(os.environ.get("MODEL_RESPONSE_CACHE_SIZE", "128"))
+
+
+class ModelResponseCache:
+    """
+    Thread-safe, size-bounded LRU cache of model responses with hit/miss counters.
+
+    :param max_entries: int - Maximum number of responses held before the least recently
+        used one is evicted. A value of 0 disables caching.
+    """
+
+    def __init__(self, max_entries: int = MODEL_RESPONSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, "ModelResponse"] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_url: str, input_features: np.ndarray) -> str:
+        """
+        Compute the cache key for querying `model_url` with `input_features`.
+
+        :param model_url: str - URL of the model endpoint
+        :param input_features: np.ndarray - Input rows sent to the model
+        :return: str - Hex digest identifying the query
+        """
+        features = np.asarray(input_features)
+        digest = hashlib.sha256()
+        digest.update(str(model_url).encode())
+        digest.update(str(features.shape).encode())
+        if features.dtype.kind in "biuf":
+            digest.update(features.dtype.str.encode())
+            digest.update(np.ascontiguousarray(features).tobytes())
+        else:
+            # Object and string arrays (e.g. text inputs) have no stable byte representation
+            digest.update(json.dumps(features.tolist(), default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional["ModelResponse"]:
+        """
+        Return the cached response for `key`, or None if it is not cached
+        """
+        with self._lock:
+            response = self._entries.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: "ModelResponse"):
+        """
+        Cache `response` under `key`, evicting the least recently used entry if full
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters and current size of the cache
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
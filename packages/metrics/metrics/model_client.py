@@ -0,0 +1,131 @@
+"""
+Shared HTTP client used by the metrics package to query model endpoints.
+
+Explainability and OOD metrics query the model many times per batch (e.g. twice per
+feature column for finite difference gradients). Sharing one pooled session keeps
+connections alive between those calls, retries requests that the model server rejected
+because it was overloaded, and caps how many requests are in flight per endpoint.
+"""
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MODEL_QUERY_CONNECT_TIMEOUT = float(os.environ.get("MODEL_QUERY_CONNECT_TIMEOUT", "10"))
+MODEL_QUERY_READ_TIMEOUT = float(os.environ.get("MODEL_QUERY_READ_TIMEOUT", "90"))
+MODEL_QUERY_MAX_RETRIES = int(os.environ.get("MODEL_QUERY_MAX_RETRIES", "3"))
+MODEL_QUERY_BACKOFF_FACTOR = float(os.environ.get("MODEL_QUERY_BACKOFF_FACTOR", "0.5"))
+MODEL_QUERY_POOL_SIZE = int(os.environ.get("MODEL_QUERY_POOL_SIZE", "20"))
+MODEL_QUERY_MAX_CONCURRENCY_PER_ENDPOINT = int(
+    os.environ.get("MODEL_QUERY_MAX_CONCURRENCY_PER_ENDPOINT", "8")
+)
+
+# Maximum number of rows sent to a model in one request when a large number of
+# perturbed inputs is split into chunks, and how many chunks may be in flight at once
+MODEL_QUERY_CHUNK_SIZE = int(os.environ.get("MODEL_QUERY_CHUNK_SIZE", "1000"))
+MODEL_QUERY_MAX_CONCURRENT_CHUNKS = int(
+    os.environ.get("MODEL_QUERY_MAX_CONCURRENT_CHUNKS", "4")
+)
+
+# Status codes that indicate the model server is temporarily unable to serve the request
+RETRY_STATUS_CODES = (429, 503)
+
+_session = None
+_session_lock = threading.Lock()
+_endpoint_semaphores: dict[str, threading.BoundedSemaphore] = {}
+_endpoint_semaphores_lock = threading.Lock()
+# Model endpoints which have replied with an npz archive, and so accept one as input
+_npz_endpoints: set[str] = set()
+
+
+def _create_session() -> requests.Session:
+    """
+    Create a session with connection pooling and retry-with-backoff for overloaded
+    model servers. Retry-After headers sent by the server are respected.
+    """
+    retry = Retry(
+        total=MODEL_QUERY_MAX_RETRIES,
+        connect=MODEL_QUERY_MAX_RETRIES,
+        read=0,
+        status=MODEL_QUERY_MAX_RETRIES,
+        backoff_factor=MODEL_QUERY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        # Model queries are side-effect free, so retrying POSTs is safe
+        allowed_methods=frozenset({"POST"}),
+        respect_retry_after_header=True,
+        # Return the last response so that callers can report the server's error
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=MODEL_QUERY_POOL_SIZE,
+        pool_maxsize=MODEL_QUERY_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Return the session shared by every model query made by the metrics package
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def _get_endpoint_semaphore(url: str) -> threading.BoundedSemaphore:
+    """
+    Return the semaphore limiting the number of concurrent requests to `url`
+    """
+    with _endpoint_semaphores_lock:
+        if url not in _endpoint_semaphores:
+            _endpoint_semaphores[url] = threading.BoundedSemaphore(
+                MODEL_QUERY_MAX_CONCURRENCY_PER_ENDPOINT
+            )
+        return _endpoint_semaphores[url]
+
+
+def accepts_npz(url: str) -> bool:
+    """
+    Whether the model endpoint at `url` is known to accept npz archives as input
+    """
+    return url in _npz_endpoints
+
+
+def set_accepts_npz(url: str, accepted: bool):
+    """
+    Record whether the model endpoint at `url` accepts npz archives as input
+    """
+    if accepted:
+        _npz_endpoints.add(url)
+    else:
+        _npz_endpoints.discard(url)
+
+
+def post_to_model(
+    url: str, json: dict = None, headers: dict = None, data: bytes = None
+) -> requests.Response:
+    """
+    POST a payload to a model endpoint using the shared session.
+
+    :param url: URL of the model endpoint
+    :param json: JSON-serialisable payload to send
+    :param headers: Optional headers (e.g. authorisation) to send with the request
+    :param data: Raw body to send instead of a JSON payload, e.g. an npz archive
+    :return: The response from the model endpoint, after any retries
+    """
+    with _get_endpoint_semaphore(url):
+        return get_session().post(
+            url,
+            json=json,
+            data=data,
+            headers=headers,
+            timeout=(MODEL_QUERY_CONNECT_TIMEOUT, MODEL_QUERY_READ_TIMEOUT),
+        )
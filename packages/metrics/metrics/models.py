@@ -1,7 +1,9 @@
-from pydantic import BaseModel, field_validator, HttpUrl, Field
-from typing import Optional, Any, Union, Tuple
-from common.utils import nested_list_to_np
+from pydantic import BaseModel, field_validator, HttpUrl, Field, PrivateAttr
+from typing import Optional, Any, Union, Tuple, Callable
+from common.utils import decode_categories, nested_list_to_np
 from metrics.exceptions import _MetricsPackageException
+from metrics.model_cache import ModelResponseCache
+from metrics.artifact_store import ArtifactStore
 import numpy as np
 from enum import Enum
 
@@ -57,6 +59,9 @@ class CalculateRequest(BaseModel):
     :param protected_attr: Optional[list[int]] - List of indices representing protected attributes.
     :param model_url: Optional[HttpUrl] - URL of the model endpoint.
     :param model_api_key: Optional[str] - API key for accessing the model endpoint.
+    :param feature_categories: Optional[dict[int, list]] - Categories of each categorical column
+        of input_features by column index, whose values in input_features are integer codes into
+        these categories (see common.utils.typed_features_to_np).
     """
     metrics: list[str]
     # TODO: Refactor to make task_name non-optional and remove regression_flag
@@ -72,23 +77,65 @@ class CalculateRequest(BaseModel):
     protected_attr: Optional[list[int]] = None
     model_url: Optional[HttpUrl] = None
     model_api_key: Optional[str] = None
+    feature_categories: Optional[dict[int, list]] = None
 
     # TODO: Refactor this to a better implementation
     regression_flag: bool = False
 
     total_sample_size: int
 
-    # Convert the 'true_labels' and 'predicted_labels' into np.arrays
+    # Cache of model responses shared by every metric calculated for this request
+    _model_response_cache: ModelResponseCache = PrivateAttr(default_factory=ModelResponseCache)
+
+    # Intermediate artifacts (e.g. LIME surrogates) shared by the metrics for this request
+    _artifacts: ArtifactStore = PrivateAttr(default_factory=ArtifactStore)
+
+    # Representations derived from fields, built on first use with the fields they were built from
+    _derived: dict[str, tuple[tuple, Any]] = PrivateAttr(default_factory=dict)
+
+    @property
+    def model_response_cache(self) -> ModelResponseCache:
+        return self._model_response_cache
+
+    @property
+    def artifacts(self) -> ArtifactStore:
+        return self._artifacts
+
+    @property
+    def decoded_input_features(self):
+        """
+        input_features with the codes of categorical columns replaced by their categories,
+        as sent to models and user-defined metrics. Decoded once, when first used.
+        """
+        return self._derive(
+            "decoded_input_features", decode_categories, "input_features", "feature_categories"
+        )
+
+    def _derive(self, name: str, build: Callable, *fields: str):
+        """
+        Returns the representation built from the given fields, building it only if it has not
+        been built yet or any of the fields was reassigned since
+        """
+        sources = tuple(getattr(self, field) for field in fields)
+        cached = self._derived.get(name)
+        if cached is None or any(old is not new for old, new in zip(cached[0], sources)):
+            cached = self._derived[name] = (sources, build(*sources))
+        return cached[1]
+
+    # Convert the 'true_labels' and 'predicted_labels' into np.arrays. Arrays given directly
+    # (e.g. decoded from a binary model response) are not validated element by element.
     @field_validator(
         "input_features",
         "confidence_scores",
         "true_labels",
         "predicted_labels",
         "protected_attr",
-        mode="after",
+        mode="wrap",
     )
-    def convert_to_np_arrays(cls, v):
-        return nested_list_to_np(v)
+    def convert_to_np_arrays(cls, v, handler):
+        if isinstance(v, np.ndarray):
+            return v
+        return nested_list_to_np(handler(v))
 
 
 def convert_calculate_request_to_dict(info: CalculateRequest) -> dict:
@@ -97,6 +144,7 @@ def convert_calculate_request_to_dict(info: CalculateRequest) -> dict:
 
     :param info: CalculateRequest - The internal model representing the metric calculation request.
     :return: dict - A dictionary containing relevant fields, with NumPy arrays converted to lists.
+        The lists are converted once per request and shared by every call, so must not be modified.
     """
     def safe_convert(value):
         """Recursively convert NumPy arrays to lists for JSON serialization."""
@@ -111,14 +159,17 @@ def convert_calculate_request_to_dict(info: CalculateRequest) -> dict:
     return {
         "metrics": info.metrics,
         "task_name": info.task_name,
-        "input_data": safe_convert(info.input_features),
-        "confidence_scores": safe_convert(info.confidence_scores),
-        "true_labels": safe_convert(info.true_labels),
-        "predicted_labels": safe_convert(info.predicted_labels),
+        "input_data": info._derive(
+            "input_data", lambda *_: safe_convert(info.decoded_input_features),
+            "input_features", "feature_categories",
+        ),
+        "confidence_scores": info._derive("confidence_scores", safe_convert, "confidence_scores"),
+        "true_labels": info._derive("true_labels", safe_convert, "true_labels"),
+        "predicted_labels": info._derive("predicted_labels", safe_convert, "predicted_labels"),
         "target_class": info.target_class,
         "privileged_groups": safe_convert(info.privileged_groups),
         "unprivileged_groups": safe_convert(info.unprivileged_groups),
-        "protected_attr": safe_convert(info.protected_attr),
+        "protected_attr": info._derive("protected_attr", safe_convert, "protected_attr"),
         "model_url": str(info.model_url) if info.model_url else None,
         "model_api_key": info.model_api_key,
         "batch_size": info.batch_size,
@@ -171,6 +222,8 @@ class MetricConfig(BaseModel):
     batch_size: int
     total_sample_size: int
     warning_msg: Optional[str] = None
+    # Mergeable statistics the metrics are derived from (see metrics.sufficient_statistics)
+    sufficient_statistics: Optional[dict[str, dict]] = None
 
 
 class WorkerException(Exception):
@@ -192,3 +245,5 @@ class WorkerResults(MetricConfig):
     """
 
     user_defined_metrics: Optional[dict[str, dict]] = None
+    # Identifies the batch, so that the aggregator can ignore results it receives twice
+    batch_id: Optional[str] = None
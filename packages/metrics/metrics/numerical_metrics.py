@@ -4,12 +4,8 @@ from typing import Callable
 from metrics.models import (
     CalculateRequest,
 )
-from metrics.utils import (
-    _query_model,
-    _lime_explanation,
-    _finite_difference_gradient_predictions,
-    _finite_difference_gradient_confidence_scores
-)
+from metrics.utils import _lime_explanation
+from metrics.artifacts import get_artifact
 from sklearn.metrics import (
     f1_score,
     roc_auc_score,
@@ -17,7 +13,6 @@ from sklearn.metrics import (
     mean_squared_error as mse,
     r2_score,
 )
-from metrics.ntg_metric_utils import generate_random_strings
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics.pairwise import cosine_similarity
 from aif360.metrics import ClassificationMetric
@@ -28,7 +23,7 @@ from metrics.exceptions import (
     MetricsComputationException,
     DataProvisionException
 )
-from common.models import ModelResponse, TaskType
+from common.models import TaskType
 
 
 def is_valid_for_per_class_metrics(metric_name, true_labels):
@@ -65,36 +60,59 @@ def is_valid_for_per_class_metrics(metric_name, true_labels):
 """
 
 
-def accuracy(info: CalculateRequest) -> float:
+def _per_class_counts(info: CalculateRequest) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
-    Calculate the accuracy of the model
+    Derive per-class counts from the confusion matrix shared by the classification metrics
 
-    :param info: CalculateRequest - contains information required to calculate the metric.
-        accuracy requires true_labels and predicted_labels to be provided.
+    :param info: CalculateRequest - requires true_labels and predicted_labels to be provided.
+    :return: (classes, tp, predicted, support) - the classes appearing in either set of labels,
+        and for each class the number of true positives, the number of samples predicted as
+        the class and the number of samples truly of the class
     """
-    return (info.true_labels == info.predicted_labels).mean()
+    classes, matrix = get_artifact(info, "confusion_matrix")
+    return (classes, *_class_counts(matrix))
 
 
-def _calculate_precision(metric_name, true_labels, predicted_labels, target_class):
+def _class_counts(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param matrix: np.ndarray - confusion matrix, as computed by _confusion_matrix
+    :return: (tp, predicted, support) - for each class the number of true positives, the number
+        of samples predicted as the class and the number of samples truly of the class
     """
-    Apply the precision formula to the given data
+    matrix = np.asarray(matrix)
+    return np.diag(matrix), matrix.sum(axis=0), matrix.sum(axis=1)
 
-    :param metric_name: str - name of the metric being calculated for error handling
-    :param true_labels: np.array - the true labels for the dataset
-    :param predicted_labels: np.array - the predicted labels for the dataset
-    :param target_class: int - the class for which precision is being calculated
 
-    :raises MetricsException: if the input is invalid for the given metric
-    :return: float - the precision score for the given class
+def _safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
     """
-    target_reshaped = np.full_like(true_labels, target_class)
-    tp = np.count_nonzero(
-        (true_labels == target_reshaped) & (predicted_labels == target_reshaped)
-    )
-    fp = np.count_nonzero(
-        (true_labels != target_reshaped) & (predicted_labels == target_reshaped)
-    )
-    return tp / (tp + fp) if (tp + fp) != 0 else 0
+    Element-wise division, returning 0 where the denominator is 0
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+def _class_index(classes: np.ndarray, target_class) -> int | None:
+    """
+    Index of target_class in classes, or None if the class does not appear in the labels
+    """
+    matches = np.flatnonzero(classes == target_class)
+    return matches[0] if len(matches) > 0 else None
+
+
+def accuracy(info: CalculateRequest) -> float:
+    """
+    Calculate the accuracy of the model
+
+    :param info: CalculateRequest - contains information required to calculate the metric.
+        accuracy requires true_labels and predicted_labels to be provided.
+    """
+    true_labels = np.asarray(info.true_labels)
+    if true_labels.ndim == 2 and true_labels.shape[1] == 1 and true_labels.shape == np.shape(info.predicted_labels):
+        _, matrix = get_artifact(info, "confusion_matrix")
+        return np.trace(matrix) / matrix.sum()
+    # Element-wise accuracy over all attributes for multi-attribute labels
+    return (info.true_labels == info.predicted_labels).mean()
 
 
 def class_precision(info: CalculateRequest) -> float:
@@ -110,9 +128,9 @@ def class_precision(info: CalculateRequest) -> float:
     """
     name = "class_precision"
     is_valid_for_per_class_metrics(name, info.true_labels)
-    return _calculate_precision(
-        name, info.true_labels, info.predicted_labels, info.target_class
-    )
+    classes, tp, predicted, _ = _per_class_counts(info)
+    index = _class_index(classes, info.target_class)
+    return 0 if index is None else _safe_divide(tp, predicted)[index].item()
 
 
 def macro_precision(info: CalculateRequest) -> float:
@@ -126,34 +144,13 @@ def macro_precision(info: CalculateRequest) -> float:
     """
     name = "macro_precision"
     is_valid_for_per_class_metrics(name, info.true_labels)
-    return sum(
-        [
-            _calculate_precision(name, info.true_labels, info.predicted_labels, c)
-            for c in np.unique(info.true_labels)
-        ]
-    ) / len(np.unique(info.true_labels))
+    _, tp, predicted, support = _per_class_counts(info)
+    return _macro_precision_from_counts(tp, predicted, support)
 
 
-def _calculate_recall(metric_name, true_labels, predicted_labels, target_class):
-    """
-    Apply the recall formula to the given data
-
-    :param metric_name: str - name of the metric being calculated for error handling
-    :param true_labels: np.array - the true labels for the dataset
-    :param predicted_labels: np.array - the predicted labels for the dataset
-    :param target_class: int - the class for which recall is being calculated
-
-    :raises MetricsException: if the input is invalid for the given metric
-    :return: float - the recall score for the given class
-    """
-    target_reshaped = np.full_like(true_labels, target_class)
-    tp = np.count_nonzero(
-        (true_labels == target_reshaped) & (predicted_labels == target_reshaped)
-    )
-    fn = np.count_nonzero(
-        (true_labels == target_reshaped) & (predicted_labels != target_reshaped)
-    )
-    return tp / (tp + fn) if (tp + fn) != 0 else 0
+def _macro_precision_from_counts(tp: np.ndarray, predicted: np.ndarray, support: np.ndarray) -> float:
+    # Average over the classes present in the true labels
+    return _safe_divide(tp, predicted)[support > 0].mean().item()
 
 
 def class_recall(info: CalculateRequest) -> float:
@@ -169,9 +166,9 @@ def class_recall(info: CalculateRequest) -> float:
     """
     name = "class_recall"
     is_valid_for_per_class_metrics(name, info.true_labels)
-    return _calculate_recall(
-        name, info.true_labels, info.predicted_labels, info.target_class
-    )
+    classes, tp, _, support = _per_class_counts(info)
+    index = _class_index(classes, info.target_class)
+    return 0 if index is None else _safe_divide(tp, support)[index].item()
 
 
 def macro_recall(info: CalculateRequest) -> float:
@@ -185,12 +182,13 @@ def macro_recall(info: CalculateRequest) -> float:
     """
     name = "macro_recall"
     is_valid_for_per_class_metrics(name, info.true_labels)
-    return sum(
-        [
-            _calculate_recall(name, info.true_labels, info.predicted_labels, c)
-            for c in np.unique(info.true_labels)
-        ]
-    ) / len(np.unique(info.true_labels))
+    _, tp, predicted, support = _per_class_counts(info)
+    return _macro_recall_from_counts(tp, predicted, support)
+
+
+def _macro_recall_from_counts(tp: np.ndarray, predicted: np.ndarray, support: np.ndarray) -> float:
+    # Average over the classes present in the true labels
+    return _safe_divide(tp, support)[support > 0].mean().item()
 
 
 # TODO: Check if this function is even required as it's not any new functionality for the library
@@ -222,7 +220,13 @@ def macro_f1(info: CalculateRequest) -> float:
     """
     name = "macro_f1"
     is_valid_for_per_class_metrics(name, info.true_labels)
-    return f1_score(info.true_labels, info.predicted_labels, average="macro")
+    _, tp, predicted, support = _per_class_counts(info)
+    return _macro_f1_from_counts(tp, predicted, support)
+
+
+def _macro_f1_from_counts(tp: np.ndarray, predicted: np.ndarray, support: np.ndarray) -> float:
+    # F1 = 2TP / (2TP + FP + FN), averaged over every class in either set of labels
+    return _safe_divide(2 * tp, predicted + support).mean().item()
 
 
 def roc_auc(info: CalculateRequest) -> float:
@@ -346,6 +350,129 @@ def _prepare_datasets_for_aif360(info: CalculateRequest):
 """
 
 
+def _matching_groups(groups: np.ndarray, group_definitions: list[dict]) -> np.ndarray:
+    """
+    Find the values of the protected attribute belonging to the given groups. As in aif360,
+    a value belongs to the groups if it matches any one of the group definitions.
+
+    :param groups: np.ndarray - the values of the protected attribute
+    :param group_definitions: list[dict] - e.g. [{"protected_attr": 1}]
+    :return: np.ndarray - boolean mask over groups
+    """
+    mask = np.zeros(len(groups), dtype=bool)
+    for definition in group_definitions:
+        unknown_attributes = set(definition) - {"protected_attr"}
+        if unknown_attributes:
+            raise DataProvisionException(
+                detail=f"Unknown protected attributes in group definition: {sorted(unknown_attributes)}"
+            )
+        if "protected_attr" in definition:
+            mask |= groups == definition["protected_attr"]
+        else:
+            # An empty definition matches every sample
+            mask[:] = True
+    return mask
+
+
+def _fairness_rates(counts: np.ndarray) -> dict[str, np.float64]:
+    """
+    Derive the rates used by the fairness metrics from binary confusion counts. As in aif360,
+    rates with a zero denominator are nan (or inf) rather than raising an error.
+
+    :param counts: np.ndarray - 2x2 counts where counts[t, p] is the number of samples whose
+        true (t) and predicted (p) labels are favourable (1) or not (0)
+    :return: dict[str, np.float64] - the rates for the samples counted
+    """
+    tn, fp, fn, tp = counts.astype(np.float64).ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "selection_rate": (tp + fp) / (tp + fp + tn + fn),
+            "true_positive_rate": tp / (tp + fn),
+            "false_negative_rate": fn / (tp + fn),
+            "positive_predictive_value": tp / (tp + fp),
+            "negative_predictive_value": tn / (tn + fn),
+        }
+
+
+def _difference(rate: str) -> Callable[[dict, dict, dict], np.float64]:
+    return lambda unprivileged, privileged, _: unprivileged[rate] - privileged[rate]
+
+
+fairness_metric_definitions = {
+    "statistical_parity_difference": _difference("selection_rate"),
+    "disparate_impact": lambda unprivileged, privileged, _: np.divide(
+        unprivileged["selection_rate"], privileged["selection_rate"]
+    ),
+    "equal_opportunity_difference": _difference("true_positive_rate"),
+    "false_negative_rate_difference": _difference("false_negative_rate"),
+    "negative_predictive_value": lambda _, __, overall: overall["negative_predictive_value"],
+    "positive_predictive_value": lambda _, __, overall: overall["positive_predictive_value"],
+    "true_positive_rate_difference": _difference("true_positive_rate"),
+}
+"""
+    Definitions of the fairness metrics in terms of the rates of the unprivileged group,
+    privileged group and all samples, matching aif360's ClassificationMetric
+"""
+
+
+def fairness_metric_fn(metric_name: str) -> Callable:
+    """
+    fairness_metric_fn generates the function to calculate a fairness metric from the per-group
+    confusion counts shared by all fairness metrics, without constructing aif360 datasets.
+
+    :param metric_name: str - name of the metric in fairness_metric_definitions
+    :return: Callable - a function calculating the metric for a CalculateRequest
+    """
+    def wrapper(info: CalculateRequest) -> float:
+        """
+        :param: info: CalculateRequest - contains information required to calculate the metric.
+            wrapper requires true_labels, predicted_labels, protected_attr, privileged_groups,
+            and unprivileged_groups to be provided.
+
+        :return: float - the calculated fairness metric value
+        """
+        groups, counts = get_artifact(info, "fairness_counts")
+        return _fairness_metric_from_counts(
+            metric_name, groups, counts, info.privileged_groups, info.unprivileged_groups
+        )
+
+    return wrapper
+
+
+def _fairness_metric_from_counts(
+    metric_name: str,
+    groups: np.ndarray,
+    counts: np.ndarray,
+    privileged_groups: list[dict],
+    unprivileged_groups: list[dict]
+) -> float:
+    """
+    Calculate a fairness metric from per-group confusion counts, as computed by
+    _group_confusion_counts.
+
+    :param metric_name: str - name of the metric in fairness_metric_definitions
+    :param groups: np.ndarray - the values of the protected attribute
+    :param counts: np.ndarray - 2x2 confusion counts for each value of the protected attribute
+    :param privileged_groups: list[dict] - definitions of the privileged groups
+    :param unprivileged_groups: list[dict] - definitions of the unprivileged groups
+    :return: float - the calculated fairness metric value
+    """
+    groups = np.asarray(groups)
+    counts = np.asarray(counts).reshape(len(groups), 2, 2)
+    unprivileged = _fairness_rates(counts[_matching_groups(groups, unprivileged_groups)].sum(axis=0))
+    privileged = _fairness_rates(counts[_matching_groups(groups, privileged_groups)].sum(axis=0))
+    overall = _fairness_rates(counts.sum(axis=0))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = fairness_metric_definitions[metric_name](unprivileged, privileged, overall)
+
+    if np.isnan(result):
+        # 0 returned to avoid division by zero errors
+        # TODO: Only return 0 if division by zero has been identified
+        return 0
+    return float(result)
+
+
 def equalized_odds_difference(info: CalculateRequest) -> float:
     """
     Compute equalized odds difference from a CalculateRequest.
@@ -359,33 +486,30 @@ def equalized_odds_difference(info: CalculateRequest) -> float:
     name = "equalized_odds_difference"
     is_valid_for_per_class_metrics(name, info.true_labels)
 
-    labels = info.true_labels
-    predictions = info.predicted_labels
-    groups = np.array(info.protected_attr)
+    groups, counts = get_artifact(info, "fairness_counts")
+    return _equalized_odds_difference_from_counts(groups, counts)
+
+
+def _equalized_odds_difference_from_counts(groups: np.ndarray, counts: np.ndarray) -> float:
+    """
+    Compute equalized odds difference between protected attribute values 0 and 1 from
+    per-group confusion counts, as computed by _group_confusion_counts.
+    """
+    groups = np.asarray(groups)
+    counts = np.asarray(counts).reshape(len(groups), 2, 2)
 
     def rate(target_label, group):
         """Compute TPR or FPR based on the target class and group."""
-        # Select only data belonging to the current group (group mask)
-        group_mask = (groups == group)
-
-        # Filter the labels, predictions, and groups for the current group
-        group_labels = labels[group_mask]
-        group_predictions = predictions[group_mask]
-
-        if target_label == 1:
-            # True Positive Rate (TPR) -> TP / (TP + FN)
-            tp = np.count_nonzero((group_labels == 1) & (group_predictions == 1))
-            fn = np.count_nonzero((group_labels == 1) & (group_predictions == 0))
-            total = tp + fn
-        else:
-            # False Positive Rate (FPR) -> FP / (FP + TN)
-            fp = np.count_nonzero((group_labels == 0) & (group_predictions == 1))
-            tn = np.count_nonzero((group_labels == 0) & (group_predictions == 0))
-            total = fp + tn
+        group_counts = counts[groups == group].sum(axis=0)
+
+        # True Positive Rate (TPR) -> TP / (TP + FN)
+        # False Positive Rate (FPR) -> FP / (FP + TN)
+        positives = group_counts[target_label, 1]
+        total = group_counts[target_label].sum()
 
         if total == 0:
             return 0.0
-        return tp / total if target_label == 1 else fp / total
+        return positives / total
 
     fpr_1 = rate(0, 1)  # False positive rate for group 1
     fpr_0 = rate(0, 0)  # False positive rate for group 0
@@ -401,6 +525,9 @@ def create_fairness_metric_fn(metric_fn: Callable[[ClassificationMetric], float]
     The function in question validates the HTTPRequest input, and generates the function (callable)
     to calculate the fairness metric.
 
+    This computes metrics through aif360 and is kept as the reference implementation for
+    fairness_metric_fn, which is used for metric calculation.
+
     :param metric_fn: Callable[[ClassificationMetric], float] - a function that takes list of
       ClassificationMetric objects and returns a metric value of type float (i.e. metric output)
     :return: Callable - a function that takes the name of the metric and information required in
@@ -449,24 +576,19 @@ def explanation_stability_score(info: CalculateRequest) -> float:
     :return: float - the explanation stability score (1 - 1/N * sum(distance_fn(E(x), E(x')))
         where distance_fn is the distance function between two explanations E(x) and E(x')
     """
-    lime_actual, _ = _lime_explanation(info)
+    lime_actual, _ = get_artifact(info, "lime")
 
     # Calculate gradients for perturbation
-    gradients = (
-        _finite_difference_gradient_predictions(info, 0.01)
-        if info.regression_flag
-        else _finite_difference_gradient_confidence_scores(info, 0.01)
-    )
+    gradients = get_artifact(info, "gradients")
     perturbation_constant = 0.01
     perturbation = perturbation_constant * gradients
 
-    # Go in direction of greatest loss
-    temp = info.input_features
-    info.input_features = info.input_features + perturbation
+    # Go in direction of greatest loss. The request is copied rather than modified in place
+    # as other metrics may be reading it concurrently
+    perturbed_info = info.model_copy(update={"input_features": info.input_features + perturbation})
 
-    # Obtain perturbed lime output
-    lime_perturbed, _ = _lime_explanation(info)
-    info.input_features = temp
+    # Obtain perturbed lime output - computed directly as it is specific to the perturbed inputs
+    lime_perturbed, _ = _lime_explanation(perturbed_info)
 
     # use cosine-similarity for now but can be replaced with model-provider function later
     # TODO: Took absolute value of cosine similarity - verify if this is correct
@@ -474,7 +596,7 @@ def explanation_stability_score(info: CalculateRequest) -> float:
     return 1 - np.mean(diff).item()
 
 
-def explanation_sparsity_score(info: CalculateRequest, lime_fn=_lime_explanation) -> float:
+def explanation_sparsity_score(info: CalculateRequest, lime_fn=None) -> float:
     """
     Calculate the explanation sparsity score for a given model and sample inputs
 
@@ -485,13 +607,18 @@ def explanation_sparsity_score(info: CalculateRequest, lime_fn=_lime_explanation
     :return: float - the explanation sparsity score (1 - sparsity_fn(E(x)))
         where sparsity_fn is || E(x) ||_0 / d - number of coeffs within one standard deviation
         of the mean coefficients.
+    :param lime_fn: function computing the LIME explanation. Defaults to the LIME explanation
+        shared with the other explainability metrics for the request.
     """
     # Threshold for sparsity - defined arbitrarily for now
     # TODO: get mean and std of the *explanations* element-wise (per feature)
     #  - then check proportion less than 2 sigma from the mean
     # Note unnormalised inputs may have a volatile stability scores due to varying gradients
     # leading to greater variations in mean and std
-    lime_explanation_coeffs, _ = lime_fn(info, esp=True)
+    if lime_fn is None:
+        lime_explanation_coeffs, _ = get_artifact(info, "lime_predictions")
+    else:
+        lime_explanation_coeffs, _ = lime_fn(info, esp=True)
     mean = np.mean(lime_explanation_coeffs)
     std = np.std(lime_explanation_coeffs)
 
@@ -501,7 +628,7 @@ def explanation_sparsity_score(info: CalculateRequest, lime_fn=_lime_explanation
     return 1 - count_far_from_mean / len(lime_explanation_coeffs)
 
 
-def explanation_fidelity_score(info: CalculateRequest, lime_fn=_lime_explanation) -> float:
+def explanation_fidelity_score(info: CalculateRequest, lime_fn=None) -> float:
     """
     Calculate the explanation fidelity score for a given model and sample inputs.
 
@@ -513,8 +640,13 @@ def explanation_fidelity_score(info: CalculateRequest, lime_fn=_lime_explanation
         fidelity_fn is the distance function between the model output f(x) and the output of
         an interpretable approximation g(x) of the model. For classification tasks, confidence_scores
         (probabilities) are compared instead.
+    :param lime_fn: function computing the LIME explanation. Defaults to the LIME explanation
+        shared with the other explainability metrics for the request.
     """
-    _, reg_model = lime_fn(info)
+    if lime_fn is None:
+        _, reg_model = get_artifact(info, "lime")
+    else:
+        _, reg_model = lime_fn(info)
 
     # regression model predicts *probability* not prediction (after updating lime explanation)
 
@@ -549,69 +681,24 @@ def explanation_fidelity_score(info: CalculateRequest, lime_fn=_lime_explanation
 """
 
 
-def ood_auroc(info: CalculateRequest, num_ood_samples: int = 1000) -> float:
+def ood_auroc(info: CalculateRequest) -> float:
     """
     Estimate OOD AUROC by comparing in-distribution (ID) and out-of-distribution (OOD)
     confidence scores.
 
     :param info: CalculateRequest - contains information required to calculate the metric.
         ood_auroc requires input_features, confidence_scores, model_url, and model_api_key.
-    :param num_ood_samples: int - number of OOD samples to generate.
 
     :return: float - the estimated OOD AUROC score
     """
-    if info.task_name == TaskType.TEXT_CLASSIFICATION:
-        # Introduce hard limit to ood_samples due to size constraints
-        num_ood_samples = min(num_ood_samples, 100)
-
-        # In-distribution dataset (list of single-element lists, extracting strings)
-        id_data: list[str] = [sample[0] for sample in info.input_features]
-
-        # Generate OOD samples via random strings of length 10
-        # (TODO: Update to more sophisticated method)
-        ood_data: np.array = generate_random_strings(num_ood_samples).reshape(-1, 1)
-
-        # Call model endpoint to get confidence scores for OOD samples
-        response: ModelResponse = _query_model(ood_data, info)
-
-        # Flatten ID scores (take max probability for each ID sample)
-        id_scores_flat: np.array = np.max(info.confidence_scores, axis=1)
-
-        # Flatten OOD scores (take max confidence per sample)
-        ood_scores_flat: np.array = np.max(response.confidence_scores, axis=1)
-
-        # Construct labels: 1 for ID, 0 for OOD
-        labels = np.concatenate([np.ones(len(id_scores_flat)), np.zeros(num_ood_samples)])
-
-        # Ensure the scores array has the same length as labels
-        scores = np.concatenate([id_scores_flat, ood_scores_flat])
-
-        # Assert lengths match
-        assert len(labels) == len(scores), \
-            f"Length mismatch between labels and scores in OOD-AUROC calculation: {len(labels)} vs {len(scores)}"
-
-        return roc_auc_score(labels, scores)
-
-    id_data: np.array = np.array(info.input_features)   # In-distribution dataset (N x d array).
-    d: int = id_data.shape[1]                           # Feature dimensionality
-
-    id_scores: list[list] = info.confidence_scores  # Confidence scores for ID samples
-
-    # Generate OOD samples
-    id_min, id_max = id_data.min(axis=0), id_data.max(axis=0)
-    ood_data = np.random.uniform(id_min, id_max, size=(num_ood_samples, d))
-
-    # Call model endpoint to get confidence scores
-    response: ModelResponse = _query_model(ood_data, info)
-
-    # Ensure ID scores are correctly structured (flatten to a 1D list)
-    id_scores_flat = np.array([max(scores) for scores in id_scores])  # Take max probability for each ID sample
+    # Maximum confidence per sample for generated OOD samples
+    ood_scores_flat: np.array = get_artifact(info, "ood_scores")
 
-    # Ensure OOD scores are correctly structured (take max confidence per sample)
-    ood_scores_flat = np.max(response.confidence_scores, axis=1)
+    # Flatten ID scores (take max probability for each ID sample)
+    id_scores_flat: np.array = np.max(info.confidence_scores, axis=1)
 
     # Construct labels: 1 for ID, 0 for OOD
-    labels = np.concatenate([np.ones(len(id_scores_flat)), np.zeros(num_ood_samples)])
+    labels = np.concatenate([np.ones(len(id_scores_flat)), np.zeros(len(ood_scores_flat))])
 
     # Ensure the scores array has the same length as labels
     scores = np.concatenate([id_scores_flat, ood_scores_flat])
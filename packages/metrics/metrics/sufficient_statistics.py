@@ -0,0 +1,423 @@
+"""
+Mergeable sufficient statistics for metrics computed over many batches.
+
+Most metric values cannot be combined across batches by averaging them (e.g. precision,
+F1, ROC-AUC and R-squared), so alongside each batch's metric values the worker sends
+compact statistics from which those metrics can be derived: confusion counts, sums of
+errors and moments of the labels, and score histograms. The aggregator merges the
+statistics of every batch and derives each metric from the merged statistics, so that
+the result does not depend on how the samples were split into batches.
+
+Statistics are plain JSON-serialisable dicts. Metrics sharing the same statistics (e.g.
+the classification metrics all use the confusion matrix) share a single entry. Counts indexed
+by labels (confusion matrices, histograms) are sparse, listing only their non-zero cells, as
+most cells of a batch's score histogram are empty.
+"""
+import os
+from functools import partial
+from typing import Callable, Optional
+import numpy as np
+from metrics.models import CalculateRequest, TaskType
+from metrics.artifacts import get_artifact
+from metrics.exceptions import MetricsComputationException
+from metrics.numerical_metrics import (
+    _class_counts,
+    _macro_precision_from_counts,
+    _macro_recall_from_counts,
+    _macro_f1_from_counts,
+    _fairness_metric_from_counts,
+    _equalized_odds_difference_from_counts,
+    fairness_metric_definitions,
+)
+
+# Number of equal-width bins over [0, 1] used to summarise confidence scores for ROC-AUC.
+# Scores falling in the same bin are treated as ties, which bounds the error of the merged
+# ROC-AUC by the fraction of positive/negative pairs sharing a bin.
+ROC_AUC_HISTOGRAM_BINS = int(os.environ.get("ROC_AUC_HISTOGRAM_BINS", "1000"))
+
+
+"""
+    Computing statistics for a batch
+"""
+
+
+def _sparse_counts(labels: np.ndarray, shape: tuple[int, ...], index: np.ndarray, counts: np.ndarray) -> dict:
+    """
+    Counts indexed by labels along some axes, holding only the non-zero cells
+
+    :param labels: np.ndarray - the labels indexing the labelled axes
+    :param shape: tuple[int, ...] - shape of the dense counts
+    :param index: np.ndarray - index of each cell, one row per cell
+    :param counts: np.ndarray - count of each cell
+    :return: dict - {"labels", "shape", "cells"}, where each cell is its index followed by its count
+    """
+    nonzero = np.asarray(counts) != 0
+    cells = np.column_stack([np.asarray(index, dtype=np.int64).reshape(-1, len(shape)), counts])[nonzero]
+    return {"labels": np.asarray(labels).tolist(), "shape": list(shape), "cells": cells.tolist()}
+
+
+def _sparse_from_dense(labels: np.ndarray, counts: np.ndarray) -> dict:
+    """Sparse counts, as built by _sparse_counts, of dense counts indexed by labels"""
+    counts = np.asarray(counts)
+    return _sparse_counts(labels, counts.shape, np.argwhere(counts), counts[counts != 0])
+
+
+def _dense_counts(statistics: dict) -> np.ndarray:
+    """The dense counts of sparse counts, as built by _sparse_counts"""
+    shape = tuple(statistics["shape"])
+    cells = np.asarray(statistics["cells"], dtype=np.int64).reshape(-1, len(shape) + 1)
+    counts = np.zeros(shape, dtype=np.int64)
+    np.add.at(counts, tuple(cells[:, :-1].T), cells[:, -1])
+    return counts
+
+
+def _accuracy_statistics(info: CalculateRequest) -> dict:
+    """
+    Number of correctly predicted labels and total number of labels, matching accuracy for
+    both single and multi-attribute labels
+    """
+    correct = np.asarray(info.true_labels) == np.asarray(info.predicted_labels)
+    return {"correct": int(correct.sum()), "total": int(correct.size)}
+
+
+def _confusion_matrix_statistics(info: CalculateRequest) -> dict:
+    """
+    The confusion matrix shared by the classification metrics, labelled by class on both axes
+    """
+    classes, matrix = get_artifact(info, "confusion_matrix")
+    return _sparse_from_dense(classes, matrix)
+
+
+def _score_histogram_statistics(info: CalculateRequest) -> dict:
+    """
+    Histograms of the confidence scores used by roc_auc, for each true label.
+
+    Cell (i, c, b) counts the samples of class labels[i] whose score in column c of the
+    scores falls in bin b. Binary and multi-class classification use the maximum
+    confidence score (one column), text classification uses the score of every class.
+    """
+    if info.task_name in [TaskType.BINARY_CLASSIFICATION, TaskType.MULTI_CLASS_CLASSIFICATION]:
+        scores = np.max(info.confidence_scores, axis=1).reshape(-1, 1)
+    elif info.task_name in [TaskType.TEXT_CLASSIFICATION]:
+        scores = np.asarray(info.confidence_scores, dtype=np.float64)
+    else:
+        raise MetricsComputationException(
+            metric_name="roc_auc",
+            detail="Task name is not supported - cannot calculate ROC-AUC",
+            status_code=400,
+        )
+
+    labels, encoded = np.unique(np.asarray(info.true_labels).ravel(), return_inverse=True)
+    num_samples, num_columns = scores.shape
+    if num_samples != len(encoded):
+        raise MetricsComputationException(
+            metric_name="roc_auc",
+            detail="Number of confidence scores does not match number of true labels",
+            status_code=400,
+        )
+
+    bins = np.clip(
+        np.floor(scores * ROC_AUC_HISTOGRAM_BINS).astype(np.int64), 0, ROC_AUC_HISTOGRAM_BINS - 1
+    )
+    shape = (len(labels), num_columns, ROC_AUC_HISTOGRAM_BINS)
+    index = (encoded.reshape(-1, 1) * num_columns + np.arange(num_columns)) * ROC_AUC_HISTOGRAM_BINS + bins
+    # Only the occupied bins are counted, never the whole histogram
+    cells, counts = np.unique(index.ravel(), return_counts=True)
+    return _sparse_counts(labels, shape, np.column_stack(np.unravel_index(cells, shape)), counts)
+
+
+def _regression_statistics(info: CalculateRequest) -> dict:
+    """
+    Per-output sums of absolute and squared errors, and the mean and sum of squared
+    deviations (M2) of the true labels, from which MAE, MSE and R-squared are derived
+    """
+    true_labels = np.asarray(info.true_labels, dtype=np.float64)
+    predicted_labels = np.asarray(info.predicted_labels, dtype=np.float64)
+    if true_labels.ndim == 1:
+        true_labels = true_labels.reshape(-1, 1)
+        predicted_labels = predicted_labels.reshape(-1, 1)
+
+    errors = predicted_labels - true_labels
+    mean = true_labels.mean(axis=0)
+    return {
+        "count": len(true_labels),
+        "sum_absolute_error": np.abs(errors).sum(axis=0).tolist(),
+        "sum_squared_error": (errors ** 2).sum(axis=0).tolist(),
+        "mean": mean.tolist(),
+        "m2": ((true_labels - mean) ** 2).sum(axis=0).tolist(),
+    }
+
+
+def _fairness_counts_statistics(info: CalculateRequest) -> dict:
+    """
+    The 2x2 confusion counts for each value of the protected attribute, together with the
+    group definitions the fairness metrics are calculated for
+    """
+    groups, counts = get_artifact(info, "fairness_counts")
+    return {
+        **_sparse_from_dense(groups, counts),
+        "privileged_groups": info.privileged_groups,
+        "unprivileged_groups": info.unprivileged_groups,
+    }
+
+
+"""
+    Merging statistics from different batches
+"""
+
+
+def _merge_sums(a: dict, b: dict) -> dict:
+    return {key: a[key] + b[key] for key in a}
+
+
+def _merge_labelled_counts(a: dict, b: dict, axes: tuple[int, ...]) -> dict:
+    """
+    Add sparse counts whose `axes` are indexed by labels, which may differ between batches
+    (e.g. a class not appearing in one batch). The counts are aligned on the union of the labels.
+    """
+    labels = sorted(set(a["labels"]) | set(b["labels"]))
+    position = {label: i for i, label in enumerate(labels)}
+    shape = tuple(len(labels) if axis in axes else size for axis, size in enumerate(a["shape"]))
+
+    def align(statistics: dict) -> np.ndarray:
+        cells = np.asarray(statistics["cells"], dtype=np.int64).reshape(-1, len(shape) + 1)
+        label_index = np.asarray([position[label] for label in statistics["labels"]], dtype=np.int64)
+        for axis in axes:
+            cells[:, axis] = label_index[cells[:, axis]]
+        return cells
+
+    cells = np.concatenate([align(a), align(b)])
+    index, inverse = np.unique(cells[:, :-1], axis=0, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=cells[:, -1], minlength=len(index)).astype(np.int64)
+    return {**a, **_sparse_counts(labels, shape, index, counts)}
+
+
+def _merge_regression_statistics(a: dict, b: dict) -> dict:
+    """
+    Add the error sums and combine the label moments with Chan et al.'s parallel algorithm
+    """
+    count = a["count"] + b["count"]
+    if a["count"] == 0 or b["count"] == 0:
+        return dict(b if a["count"] == 0 else a)
+
+    mean_a, mean_b = np.asarray(a["mean"]), np.asarray(b["mean"])
+    delta = mean_b - mean_a
+    return {
+        "count": count,
+        "sum_absolute_error": (np.asarray(a["sum_absolute_error"]) + b["sum_absolute_error"]).tolist(),
+        "sum_squared_error": (np.asarray(a["sum_squared_error"]) + b["sum_squared_error"]).tolist(),
+        "mean": (mean_a + delta * b["count"] / count).tolist(),
+        "m2": (
+            np.asarray(a["m2"]) + b["m2"] + delta ** 2 * a["count"] * b["count"] / count
+        ).tolist(),
+    }
+
+
+"""
+    Deriving metrics from statistics
+"""
+
+
+def _confusion_matrix_metric(from_counts: Callable, statistics: dict) -> float:
+    return from_counts(*_class_counts(_dense_counts(statistics)))
+
+
+def _histogram_auc(positives: np.ndarray, negatives: np.ndarray) -> float:
+    """
+    Area under the ROC curve from score histograms of the positive and negative samples,
+    i.e. the probability that a positive sample scores higher than a negative one, with
+    samples in the same bin counting as ties
+    """
+    num_positives, num_negatives = positives.sum(), negatives.sum()
+    if num_positives == 0 or num_negatives == 0:
+        return np.nan
+    negatives_below = np.cumsum(negatives) - negatives
+    return (positives * (negatives_below + 0.5 * negatives)).sum() / (num_positives * num_negatives)
+
+
+def _roc_auc_from_histograms(statistics: dict) -> float:
+    """
+    ROC-AUC as calculated by roc_auc: for a single score column, the larger label is the
+    positive class; otherwise the macro average of one-vs-rest ROC-AUC for each class
+    """
+    counts = _dense_counts(statistics).astype(np.float64)
+    num_labels, num_columns, _ = counts.shape
+
+    if num_columns == 1 and num_labels == 2:
+        result = _histogram_auc(counts[1, 0], counts[0, 0])
+    elif num_columns > 1 and num_labels == num_columns:
+        result = np.mean([
+            _histogram_auc(counts[i, i], counts[:, i].sum(axis=0) - counts[i, i])
+            for i in range(num_columns)
+        ])
+    else:
+        result = np.nan
+
+    if np.isnan(result):
+        raise MetricsComputationException(
+            metric_name="roc_auc",
+            detail="ROC-AUC score is NaN - check if the input is valid",
+            status_code=400,
+        )
+    return float(result)
+
+
+def _r_squared_from_statistics(statistics: dict) -> float:
+    """
+    R-squared averaged uniformly over outputs. As in sklearn, an output with constant true
+    labels scores 1 if it is predicted perfectly and 0 otherwise.
+    """
+    residuals = np.asarray(statistics["sum_squared_error"], dtype=np.float64)
+    total = np.asarray(statistics["m2"], dtype=np.float64)
+    scores = np.where(residuals == 0, 1.0, 0.0)
+    nonconstant = total != 0
+    scores[nonconstant] = 1 - residuals[nonconstant] / total[nonconstant]
+    return float(scores.mean())
+
+
+def _mean_per_output(key: str, statistics: dict) -> float:
+    return float(np.mean(np.asarray(statistics[key], dtype=np.float64) / statistics["count"]))
+
+
+def _fairness_metric_from_statistics(metric_name: str, statistics: dict) -> float:
+    return _fairness_metric_from_counts(
+        metric_name,
+        np.asarray(statistics["labels"]),
+        _dense_counts(statistics),
+        statistics["privileged_groups"],
+        statistics["unprivileged_groups"],
+    )
+
+
+sufficient_statistics = {
+    "accuracy": {
+        "compute": _accuracy_statistics,
+        "merge": _merge_sums,
+    },
+    "confusion_matrix": {
+        "compute": _confusion_matrix_statistics,
+        "merge": partial(_merge_labelled_counts, axes=(0, 1)),
+    },
+    "score_histogram": {
+        "compute": _score_histogram_statistics,
+        "merge": partial(_merge_labelled_counts, axes=(0,)),
+    },
+    "regression": {
+        "compute": _regression_statistics,
+        "merge": _merge_regression_statistics,
+    },
+    "fairness_counts": {
+        "compute": _fairness_counts_statistics,
+        "merge": partial(_merge_labelled_counts, axes=(0,)),
+    },
+}
+"""
+    Mapping of statistics names to the functions computing them for a batch and merging
+    them between batches
+"""
+
+metric_to_sufficient_statistics = {
+    "accuracy": {
+        "statistics": "accuracy",
+        "finalize": lambda statistics: statistics["correct"] / statistics["total"],
+    },
+    "precision": {
+        "statistics": "confusion_matrix",
+        "finalize": partial(_confusion_matrix_metric, _macro_precision_from_counts),
+    },
+    "recall": {
+        "statistics": "confusion_matrix",
+        "finalize": partial(_confusion_matrix_metric, _macro_recall_from_counts),
+    },
+    "f1_score": {
+        "statistics": "confusion_matrix",
+        "finalize": partial(_confusion_matrix_metric, _macro_f1_from_counts),
+    },
+    "roc_auc": {
+        "statistics": "score_histogram",
+        "finalize": _roc_auc_from_histograms,
+    },
+    "mean_absolute_error": {
+        "statistics": "regression",
+        "finalize": partial(_mean_per_output, "sum_absolute_error"),
+    },
+    "mean_squared_error": {
+        "statistics": "regression",
+        "finalize": partial(_mean_per_output, "sum_squared_error"),
+    },
+    "r_squared": {
+        "statistics": "regression",
+        "finalize": _r_squared_from_statistics,
+    },
+    **{
+        metric_name: {
+            "statistics": "fairness_counts",
+            "finalize": partial(_fairness_metric_from_statistics, metric_name),
+        }
+        for metric_name in fairness_metric_definitions
+    },
+    "equalized_odds_difference": {
+        "statistics": "fairness_counts",
+        "finalize": lambda statistics: _equalized_odds_difference_from_counts(
+            np.asarray(statistics["labels"]), _dense_counts(statistics)
+        ),
+    },
+}
+"""
+    Mapping of metric names to the statistics they are derived from, and the function
+    deriving the metric from (merged) statistics. Metrics not listed here (e.g. the
+    explainability metrics) are combined by averaging their per-batch values.
+"""
+
+
+def compute_sufficient_statistics(info: CalculateRequest, metrics: list[str]) -> dict[str, dict]:
+    """
+    Compute the statistics required by the given metrics for a batch. Statistics which
+    cannot be computed are left out, in which case the aggregator falls back to averaging
+    the metrics' values.
+
+    :param info: CalculateRequest - data the metrics were calculated for
+    :param metrics: list[str] - the metrics calculated successfully for the batch
+    :return: dict[str, dict] - mapping of statistics names to the batch's statistics
+    """
+    names = dict.fromkeys(
+        metric_to_sufficient_statistics[metric]["statistics"]
+        for metric in metrics
+        if metric in metric_to_sufficient_statistics
+    )
+    statistics = {}
+    for name in names:
+        try:
+            statistics[name] = sufficient_statistics[name]["compute"](info)
+        except Exception as e:
+            print(f"Failed to compute sufficient statistics {name}: {e}")
+    return statistics
+
+
+def merge_sufficient_statistics(name: str, a: dict, b: dict) -> dict:
+    """
+    Merge the statistics `name` of two disjoint sets of samples
+
+    :param name: str - name of the statistics in sufficient_statistics
+    :param a: dict - statistics of the first set of samples
+    :param b: dict - statistics of the second set of samples
+    :return: dict - statistics of both sets of samples
+    """
+    return sufficient_statistics[name]["merge"](a, b)
+
+
+def finalize_metric(metric: str, statistics: dict[str, dict]) -> Optional[float]:
+    """
+    Derive a metric from merged statistics.
+
+    :param metric: str - name of the metric
+    :param statistics: dict[str, dict] - mapping of statistics names to merged statistics
+    :return: Optional[float] - the metric's value, or None if the metric cannot be derived
+        from the statistics provided
+    """
+    if metric not in metric_to_sufficient_statistics:
+        return None
+    name = metric_to_sufficient_statistics[metric]["statistics"]
+    if name not in statistics:
+        return None
+    return metric_to_sufficient_statistics[metric]["finalize"](statistics[name])
@@ -4,6 +4,7 @@ from metrics.numerical_metrics import (
     explanation_fidelity_score
 )
 from metrics.ntg_metric_utils import text_input_lime, generate_synonym_perturbations
+from metrics.artifacts import get_artifact
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 
@@ -18,7 +19,7 @@ def expl_stability_text_input(info: CalculateRequest) -> float:
 
     :return: Stability score for the model.
     """
-    masked_coefs, _ = text_input_lime(info)
+    masked_coefs, _ = get_artifact(info, "text_input_lime")
     print("Running expl_stability_text_input")
     # TODO: Refactor generate_synonym_perturbations to take in an np.array of strings rather than a single string
     synonym_coefs = []
@@ -36,20 +37,20 @@ def expl_stability_text_input(info: CalculateRequest) -> float:
         # Generate synonym perturbations for one input at a time - shape = (num_perturbations, 1)
         synonym_sentences = np.array(generate_synonym_perturbations(inp)).reshape(-1, 1)
 
-        # Obtain the LIME coefficients for the synonym perturbations
-        temp_input_features = info.input_features
-
-        temp_scores = targets
+        # Obtain the LIME coefficients for the synonym perturbations. The request is copied
+        # rather than modified in place as other metrics may be reading it concurrently
         # Duplicate the confidence scores for the synonym perturbations shape = (num_perturbations, c)
         # where c is the number classes in the model
         if info.task_name in [TaskType.NEXT_TOKEN_GENERATION, TaskType.REGRESSION]:
-            info.predicted_labels = np.array([targets[i]] * synonym_sentences.shape[0])
-            assert info.predicted_labels.ndim == 2
+            scores_field = "predicted_labels"
         else:
-            info.confidence_scores = np.array([targets[i]] * synonym_sentences.shape[0])
-            assert info.confidence_scores.ndim == 2
-        info.input_features = synonym_sentences
-        mask_with_synonyms_coefs, _ = text_input_lime(info)
+            scores_field = "confidence_scores"
+        perturbed_info = info.model_copy(update={
+            scores_field: np.array([targets[i]] * synonym_sentences.shape[0]),
+            "input_features": synonym_sentences,
+        })
+        assert getattr(perturbed_info, scores_field).ndim == 2
+        mask_with_synonyms_coefs, _ = text_input_lime(perturbed_info)
 
         # Append the LIME coefficients for the synonym perturbations to the list of coefficients
         synonym_coefs += mask_with_synonyms_coefs.tolist()
@@ -57,13 +58,6 @@ def expl_stability_text_input(info: CalculateRequest) -> float:
         # and the original sample
         masked_coefs_resized.append(masked_coefs.tolist())
 
-        # Reset the input features and confidence scores to the original values after
-        # obtaining the LIME coefficients for the synonym perturbations
-        info.input_features = temp_input_features
-        if info.task_name in [TaskType.NEXT_TOKEN_GENERATION, TaskType.REGRESSION]:
-            info.predicted_labels = temp_scores
-        else:
-            info.confidence_scores = temp_scores
         print(f"mask_with_synonyms_coefs.shape: {mask_with_synonyms_coefs.shape}")
     synonym_coefs = np.array(synonym_coefs)
     synonym_coefs = synonym_coefs.reshape(synonym_coefs.shape[0], -1)
@@ -1,17 +1,107 @@
-from metrics.exceptions import ModelQueryException
+from metrics.exceptions import ModelQueryException, DataInconsistencyException
+from metrics.cancellation import check_cancelled, current_cancel_event
 from metrics.models import CalculateRequest
+from metrics.model_client import (
+    accepts_npz,
+    post_to_model,
+    set_accepts_npz,
+    MODEL_QUERY_CHUNK_SIZE,
+    MODEL_QUERY_MAX_CONCURRENT_CHUNKS,
+)
 from common.models import DatasetResponse, ModelResponse
+from common.utils import decode_categories
+from common.models.npz import NPZ_ACCEPT, NPZ_CONTENT_TYPE, decode_npz, encode_npz, is_npz
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.linear_model import Ridge
 from scipy.spatial.distance import euclidean
 import numpy as np
 import requests
+import os
+
+# Whether finite difference gradients query every perturbation in a few batched
+# requests (True) or make two sequential requests per feature column (False)
+FINITE_DIFFERENCE_BATCHED = os.environ.get("FINITE_DIFFERENCE_BATCHED", "true").lower() == "true"
 
 # TODO: Update pydocs for regression tasks
 
 
+def _finite_difference_perturbations(X: np.ndarray, h: float, start: int, end: int) -> np.ndarray:
+    """
+    Build rows [start, end) of the stacked finite difference perturbations of X.
+
+    The full stack has 2 * d * n rows for n samples and d features: the first d * n rows
+    are the forward perturbations and the last d * n the backward ones. Within each half,
+    block i holds every sample with feature i perturbed. Only the requested rows are
+    materialised, so the full stack is never held in memory.
+
+    :param X: Input features of shape (n, d)
+    :param h: Perturbation magnitude
+    :param start: Index of the first row to build
+    :param end: Index one past the last row to build
+    :return: Perturbed rows of shape (end - start, d)
+    """
+    num_samples, num_features = X.shape
+    half = num_samples * num_features
+    rows = np.arange(start, end)
+    signs = np.where(rows < half, 1.0, -1.0)
+    columns = (rows % half) // num_samples
+    samples = rows % num_samples
+
+    perturbed = X[samples].copy()
+    perturbed[np.arange(len(rows)), columns] += signs * h
+    return perturbed
+
+
+def _query_finite_difference_perturbations(
+    X: np.ndarray,
+    info: CalculateRequest,
+    h: float,
+    output: str,
+    chunk_size: int = MODEL_QUERY_CHUNK_SIZE,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Query the model on every forward and backward perturbation of X, split into
+    requests of at most `chunk_size` rows which are sent concurrently.
+
+    :param X: Input features of shape (n, d)
+    :param info: Information required to query the model
+    :param h: Perturbation magnitude
+    :param output: ModelResponse field to collect ("predictions" or "confidence_scores")
+    :param chunk_size: Maximum number of rows sent in a single request
+    :return: (forward, backward) model outputs, each of shape (d, n, k) where k is the
+        number of output columns
+    """
+    num_samples, num_features = X.shape
+    total_rows = 2 * num_samples * num_features
+    chunk_size = max(1, chunk_size)
+    # Chunks are queried on other threads, which do not inherit the metric's cancellation
+    cancel_event = current_cancel_event()
+
+    def query_chunk(start: int) -> np.ndarray:
+        check_cancelled(cancel_event)
+        chunk = _finite_difference_perturbations(X, h, start, min(start + chunk_size, total_rows))
+        chunk_output = getattr(_query_model(chunk, info), output)
+        if chunk_output is None:
+            raise ModelQueryException(
+                detail=f"Model response does not contain {output} for perturbed inputs",
+                status_code=400
+            )
+        return np.array(chunk_output, dtype=np.float64)
+
+    starts = range(0, total_rows, chunk_size)
+    with ThreadPoolExecutor(max_workers=max(1, MODEL_QUERY_MAX_CONCURRENT_CHUNKS)) as executor:
+        outputs = np.concatenate(list(executor.map(query_chunk, starts)))
+
+    assert len(outputs) == total_rows, f"Model returned {len(outputs)} outputs for {total_rows} inputs"
+    outputs = outputs.reshape(2, num_features, num_samples, -1)
+    return outputs[0], outputs[1]
+
+
 def _finite_difference_gradient_predictions(
     info: CalculateRequest,
-    h: float = 1e-5
+    h: float = 1e-5,
+    batched: bool = FINITE_DIFFERENCE_BATCHED,
+    chunk_size: int = MODEL_QUERY_CHUNK_SIZE
 ) -> np.ndarray:
     """
     Compute the finite difference approximation of the gradient for given data.
@@ -20,12 +110,24 @@ def _finite_difference_gradient_predictions(
         info: Information required to compute the gradient including info.input_features,
               model_url and model_api_key.
         h: Perturbation magnitude.
+        batched: If True, query all perturbations in requests of at most chunk_size rows
+              sent concurrently, rather than two sequential requests per feature column.
+        chunk_size: Maximum number of rows per request in batched mode.
 
     Returns:
         Gradient matrix of shape (num_samples, num_features).
     """
     X = np.array(info.input_features, dtype=np.float64)
     _, num_features = X.shape
+
+    if batched:
+        forward_out, backward_out = _query_finite_difference_perturbations(
+            X, info, h, "predictions", chunk_size
+        )
+        assert forward_out.shape[2] == 1, f"Forward output shape is {forward_out.shape}"
+        # (d, n, 1) -> (n, d)
+        return ((forward_out - backward_out)[:, :, 0] / (2 * h)).T
+
     gradients = np.zeros_like(X)
 
     for i in range(num_features):
@@ -51,7 +153,9 @@ def _finite_difference_gradient_predictions(
 
 def _finite_difference_gradient_confidence_scores(
     info: CalculateRequest,
-    h: float = 1e-5
+    h: float = 1e-5,
+    batched: bool = FINITE_DIFFERENCE_BATCHED,
+    chunk_size: int = MODEL_QUERY_CHUNK_SIZE
 ) -> np.ndarray:
     """
     Compute the finite difference approximation of the gradient for given data. Use the
@@ -59,9 +163,25 @@ def _finite_difference_gradient_confidence_scores(
 
     :param info: Information required to compute the gradient including info.input_features,
                  info.confidence_scores, model_url and model_api_key.
+    :param h: Perturbation magnitude.
+    :param batched: If True, query all perturbations in requests of at most chunk_size rows
+                    sent concurrently, rather than two sequential requests per feature column.
+    :param chunk_size: Maximum number of rows per request in batched mode.
     """
     X = np.array(info.input_features, dtype=np.float64)
     num_datapoints, num_columns = X.shape
+
+    if batched:
+        target_class_indices = np.argmax(info.confidence_scores, axis=1)
+        forward_out, backward_out = _query_finite_difference_perturbations(
+            X, info, h, "confidence_scores", chunk_size
+        )
+        # Confidence score of each datapoint's target class: (d, n, k) -> (d, n)
+        rows = np.arange(num_datapoints)
+        column_forward = forward_out[:, rows, target_class_indices]
+        column_backward = backward_out[:, rows, target_class_indices]
+        return ((column_forward - column_backward) / (2 * h)).T
+
     gradients = np.zeros_like(X)
     print("Calculating finite difference gradient for confidence scores")
     print(f"Info: {info}")
@@ -88,6 +208,69 @@ def _finite_difference_gradient_confidence_scores(
     return gradients
 
 
+def _confusion_matrix(true_labels: np.ndarray, predicted_labels: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the confusion matrix for the given labels in a single pass over the data.
+
+    :param true_labels: np.ndarray - the true labels for the dataset
+    :param predicted_labels: np.ndarray - the predicted labels for the dataset
+    :return: (classes, matrix) - the sorted classes appearing in either set of labels, and
+        the matrix where matrix[i, j] is the number of samples of class classes[i] that were
+        predicted as class classes[j]
+    """
+    true_flat = np.asarray(true_labels).ravel()
+    predicted_flat = np.asarray(predicted_labels).ravel()
+    if true_flat.shape != predicted_flat.shape:
+        raise DataInconsistencyException(
+            detail=f"Number of true labels ({len(true_flat)}) does not match number of "
+                   f"predicted labels ({len(predicted_flat)})"
+        )
+
+    # Encode both sets of labels against the same classes, then count each
+    # (true, predicted) pair at once
+    classes, encoded = np.unique(np.concatenate([true_flat, predicted_flat]), return_inverse=True)
+    num_classes = len(classes)
+    num_samples = len(true_flat)
+    pairs = encoded[:num_samples] * num_classes + encoded[num_samples:]
+    matrix = np.bincount(pairs, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+    return classes, matrix
+
+
+def _group_confusion_counts(
+    true_labels: np.ndarray,
+    predicted_labels: np.ndarray,
+    protected_attr: np.ndarray,
+    favourable_label=1
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute binary confusion counts for every value of the protected attribute in a single
+    pass over the data.
+
+    :param true_labels: np.ndarray - the true labels for the dataset
+    :param predicted_labels: np.ndarray - the predicted labels for the dataset
+    :param protected_attr: np.ndarray - the protected attribute value of each sample
+    :param favourable_label: the label considered the positive outcome
+    :return: (groups, counts) - the sorted values of the protected attribute, and the counts
+        where counts[g, t, p] is the number of samples in group groups[g] whose true (t) and
+        predicted (p) labels are favourable (1) or not (0)
+    """
+    if protected_attr is None:
+        raise ValueError("protected_attr is missing from the request.")
+
+    true_positive = np.asarray(true_labels).ravel() == favourable_label
+    predicted_positive = np.asarray(predicted_labels).ravel() == favourable_label
+    attrs = np.asarray(protected_attr).ravel()
+    if not (len(true_positive) == len(predicted_positive) == len(attrs)):
+        raise DataInconsistencyException(
+            detail="Number of true labels, predicted labels and protected attributes do not match"
+        )
+
+    groups, encoded = np.unique(attrs, return_inverse=True)
+    cells = encoded * 4 + true_positive.astype(np.int64) * 2 + predicted_positive.astype(np.int64)
+    counts = np.bincount(cells, minlength=len(groups) * 4).reshape(len(groups), 2, 2)
+    return groups, counts
+
+
 def _fgsm_attack(x: np.array, gradient: np.array, epsilon: float) -> np.array:
     """
     Compute adversarial example using FGSM.
@@ -105,20 +288,13 @@ def _fgsm_attack(x: np.array, gradient: np.array, epsilon: float) -> np.array:
     return x_adv
 
 
-# TODO: Refactor ESP flag to cleaner alternative (modified to make ESP pass)
-def _lime_explanation(info: CalculateRequest, kernel_width: float = 0.75, esp=False) -> np.ndarray:
+def _lime_perturbations(info: CalculateRequest) -> tuple[np.ndarray, ModelResponse]:
     """
-    Compute LIME explanation for a black-box model.
-
-    Args:
-        info: information required to compute the explanation including info.input_features,
-            confidence_scores, model_url and model_api_key
-        kernel_width: Width of the Gaussian kernel for weighting
-        esp: flag indicating if the metric to compute is Explainability Sparsity Score (ESP always
-            uses predictions - not probabilities) # TODO: Check if ESP really does always use predictions
+    Draw the perturbed samples used to fit a LIME surrogate and query the model on them.
 
-    Returns:
-        explanation: Linear surrogate model coefficients (d-dimensional array)
+    :param info: information required to query the model including info.input_features,
+        model_url and model_api_key
+    :return: (perturbed_samples, response) - the perturbed samples and the model's response
     """
     num_samples, d = info.input_features.shape
 
@@ -136,6 +312,33 @@ def _lime_explanation(info: CalculateRequest, kernel_width: float = 0.75, esp=Fa
 
     # Call model endpoint to get confidence scores
     response: ModelResponse = _query_model(perturbed_samples, info)
+    return perturbed_samples, response
+
+
+# TODO: Refactor ESP flag to cleaner alternative (modified to make ESP pass)
+def _lime_explanation(
+    info: CalculateRequest,
+    kernel_width: float = 0.75,
+    esp=False,
+    perturbations: tuple[np.ndarray, ModelResponse] = None
+) -> np.ndarray:
+    """
+    Compute LIME explanation for a black-box model.
+
+    Args:
+        info: information required to compute the explanation including info.input_features,
+            confidence_scores, model_url and model_api_key
+        kernel_width: Width of the Gaussian kernel for weighting
+        esp: flag indicating if the metric to compute is Explainability Sparsity Score (ESP always
+            uses predictions - not probabilities) # TODO: Check if ESP really does always use predictions
+        perturbations: Perturbed samples and model response from _lime_perturbations to fit the
+            surrogate on. New perturbations are drawn if not provided.
+
+    Returns:
+        explanation: Linear surrogate model coefficients (d-dimensional array)
+    """
+    perturbed_samples, response = perturbations if perturbations is not None else _lime_perturbations(info)
+
     # Compute model probabilities for perturbed samples
     # TODO: Remove ESP param for alternatives
     outputs = response.predictions if (info.regression_flag or esp) else response.confidence_scores
@@ -161,6 +364,16 @@ def _lime_explanation(info: CalculateRequest, kernel_width: float = 0.75, esp=Fa
     return reg_model.coef_, reg_model
 
 
+def _encode_npz_or_none(model_input: DatasetResponse) -> bytes | None:
+    """
+    Encode the model input as an npz archive, or return None if it can only be sent as JSON
+    """
+    try:
+        return encode_npz(model_input)
+    except ValueError:
+        return None
+
+
 def _query_model(generated_input_features: np.array, info: CalculateRequest) -> ModelResponse:
     """
     Helper function to query the model API using the generated input features,
@@ -173,23 +386,39 @@ def _query_model(generated_input_features: np.array, info: CalculateRequest) ->
     Returns:
     - response : Response from the model API
     """
-
+    # Stop metrics which timed out rather than query the model for them
+    check_cancelled()
+    cache = info.model_response_cache
+    cache_key = cache.key(str(info.model_url), generated_input_features)
+    cached_response = cache.get(cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    generated_input_features = np.asarray(generated_input_features)
     model_input = DatasetResponse(
-        features=generated_input_features.tolist(),
-        labels=np.zeros((len(generated_input_features), 1)).tolist(),
-        group_ids=np.zeros(len(generated_input_features), dtype=int).tolist(),
+        # Models are sent the categories of categorical features rather than their codes
+        features=decode_categories(generated_input_features, info.feature_categories),
+        labels=np.zeros((len(generated_input_features), 1)),
+        group_ids=np.zeros(len(generated_input_features), dtype=int),
     )
 
-    if info.model_api_key is None:
-        response = requests.post(url=info.model_url, json=model_input.model_dump(mode="json"))
-    else:
+    url = str(info.model_url)
+    headers = {"Accept": NPZ_ACCEPT}
+    if info.model_api_key is not None:
+        headers["Authorization"] = f"Bearer {info.model_api_key}"
 
-        print(f"info.model_url = {info.model_url}")
-        response = requests.post(
-            url=info.model_url,
-            json=model_input.model_dump(mode="json"),
-            headers={"Authorization": f"Bearer {info.model_api_key}"},
+    response = None
+    body = _encode_npz_or_none(model_input) if accepts_npz(url) else None
+    if body is not None:
+        response = post_to_model(
+            url, data=body, headers={**headers, "Content-Type": NPZ_CONTENT_TYPE}
         )
+        if response.status_code == 415:
+            # The endpoint no longer accepts archives, so send JSON instead
+            set_accepts_npz(url, False)
+            response = None
+    if response is None:
+        response = post_to_model(url, json=model_input.model_dump(mode="json"), headers=headers)
 
     try:
         response.raise_for_status()
@@ -200,9 +429,16 @@ def _query_model(generated_input_features: np.array, info: CalculateRequest) ->
         )
 
     try:
-        return ModelResponse(**response.json())
+        if is_npz(response.headers.get("Content-Type")):
+            model_response = decode_npz(ModelResponse, response.content)
+            set_accepts_npz(url, True)
+        else:
+            model_response = ModelResponse(**response.json())
     except Exception as e:
         raise ModelQueryException(
             detail=str(e),
             status_code=500
         )
+
+    cache.put(cache_key, model_response)
+    return model_response
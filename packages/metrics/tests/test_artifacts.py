@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock, patch
+import pytest
+from metrics.artifact_store import ArtifactStore
+from metrics.artifacts import plan_artifacts, get_artifact, intermediate_artifacts
+from metrics.models import CalculateRequest
+
+
+def test_artifact_store_computes_each_artifact_once():
+    store = ArtifactStore()
+    compute = MagicMock(return_value=42)
+
+    assert store.get_or_compute("answer", compute) == 42
+    assert store.get_or_compute("answer", compute) == 42
+    compute.assert_called_once()
+
+
+def test_artifact_store_reraises_failures_to_every_caller():
+    store = ArtifactStore()
+    compute = MagicMock(side_effect=ValueError("model unavailable"))
+
+    for _ in range(2):
+        with pytest.raises(ValueError, match="model unavailable"):
+            store.get_or_compute("lime", compute)
+    compute.assert_called_once()
+
+
+def test_plan_orders_dependencies_first_without_duplicates():
+    plan = plan_artifacts({"lime", "lime_predictions", "gradients"})
+
+    assert sorted(plan) == ["gradients", "lime", "lime_perturbations", "lime_predictions"]
+    assert plan.index("lime_perturbations") < plan.index("lime")
+    assert plan.index("lime_perturbations") < plan.index("lime_predictions")
+
+
+def test_lime_surrogates_share_one_set_of_perturbations():
+    info = CalculateRequest(
+        metrics=["explanation_sparsity_score", "explanation_fidelity_score"],
+        input_features=[[1, 2], [3, 4]],
+        model_url="http://model/predict",
+        total_sample_size=2,
+    )
+    perturbations = MagicMock(return_value="perturbations")
+    lime = MagicMock(return_value=("coefficients", "surrogate"))
+
+    with patch.dict(intermediate_artifacts["lime_perturbations"], function=perturbations), \
+         patch("metrics.artifacts._lime_explanation", lime):
+        get_artifact(info, "lime")
+        get_artifact(info, "lime_predictions")
+        get_artifact(info, "lime")
+
+    perturbations.assert_called_once_with(info)
+    assert lime.call_count == 2
+    assert all(call.kwargs["perturbations"] == "perturbations" for call in lime.call_args_list)
@@ -6,6 +6,8 @@ from metrics.numerical_metrics import (
     class_recall,
     macro_recall,
     create_fairness_metric_fn,
+    fairness_metric_fn,
+    fairness_metric_definitions,
     _prepare_datasets_for_aif360,
     class_f1,
     macro_f1,
@@ -16,14 +18,23 @@ from metrics.numerical_metrics import (
 )
 from metrics.metrics import (
     calculate_metrics,
+    metric_to_fn_and_requirements,
 )
 from metrics.exceptions import (
     MetricsComputationException,
     DataInconsistencyException,
-    DataProvisionException
+    DataProvisionException,
+    MetricCancelledException
 )
+from metrics.cancellation import run_cancellable
 from metrics.models import CalculateRequest, MetricsPackageExceptionModel, TaskType
+from metrics.utils import _confusion_matrix, _query_model
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+from unittest.mock import patch
+import numpy as np
 import pytest
+import threading
+import time
 
 
 @pytest.mark.parametrize(
@@ -411,3 +422,185 @@ def test_calculate_metrics_with_invalid_data_throws_data_inconsistency_error():
         calculate_metrics(info)
         assert "Data inconsistency error" in e.value.detail
         assert "Length mismatch between confidence scores and true labels" in e.value.detail
+
+
+def _slow_metric(info):
+    time.sleep(1)
+    return 0.5
+
+
+def _failing_metric(info):
+    raise ValueError("metric failed")
+
+
+@pytest.mark.parametrize("execution_mode", ["sequential", "parallel"])
+def test_execution_modes_capture_exceptions_per_metric(execution_mode):
+    info = CalculateRequest(
+        metrics=["accuracy", "failing_metric"],
+        true_labels=[[1], [0]],
+        predicted_labels=[[1], [1]],
+        batch_size=2,
+        total_sample_size=2,
+    )
+    failing_metric = {"function": _failing_metric, "required_inputs": [], "range": (0, 1), "ideal_value": 1}
+
+    with patch.dict(metric_to_fn_and_requirements, {"failing_metric": failing_metric}), \
+         patch("metrics.metrics.METRICS_EXECUTION_MODE", execution_mode):
+        result = calculate_metrics(info)
+
+    assert result.metric_values["accuracy"].computed_value == 0.5
+    assert isinstance(result.metric_values["failing_metric"], MetricsPackageExceptionModel)
+    assert "metric failed" in result.metric_values["failing_metric"].detail
+
+
+def test_parallel_metrics_time_out_individually():
+    info = CalculateRequest(
+        metrics=["accuracy", "slow_metric"],
+        true_labels=[[1], [0]],
+        predicted_labels=[[1], [0]],
+        batch_size=2,
+        total_sample_size=2,
+    )
+    slow_metric = {
+        "function": _slow_metric, "required_inputs": [], "range": (0, 1), "ideal_value": 1, "timeout": 0.1
+    }
+
+    with patch.dict(metric_to_fn_and_requirements, {"slow_metric": slow_metric}), \
+         patch("metrics.metrics.METRICS_EXECUTION_MODE", "parallel"):
+        result = calculate_metrics(info)
+
+    assert result.metric_values["accuracy"].computed_value == 1
+    assert result.metric_values["slow_metric"].status_code == 504
+
+
+def _queued_metric(info):
+    time.sleep(0.3)
+    return 0.5
+
+
+def test_parallel_metric_time_limits_start_when_metrics_run():
+    info = CalculateRequest(
+        metrics=["first_metric", "second_metric"],
+        batch_size=2,
+        total_sample_size=2,
+    )
+    queued_metric = {
+        "function": _queued_metric, "required_inputs": [], "range": (0, 1), "ideal_value": 1, "timeout": 0.5
+    }
+
+    # With one thread, the second metric waits for the first, longer than its time limit
+    with patch.dict(metric_to_fn_and_requirements, {"first_metric": queued_metric, "second_metric": queued_metric}), \
+         patch("metrics.metrics.METRICS_EXECUTION_MODE", "parallel"), \
+         patch("metrics.metrics.METRICS_MAX_THREADS", 1):
+        result = calculate_metrics(info)
+
+    assert result.metric_values["first_metric"].computed_value == 0.5
+    assert result.metric_values["second_metric"].computed_value == 0.5
+
+
+def test_cancelled_metrics_stop_before_querying_the_model():
+    cancelled = threading.Event()
+    cancelled.set()
+
+    # The model is never queried, so the request needs no model to be set
+    with pytest.raises(MetricCancelledException):
+        run_cancellable(cancelled, _query_model, np.zeros((1, 1)), None)
+
+
+def test_confusion_matrix_counts_true_and_predicted_pairs():
+    classes, matrix = _confusion_matrix(
+        np.array([[2], [0], [2], [1]]), np.array([[2], [2], [0], [1]])
+    )
+
+    assert classes.tolist() == [0, 1, 2]
+    assert matrix.tolist() == [
+        [0, 0, 1],
+        [0, 1, 0],
+        [1, 0, 1],
+    ]
+
+
+def test_confusion_matrix_metrics_match_sklearn_for_many_classes():
+    rng = np.random.default_rng(0)
+    true_labels = rng.integers(0, 50, size=(2000, 1))
+    predicted_labels = np.where(
+        rng.random((2000, 1)) < 0.7, true_labels, rng.integers(0, 60, size=(2000, 1))
+    )
+    info = CalculateRequest(
+        batch_size=2000,
+        total_sample_size=2000,
+        metrics=["accuracy", "precision", "recall", "f1_score"],
+        true_labels=true_labels.tolist(),
+        predicted_labels=predicted_labels.tolist(),
+    )
+    present = np.unique(true_labels)
+
+    assert accuracy(info) == pytest.approx(accuracy_score(true_labels, predicted_labels))
+    assert macro_precision(info) == pytest.approx(
+        precision_score(true_labels, predicted_labels, labels=present, average="macro", zero_division=0)
+    )
+    assert macro_recall(info) == pytest.approx(
+        recall_score(true_labels, predicted_labels, labels=present, average="macro", zero_division=0)
+    )
+    assert macro_f1(info) == pytest.approx(
+        f1_score(true_labels.ravel(), predicted_labels.ravel(), average="macro", zero_division=0)
+    )
+
+
+def test_class_metrics_are_zero_for_unseen_class():
+    info = CalculateRequest(
+        batch_size=2,
+        total_sample_size=2,
+        metrics=["class_precision"],
+        true_labels=[[0], [1]],
+        predicted_labels=[[0], [1]],
+        target_class=5,
+    )
+    assert class_precision(info) == 0
+    assert class_recall(info) == 0
+
+
+@pytest.mark.parametrize("metric_name", list(fairness_metric_definitions))
+@pytest.mark.parametrize(
+    "seed, num_groups, privileged_groups, unprivileged_groups",
+    [
+        (0, 2, [{"protected_attr": 1}], [{"protected_attr": 0}]),
+        (1, 3, [{"protected_attr": 1}, {"protected_attr": 2}], [{"protected_attr": 0}]),
+        (2, 3, [{"protected_attr": 2}], [{"protected_attr": 0}]),
+    ],
+)
+def test_native_fairness_metrics_match_aif360(
+    metric_name, seed, num_groups, privileged_groups, unprivileged_groups
+):
+    rng = np.random.default_rng(seed)
+    info = CalculateRequest(
+        batch_size=200,
+        total_sample_size=200,
+        metrics=[metric_name],
+        true_labels=rng.integers(0, 2, size=(200, 1)).tolist(),
+        predicted_labels=rng.integers(0, 2, size=(200, 1)).tolist(),
+        privileged_groups=privileged_groups,
+        unprivileged_groups=unprivileged_groups,
+        protected_attr=rng.integers(0, num_groups, size=200).tolist(),
+    )
+
+    expected = create_fairness_metric_fn(lambda metric: getattr(metric, metric_name)())(info)
+    assert fairness_metric_fn(metric_name)(info) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("metric_name", list(fairness_metric_definitions))
+def test_native_fairness_metrics_match_aif360_on_zero_division(metric_name):
+    # The privileged group has no positive true labels or predictions
+    info = CalculateRequest(
+        batch_size=1,
+        total_sample_size=10,
+        metrics=[metric_name],
+        true_labels=[[1], [0], [1], [1], [0], [1], [0], [0]],
+        predicted_labels=[[1], [0], [1], [0], [0], [1], [0], [0]],
+        privileged_groups=[{"protected_attr": 1}],
+        unprivileged_groups=[{"protected_attr": 0}],
+        protected_attr=[0, 1, 0, 0, 1, 0, 1, 1],
+    )
+
+    expected = create_fairness_metric_fn(lambda metric: getattr(metric, metric_name)())(info)
+    assert fairness_metric_fn(metric_name)(info) == pytest.approx(expected)
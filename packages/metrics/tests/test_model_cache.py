@@ -0,0 +1,68 @@
+from unittest.mock import MagicMock, patch
+import numpy as np
+from common.models import ModelResponse
+from metrics.model_cache import ModelResponseCache
+from metrics.models import CalculateRequest
+from metrics.utils import _query_model
+
+
+def test_cache_counts_hits_and_misses():
+    cache = ModelResponseCache(max_entries=2)
+    key = cache.key("http://model/predict", np.array([[1, 2]]))
+    response = ModelResponse(predictions=[[1]])
+
+    assert cache.get(key) is None
+    cache.put(key, response)
+    assert cache.get(key) is response
+
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_cache_evicts_least_recently_used_entry():
+    cache = ModelResponseCache(max_entries=2)
+    cache.put("a", ModelResponse(predictions=[[1]]))
+    cache.put("b", ModelResponse(predictions=[[2]]))
+    cache.get("a")
+    cache.put("c", ModelResponse(predictions=[[3]]))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_cache_key_depends_on_model_url_and_inputs():
+    features = np.array([[1.0, 2.0], [3.0, 4.0]])
+    key = ModelResponseCache.key("http://model/predict", features)
+
+    assert key == ModelResponseCache.key("http://model/predict", features.copy())
+    assert key != ModelResponseCache.key("http://other/predict", features)
+    assert key != ModelResponseCache.key("http://model/predict", features[::-1])
+    assert key != ModelResponseCache.key("http://model/predict", features.reshape(1, 4))
+    assert ModelResponseCache.key("http://model/predict", np.array([["a"], ["b"]])) != \
+        ModelResponseCache.key("http://model/predict", np.array([["a"], ["c"]]))
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ModelResponseCache(max_entries=0)
+    cache.put("a", ModelResponse(predictions=[[1]]))
+    assert cache.get("a") is None
+
+
+def test_query_model_reuses_cached_responses_within_a_request():
+    info = CalculateRequest(
+        metrics=["explanation_sparsity_score"],
+        input_features=[[1, 2]],
+        model_url="http://model/predict",
+        total_sample_size=1,
+    )
+    mock_response = MagicMock()
+    mock_response.json.return_value = {"predictions": [[1]]}
+
+    with patch("metrics.utils.post_to_model", return_value=mock_response) as mock_post:
+        first = _query_model(np.array([[1.0, 2.0]]), info)
+        second = _query_model(np.array([[1.0, 2.0]]), info)
+        _query_model(np.array([[2.0, 2.0]]), info)
+
+    assert first is second
+    assert mock_post.call_count == 2
+    assert info.model_response_cache.stats()["hits"] == 1
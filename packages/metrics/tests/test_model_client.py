@@ -0,0 +1,137 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+import numpy as np
+from common.models import DatasetResponse, ModelResponse
+from common.models.npz import NPZ_CONTENT_TYPE, decode_npz, encode_npz
+from common.utils import decode_categories
+from metrics import model_client
+from metrics.model_client import (
+    RETRY_STATUS_CODES,
+    accepts_npz,
+    get_session,
+    post_to_model,
+    set_accepts_npz,
+    _get_endpoint_semaphore,
+)
+from metrics.models import CalculateRequest, convert_calculate_request_to_dict
+from metrics.utils import _query_model
+
+
+def test_session_is_shared_between_queries():
+    assert get_session() is get_session()
+
+
+def test_session_retries_overloaded_responses_for_post():
+    adapter = get_session().get_adapter("http://example.com/predict")
+    retry = adapter.max_retries
+
+    assert set(RETRY_STATUS_CODES) <= set(retry.status_forcelist)
+    assert retry.is_retry("POST", status_code=429)
+    assert retry.is_retry("POST", status_code=503)
+    assert not retry.is_retry("POST", status_code=500)
+
+
+def test_endpoint_semaphores_are_per_url():
+    first = _get_endpoint_semaphore("http://example.com/a")
+    assert _get_endpoint_semaphore("http://example.com/a") is first
+    assert _get_endpoint_semaphore("http://example.com/b") is not first
+
+
+def test_post_to_model_limits_concurrent_requests_per_endpoint():
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def slow_post(*args, **kwargs):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        return MagicMock(status_code=200)
+
+    mock_session = MagicMock()
+    mock_session.post.side_effect = slow_post
+    url = "http://example.com/limited"
+
+    with patch.object(model_client, "get_session", return_value=mock_session), \
+         patch.object(model_client, "MODEL_QUERY_MAX_CONCURRENCY_PER_ENDPOINT", 2):
+        threads = [
+            threading.Thread(target=post_to_model, args=(url, {})) for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert mock_session.post.call_count == 6
+    assert max_in_flight <= 2
+
+
+def test_query_model_sends_npz_once_model_replies_with_npz():
+    url = "http://example.com/npz-model"
+    info = CalculateRequest(
+        metrics=["explanation_sparsity_score"],
+        input_features=[[1, 2]],
+        model_url=url,
+        total_sample_size=1,
+    )
+    npz_response = MagicMock(status_code=200)
+    npz_response.headers = {"Content-Type": NPZ_CONTENT_TYPE}
+    npz_response.content = encode_npz(ModelResponse(predictions=np.array([[1.0]])))
+
+    with patch("metrics.utils.post_to_model", return_value=npz_response) as mock_post:
+        first = _query_model(np.array([[1.0, 2.0]]), info)
+        assert "json" in mock_post.call_args.kwargs
+        assert accepts_npz(url)
+
+        _query_model(np.array([[3.0, 4.0]]), info)
+        kwargs = mock_post.call_args.kwargs
+        assert kwargs["headers"]["Content-Type"] == NPZ_CONTENT_TYPE
+        sent = decode_npz(DatasetResponse, kwargs["data"])
+        np.testing.assert_array_equal(sent.features, [[3.0, 4.0]])
+
+    np.testing.assert_array_equal(first.predictions, [[1.0]])
+    set_accepts_npz(url, False)
+
+
+def test_query_model_sends_categories_rather_than_codes():
+    info = CalculateRequest(
+        metrics=["explanation_sparsity_score"],
+        input_features=np.array([[1.0, 0.0], [2.0, 1.0]]),
+        feature_categories={1: ["red", "blue"]},
+        model_url="http://example.com/categorical-model",
+        total_sample_size=2,
+    )
+    mock_response = MagicMock()
+    mock_response.json.return_value = {"predictions": [[1], [0]]}
+
+    with patch("metrics.utils.post_to_model", return_value=mock_response) as mock_post:
+        _query_model(info.input_features, info)
+
+    assert mock_post.call_args.kwargs["json"]["features"] == [[1.0, "red"], [2.0, "blue"]]
+    assert convert_calculate_request_to_dict(info)["input_data"] == [[1.0, "red"], [2.0, "blue"]]
+
+
+def test_request_representations_are_built_once():
+    info = CalculateRequest(
+        metrics=["explanation_sparsity_score"],
+        input_features=np.array([[1.0, 0.0], [2.0, 1.0]]),
+        true_labels=np.array([[1], [0]]),
+        feature_categories={1: ["red", "blue"]},
+        total_sample_size=2,
+    )
+
+    with patch("metrics.models.decode_categories", wraps=decode_categories) as mock_decode:
+        first = convert_calculate_request_to_dict(info)
+        assert info.decoded_input_features is info.decoded_input_features
+        second = convert_calculate_request_to_dict(info)
+    assert mock_decode.call_count == 1
+    assert second["input_data"] is first["input_data"]
+    assert second["true_labels"] is first["true_labels"]
+
+    info.input_features = np.array([[3.0, 1.0]])
+    assert convert_calculate_request_to_dict(info)["input_data"] == [[3.0, "blue"]]
@@ -1,5 +1,8 @@
 from metrics.models import CalculateRequest
-from metrics.utils import _finite_difference_gradient_predictions
+from metrics.utils import (
+    _finite_difference_gradient_predictions,
+    _finite_difference_perturbations
+)
 from tests.metric_mocks.mock_model_finite_diff_grad import (
     TEST_INPUT,
     EPSILON,
@@ -40,6 +43,40 @@ def test_finite_diff_gradient(server_factory):
         )
 
 
+def test_finite_diff_gradient_batched_matches_sequential(server_factory):
+    metric_name = "finite_diff_grad"
+    with server_factory(metric_name):
+        info = CalculateRequest(
+            batch_size=1,
+            total_sample_size=10,
+            metrics=[metric_name],
+            input_features=TEST_INPUT,
+            model_url=f"http://{HOST}:{server_configs[metric_name]['port']}/predict",
+        )
+
+        sequential = _finite_difference_gradient_predictions(info, EPSILON, batched=False)
+        # A chunk size that does not divide the 8 perturbed rows exercises a partial chunk
+        batched = _finite_difference_gradient_predictions(info, EPSILON, batched=True, chunk_size=3)
+
+        assert sequential.tolist() == EXPECTED_GRADIENT
+        assert batched.tolist() == EXPECTED_GRADIENT
+
+
+def test_finite_difference_perturbations_are_stacked_forward_then_backward():
+    X = np.array([[1.0, 2.0], [3.0, 4.0]])
+    h = 0.5
+
+    stacked = _finite_difference_perturbations(X, h, 0, 8)
+
+    assert stacked.tolist() == [
+        [1.5, 2.0], [3.5, 4.0],  # forward, feature 0
+        [1.0, 2.5], [3.0, 4.5],  # forward, feature 1
+        [0.5, 2.0], [2.5, 4.0],  # backward, feature 0
+        [1.0, 1.5], [3.0, 3.5],  # backward, feature 1
+    ]
+    assert _finite_difference_perturbations(X, h, 3, 6).tolist() == stacked[3:6].tolist()
+
+
 def test_ood_auroc(server_factory):
     metric_name = "ood_auroc"
     with server_factory(metric_name):
@@ -0,0 +1,212 @@
+import numpy as np
+import pytest
+from sklearn.metrics import (
+    accuracy_score,
+    precision_score,
+    recall_score,
+    f1_score,
+    roc_auc_score,
+    mean_absolute_error,
+    mean_squared_error,
+    r2_score,
+)
+from metrics.models import CalculateRequest, TaskType
+from metrics.metrics import calculate_metrics
+from metrics.numerical_metrics import fairness_metric_fn, equalized_odds_difference
+from metrics.sufficient_statistics import (
+    compute_sufficient_statistics,
+    merge_sufficient_statistics,
+    finalize_metric,
+    metric_to_sufficient_statistics,
+    ROC_AUC_HISTOGRAM_BINS,
+)
+
+FAIRNESS_METRICS = [
+    metric for metric, properties in metric_to_sufficient_statistics.items()
+    if properties["statistics"] == "fairness_counts"
+]
+
+
+def merged_statistics(requests: list[CalculateRequest], metrics: list[str]) -> dict:
+    """Compute the statistics of each request and merge them, as the aggregator does"""
+    merged = {}
+    for info in requests:
+        for name, statistics in compute_sufficient_statistics(info, metrics).items():
+            merged[name] = (
+                merge_sufficient_statistics(name, merged[name], statistics)
+                if name in merged else statistics
+            )
+    return merged
+
+
+def batches(num_batches: int, metrics: list[str], fields: dict = None, **columns) -> list[CalculateRequest]:
+    """
+    Split each column into num_batches requests for the given metrics, each also containing
+    the given fields
+    """
+    split = {name: np.array_split(np.asarray(values), num_batches) for name, values in columns.items()}
+    total_sample_size = len(next(iter(columns.values())))
+    return [
+        CalculateRequest(
+            metrics=metrics,
+            **{name: values[i].tolist() for name, values in split.items()},
+            batch_size=len(next(iter(split.values()))[i]),
+            total_sample_size=total_sample_size,
+            **(fields or {}),
+        )
+        for i in range(num_batches)
+    ]
+
+
+@pytest.mark.parametrize("num_batches", [1, 3, 10])
+def test_classification_metrics_merge_exactly(num_batches):
+    rng = np.random.default_rng(0)
+    # Classes are unbalanced so that some batches are missing some classes
+    true_labels = rng.choice([0, 1, 2, 3], p=[0.6, 0.3, 0.08, 0.02], size=(200, 1))
+    predicted_labels = rng.choice([0, 1, 2, 3], p=[0.5, 0.3, 0.15, 0.05], size=(200, 1))
+    metrics = ["accuracy", "precision", "recall", "f1_score"]
+
+    statistics = merged_statistics(
+        batches(num_batches, metrics, true_labels=true_labels, predicted_labels=predicted_labels), metrics
+    )
+
+    assert finalize_metric("accuracy", statistics) == pytest.approx(
+        accuracy_score(true_labels, predicted_labels)
+    )
+    assert finalize_metric("precision", statistics) == pytest.approx(
+        precision_score(
+            true_labels, predicted_labels, average="macro", labels=np.unique(true_labels), zero_division=0
+        )
+    )
+    assert finalize_metric("recall", statistics) == pytest.approx(
+        recall_score(
+            true_labels, predicted_labels, average="macro", labels=np.unique(true_labels), zero_division=0
+        )
+    )
+    assert finalize_metric("f1_score", statistics) == pytest.approx(
+        f1_score(true_labels, predicted_labels, average="macro", zero_division=0)
+    )
+
+
+@pytest.mark.parametrize("num_batches", [1, 4, 25])
+def test_regression_metrics_merge_exactly(num_batches):
+    rng = np.random.default_rng(1)
+    true_labels = rng.normal(5, 3, size=(100, 2))
+    predicted_labels = true_labels + rng.normal(0, 1, size=(100, 2))
+    metrics = ["mean_absolute_error", "mean_squared_error", "r_squared"]
+
+    statistics = merged_statistics(
+        batches(num_batches, metrics, true_labels=true_labels, predicted_labels=predicted_labels), metrics
+    )
+
+    assert finalize_metric("mean_absolute_error", statistics) == pytest.approx(
+        mean_absolute_error(true_labels, predicted_labels)
+    )
+    assert finalize_metric("mean_squared_error", statistics) == pytest.approx(
+        mean_squared_error(true_labels, predicted_labels)
+    )
+    assert finalize_metric("r_squared", statistics) == pytest.approx(
+        r2_score(true_labels, predicted_labels)
+    )
+
+
+def test_r_squared_of_constant_true_labels_matches_sklearn():
+    statistics = merged_statistics(
+        batches(
+            2, ["r_squared"],
+            true_labels=[[1.0], [1.0], [1.0], [1.0]],
+            predicted_labels=[[1.0], [1.0], [2.0], [1.0]],
+        ),
+        ["r_squared"]
+    )
+    assert finalize_metric("r_squared", statistics) == r2_score([1, 1, 1, 1], [1, 1, 2, 1])
+
+
+@pytest.mark.parametrize("num_batches", [1, 5])
+def test_roc_auc_merges_within_histogram_resolution(num_batches):
+    rng = np.random.default_rng(2)
+    true_labels = rng.integers(0, 2, size=(500, 1))
+    positive_scores = np.clip(0.5 + 0.3 * (true_labels.ravel() - 0.5) + rng.normal(0, 0.2, 500), 0, 1)
+    confidence_scores = np.stack([1 - positive_scores, positive_scores], axis=1)
+
+    requests = batches(
+        num_batches,
+        ["roc_auc"],
+        {"task_name": TaskType.BINARY_CLASSIFICATION},
+        true_labels=true_labels,
+        confidence_scores=confidence_scores
+    )
+    statistics = merged_statistics(requests, ["roc_auc"])
+
+    expected = roc_auc_score(true_labels.ravel(), confidence_scores.max(axis=1))
+    assert finalize_metric("roc_auc", statistics) == pytest.approx(expected, abs=1e-2)
+
+
+def test_counts_only_hold_non_zero_cells():
+    requests = batches(
+        2,
+        ["precision", "roc_auc"],
+        {"task_name": TaskType.BINARY_CLASSIFICATION},
+        true_labels=[[0], [0], [1], [2]],
+        predicted_labels=[[0], [1], [1], [2]],
+        confidence_scores=[[0.9, 0.1], [0.4, 0.6], [0.3, 0.7], [0.2, 0.8]],
+    )
+    first, second = (compute_sufficient_statistics(info, ["precision", "roc_auc"]) for info in requests)
+
+    # Each sample falls in a single bin of the histogram
+    assert first["score_histogram"]["shape"] == [1, 1, ROC_AUC_HISTOGRAM_BINS]
+    assert len(first["score_histogram"]["cells"]) == 2
+    # The second batch has no samples of class 0, which are aligned on merging
+    assert first["confusion_matrix"]["cells"] == [[0, 0, 1], [0, 1, 1]]
+    assert second["confusion_matrix"]["labels"] == [1, 2]
+    merged = merge_sufficient_statistics("confusion_matrix", first["confusion_matrix"], second["confusion_matrix"])
+    assert merged == {
+        "labels": [0, 1, 2],
+        "shape": [3, 3],
+        "cells": [[0, 0, 1], [0, 1, 1], [1, 1, 1], [2, 2, 1]],
+    }
+
+
+@pytest.mark.parametrize("metric", FAIRNESS_METRICS)
+def test_fairness_metrics_merge_exactly(metric):
+    rng = np.random.default_rng(3)
+    columns = {
+        "true_labels": rng.integers(0, 2, size=(300, 1)),
+        "predicted_labels": rng.integers(0, 2, size=(300, 1)),
+        "protected_attr": rng.integers(0, 2, size=300),
+    }
+    groups = {
+        "privileged_groups": [{"protected_attr": 1}],
+        "unprivileged_groups": [{"protected_attr": 0}],
+    }
+    statistics = merged_statistics(batches(6, [metric], groups, **columns), [metric])
+
+    full = CalculateRequest(
+        metrics=[metric],
+        **{name: values.tolist() for name, values in columns.items()},
+        total_sample_size=300,
+        **groups,
+    )
+    if metric == "equalized_odds_difference":
+        expected = equalized_odds_difference(full)
+    else:
+        expected = fairness_metric_fn(metric)(full)
+    assert finalize_metric(metric, statistics) == pytest.approx(expected)
+
+
+def test_finalize_metric_without_statistics():
+    assert finalize_metric("explanation_stability_score", {}) is None
+    assert finalize_metric("accuracy", {}) is None
+
+
+def test_calculate_metrics_returns_statistics_for_successful_metrics():
+    info = CalculateRequest(
+        # roc_auc fails as no confidence scores are provided
+        metrics=["accuracy", "roc_auc"],
+        true_labels=[[0], [1], [1]],
+        predicted_labels=[[0], [1], [0]],
+        batch_size=3,
+        total_sample_size=3,
+    )
+    result = calculate_metrics(info)
+    assert result.sufficient_statistics == {"accuracy": {"correct": 2, "total": 3}}
@@ -1,5 +1,9 @@
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.security import APIKeyHeader
+from pydantic import BaseModel, ValidationError
+from common.models import DatasetResponse
+from common.models.npz import NPZ_CONTENT_TYPE, decode_npz, encode_npz, is_npz
 
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
 
@@ -35,3 +39,31 @@ def get_dataset_api_key(api_key: str = Depends(api_key_header)):
     elif api_key == MOCK_DATASET_API_KEY:
         return api_key
     raise HTTPException(status_code=401, detail="Unauthorized access: Please check your API Key")
+
+
+async def dataset_request_body(request: Request) -> DatasetResponse:
+    """
+    Read the dataset sent to a model, either as JSON or as an npz archive
+    """
+    body = await request.body()
+    try:
+        if is_npz(request.headers.get("Content-Type")):
+            return decode_npz(DatasetResponse, body)
+        return DatasetResponse.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {e}")
+
+
+def negotiate_response(request: Request, response: BaseModel):
+    """
+    Send the response as an npz archive if the client accepts one, otherwise as JSON
+    """
+    if is_npz(request.headers.get("Accept")):
+        try:
+            return Response(content=encode_npz(response), media_type=NPZ_CONTENT_TYPE)
+        except ValueError:
+            # e.g. it contains None values, which only JSON can represent
+            pass
+    return response
@@ -2,11 +2,11 @@
 Mock dataserver for the Financial PhraseBank dataset.
 """
 from sklearn.datasets import fetch_openml
-from fastapi import FastAPI, Query, Depends, HTTPException
+from fastapi import FastAPI, Query, Depends, HTTPException, Request
 import pandas as pd
 import numpy as np
 from fastapi.middleware.cors import CORSMiddleware
-from mocks.api_utils import get_dataset_api_key
+from mocks.api_utils import get_dataset_api_key, negotiate_response
 from common.models import DatasetResponse
 
 app: FastAPI = FastAPI()
@@ -32,7 +32,7 @@ async def read_root():
 
 
 @app.get('/fetch-datapoints', dependencies=[Depends(get_dataset_api_key)], response_model=DatasetResponse)
-async def fetch_datapoints(num_datapoints: int = Query(2, alias="n")):
+async def fetch_datapoints(request: Request, num_datapoints: int = Query(2, alias="n")):
     """
     Fetch num_datapoints from the Financial PhraseBank and return them as JSON.
 
@@ -59,11 +59,12 @@ async def fetch_datapoints(num_datapoints: int = Query(2, alias="n")):
         features = features.to_numpy().reshape(-1, len(BOSTON_FEATURES))
         labels = labels.to_numpy().reshape(-1, 1)
 #
-        return DatasetResponse(
-            features=features.tolist(),
-            labels=labels.tolist(),
-            group_ids=[0] * len(features)  # No groups in this dataset
-        )
+        return negotiate_response(request, DatasetResponse(
+            features=features,
+            labels=labels,
+            group_ids=np.zeros(len(features), dtype=int),  # No groups in this dataset
+            column_dtypes=["float64"] * len(BOSTON_FEATURES)
+        ))
     except Exception as e:
         return HTTPException(detail=f"Error: {e}", status_code=500)
 
@@ -1,7 +1,7 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request
 import numpy as np
 from sklearn.pipeline import Pipeline
-from mocks.api_utils import get_model_api_key
+from mocks.api_utils import dataset_request_body, get_model_api_key, negotiate_response
 from mocks.utils import load_scikit_model
 from common.models import DatasetResponse, ModelResponse
 from fastapi import HTTPException
@@ -27,12 +27,13 @@ def read_root():
 
 
 @app.post("/predict", dependencies=[Depends(get_model_api_key)], response_model=ModelResponse)
-def predict(input: DatasetResponse) -> ModelResponse:
+def predict(request: Request, input: DatasetResponse = Depends(dataset_request_body)) -> ModelResponse:
     """
     Given a dataset, predict the expected outputs for the model
     """
     try:
-        if not input.features or input.features == [[]]:
+        # Features may be a list or, if sent as an npz archive, an array
+        if np.size(input.features) == 0:
             return ModelResponse(predictions=input.features)
         output: np.ndarray = model.predict(input.features).reshape(-1, 1)
         predictions: list[list] = output.tolist()
@@ -40,7 +41,7 @@ def predict(input: DatasetResponse) -> ModelResponse:
         raise HTTPException(detail=f"Error occured during model prediction: {e}", status_code=500)
 
     # Does not need to return confidence scores as a regression model
-    return ModelResponse(predictions=predictions)
+    return negotiate_response(request, ModelResponse(predictions=predictions))
 
 
 if __name__ == "__main__":
@@ -10,6 +10,8 @@ from folktables import ACSDataSource, ACSEmployment
 import pandas as pd
 import pytest
 from mocks.utils import load_scikit_model
+from common.models import DatasetResponse, ModelResponse
+from common.models.npz import NPZ_ACCEPT, NPZ_CONTENT_TYPE, decode_npz, encode_npz, is_npz
 
 # TODO: Modify the tests to use pydantic models to ensure they are correctly validated
 
@@ -128,6 +130,33 @@ def test_scikit_regressor_valid_data():
     )
 
 
+def test_scikit_regressor_exchanges_npz_archives():
+    headers = {"Accept": NPZ_ACCEPT}
+    data = boston_housing_mock.get(
+        "/fetch-datapoints",
+        headers={**headers, "Authorization": f"Bearer {MOCK_DATASET_API_KEY}"},
+        params={"n": 10}
+    )
+    assert data.status_code == 200, data.text
+    assert is_npz(data.headers["Content-Type"])
+    dataset = decode_npz(DatasetResponse, data.content)
+    assert dataset.features.shape == (10, 13)
+
+    response = scikit_regressor_mock.post(
+        "/predict",
+        content=encode_npz(dataset),
+        headers={
+            **headers,
+            "Content-Type": NPZ_CONTENT_TYPE,
+            "Authorization": f"Bearer {MOCK_MODEL_API_KEY}",
+        }
+    )
+    assert response.status_code == 200, response.text
+    assert is_npz(response.headers["Content-Type"])
+    predictions = decode_npz(ModelResponse, response.content).predictions
+    assert predictions.shape == (10, 1)
+
+
 def test_valid_data_huggingface():
     # post a valid text
     response = huggingface_mock.post("/predict", json={
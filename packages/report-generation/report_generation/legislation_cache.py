@@ -0,0 +1,165 @@
+"""
+Cache of parsed legislation articles, kept in memory and on disk.
+
+Each article is fetched and parsed once per (legislation, article), however many properties
+and reports it appears in. Cached articles are used for LEGISLATION_CACHE_TTL seconds, after
+which they are revalidated with the server using their ETag or Last-Modified date, and only
+downloaded and parsed again if they changed. If an article cannot be fetched, e.g. offline,
+the cached article is used however old it is, so reports can be generated from a seeded cache.
+"""
+
+import os
+import re
+import copy
+import json
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+from common.models.common import LegislationInfo
+
+# Directory of the cached articles, e.g. a volume seeded with articles to work offline
+LEGISLATION_CACHE_DIR = os.environ.get(
+    "LEGISLATION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "aignostic", "legislation")
+)
+# Seconds for which cached articles are used before they are revalidated
+LEGISLATION_CACHE_TTL = int(os.environ.get("LEGISLATION_CACHE_TTL", "604800"))
+# Seconds to wait for a legislation website to respond
+LEGISLATION_FETCH_TIMEOUT = float(os.environ.get("LEGISLATION_FETCH_TIMEOUT", "10"))
+
+
+def _file_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+
+
+class LegislationCache:
+    """
+    Usage:
+    cache = LegislationCache(parse_legislation_page)
+    cache.warm_up(LEGISLATION_INFORMATION, ["10", "13"])
+    article = cache.get(info, "13")
+    """
+
+    def __init__(
+        self,
+        parse: Callable[[str, Optional[str], LegislationInfo], dict],
+        cache_dir: str = LEGISLATION_CACHE_DIR,
+        ttl: float = LEGISLATION_CACHE_TTL,
+        timeout: float = LEGISLATION_FETCH_TIMEOUT,
+    ):
+        """
+        :param parse: Callable - parses an article's page into its extract, given the article
+            number, the page's HTML, or None if it could not be fetched, and the legislation
+        :param cache_dir: str - directory to store cached articles in
+        :param ttl: float - seconds for which cached articles are used before revalidating them
+        :param timeout: float - seconds to wait for a legislation website to respond
+        """
+        self._parse = parse
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        self._timeout = timeout
+        self._entries: dict[tuple[str, str], dict] = {}
+        # One lock per article, so each article is fetched once even if requested concurrently
+        self._locks: dict[tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, info: LegislationInfo, article_num: str) -> dict:
+        """
+        Returns the parsed extract of an article, fetching it only if it is not cached or
+        is due to be revalidated
+
+        :param info: LegislationInfo - the legislation the article belongs to
+        :param article_num: str - the article's number
+        """
+        key = (info.name, article_num)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+            if entry is None or time.time() - entry["fetched_at"] >= self._ttl:
+                entry = self._fetch(info, article_num, entry)
+            # Callers may modify the extract they are given
+            return copy.deepcopy(entry["data"])
+
+    def warm_up(self, legislation: dict[str, LegislationInfo], article_nums: Iterable[str], max_workers: int = 8):
+        """
+        Cache the given articles of every legislation, e.g. when starting up
+
+        :param legislation: dict[str, LegislationInfo] - legislation to cache the articles of
+        :param article_nums: Iterable[str] - numbers of the articles to cache
+        :param max_workers: int - maximum number of articles to fetch at once
+        """
+        articles = [(info, article_num) for info in legislation.values() for article_num in set(article_nums)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda article: self.get(*article), articles))
+        print(f"Legislation cache warmed up with {len(articles)} articles")
+
+    def _fetch(self, info: LegislationInfo, article_num: str, entry: Optional[dict]) -> dict:
+        url = info.url + info.article_extract(article_num)
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            response = requests.get(url, headers=headers, timeout=self._timeout)
+        except requests.RequestException as e:
+            print(f"Failed to fetch {url}: {e}")
+            response = None
+
+        if response is not None and response.status_code == 304 and entry is not None:
+            # Unchanged, so the cached article is used for another TTL
+            entry = {**entry, "fetched_at": time.time()}
+        elif response is not None and response.status_code == 200:
+            entry = {
+                "url": url,
+                "fetched_at": time.time(),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "data": self._parse(article_num, response.text, info),
+            }
+        elif entry is not None:
+            # Keep using the cached article until it can be fetched again
+            print(f"Using cached article {article_num} of {info.name}, which could not be revalidated")
+            return entry
+        else:
+            # Failures are not cached, so the article is fetched again next time
+            return {"data": self._parse(article_num, None, info)}
+
+        key = (info.name, article_num)
+        self._entries[key] = entry
+        self._store(key, entry)
+        return entry
+
+    def _path(self, key: tuple[str, str]) -> str:
+        name, article_num = key
+        return os.path.join(self._cache_dir, _file_name(name), f"{_file_name(article_num)}.json")
+
+    def _load(self, key: tuple[str, str]) -> Optional[dict]:
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable cached article {self._path(key)}: {e}")
+            return None
+        self._entries[key] = entry
+        return entry
+
+    def _store(self, key: tuple[str, str], entry: dict):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written to a temporary file first, so other processes never read a partial article
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            print(f"Failed to cache article at {path}: {e}")
@@ -1,7 +1,9 @@
 import requests
 from bs4 import BeautifulSoup
 import re
+from typing import Optional
 from .constants import property_to_metrics, property_to_regulations
+from .legislation_cache import LegislationCache
 from llm_insights.insights import init_llm, metric_insights
 from common.models.common import LegislationInfo, LegislationInformation
 
@@ -32,7 +34,14 @@ def extract_legislation_text(article_num: str, url: str, article_extension: call
     response = requests.get(legislation_url)
     if response.status_code != 200:
         return f"Failed to fetch Article {article_num}."
-    soup = BeautifulSoup(response.text, "html.parser")
+    return article_text_from_html(article_num, response.text)
+
+
+def article_text_from_html(article_num: str, html: str) -> str:
+    """
+    Extracts the text of an article from its page.
+    """
+    soup = BeautifulSoup(html, "html.parser")
     article_content = soup.find("article")
     if not article_content:
         return f"Could not parse content for Article {article_num}."
@@ -114,6 +123,30 @@ def parse_legislation_text(article_num: str, article_content: str, info: Legisla
     return data
 
 
+def parse_legislation_page(article_num: str, html: Optional[str], info: LegislationInfo) -> dict:
+    """
+    Parses an article's page into structured data, or reports that it could not be fetched
+    if html is None.
+    """
+    if html is None:
+        article_content = f"Failed to fetch Article {article_num}."
+    else:
+        article_content = article_text_from_html(article_num, html)
+    return parse_legislation_text(article_num, article_content, info)
+
+
+# Articles are fetched and parsed once, rather than for every property of every report
+legislation_cache = LegislationCache(parse_legislation_page)
+
+
+def warm_up_legislation_cache(legislation: LegislationInformation):
+    """
+    Caches every article which reports may contain for the given legislation.
+    """
+    article_nums = {article for articles in property_to_regulations.values() for article in articles}
+    legislation_cache.warm_up(legislation, article_nums)
+
+
 def get_legislation_extracts(metrics_data: dict, legislation: LegislationInformation) -> list[dict]:
     """
     Generates a comprehensive report based on the provided metrics data and API key.
@@ -160,17 +193,8 @@ def get_legislation_extracts(metrics_data: dict, legislation: LegislationInforma
         property_result["legislation_extracts"] = []
         for id, info in legislation.items():
             final_legislation_extracts_per_leg = []
-            url = info.url
-            article_extract = info.article_extract
             for regulations in property_to_regulations[property]:
-                article_content = extract_legislation_text(
-                    regulations,
-                    url,
-                    article_extract)
-                parsed_data = parse_legislation_text(
-                    regulations,
-                    article_content,
-                    info)
+                parsed_data = legislation_cache.get(info, regulations)
                 final_legislation_extracts_per_leg.append(parsed_data)
             property_result["legislation_extracts"].append((
                 final_legislation_extracts_per_leg))
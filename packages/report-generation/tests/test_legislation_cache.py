@@ -0,0 +1,113 @@
+from unittest import mock
+import pytest
+import requests
+from common.models import LegislationInfo
+from report_generation.constants import property_to_regulations
+from report_generation.legislation_cache import LegislationCache
+from report_generation.utils import get_legislation_extracts, parse_legislation_page
+
+REQUESTS_GET = 'report_generation.legislation_cache.requests.get'
+
+GDPR = LegislationInfo(
+    name="GDPR",
+    url="https://gdpr-info.eu/",
+    article_extract=lambda article_number: f"art-{article_number}-gdpr/"
+)
+
+
+def article_page(article_num, description="Description of the article."):
+    return (
+        f"<html><body><article>Art. {article_num} GDPR\nTitle of Article {article_num}\n"
+        f"{description}</article></body></html>"
+    )
+
+
+def response(status_code, text="", headers=None):
+    return mock.Mock(status_code=status_code, text=text, headers=headers or {})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LegislationCache(parse_legislation_page, cache_dir=str(tmp_path), ttl=60)
+
+
+def test_articles_are_fetched_once(cache):
+    with mock.patch(REQUESTS_GET, return_value=response(200, article_page("13"))) as mock_get:
+        first = cache.get(GDPR, "13")
+        first["description"] = "Modified by the caller"
+        second = cache.get(GDPR, "13")
+
+    mock_get.assert_called_once()
+    assert mock_get.call_args.args[0] == "https://gdpr-info.eu/art-13-gdpr/"
+    assert second["article_title"] == "Title of Article 13"
+    assert second["description"] == "Description of the article."
+
+
+def test_report_fetches_each_article_once(cache):
+    with mock.patch('report_generation.utils.legislation_cache', cache), \
+         mock.patch(REQUESTS_GET, side_effect=lambda url, **_: response(200, article_page("1"))) as mock_get:
+        get_legislation_extracts({}, {"gdpr": GDPR})
+
+    articles = {article for articles in property_to_regulations.values() for article in articles}
+    assert mock_get.call_count == len(articles)
+
+
+def test_articles_are_cached_on_disk(cache, tmp_path):
+    with mock.patch(REQUESTS_GET, return_value=response(200, article_page("13"))):
+        cache.get(GDPR, "13")
+
+    # A new process reads the article from disk
+    with mock.patch(REQUESTS_GET) as mock_get:
+        article = LegislationCache(parse_legislation_page, cache_dir=str(tmp_path), ttl=60).get(GDPR, "13")
+    mock_get.assert_not_called()
+    assert article["article_title"] == "Title of Article 13"
+
+
+def test_expired_articles_are_revalidated(cache):
+    with mock.patch(REQUESTS_GET, return_value=response(200, article_page("13"), {"ETag": '"v1"'})):
+        cache.get(GDPR, "13")
+
+    with mock.patch('report_generation.legislation_cache.time.time', return_value=10 ** 10), \
+         mock.patch(REQUESTS_GET, return_value=response(304)) as mock_get:
+        article = cache.get(GDPR, "13")
+        # Revalidated articles are used for another TTL
+        cache.get(GDPR, "13")
+
+    mock_get.assert_called_once()
+    assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    assert article["description"] == "Description of the article."
+
+
+def test_expired_articles_are_replaced_when_changed(cache):
+    with mock.patch(REQUESTS_GET, return_value=response(200, article_page("13"))):
+        cache.get(GDPR, "13")
+
+    with mock.patch('report_generation.legislation_cache.time.time', return_value=10 ** 10), \
+         mock.patch(REQUESTS_GET, return_value=response(200, article_page("13", "Amended."))):
+        assert cache.get(GDPR, "13")["description"] == "Amended."
+
+
+def test_cached_articles_are_used_offline(cache):
+    with mock.patch(REQUESTS_GET, return_value=response(200, article_page("13"))):
+        cache.get(GDPR, "13")
+
+    with mock.patch('report_generation.legislation_cache.time.time', return_value=10 ** 10), \
+         mock.patch(REQUESTS_GET, side_effect=requests.ConnectionError("Offline")):
+        assert cache.get(GDPR, "13")["article_title"] == "Title of Article 13"
+
+
+def test_failures_are_not_cached(cache):
+    with mock.patch(REQUESTS_GET, return_value=response(404)):
+        article = cache.get(GDPR, "13")
+    assert article["description"] == "Failed to fetch Article 13."
+
+    with mock.patch(REQUESTS_GET, return_value=response(200, article_page("13"))) as mock_get:
+        assert cache.get(GDPR, "13")["article_title"] == "Title of Article 13"
+    mock_get.assert_called_once()
+
+
+def test_warm_up_caches_every_article(cache):
+    with mock.patch(REQUESTS_GET, side_effect=lambda url, **_: response(200, article_page("1"))) as mock_get:
+        cache.warm_up({"gdpr": GDPR}, ["10", "13", "13"])
+        cache.get(GDPR, "10")
+    assert mock_get.call_count == 2
@@ -9,6 +9,7 @@ import pytest
 
 EXTRACT = 'report_generation.utils.extract_legislation_text'
 PARSE = 'report_generation.utils.parse_legislation_text'
+CACHE_GET = 'report_generation.utils.legislation_cache.get'
 LLM_INIT = 'llm_insights.insights.init_llm'
 LLM_INSIGHTS = 'llm_insights.insights.metric_insights'
 
@@ -197,6 +198,7 @@ def test_parse_legislation_text_with_empty_content():
 def mock_dependencies():
     with mock.patch(EXTRACT) as mock_extract, \
          mock.patch(PARSE) as mock_parse, \
+         mock.patch(CACHE_GET) as mock_cache_get, \
          mock.patch(LLM_INIT) as mock_llm_init, \
          mock.patch(LLM_INSIGHTS) as mock_llm_insights:
         mock_extract.return_value = [
@@ -213,6 +215,9 @@ def mock_dependencies():
                 "suitable_recitals": ["https://gdpr-info.eu/recitals/no-R1/"]
             }
         ]
+        mock_cache_get.side_effect = lambda info, article_num: mock_parse(
+            article_num, mock_extract(article_num, info.url, info.article_extract), info
+        )
         mock_llm_init.return_value = mock.Mock()
         mock_llm_insights.return_value = ""
 
@@ -0,0 +1,93 @@
+import sys
+import pytest
+from user_added_metrics.executor_pool import ExecutorError, ExecutorPool, ExecutorPools
+
+
+@pytest.fixture
+def script_dir(tmp_path):
+    """A user script, run with this interpreter rather than a virtual environment"""
+    (tmp_path / "user_script.py").write_text(
+        """
+import os
+import time
+
+print("Printed output does not corrupt replies")
+
+def metric_pid(data):
+    return {"computed_value": os.getpid(), "ideal_value": data["ideal"], "range": (0, 1)}
+
+def metric_invalid(data):
+    return 1
+
+def metric_raises(data):
+    raise ValueError("Invalid data")
+
+def metric_exits(data):
+    os._exit(1)
+
+def metric_hangs(data):
+    time.sleep(60)
+"""
+    )
+    return str(tmp_path)
+
+
+@pytest.fixture
+def pools():
+    pools = ExecutorPools()
+    yield pools
+    pools.close_all()
+
+
+def call(pools, script_dir, function_name, user_id="user"):
+    return pools.call(user_id, sys.executable, script_dir, function_name, '{"ideal": 1}')
+
+
+def test_executor_is_reused_across_calls(pools, script_dir):
+    first = call(pools, script_dir, "metric_pid")["result"]
+    second = call(pools, script_dir, "metric_pid")["result"]
+    assert first["computed_value"] == second["computed_value"]
+    assert first["ideal_value"] == 1
+    assert first["range"] == [0, 1]
+
+
+def test_errors_in_user_functions_are_returned(pools, script_dir):
+    assert call(pools, script_dir, "metric_invalid") == {"error": "Invalid return format from user function"}
+    assert call(pools, script_dir, "metric_raises") == {"error": "Invalid data"}
+
+
+def test_executor_failures_raise_executor_error(pools, script_dir):
+    with pytest.raises(ExecutorError):
+        call(pools, script_dir, "metric_missing")
+    with pytest.raises(ExecutorError):
+        call(pools, script_dir, "metric_exits")
+    # A new executor replaces the one which exited
+    assert "result" in call(pools, script_dir, "metric_pid")
+
+
+def test_closing_a_users_pool_restarts_its_executors(pools, script_dir):
+    pid = call(pools, script_dir, "metric_pid")["result"]["computed_value"]
+    pools.close("user")
+    assert call(pools, script_dir, "metric_pid")["result"]["computed_value"] != pid
+
+
+def test_executors_are_recycled(script_dir):
+    pool = ExecutorPool(sys.executable, script_dir, max_memory_mb=0)
+    first = pool.call("metric_pid", '{"ideal": 1}')["result"]["computed_value"]
+    # Executors over the memory limit are not reused
+    assert pool.call("metric_pid", '{"ideal": 1}')["result"]["computed_value"] != first
+
+    pool = ExecutorPool(sys.executable, script_dir)
+    pool.call("metric_pid", '{"ideal": 1}')
+    pool.reap(idle_timeout=0)
+    assert not pool._idle
+    pool.close()
+
+
+def test_hung_metrics_are_killed_and_free_their_executor(script_dir):
+    pool = ExecutorPool(sys.executable, script_dir, size=1, timeout=0.5)
+    with pytest.raises(ExecutorError, match="did not return within"):
+        pool.call("metric_hangs", '{"ideal": 1}')
+    # The pool's only slot is free again, with a new executor
+    assert "result" in pool.call("metric_pid", '{"ideal": 1}')
+    pool.close()
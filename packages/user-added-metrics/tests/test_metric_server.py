@@ -156,6 +156,36 @@ def test_execute_numpy_function(sample_script, sample_requirements):
     assert result["range"] == [2, 8]
 
 
+def test_execute_functions_in_one_request(sample_script, sample_requirements):
+    """Test executing several user-defined functions with the same parameters."""
+    user_id = str(uuid.uuid4())
+    with open(sample_requirements, "rb") as req_file, open(sample_script, "rb") as script_file:
+        response = client.post(
+            f"/upload-metrics-and-dependencies?user_id={user_id}",
+            files={"requirements": req_file, "script": script_file},
+        )
+    assert response.status_code == 200
+
+    payload = {
+        "user_id": user_id,
+        "params": {"a": 1, "b": 2, "matrix": [[1, 2], [3, 4]]},
+    }
+    exec_response = client.post("/compute-metrics", json=payload)
+    assert exec_response.status_code == 200
+    results = exec_response.json()["results"]
+    assert results["metric_add_numbers"]["result"]["computed_value"] == 3
+    assert results["metric_multiply_matrix"]["result"]["range"] == [2, 8]
+
+    # Only the chosen functions are executed
+    payload["function_names"] = ["metric_add_numbers", "metric_missing"]
+    exec_response = client.post("/compute-metrics", json=payload)
+    assert exec_response.status_code == 200
+    results = exec_response.json()["results"]
+    assert list(results) == ["metric_add_numbers", "metric_missing"]
+    assert results["metric_add_numbers"]["result"]["computed_value"] == 3
+    assert "error" in results["metric_missing"]
+
+
 def test_clear_user_data(sample_script, sample_requirements):
     """Test clearing user-specific data."""
     user_id = str(uuid.uuid4())
@@ -0,0 +1,274 @@
+"""
+Pools of long-lived processes that execute user-defined metrics in each user's virtual environment.
+
+Each executor is started with the user's Python interpreter, imports the user's script once,
+and then runs metric functions as they are requested over its stdin and stdout, so calls do
+not pay for starting an interpreter and importing NumPy and the script every time.
+Executors are recycled once they have been idle for too long or use too much memory, and
+killed if a metric does not return in time, so a hung metric never holds on to a user's executor.
+"""
+
+import os
+import json
+import time
+import select
+import threading
+import subprocess
+from collections import deque
+from typing import Optional
+
+
+# Maximum number of executors kept for each user, bounding how many of a user's metrics run at once
+USER_METRIC_EXECUTORS_PER_USER = int(os.environ.get("USER_METRIC_EXECUTORS_PER_USER", "2"))
+# Seconds an executor may be idle before it is stopped
+USER_METRIC_EXECUTOR_IDLE_TIMEOUT = float(os.environ.get("USER_METRIC_EXECUTOR_IDLE_TIMEOUT", "300"))
+# Peak resident memory in MB above which an executor is replaced after its current call
+USER_METRIC_EXECUTOR_MAX_MEMORY_MB = int(os.environ.get("USER_METRIC_EXECUTOR_MAX_MEMORY_MB", "1024"))
+# Seconds a metric function may run before its executor is killed, freeing its slot for other calls
+USER_METRIC_TIMEOUT = float(os.environ.get("USER_METRIC_TIMEOUT", "60"))
+
+# Program run by each executor. Requests and replies are JSON objects, one per line.
+# Anything printed by the user's script goes to stderr, so it cannot corrupt the replies.
+EXECUTOR_PROGRAM = """
+import sys
+import json
+import resource
+import traceback
+
+replies = sys.stdout
+sys.stdout = sys.stderr
+sys.path.insert(0, sys.argv[1])
+try:
+    import user_script
+    import_error = None
+except BaseException:
+    import_error = traceback.format_exc()
+
+for line in sys.stdin:
+    request = json.loads(line)
+    try:
+        if import_error is not None:
+            raise ImportError(import_error)
+        func = getattr(user_script, request["function_name"])
+    except Exception as e:
+        reply = {"failure": str(e)}
+    else:
+        try:
+            result = func(request["params"])
+
+            # Ensure result follows expected format
+            if isinstance(result, dict) and all(k in result for k in ["computed_value", "ideal_value", "range"]):
+                result["range"] = list(result["range"])  # Ensure range is a list, not a tuple
+                reply = {"result": result}
+            else:
+                reply = {"error": "Invalid return format from user function"}
+        except Exception as e:
+            reply = {"error": str(e)}
+
+    reply["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        reply = json.dumps(reply)
+    except Exception as e:
+        reply = json.dumps({"error": str(e)})
+    replies.write(reply + "\\n")
+    replies.flush()
+"""
+
+
+class ExecutorError(Exception):
+    """Raised when a metric could not be executed, e.g. the function does not exist or the executor died"""
+
+
+class MetricExecutor:
+    """A process running user-defined metrics from one user's script, one call at a time"""
+
+    def __init__(self, python_bin: str, script_dir: str):
+        self._process = subprocess.Popen(
+            [python_bin, "-c", EXECUTOR_PROGRAM, script_dir],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+        )
+        self.last_used = time.monotonic()
+        self.max_rss_kb = 0
+        # Output read from the executor but not yet returned as a reply
+        self._output = b""
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def call(self, function_name: str, params_json: str, timeout: float = USER_METRIC_TIMEOUT) -> dict:
+        """
+        Run a metric function, returning {"result": ...} or {"error": ...} if the function
+        raised an error or returned an invalid result. If the function does not return within
+        the timeout, the executor is killed and ExecutorError is raised.
+
+        :param function_name: str - the metric function to run
+        :param params_json: str - the parameters to pass to the function, encoded as JSON
+        :param timeout: float - seconds to wait for the function to return
+        """
+        try:
+            self._process.stdin.write(
+                f'{{"function_name": {json.dumps(function_name)}, "params": {params_json}}}\n'.encode()
+            )
+            self._process.stdin.flush()
+            line = self._readline(time.monotonic() + timeout)
+        except (BrokenPipeError, ValueError) as e:
+            raise ExecutorError(f"Executor stopped unexpectedly: {e}")
+        if line is None:
+            self._process.kill()
+            self._process.wait()
+            raise ExecutorError(f"{function_name} did not return within {timeout} seconds")
+        if not line:
+            raise ExecutorError(f"Executor exited with code {self._process.wait()}")
+        self.last_used = time.monotonic()
+
+        try:
+            reply = json.loads(line)
+        except json.JSONDecodeError:
+            # The executor's replies can no longer be trusted
+            self._process.kill()
+            self._process.wait()
+            raise ExecutorError("Failed to decode JSON from user function output")
+        self.max_rss_kb = reply.pop("max_rss_kb", 0)
+        if "failure" in reply:
+            raise ExecutorError(reply["failure"])
+        return reply
+
+    def _readline(self, deadline: float) -> Optional[bytes]:
+        """
+        Read a line from the executor, returning b"" if it exited, or None if no line was
+        written before the deadline
+        """
+        stdout = self._process.stdout.fileno()
+        while b"\n" not in self._output:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([stdout], [], [], remaining)[0]:
+                return None
+            chunk = os.read(stdout, 65536)
+            if not chunk:
+                return b""
+            self._output += chunk
+        line, _, self._output = self._output.partition(b"\n")
+        return line
+
+    def close(self):
+        if self.is_alive:
+            self._process.stdin.close()
+            try:
+                self._process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        self._process.stdout.close()
+
+
+class ExecutorPool:
+    """
+    Executors for one user's script. Calls reuse an idle executor, and start a new one if
+    every executor is busy, waiting when the pool is full.
+    """
+
+    def __init__(
+        self,
+        python_bin: str,
+        script_dir: str,
+        size: int = USER_METRIC_EXECUTORS_PER_USER,
+        max_memory_mb: int = USER_METRIC_EXECUTOR_MAX_MEMORY_MB,
+        timeout: float = USER_METRIC_TIMEOUT,
+    ):
+        self._python_bin = python_bin
+        self._timeout = timeout
+        self._script_dir = script_dir
+        self._max_rss_kb = max_memory_mb * 1024
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle: deque[MetricExecutor] = deque()
+        self._closed = False
+
+    def call(self, function_name: str, params_json: str) -> dict:
+        with self._slots:
+            with self._lock:
+                executor = self._idle.pop() if self._idle else None
+            if executor is None or not executor.is_alive:
+                executor = MetricExecutor(self._python_bin, self._script_dir)
+
+            try:
+                return executor.call(function_name, params_json, self._timeout)
+            finally:
+                self._release(executor)
+
+    def _release(self, executor: MetricExecutor):
+        with self._lock:
+            if not self._closed and executor.is_alive and executor.max_rss_kb <= self._max_rss_kb:
+                self._idle.append(executor)
+                return
+        executor.close()
+
+    def reap(self, idle_timeout: float):
+        """Stop executors which have been idle for longer than the timeout"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [e for e in self._idle if now - e.last_used > idle_timeout]
+            self._idle = deque(e for e in self._idle if e not in expired)
+        for executor in expired:
+            executor.close()
+
+    def close(self):
+        """Stop idle executors, and busy executors once their current call completes"""
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for executor in idle:
+            executor.close()
+
+
+class ExecutorPools:
+    """
+    The executor pool of each user, with a background thread stopping idle executors
+
+    Usage:
+    pools = ExecutorPools()
+    output = pools.call(user_id, python_bin, script_dir, "metric_accuracy", json.dumps(params))
+    ...
+    pools.close(user_id)  # e.g. when the user's script is replaced or deleted
+    """
+
+    def __init__(self, idle_timeout: float = USER_METRIC_EXECUTOR_IDLE_TIMEOUT):
+        self._idle_timeout = idle_timeout
+        self._pools: dict[str, ExecutorPool] = {}
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+
+    def call(self, user_id: str, python_bin: str, script_dir: str, function_name: str, params_json: str) -> dict:
+        with self._lock:
+            pool = self._pools.get(user_id)
+            if pool is None:
+                pool = self._pools[user_id] = ExecutorPool(python_bin, script_dir)
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_forever, name="ExecutorReaper", daemon=True)
+                self._reaper.start()
+        return pool.call(function_name, params_json)
+
+    def close(self, user_id: str):
+        with self._lock:
+            pool = self._pools.pop(user_id, None)
+        if pool is not None:
+            pool.close()
+
+    def close_all(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self._idle_timeout / 2)
+            with self._lock:
+                pools = list(self._pools.values())
+            for pool in pools:
+                pool.reap(self._idle_timeout)
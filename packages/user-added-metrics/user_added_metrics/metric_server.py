@@ -1,14 +1,16 @@
 import json
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File, HTTPException
 import importlib.util
 import os
 import shutil
-from common.models.common import ComputeUserMetricRequest
+from common.models.common import ComputeUserMetricRequest, ComputeUserMetricsRequest
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 import sys
 import numpy as np
+from user_added_metrics.executor_pool import ExecutorError, ExecutorPools, USER_METRIC_EXECUTORS_PER_USER
 
 
 app = FastAPI()
@@ -33,6 +35,9 @@ os.makedirs(VENV_DIR, exist_ok=True)
 # store loaded user functions
 user_functions = {}
 
+# long-lived processes executing each user's functions in their virtual environment
+executor_pools = ExecutorPools()
+
 
 def get_user_path(base_dir, user_id):
     """Generates a user-specific directory path."""
@@ -97,6 +102,9 @@ async def upload_metrics_and_dependencies(user_id: str,
         pip_path = os.path.join(user_venv_dir, "bin", "pip")
         subprocess.run([pip_path, "install", "numpy"], check=True)
 
+    # Executors still running a previously uploaded script must not be reused
+    executor_pools.close(user_id)
+
     # Save user script
     script_path = os.path.join(user_upload_dir, "user_script.py")
     with open(script_path, "wb") as buffer:
@@ -134,6 +142,7 @@ async def clear_user_data(user_id: str):
     user_upload_dir = get_user_path(UPLOAD_DIR, user_id)
     user_venv_dir = get_user_path(VENV_DIR, user_id)
 
+    executor_pools.close(user_id)
     shutil.rmtree(user_upload_dir, ignore_errors=True)
     shutil.rmtree(user_venv_dir, ignore_errors=True)
     user_functions.pop(user_id, None)
@@ -155,19 +164,8 @@ def ensure_json_serializable(obj):
     return obj
 
 
-@app.post("/compute-metric")
-async def compute_metric(data: ComputeUserMetricRequest):
-    """
-    Executes a user-defined function in an **isolated virtual environment**.
-
-    - Passes parameters via stdin for safety.
-    - Converts JSON lists **without NumPy**.
-    - Ensures the result is **always JSON-safe**.
-    """
-    user_id = data.user_id
-    function_name = data.function_name
-    params = data.params  # Already a Python dict with lists, no NumPy
-
+def get_user_executable(user_id):
+    """Returns the Python binary of the user's virtual environment and the directory of their script."""
     user_venv_dir = get_user_path(VENV_DIR, user_id)
     user_upload_dir = get_user_path(UPLOAD_DIR, user_id)
     python_bin = os.path.join(user_venv_dir, "bin", "python")
@@ -179,48 +177,62 @@ async def compute_metric(data: ComputeUserMetricRequest):
     if not os.path.exists(script_path):
         raise HTTPException(status_code=404, detail=f"User script not found for user {user_id}")
 
-    params_json = json.dumps(params)  # Serialize params to a JSON string
+    return python_bin, user_upload_dir
 
-    # Command to execute the function inside the user's venv
-    # THIS HAS TO BE INDENTED AS SUCH TO WORK - DO NOT CHANGE
-    command = [
-        python_bin, "-c",
-        f"""
-import sys
-import json
-sys.path.insert(0, '{user_upload_dir}')
-from user_script import {function_name} as func
 
-# Read parameters from stdin
-params = json.loads(sys.stdin.read())
+@app.post("/compute-metric")
+def compute_metric(data: ComputeUserMetricRequest):
+    """
+    Executes a user-defined function in an **isolated virtual environment**.
 
-# Execute function
-try:
-    result = func(params)
+    - Runs in a long-lived executor process for the user, which has already imported the script.
+    - Passes parameters as JSON over the executor's stdin.
+    - Ensures the result is **always JSON-safe**.
+    """
+    user_id = data.user_id
+    function_name = data.function_name
+    params = data.params  # Already a Python dict with lists, no NumPy
 
-    # Ensure result follows expected format
-    if isinstance(result, dict) and all(k in result for k in ["computed_value", "ideal_value", "range"]):
-        result["range"] = list(result["range"])  # Ensure range is a list, not a tuple
-        print(json.dumps({{"result": result}}))
-    else:
-        print(json.dumps({{"error": "Invalid return format from user function"}}))
+    python_bin, user_upload_dir = get_user_executable(user_id)
+    try:
+        output = executor_pools.call(user_id, python_bin, user_upload_dir, function_name, json.dumps(params))
+    except ExecutorError as e:
+        raise HTTPException(status_code=500, detail=f"User-defined metric execution failed: {e}")
 
-except Exception as e:
-    print(json.dumps({{"error": str(e)}}))
-"""
-    ]
+    print(output)
+    return output
 
-    process = subprocess.run(command, input=params_json, capture_output=True, text=True)
 
-    if process.returncode != 0:
-        raise HTTPException(status_code=500, detail=f"User-defined metric execution failed: {process.stderr}")
+@app.post("/compute-metrics")
+def compute_metrics(data: ComputeUserMetricsRequest):
+    """
+    Executes several user-defined functions with the same parameters, in parallel on the user's executors.
 
-    print(process.stdout)
-    try:
-        output = json.loads(process.stdout.strip())
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Failed to decode JSON from user function output")
-    return output
+    - Computes all of the user's functions unless `function_names` is given.
+    - Serialises the parameters once for every function.
+    - Returns the output of each function as /compute-metric would, keyed by function name.
+    """
+    user_id = data.user_id
+    function_names = data.function_names
+    if function_names is None:
+        if user_id not in user_functions:
+            raise HTTPException(status_code=404, detail="User ID not found")
+        function_names = list(user_functions[user_id].keys())
+
+    python_bin, user_upload_dir = get_user_executable(user_id)
+    params_json = json.dumps(data.params)
+
+    def compute(function_name):
+        try:
+            return executor_pools.call(user_id, python_bin, user_upload_dir, function_name, params_json)
+        except ExecutorError as e:
+            return {"error": f"User-defined metric execution failed: {e}"}
+
+    with ThreadPoolExecutor(max_workers=USER_METRIC_EXECUTORS_PER_USER) as pool:
+        results = dict(zip(function_names, pool.map(compute, function_names)))
+
+    print(results)
+    return {"user_id": user_id, "results": results}
 
 
 if __name__ == "__main__":
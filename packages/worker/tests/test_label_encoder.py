@@ -0,0 +1,78 @@
+import numpy as np
+from unittest.mock import MagicMock
+from worker.label_encoder import JobLabelEncoder, _label_key
+
+
+def redis_client_with_codes(codes: dict):
+    """A Redis client whose label encoding script assigns codes from the given hash, like Redis"""
+
+    def script(keys, args):
+        job_codes = codes.setdefault(keys[0], {})
+        for label in args[1:]:
+            job_codes.setdefault(label, len(job_codes))
+        return [item for label, code in job_codes.items() for item in (label.encode(), str(code).encode())]
+
+    client = MagicMock()
+    client.register_script.return_value = MagicMock(side_effect=script)
+    return client
+
+
+def test_labels_equal_in_python_have_the_same_key():
+    assert _label_key(1) == _label_key(1.0) == _label_key(True) == _label_key(np.int64(1))
+    assert _label_key("1") != _label_key(1)
+    assert _label_key(0.5) == _label_key(np.float32(0.5))
+
+
+def test_encoders_share_codes_through_redis():
+    codes = {}
+    first = JobLabelEncoder(redis_client_with_codes(codes), ttl=60)
+    second = JobLabelEncoder(redis_client_with_codes(codes), ttl=60)
+
+    assert first.encode("job", np.array(["b", "c"])).tolist() == [0, 1]
+    assert second.encode("job", np.array(["a", "c"])).tolist() == [2, 1]
+    assert first.encode("job", np.array(["a", "b"])).tolist() == [2, 0]
+    assert codes == {"aignostic.labels:job": {'"b"': 0, '"c"': 1, '"a"': 2}}
+
+
+def test_encoder_only_sends_unseen_labels_to_redis():
+    client = redis_client_with_codes({})
+    script = client.register_script.return_value
+    encoder = JobLabelEncoder(client, ttl=60)
+
+    encoder.encode("job", np.array(["a", "b"]))
+    encoder.encode("job", np.array(["a", "b"]))
+    encoder.encode("job", np.array(["b", "c"]))
+
+    assert [call.kwargs["args"] for call in script.call_args_list] == [
+        [60, '"a"', '"b"'],
+        [60, '"c"'],
+    ]
+
+
+def test_integer_labels_are_their_own_codes():
+    client = redis_client_with_codes({})
+    encoder = JobLabelEncoder(client, ttl=60)
+
+    # The first batch only contains positives, which must not become class 0
+    assert encoder.encode("job", np.array([1])).tolist() == [1]
+    assert encoder.encode("job", np.array([0, 1])).tolist() == [0, 1]
+    assert encoder.encode("job", np.array([False, True, 2.0])).tolist() == [0, 1, 2]
+    client.register_script.return_value.assert_not_called()
+
+
+def test_encoder_evicts_least_recently_used_jobs():
+    encoder = JobLabelEncoder(cache_size=1)
+    encoder.encode("first", np.array(["a"]))
+    encoder.encode("second", np.array(["b"]))
+    assert list(encoder._codes) == ["second"]
+
+
+def test_categories_are_numbered_from_zero_and_shared():
+    codes = {}
+    first = JobLabelEncoder(redis_client_with_codes(codes), ttl=60, integers_as_codes=False)
+    second = JobLabelEncoder(redis_client_with_codes(codes), ttl=60, integers_as_codes=False)
+
+    assert first.encode("job:0", [5, "x"]).tolist() == [0, 1]
+    assert second.encode("job:0", ["y", 5]).tolist() == [2, 0]
+    # Every category is known after a round trip, including those added by other workers
+    assert second.categories("job:0") == [5, "x", "y"]
@@ -1,4 +1,7 @@
+import asyncio
 import uuid
+from concurrent.futures import Future
+import numpy as np
 
 from common.models.common import WorkerError
 import pytest
@@ -11,8 +14,10 @@ from common.models import (
     ModelResponse,
 )
 from worker.worker import Worker
-from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestException
+import httpx
 from common.rabbitmq.constants import STATUS_QUEUE
+from common.models.envelope import decode_message
+from common.models.npz import NPZ_ACCEPT, NPZ_CONTENT_TYPE, decode_npz, encode_npz
 from common.models.pipeline import Batch, JobStatus, JobStatusMessage, MetricCalculationJob
 from metrics.models import WorkerException, TaskType
 import json
@@ -21,9 +26,26 @@ import json
 worker = Worker()
 
 
+@pytest.fixture
+def mock_http_client():
+    """Patch the worker's pooled HTTP client with one whose requests are mocked"""
+    client = MagicMock()
+    client.get = AsyncMock()
+    client.post = AsyncMock()
+    with patch.object(Worker, "_get_http_client", return_value=client):
+        yield client
+
+
+def http_status_error(message: str, status_code: int = 500) -> httpx.HTTPStatusError:
+    return httpx.HTTPStatusError(
+        message, request=MagicMock(), response=MagicMock(status_code=status_code)
+    )
+
+
+@patch("worker.worker.Publisher")
 @patch("worker.worker.connect_to_rabbitmq")
 @patch("worker.worker.init_queues")
-def test_connect_worker(mock_init_queues, mock_connect_to_rabbitmq):
+def test_connect_worker(mock_init_queues, mock_connect_to_rabbitmq, mock_publisher):
     mock_connection = MagicMock()
     mock_channel = MagicMock()
     mock_connect_to_rabbitmq.return_value = mock_connection
@@ -35,6 +57,9 @@ def test_connect_worker(mock_init_queues, mock_connect_to_rabbitmq):
     mock_connect_to_rabbitmq.assert_called_once()
     mock_connection.channel.assert_called_once()
     mock_init_queues.assert_called_once_with(mock_channel)
+    # Results and statuses are published with confirms on the publisher's own connection
+    mock_channel.confirm_delivery.assert_not_called()
+    mock_publisher.return_value.start.assert_called_once()
 
 
 def test_queue_result():
@@ -100,10 +125,14 @@ async def test_process_job_with_user_defined_metrics(mock_post, mock_get):
             status_code=200,
             json=MagicMock(
                 return_value={
-                    "result": {
-                        "computed_value": 0.85,
-                        "ideal_value": 1,
-                        "range": [0, 1],
+                    "results": {
+                        "user_metric_1": {
+                            "result": {
+                                "computed_value": 0.85,
+                                "ideal_value": 1,
+                                "range": [0, 1],
+                            }
+                        }
                     }
                 }
             ),
@@ -117,6 +146,14 @@ async def test_process_job_with_user_defined_metrics(mock_post, mock_get):
             "user_metric_1": {"computed_value": 0.85, "ideal_value": 1, "range": [0, 1]}
         }
 
+        # Every function is computed in one request, and the functions are only fetched once per job
+        mock_post.assert_called_once()
+        assert mock_post.call_args.args[0].endswith("/compute-metrics")
+        assert mock_post.call_args.kwargs["json"]["function_names"] == ["user_metric_1"]
+        await worker.process_job(job)
+        mock_get.assert_called_once()
+        assert mock_post.call_count == 2
+
 
 @patch("worker.worker.requests.get")
 @patch("worker.worker.requests.post")
@@ -213,10 +250,14 @@ async def test_process_job_clear_user_data_on_success(mock_post, mock_get, mock_
             status_code=200,
             json=MagicMock(
                 return_value={
-                    "result": {
-                        "computed_value": 0.85,
-                        "ideal_value": 1,
-                        "range": [0, 1],
+                    "results": {
+                        "user_metric_1": {
+                            "result": {
+                                "computed_value": 0.85,
+                                "ideal_value": 1,
+                                "range": [0, 1],
+                            }
+                        }
                     }
                 }
             ),
@@ -340,9 +381,9 @@ async def test_process_job_success(mock_calculate_metrics):
         mock_send_status_completed.assert_called_once()
 
 
-@patch("worker.worker.requests.post")
 @pytest.mark.asyncio
-async def test_query_model_success(mock_post):
+async def test_query_model_success(mock_http_client):
+    mock_post = mock_http_client.post
     mock_response = MagicMock()
     mock_response.headers = {"Content-Type": "application/json"}
     mock_response.json.return_value = {"predictions": [[0], [1]]}
@@ -355,9 +396,9 @@ async def test_query_model_success(mock_post):
     assert result.predictions == [[0], [1]]
 
 
-@patch("worker.worker.requests.get")
 @pytest.mark.asyncio
-async def test_fetch_data_success(mock_get):
+async def test_fetch_data_success(mock_http_client):
+    mock_get = mock_http_client.get
     mock_response = MagicMock()
     mock_response.headers = {"Content-Type": "application/json"}
     mock_response.json.return_value = {
@@ -372,12 +413,144 @@ async def test_fetch_data_success(mock_get):
     assert result.features == [[1, 2]]
 
 
+@pytest.mark.asyncio
+async def test_fetch_data_decodes_npz_response(mock_http_client):
+    dataset = DatasetResponse(features=[[1.5, 2.0]], labels=[[0]], group_ids=[1])
+    mock_response = MagicMock()
+    mock_response.headers = {"Content-Type": NPZ_CONTENT_TYPE}
+    mock_response.content = encode_npz(dataset)
+    mock_http_client.get.return_value = mock_response
+
+    result = await worker.fetch_data("http://example.com/data", "data_key", 1)
+
+    assert mock_http_client.get.call_args.kwargs["headers"]["Accept"] == NPZ_ACCEPT
+    np.testing.assert_array_equal(result.features, [[1.5, 2.0]])
+    np.testing.assert_array_equal(result.labels, [[0]])
+    mock_response.json.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_query_model_sends_npz_once_model_replies_with_npz(mock_http_client):
+    npz_worker = Worker()
+    data = DatasetResponse(features=[[1, 2], [3, 4]], labels=[[0], [1]], group_ids=[1, 1])
+    mock_response = MagicMock(status_code=200)
+    mock_response.headers = {"Content-Type": NPZ_CONTENT_TYPE}
+    mock_response.content = encode_npz(ModelResponse(predictions=np.array([[0], [1]])))
+    mock_http_client.post.return_value = mock_response
+
+    # JSON is sent until the model has shown it supports archives
+    result = await npz_worker.query_model("http://example.com/model", data, "model_key")
+    assert mock_http_client.post.call_args.kwargs["json"] == data.model_dump()
+    np.testing.assert_array_equal(result.predictions, [[0], [1]])
+
+    await npz_worker.query_model("http://example.com/model", data, "model_key")
+    kwargs = mock_http_client.post.call_args.kwargs
+    assert kwargs["headers"]["Content-Type"] == NPZ_CONTENT_TYPE
+    np.testing.assert_array_equal(decode_npz(DatasetResponse, kwargs["content"]).features, data.features)
+
+
+def test_check_model_response_compares_array_types_by_kind():
+    labels = [[0], [1]]
+    worker._check_model_response(np.array([[1], [0]]), labels)
+    with pytest.raises(WorkerException, match="Model output type does not match target attribute type"):
+        worker._check_model_response(np.array([[1.0], [0.0]]), labels)
+
+
+def test_materialise_features_gives_categories_the_same_codes_in_every_batch():
+    schema_worker = Worker()
+    first = DatasetResponse(
+        features=[[1, "a"], [2, "b"]], labels=[[0], [1]], group_ids=None,
+        column_dtypes=["float32", "category"],
+    )
+    features, categories = schema_worker.materialise_features("job", first)
+    assert features.dtype == np.float32
+    assert features.tolist() == [[1.0, 0.0], [2.0, 1.0]]
+    assert categories == {1: ["a", "b"]}
+
+    later = DatasetResponse(
+        features=[[3, "c"], [4, "b"]], labels=[[0], [1]], group_ids=None,
+        column_dtypes=["float32", "category"],
+    )
+    features, categories = schema_worker.materialise_features("job", later)
+    assert features.tolist() == [[3.0, 2.0], [4.0, 1.0]]
+    assert categories == {1: ["a", "b", "c"]}
+
+    # Other jobs number their categories from 0
+    features, categories = schema_worker.materialise_features("other", later)
+    assert features.tolist() == [[3.0, 0.0], [4.0, 1.0]]
+    assert categories == {1: ["c", "b"]}
+
+    # Batches without dtypes are not typed
+    untyped = DatasetResponse(features=[[3, "b"]], labels=[[0]], group_ids=None)
+    features, categories = schema_worker.materialise_features("job", untyped)
+    assert features == [[3, "b"]] and categories is None
+
+    with pytest.raises(WorkerException):
+        schema_worker.materialise_features(
+            "job", DatasetResponse(features=[[1]], labels=[[0]], group_ids=None, column_dtypes=["float32", "category"])
+        )
+
+
 def test_check_model_response():
     predictions = [[0, 1], [1, 0]]
     labels = [[0, 1], [1, 0]]
     worker._check_model_response(predictions, labels)
 
 
+@pytest.mark.parametrize("validation", ["full", "sampled", "shape"])
+def test_check_model_response_checks_shape_at_every_level(validation):
+    labels = [[0, 1], [1, 0], [1, 1]]
+    with pytest.raises(WorkerException, match="Number of model outputs does not match"):
+        worker._check_model_response([[0, 1]], labels, validation)
+    with pytest.raises(WorkerException, match="Number of attributes predicted by model"):
+        worker._check_model_response([[0], [1], [1]], labels, validation)
+    with pytest.raises(WorkerException, match="Model output type does not match"):
+        worker._check_model_response([["0", 1], [1, 0], [1, 1]], labels, validation)
+    with pytest.raises(WorkerException, match="Inconsistent number of attributes"):
+        worker._check_model_response([[0, 1], [1, 0, 1], [1, 1]], labels, validation)
+
+
+def test_check_model_response_validation_levels_check_types():
+    labels = [[0.5]] * 2000
+    predictions = [[0.5]] * 1999 + [[1]]
+
+    with pytest.raises(WorkerException, match="All columns for an output label should be of the same type"):
+        worker._check_model_response(predictions, labels, "full")
+    # Only the first row's types are checked
+    worker._check_model_response(predictions, labels, "shape")
+
+    # Only a sample of rows is checked
+    with patch("worker.worker.WORKER_MODEL_RESPONSE_VALIDATION_SAMPLE_SIZE", 10), \
+         patch("numpy.random.default_rng") as mock_rng:
+        mock_rng.return_value.choice.return_value = np.arange(10)
+        worker._check_model_response(predictions, labels, "sampled")
+        mock_rng.return_value.choice.return_value = np.arange(1990, 2000)
+        with pytest.raises(WorkerException, match="All columns for an output label"):
+            worker._check_model_response(predictions, labels, "sampled")
+
+    with pytest.raises(ValueError):
+        worker._check_model_response(predictions, labels, "lenient")
+
+
+def test_model_response_validation_level_is_checked_when_worker_is_created():
+    with patch("worker.worker.WORKER_MODEL_RESPONSE_VALIDATION", "lenient"):
+        with pytest.raises(ValueError, match="Unknown model response validation level: lenient"):
+            Worker()
+        assert Worker(model_response_validation="shape")._model_response_validation == "shape"
+
+    with pytest.raises(ValueError):
+        Worker(model_response_validation="none")
+
+
+def test_check_model_response_follows_isinstance_for_python_values():
+    # Booleans are integers, but integers are not floats or booleans
+    worker._check_model_response([[1], [True]], [[0], [1]], "full")
+    with pytest.raises(WorkerException, match="All columns for an output label"):
+        worker._check_model_response([[True], [1]], [[False], [True]], "full")
+    with pytest.raises(WorkerException, match="All columns for an output label"):
+        worker._check_model_response([[1.0], [1]], [[0.0], [1.0]], "full")
+
+
 def test_invalid_job_format_raises_worker_exception():
     with patch.object(worker, "_channel", new_callable=MagicMock) as mock_channel:
         job = Batch(
@@ -402,22 +575,22 @@ def test_invalid_job_format_raises_worker_exception():
             mock_channel.basic_get.assert_called_once()
 
 
-@patch("worker.worker.requests.get")
 @pytest.mark.asyncio
-async def test_fetch_data_http_error_gives_worker_exception(mock_get):
+async def test_fetch_data_http_error_gives_worker_exception(mock_http_client):
     """Test that WorkerException is raised when an HTTP error occurs."""
+    mock_get = mock_http_client.get
     mock_response = MagicMock()
-    mock_response.raise_for_status.side_effect = HTTPError("HTTP Error")
+    mock_response.raise_for_status.side_effect = http_status_error("HTTP Error")
     mock_get.return_value = mock_response
 
     with pytest.raises(WorkerException):
         await worker.fetch_data("http://example.com/data", "data_key", 1)
 
 
-@patch("worker.worker.requests.get")
 @pytest.mark.asyncio
-async def test_fetch_data_invalid_data_format_gives_worker_exception(mock_get):
+async def test_fetch_data_invalid_data_format_gives_worker_exception(mock_http_client):
     """Test that WorkerException is raised when the data format is incorrect."""
+    mock_get = mock_http_client.get
     mock_response = MagicMock()
     mock_response.headers = {"Content-Type": "application/json"}
     mock_response.json.return_value = {
@@ -432,16 +605,16 @@ async def test_fetch_data_invalid_data_format_gives_worker_exception(mock_get):
     assert "Data error - Incorrect format from dataset API:" in str(excinfo.value)
 
 
-@patch("worker.worker.requests.get")
 @pytest.mark.asyncio
-async def test_fetch_data_get_exceptions_are_handled(mock_get):
+async def test_fetch_data_get_exceptions_are_handled(mock_http_client):
     """Test that WorkerException is raised when an error occurs during get request."""
+    mock_get = mock_http_client.get
 
     errors = [
-        ConnectionError("Connection error"),
-        Timeout("Timeout error"),
-        HTTPError("HTTP error"),
-        RequestException("Request error"),
+        httpx.ConnectError("Connection error"),
+        httpx.TimeoutException("Timeout error"),
+        http_status_error("HTTP error"),
+        httpx.RequestError("Request error"),
         Exception("Some other error occurred"),
     ]
 
@@ -454,10 +627,10 @@ async def test_fetch_data_get_exceptions_are_handled(mock_get):
             await worker.fetch_data("http://example.com/data", "data_key", 1)
 
 
-@patch("worker.worker.requests.get")
 @pytest.mark.asyncio
-async def test_fetch_data_unknown_exception_during_parsing(mock_get):
+async def test_fetch_data_unknown_exception_during_parsing(mock_http_client):
     """Test that WorkerException is raised when an unknown exception occurs during parsing."""
+    mock_get = mock_http_client.get
     mock_response = MagicMock()
     mock_response.headers = {"Content-Type": "application/json"}
     mock_response.json.side_effect = Exception("Some error occurred")
@@ -468,15 +641,15 @@ async def test_fetch_data_unknown_exception_during_parsing(mock_get):
         await worker.fetch_data("http://example.com/data", "data_key", 1)
 
 
-@patch("worker.worker.requests.post")
 @pytest.mark.asyncio
-async def test_query_model_post_exceptions_are_handled(mock_post):
+async def test_query_model_post_exceptions_are_handled(mock_http_client):
+    mock_post = mock_http_client.post
 
     errors = [
-        ConnectionError("Connection error"),
-        Timeout("Timeout error"),
-        HTTPError("HTTP error"),
-        RequestException("Request error"),
+        httpx.ConnectError("Connection error"),
+        httpx.TimeoutException("Timeout error"),
+        http_status_error("HTTP error"),
+        httpx.RequestError("Request error"),
         Exception("Some other error occurred"),
     ]
 
@@ -491,10 +664,10 @@ async def test_query_model_post_exceptions_are_handled(mock_post):
             await worker.query_model("http://example.com/predict", mock_data, "model_key")
 
 
-@patch("worker.worker.requests.post")
 @pytest.mark.asyncio
-async def test_query_model_unknown_exception_during_parsing(mock_post):
+async def test_query_model_unknown_exception_during_parsing(mock_http_client):
     """Test that WorkerException is raised when an unknown exception occurs during parsing."""
+    mock_post = mock_http_client.post
     mock_response = MagicMock()
     mock_response.headers = {"Content-Type": "application/json"}
     mock_response.json.side_effect = Exception("Some error occurred")
@@ -510,14 +683,13 @@ def test_send_status_completed():
     with patch.object(worker, "_channel", new_callable=MagicMock) as mock_channel, \
          patch("worker.worker.publish_to_queue") as mock_publish_to_queue:
         worker.send_status_completed("1234", "ABCD")
-        mock_publish_to_queue.assert_called_once_with(
-            mock_channel,
-            STATUS_QUEUE,
-            JobStatusMessage(
-                job_id="1234",
-                batch_id="ABCD",
-                status=JobStatus.COMPLETED,
-            ).model_dump_json()
+        mock_publish_to_queue.assert_called_once()
+        channel, queue, body, properties = mock_publish_to_queue.call_args.args
+        assert (channel, queue) == (mock_channel, STATUS_QUEUE)
+        assert decode_message(JobStatusMessage, body, properties) == JobStatusMessage(
+            job_id="1234",
+            batch_id="ABCD",
+            status=JobStatus.COMPLETED,
         )
 
 
@@ -525,32 +697,49 @@ def test_send_status_error():
     with patch.object(worker, "_channel", new_callable=MagicMock) as mock_channel, \
          patch("worker.worker.publish_to_queue") as mock_publish_to_queue:
         worker.send_status_error("1234", "ABCD", "error message")
-        mock_publish_to_queue.assert_called_once_with(
-            mock_channel,
-            STATUS_QUEUE,
-            JobStatusMessage(
-                job_id="1234",
-                batch_id="ABCD",
-                status=JobStatus.ERRORED,
-                errorMessage="error message",
-            ).model_dump_json()
+        mock_publish_to_queue.assert_called_once()
+        channel, queue, body, properties = mock_publish_to_queue.call_args.args
+        assert (channel, queue) == (mock_channel, STATUS_QUEUE)
+        assert decode_message(JobStatusMessage, body, properties) == JobStatusMessage(
+            job_id="1234",
+            batch_id="ABCD",
+            status=JobStatus.ERRORED,
+            errorMessage="error message",
         )
 
 
 def test_convert_to_numeric_classes():
+    worker = Worker()
     predicted_labels = [["Class A"], ["Class B"], ["Class A"], ["Class B"]]
     true_labels = [["Class B"], ["Class B"], ["Class A"], ["Class B"]]
-    new_predicted_labels, new_true_labels = worker.convert_to_numeric_classes(predicted_labels, true_labels)
-    assert (new_predicted_labels == [[0], [1], [0], [1]] and new_true_labels == [[1], [1], [0], [1]]) or \
-           (new_predicted_labels == [[1], [0], [1], [0]] and new_true_labels == [[0], [0], [1], [0]])
+    new_predicted_labels, new_true_labels = worker.convert_to_numeric_classes(
+        "1234", predicted_labels, true_labels
+    )
+    assert new_predicted_labels.tolist() == [[0], [1], [0], [1]]
+    assert new_true_labels.tolist() == [[1], [1], [0], [1]]
+
+
+def test_convert_to_numeric_classes_is_stable_across_batches_of_a_job():
+    worker = Worker()
+    worker.convert_to_numeric_classes("1234", [["b"], ["c"]], [["c"], ["b"]])
+    # "a" sorts first, but is given the next free class
+    new_predicted_labels, new_true_labels = worker.convert_to_numeric_classes(
+        "1234", np.array([["c"], ["a"]]), [["b"], ["a"]]
+    )
+    assert new_predicted_labels.tolist() == [[1], [2]]
+    assert new_true_labels.tolist() == [[0], [2]]
+
+    # Each job has its own classes
+    new_predicted_labels, _ = worker.convert_to_numeric_classes("5678", [["c"]], [["c"]])
+    assert new_predicted_labels.tolist() == [[0]]
 
 
-@patch("worker.worker.requests.post")
 @pytest.mark.asyncio
-async def test_query_model_http_error_gives_worker_exception(mock_post):
+async def test_query_model_http_error_gives_worker_exception(mock_http_client):
     """Test that WorkerException is raised when an HTTP error occurs."""
+    mock_post = mock_http_client.post
     mock_response = MagicMock()
-    mock_response.raise_for_status.side_effect = HTTPError("HTTP Error")
+    mock_response.raise_for_status.side_effect = http_status_error("HTTP Error")
     mock_post.return_value = mock_response
 
     mock_data = DatasetResponse(features=[[1, 2]], labels=[[0]], group_ids=[1])
@@ -559,10 +748,10 @@ async def test_query_model_http_error_gives_worker_exception(mock_post):
         await worker.query_model("http://example.com/predict", mock_data, "model_key")
 
 
-@patch("worker.worker.requests.post")
 @pytest.mark.asyncio
-async def test_query_model_invalid_data_format_gives_worker_exception(mock_post):
+async def test_query_model_invalid_data_format_gives_worker_exception(mock_http_client):
     """Test that WorkerException is raised when the data format is incorrect."""
+    mock_post = mock_http_client.post
     mock_response = MagicMock()
     mock_response.json.return_value = {
         "invalid": "data"
@@ -645,3 +834,145 @@ async def test_worker_exception_during_process_job_send_error_to_frontend():
 
         mock_queue_error.assert_called_once()
         mock_send_status_error.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_process_job_bounded_limits_batches_in_flight():
+    bounded_worker = Worker(max_concurrent_batches=2)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def slow_process_job(batch):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    with patch.object(bounded_worker, "process_job", side_effect=slow_process_job):
+        await asyncio.gather(
+            *(bounded_worker.process_job_bounded(MagicMock()) for _ in range(5))
+        )
+
+    assert max_in_flight == 2
+
+
+def test_publish_is_handed_to_publisher_when_connected():
+    connected_worker = Worker()
+    connected_worker._publisher = MagicMock()
+    connected_worker._channel = MagicMock()
+
+    with patch("worker.worker.publish_to_queue") as mock_publish_to_queue:
+        connected_worker.send_status_completed("1234", "ABCD")
+
+        mock_publish_to_queue.assert_not_called()
+        connected_worker._publisher.publish.assert_called_once()
+        body, queue, properties = connected_worker._publisher.publish.call_args.args
+        assert queue == STATUS_QUEUE
+        assert decode_message(JobStatusMessage, body, properties) == JobStatusMessage(
+            job_id="1234", batch_id="ABCD", status=JobStatus.COMPLETED
+        )
+
+
+@pytest.mark.asyncio
+async def test_process_job_bounded_waits_for_confirms():
+    connected_worker = Worker()
+    connected_worker._publisher = MagicMock()
+    confirm = Future()
+    connected_worker._publisher.publish.return_value = confirm
+
+    async def process_job(batch):
+        connected_worker.send_status_completed("1234", "ABCD")
+
+    with patch.object(connected_worker, "process_job", side_effect=process_job):
+        task = asyncio.create_task(connected_worker.process_job_bounded(MagicMock()))
+        await asyncio.sleep(0.05)
+        # The batch is not finished until its status message is confirmed
+        assert not task.done()
+
+        confirm.set_result(True)
+        await asyncio.wait_for(task, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_process_job_bounded_raises_when_not_confirmed():
+    connected_worker = Worker()
+    connected_worker._publisher = MagicMock()
+    nacked, confirmed = Future(), Future()
+    nacked.set_exception(Exception("Message was nacked"))
+    confirmed.set_result(True)
+    connected_worker._publisher.publish.side_effect = [nacked, confirmed]
+
+    async def process_job(batch):
+        connected_worker.send_status_completed("1234", "ABCD")
+        connected_worker.send_status_completed("1234", "EFGH")
+
+    with patch.object(connected_worker, "process_job", side_effect=process_job):
+        # Raised so that the batch is requeued rather than acknowledged
+        with pytest.raises(Exception, match="Message was nacked"):
+            await connected_worker.process_job_bounded(MagicMock())
+
+
+def settled_batch(redelivered=False, publisher_running=True, error=None):
+    """Settle a batch, returning the callbacks handed to the connection thread"""
+    connected_worker = Worker()
+    connected_worker._connection = MagicMock()
+    connected_worker._connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    connected_worker._publisher = MagicMock(is_running=publisher_running)
+    channel = MagicMock()
+    future = Future()
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+    connected_worker._settle_batch(channel, MagicMock(delivery_tag=7, redelivered=redelivered), future)
+    return channel
+
+
+def test_settle_batch_acks_confirmed_batches():
+    channel = settled_batch()
+    channel.basic_ack.assert_called_once_with(delivery_tag=7)
+    channel.basic_nack.assert_not_called()
+
+
+def test_settle_batch_requeues_unconfirmed_batches_once():
+    channel = settled_batch(error=Exception("Message was nacked"))
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+
+    channel = settled_batch(redelivered=True, error=Exception("Message was nacked"))
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=False)
+
+
+def test_settle_batch_stops_consuming_once_publisher_stopped():
+    channel = settled_batch(publisher_running=False, error=Exception("Publisher has been stopped"))
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+    channel.stop_consuming.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_fetch_data_maps_http_client_errors_to_status_codes(mock_http_client):
+    errors = [
+        (httpx.ConnectError("Connection error"), 503),
+        (httpx.ReadTimeout("Timeout error"), 504),
+        (http_status_error("Not found", status_code=404), 404),
+        (httpx.RequestError("Request error"), 500),
+    ]
+
+    for error, status_code in errors:
+        mock_http_client.get.side_effect = error
+
+        with pytest.raises(WorkerException) as excinfo:
+            await worker.fetch_data("http://example.com/data", "data_key", 1)
+
+        assert excinfo.value.status_code == status_code
+
+
+@pytest.mark.asyncio
+async def test_http_client_is_reused_across_requests():
+    pooled_worker = Worker()
+
+    client = pooled_worker._get_http_client()
+    assert pooled_worker._get_http_client() is client
+
+    await pooled_worker.close_http_client()
+    assert pooled_worker._http_client is None
@@ -0,0 +1,170 @@
+"""
+Encoding of class labels as integers, consistently across every batch of a job.
+
+Metrics for a job are calculated batch by batch and then aggregated, so a label must be
+given the same integer in every batch, whichever worker processes it. Integer (and boolean)
+labels are their own codes, so e.g. 1 is always the positive class. The codes of each job's
+other labels are kept in a Redis hash shared by every worker, and new labels are given the
+next free code by a Lua script, which Redis runs atomically. Each worker caches the codes
+of recent jobs, so only labels it has not seen before cost a round trip to Redis.
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+import redis as redis
+from common.redis.keys import redis_key
+
+# Seconds a job's label codes are kept in Redis after its last batch
+WORKER_LABEL_ENCODING_TTL = int(os.environ.get("WORKER_LABEL_ENCODING_TTL", "86400"))
+# Maximum number of jobs whose label codes are cached by each worker
+WORKER_LABEL_ENCODING_CACHE_SIZE = int(
+    os.environ.get("WORKER_LABEL_ENCODING_CACHE_SIZE", "1024")
+)
+
+ENCODE_LABELS = """
+-- KEYS[1]: the job's label codes
+-- ARGV[1]: seconds to keep the codes for, ARGV[2...]: labels
+-- Give each label not yet in the hash the next free code, and return every label and its code,
+-- so that workers always know codes 0 to n - 1 without gaps
+for i = 2, #ARGV do
+    if redis.call("HEXISTS", KEYS[1], ARGV[i]) == 0 then
+        redis.call("HSET", KEYS[1], ARGV[i], redis.call("HLEN", KEYS[1]))
+    end
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return redis.call("HGETALL", KEYS[1])
+"""
+
+
+def _integer_label(label) -> Optional[int]:
+    """
+    The label as an integer if it is an integer, a boolean or an integral float (e.g. 1.0),
+    otherwise None
+    """
+    if isinstance(label, np.generic):
+        label = label.item()
+    if isinstance(label, (bool, int)) or (isinstance(label, float) and label.is_integer()):
+        return int(label)
+    return None
+
+
+def _label_key(label) -> str:
+    """
+    Key of a label in a job's codes. Labels which are equal in Python (e.g. 1, 1.0, True
+    and numpy.int64(1)) have the same key.
+    """
+    integer = _integer_label(label)
+    if integer is not None:
+        return json.dumps(integer)
+    if isinstance(label, np.generic):
+        label = label.item()
+    return json.dumps(label)
+
+
+class JobLabelEncoder:
+    """
+    Gives each class label of a job an integer code, which is the same in every batch of
+    the job. Integer labels are their own codes, whichever batch they are first seen in, so
+    the classes of binary and fairness metrics are never swapped. Other labels (e.g. strings)
+    are numbered from 0 in the order they are first seen, so a job should not mix them with
+    integer labels.
+
+    The same codes are given to the categories of categorical feature columns, with
+    integers_as_codes=False so that every category, integer or not, is numbered from 0.
+
+    Without a Redis client, codes are only consistent across the batches processed by
+    this worker.
+    """
+
+    def __init__(
+        self,
+        redis_client: Optional[redis.Redis] = None,
+        ttl: int = WORKER_LABEL_ENCODING_TTL,
+        cache_size: int = WORKER_LABEL_ENCODING_CACHE_SIZE,
+        namespace: str = "labels",
+        integers_as_codes: bool = True,
+    ):
+        """
+        :param redis_client: Optional[redis.Redis] - the client to share codes through, or None
+            to keep them in this worker
+        :param ttl: int - seconds a job's codes are kept in Redis after they were last extended
+        :param cache_size: int - maximum number of jobs whose codes are cached by this worker
+        :param namespace: str - Redis namespace of the codes
+        :param integers_as_codes: bool - whether integer labels are their own codes
+        """
+        self._script = (
+            redis_client.register_script(ENCODE_LABELS) if redis_client is not None else None
+        )
+        self._ttl = ttl
+        self._cache_size = cache_size
+        self._namespace = namespace
+        self._integers_as_codes = integers_as_codes
+        # Codes of the labels seen for each recent job, by label key
+        self._codes: OrderedDict[str, dict[str, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, job_id: str, labels: np.ndarray) -> np.ndarray:
+        """
+        Give each label its code for the job, assigning codes to labels not seen before
+
+        :param job_id: str - the job the labels belong to
+        :param labels: np.ndarray - distinct labels, e.g. from numpy.unique
+        :return: np.ndarray - the code of each label
+        """
+        if self._integers_as_codes:
+            integers = [_integer_label(label) for label in labels]
+        else:
+            integers = [None] * len(labels)
+        if all(integer is not None for integer in integers):
+            return np.array(integers, dtype=np.int64)
+
+        keys = [_label_key(label) for label in labels]
+        with self._lock:
+            codes = self._job_codes(job_id)
+            unseen = [
+                key for key, integer in dict.fromkeys(zip(keys, integers))
+                if integer is None and key not in codes
+            ]
+            if unseen and self._script is None:
+                codes.update({key: len(codes) + i for i, key in enumerate(unseen)})
+                unseen = []
+            known = {key: codes[key] for key in keys if key in codes}
+
+        if unseen:
+            reply = self._script(
+                keys=[redis_key(self._namespace, job_id)], args=[self._ttl, *unseen]
+            )
+            all_codes = {
+                key.decode() if isinstance(key, bytes) else key: int(code)
+                for key, code in zip(reply[::2], reply[1::2])
+            }
+            known.update({key: all_codes[key] for key in keys if key in all_codes})
+            with self._lock:
+                self._job_codes(job_id).update(all_codes)
+        return np.array(
+            [known[key] if integer is None else integer for key, integer in zip(keys, integers)],
+            dtype=np.int64,
+        )
+
+    def categories(self, job_id: str) -> list:
+        """
+        Returns the job's labels known to this worker, indexed by their code. Integer labels
+        which are their own codes are not included.
+        """
+        with self._lock:
+            codes = self._job_codes(job_id)
+            return [json.loads(key) for key in sorted(codes, key=codes.get)]
+
+    def _job_codes(self, job_id: str) -> dict[str, int]:
+        """The cached codes of a job, evicting the least recently used job if needed"""
+        codes = self._codes.get(job_id)
+        if codes is None:
+            codes = self._codes[job_id] = {}
+            if len(self._codes) > self._cache_size:
+                self._codes.popitem(last=False)
+        self._codes.move_to_end(job_id)
+        return codes
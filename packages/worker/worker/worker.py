@@ -9,14 +9,26 @@ Each worker:
 """
 
 import os
-import json
 import asyncio
 import random
+import functools
 import threading
+import contextvars
+from collections import OrderedDict
+from itertools import chain
+from concurrent.futures import Future
+import numpy as np
+from common.models.envelope import decode_message, encode_message
+from common.models.npz import NPZ_ACCEPT, NPZ_CONTENT_TYPE, decode_npz, encode_npz, is_npz
 from common.models.pipeline import Batch, JobStatus, JobStatusMessage
 from common.rabbitmq.connect import connect_to_rabbitmq, init_queues, publish_to_queue
+from common.rabbitmq.publisher import Publisher
+from common.redis.connect import connect_to_redis
+from common.utils import typed_features_to_np
 from metrics.models import WorkerResults, convert_calculate_request_to_dict, TaskType
 import requests
+import redis as redis
+import httpx
 from pydantic.networks import HttpUrl
 import metrics.metrics as metrics_lib
 from common.models import (
@@ -29,19 +41,73 @@ from common.models import (
 )
 from common.rabbitmq.constants import BATCH_QUEUE, RESULT_QUEUE, STATUS_QUEUE
 from metrics.models import WorkerException
-from pydantic import ValidationError
+from worker.label_encoder import JobLabelEncoder
+from pydantic import BaseModel, ValidationError
 
 from pika.adapters.blocking_connection import BlockingChannel
 import re
-from requests.exceptions import RequestException, HTTPError, ConnectionError, Timeout
 
 
 RABBIT_MQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
 
+# Redis holds the label codes of classification jobs, shared by every worker. If unset,
+# each worker encodes the labels of the batches it processes on its own.
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = os.environ.get("REDIS_PORT", "6379")
+
 USER_METRIC_SERVER_URL = os.environ.get(
     "USER_METRIC_SERVER_URL", "http://user-added-metrics:8010"
 )
 
+# Maximum number of batches a single worker processes at once. This is used both as
+# the RabbitMQ prefetch count and as the size of the in-flight semaphore.
+WORKER_MAX_CONCURRENT_BATCHES = max(
+    1, int(os.environ.get("WORKER_MAX_CONCURRENT_BATCHES", "1"))
+)
+
+# Settings for the pooled HTTP client used to talk to dataset and model APIs
+WORKER_HTTP_CONNECT_TIMEOUT = float(os.environ.get("WORKER_HTTP_CONNECT_TIMEOUT", "10"))
+WORKER_HTTP_READ_TIMEOUT = float(os.environ.get("WORKER_HTTP_READ_TIMEOUT", "90"))
+WORKER_HTTP_MAX_CONNECTIONS = int(os.environ.get("WORKER_HTTP_MAX_CONNECTIONS", "100"))
+WORKER_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("WORKER_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+WORKER_HTTP_KEEPALIVE_EXPIRY = float(
+    os.environ.get("WORKER_HTTP_KEEPALIVE_EXPIRY", "30")
+)
+
+# How strictly the types of the values predicted by models are checked - "full" checks
+# every value, "sampled" the values of a random sample of rows, and "shape" only the first row
+MODEL_RESPONSE_VALIDATION_LEVELS = ("full", "sampled", "shape")
+WORKER_MODEL_RESPONSE_VALIDATION = os.environ.get("WORKER_MODEL_RESPONSE_VALIDATION", "full")
+WORKER_MODEL_RESPONSE_VALIDATION_SAMPLE_SIZE = int(
+    os.environ.get("WORKER_MODEL_RESPONSE_VALIDATION_SAMPLE_SIZE", "1000")
+)
+
+# Maximum number of jobs whose user-defined metric functions are remembered
+WORKER_USER_METRICS_CACHE_SIZE = int(os.environ.get("WORKER_USER_METRICS_CACHE_SIZE", "1024"))
+
+
+# Messages published while processing the current batch, whose confirms are awaited
+# before the batch is acknowledged
+_batch_publishes: contextvars.ContextVar[list[Future]] = contextvars.ContextVar("batch_publishes")
+
+# Kinds of array values (see numpy.dtype.kind) a prediction may have for each kind of label,
+# following isinstance (e.g. booleans are integers, but integers are not floats)
+_COMPATIBLE_KINDS = {"b": "b", "i": "biu", "u": "biu", "f": "f", "U": "U"}
+
+# Type of each value of an object array, computed in a single pass
+_value_types = np.frompyfunc(type, 1, 1)
+
+
+def _flatten_labels(labels) -> np.ndarray:
+    """
+    Flatten the labels of a batch into a 1D array
+    """
+    if isinstance(labels, np.ndarray):
+        return labels.ravel()
+    return np.array(list(chain.from_iterable(labels)))
+
 
 def convert_localhost_url(url: str) -> str:
     """
@@ -54,15 +120,41 @@ def convert_localhost_url(url: str) -> str:
 class Worker:
     _channel: BlockingChannel
 
-    def __init__(self, host="localhost"):
+    def __init__(
+        self, host="localhost", max_concurrent_batches: int = None, model_response_validation: str = None
+    ):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
+        `max_concurrent_batches` bounds how many batches are processed at once,
+        defaulting to WORKER_MAX_CONCURRENT_BATCHES. `model_response_validation` is
+        how strictly model responses are checked, defaulting to
+        WORKER_MODEL_RESPONSE_VALIDATION, and must be one of MODEL_RESPONSE_VALIDATION_LEVELS.
         """
+        # Check the level up front, so a misconfigured worker does not start rather than
+        # failing every batch
+        self._model_response_validation = model_response_validation or WORKER_MODEL_RESPONSE_VALIDATION
+        if self._model_response_validation not in MODEL_RESPONSE_VALIDATION_LEVELS:
+            raise ValueError(f"Unknown model response validation level: {self._model_response_validation}")
 
         self._host = host
         self._connection = None
         self._channel = None
+        self._publisher = None
+        self._max_concurrent_batches = (
+            max_concurrent_batches or WORKER_MAX_CONCURRENT_BATCHES
+        )
+        self._batch_semaphore = asyncio.Semaphore(self._max_concurrent_batches)
+        self._http_client = None
+        self._http_client_loop = None
+        # Model URLs which have replied with an npz archive, and so accept one as input
+        self._npz_model_urls: set[str] = set()
+        self._label_encoder = JobLabelEncoder()
+        # Codes of the categories of each job's categorical feature columns
+        self._category_encoder = JobLabelEncoder(namespace="categories", integers_as_codes=False)
+        # User-defined metric functions of each job, which are only fetched once
+        self._user_metric_functions: OrderedDict[str, list[str]] = OrderedDict()
+        self._user_metric_functions_lock = threading.Lock()
 
     def connect(self):
         """Connect to RabbitMQ, returning the connection handle.
@@ -72,9 +164,37 @@ class Worker:
         """
         self._connection = connect_to_rabbitmq(host=self._host)
         self._channel = self._connection.channel()
-        self._channel.confirm_delivery()
         init_queues(self._channel)
+        # Results and statuses are published on a separate connection, which pipelines
+        # messages and tracks the broker's confirms asynchronously
+        self._publisher = Publisher(
+            name="WorkerPublisher", host=self._host, queues=[RESULT_QUEUE, STATUS_QUEUE]
+        )
+        self._publisher.start()
         print("Connection established to RabbitMQ")
+        if REDIS_HOST:
+            redis_client = connect_to_redis(f"redis://{REDIS_HOST}:{REDIS_PORT}")
+            self._label_encoder = JobLabelEncoder(redis_client)
+            self._category_encoder = JobLabelEncoder(
+                redis_client, namespace="categories", integers_as_codes=False
+            )
+
+    def _publish(self, queue: str, message: BaseModel):
+        """
+        Encode and publish a message without waiting for the broker to confirm it. Messages published
+        while processing a batch are confirmed before the batch is acknowledged (see
+        process_job_bounded). Before the worker is connected, messages are published
+        directly on the worker's channel.
+        """
+        body, properties = encode_message(message)
+        if self._publisher is None:
+            self._channel = publish_to_queue(self._channel, queue, body, properties)
+            return
+
+        future = self._publisher.publish(body, queue, properties)
+        publishes = _batch_publishes.get(None)
+        if publishes is not None:
+            publishes.append(future)
 
     def queue_result(self, result: WorkerResults, user_id: str):
         """
@@ -82,9 +202,7 @@ class Worker:
         """
         job = AggregatorJob(job_type=JobType.RESULT, user_id=user_id, content=result)
 
-        self._channel = publish_to_queue(
-            self._channel, RESULT_QUEUE, job.model_dump_json()
-        )
+        self._publish(RESULT_QUEUE, job)
 
     def queue_error(self, error: WorkerError, user_id: str):
         """
@@ -96,19 +214,51 @@ class Worker:
             user_id=user_id,
             content=error,
         )
-        self._channel = publish_to_queue(
-            self._channel, RESULT_QUEUE, job.model_dump_json()
-        )
+        self._publish(RESULT_QUEUE, job)
 
     def close(self):
         self._channel.close()
+        if self._publisher is not None:
+            self._publisher.stop()
 
-    def unpack_batch(self, data: str) -> Batch:
-        batch_data = json.loads(data)
-        print(f"Received job: {batch_data}")
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """
+        Return the pooled HTTP client used for dataset and model requests.
+
+        Connections are kept alive and reused per host across batches. The client is
+        bound to the event loop it is first used on, so a new one is created if the
+        worker is driven by a different loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._http_client is None or self._http_client_loop is not loop:
+            self._http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    WORKER_HTTP_READ_TIMEOUT, connect=WORKER_HTTP_CONNECT_TIMEOUT
+                ),
+                limits=httpx.Limits(
+                    max_connections=WORKER_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=WORKER_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=WORKER_HTTP_KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._http_client_loop = loop
+        return self._http_client
+
+    async def close_http_client(self):
+        """
+        Close the pooled HTTP client, releasing any kept-alive connections
+        """
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+            self._http_client_loop = None
+
+    def unpack_batch(self, data: str | bytes, properties=None) -> Batch:
         try:
             print("Unpacking batch data")
-            return Batch(**batch_data)
+            batch = decode_message(Batch, data, properties)
+            print(f"Received job: {batch}")
+            return batch
         except ValueError as e:
             raise WorkerException(f"Invalid batch format: {e}", status_code=400)
 
@@ -125,36 +275,39 @@ class Worker:
         """
 
         url = convert_localhost_url(str(data_url))
-        headers = (
-            {"Authorization": f"Bearer {dataset_api_key}"} if dataset_api_key else {}
-        )
+        # Ask for an npz archive, which servers that don't support it ignore
+        headers = {"Accept": NPZ_ACCEPT}
+        if dataset_api_key:
+            headers["Authorization"] = f"Bearer {dataset_api_key}"
         params = {"n": batch_size}
 
         try:
-            response = requests.get(url, headers=headers, params=params, timeout=90)
+            response = await self._get_http_client().get(
+                url, headers=headers, params=params
+            )
 
             # Raise for HTTP errors (4xx, 5xx)
             response.raise_for_status()
 
-        except ConnectionError as e:
+        except httpx.ConnectError as e:
             raise WorkerException(
                 detail=f"Failed to connect to dataset API at {url}: {e}",
                 status_code=503,
             )
 
-        except Timeout as e:
+        except httpx.TimeoutException as e:
             raise WorkerException(
                 detail=f"Request to dataset API at {url} timed out: {e}",
                 status_code=504,
             )
 
-        except HTTPError as e:
+        except httpx.HTTPStatusError as e:
             raise WorkerException(
                 detail=f"HHTP Error on request to dataset API at {url}: {e}",
-                status_code=response.status_code,
+                status_code=e.response.status_code,
             )
 
-        except RequestException as e:
+        except httpx.RequestError as e:
             raise WorkerException(
                 detail=f"An error occurred while contacting the dataset API: {e}",
                 status_code=500,
@@ -167,8 +320,12 @@ class Worker:
             )
 
         try:
-            # Ensure response is JSON
-            if "application/json" not in response.headers.get("Content-Type", ""):
+            content_type = response.headers.get("Content-Type", "")
+            if is_npz(content_type):
+                return decode_npz(DatasetResponse, response.content)
+
+            # Otherwise ensure response is JSON
+            if "application/json" not in content_type:
                 raise WorkerException(
                     f"Unexpected response type from dataset API: {response.headers.get('Content-Type')}",
                     status_code=500,
@@ -201,33 +358,40 @@ class Worker:
         - modelAPIKey : API key for the model
         """
         url = convert_localhost_url(str(model_url))
-        headers = {"Authorization": f"Bearer {model_api_key}"} if model_api_key else {}
+        headers = {"Accept": NPZ_ACCEPT}
+        if model_api_key:
+            headers["Authorization"] = f"Bearer {model_api_key}"
 
         try:
-            response = requests.post(
-                url, json=data.model_dump(), headers=headers, timeout=90
-            )
+            response = None
+            # Only send an npz archive to models which have replied with one
+            if url in self._npz_model_urls:
+                response = await self._post_npz(url, data, headers)
+            if response is None:
+                response = await self._get_http_client().post(
+                    url, json=data.model_dump(), headers=headers
+                )
 
-            # Raise for status (HTTPError for 4xx, 5xx)
+            # Raise for status (HTTPStatusError for 4xx, 5xx)
             response.raise_for_status()
 
-        except ConnectionError as e:
+        except httpx.ConnectError as e:
             raise WorkerException(
                 detail=f"Failed to connect to model at {url}: {e}", status_code=503
             )
 
-        except Timeout as e:
+        except httpx.TimeoutException as e:
             raise WorkerException(
                 detail=f"Request to model at {url} timed out: {e}", status_code=504
             )
 
-        except HTTPError as e:
+        except httpx.HTTPStatusError as e:
             raise WorkerException(
                 detail=f"HHTP Error on request to dataset API at {url}: {e}",
-                status_code=response.status_code,
+                status_code=e.response.status_code,
             )
 
-        except RequestException as e:
+        except httpx.RequestError as e:
             raise WorkerException(
                 detail=f"An error occurred while contacting the model: {e}",
                 status_code=500,
@@ -240,14 +404,18 @@ class Worker:
             )
 
         try:
-            # Ensure response is JSON
-            if "application/json" not in response.headers.get("Content-Type", ""):
+            content_type = response.headers.get("Content-Type", "")
+            if is_npz(content_type):
+                model_response = decode_npz(ModelResponse, response.content)
+                self._npz_model_urls.add(url)
+            # Otherwise ensure response is JSON
+            elif "application/json" not in content_type:
                 raise WorkerException(
                     f"Unexpected response type from model: {response.headers.get('Content-Type')}",
                     status_code=500,
                 )
-
-            model_response = ModelResponse(**response.json())
+            else:
+                model_response = ModelResponse(**response.json())
             self._check_model_response(model_response.predictions, data.labels)
 
             return model_response
@@ -258,6 +426,164 @@ class Worker:
                 status_code=500,
             )
 
+    def materialise_features(
+        self, job_id: str, dataset: DatasetResponse
+    ) -> tuple[list[list] | np.ndarray, dict[int, list] | None]:
+        """
+        Convert the dataset's features into a typed array, using the column dtypes declared
+        with the batch. Categories are given the same codes in every batch of the job, whichever
+        worker processes it. Without declared dtypes, the features are returned unchanged.
+
+        Returns the features and the categories of any categorical columns
+        """
+        if dataset.column_dtypes is None:
+            return dataset.features, None
+
+        def encode_categories(column: int, categories: list) -> tuple[np.ndarray, list]:
+            key = f"{job_id}:{column}"
+            return self._category_encoder.encode(key, categories), self._category_encoder.categories(key)
+
+        try:
+            features, categories = typed_features_to_np(
+                dataset.features, dataset.column_dtypes, encode_categories
+            )
+        except (TypeError, ValueError) as e:
+            raise WorkerException(
+                f"Data error - Features do not match the declared column dtypes: {e}",
+                status_code=400,
+            )
+        except redis.RedisError as e:
+            raise WorkerException(f"Could not encode feature categories: {e}", status_code=503)
+        return features, categories or None
+
+    def get_user_metric_functions(self, job_id: str) -> list[str]:
+        """
+        Return the names of the user-defined metric functions uploaded for the job, which
+        are fetched from the user metric server for the job's first batch only
+        """
+        with self._user_metric_functions_lock:
+            functions = self._user_metric_functions.get(job_id)
+            if functions is not None:
+                self._user_metric_functions.move_to_end(job_id)
+                return functions
+
+        # TODO: Add more robustness for server querying e.g. timeouts and retries
+        try:
+            # query the user metric server to get the user-defined metrics
+            user_metrics_server_response = requests.get(
+                f"{USER_METRIC_SERVER_URL}/inspect-uploaded-functions/{job_id}",
+            )
+        except Exception as e:
+            print(f"Exception occurred while fetching user metrics: {e}")
+            return []
+
+        if user_metrics_server_response.status_code == 200:
+            functions = user_metrics_server_response.json()["functions"]
+            print(f"User defined metrics: {functions}")
+        elif user_metrics_server_response.status_code == 404:
+            # No functions were uploaded for the job
+            functions = []
+        else:
+            print(f"SERVER RESPONSE NOT OKAY: {user_metrics_server_response.text}")
+            return []
+
+        with self._user_metric_functions_lock:
+            self._user_metric_functions[job_id] = functions
+            if len(self._user_metric_functions) > WORKER_USER_METRICS_CACHE_SIZE:
+                self._user_metric_functions.popitem(last=False)
+        return functions
+
+    def compute_user_metrics(
+        self, job_id: str, metrics_request: CalculateRequest
+    ) -> dict[str, dict] | None:
+        """
+        Compute every user-defined metric uploaded for the job in a single request to the
+        user metric server, which receives the batch's parameters once for all of them.
+
+        Returns the result of each metric which was computed successfully, or None if there are none
+        """
+        functions = self.get_user_metric_functions(job_id)
+        if not functions:
+            return None
+
+        try:
+            # Converted once, and only if there are user-defined metrics
+            params_dict = convert_calculate_request_to_dict(metrics_request)
+            exec_response = requests.post(
+                f"{USER_METRIC_SERVER_URL}/compute-metrics",
+                json={
+                    "user_id": job_id,
+                    "function_names": functions,
+                    "params": params_dict,
+                },
+            )
+            if exec_response.status_code != 200:
+                print(f"SERVER RESPONSE NOT OKAY: {exec_response.text}")
+                return None
+            outputs = exec_response.json()["results"]
+        except Exception as e:
+            print(f"ERROR EXECUTING USER METRICS: {e}")
+            return None
+
+        user_defined_metrics = {}
+        for metric, output in outputs.items():
+            if "result" in output:
+                print(f"User metric {metric} result: {output['result']}")
+                user_defined_metrics[metric] = output["result"]
+            else:
+                print(f"ERROR EXECUTING USER METRIC {metric}: {output.get('error')}")
+        return user_defined_metrics or None
+
+    async def _post_npz(
+        self, url: str, data: DatasetResponse, headers: dict
+    ) -> httpx.Response | None:
+        """
+        Send the data to the model as an npz archive. Returns None if the data cannot be
+        encoded as arrays, or the model no longer accepts archives, so that JSON is sent instead.
+        """
+        try:
+            body = encode_npz(data)
+        except ValueError:
+            return None
+        response = await self._get_http_client().post(
+            url, content=body, headers={**headers, "Content-Type": NPZ_CONTENT_TYPE}
+        )
+        if response.status_code == 415:
+            self._npz_model_urls.discard(url)
+            return None
+        return response
+
+    async def process_job_bounded(self, batch: Batch):
+        """
+        Process a batch, waiting for a free slot if the worker already has
+        `max_concurrent_batches` batches in flight
+        """
+        async with self._batch_semaphore:
+            publishes = []
+            token = _batch_publishes.set(publishes)
+            try:
+                await self.process_job(batch)
+            finally:
+                _batch_publishes.reset(token)
+            # Only let the batch be acknowledged once its results and status are queued
+            await self._wait_for_confirms(publishes)
+
+    async def _wait_for_confirms(self, publishes: list[Future]):
+        """
+        Wait for the broker to confirm the given messages, raising the first failure (a nack,
+        or the publisher stopping) once all of them are settled, so that the batch is requeued
+        rather than acknowledged with its results lost
+        """
+        error = None
+        for future in publishes:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception as e:
+                print(f"Message was not confirmed by RabbitMQ: {e}")
+                error = error or e
+        if error is not None:
+            raise error
+
     async def process_job(self, batch: Batch):
 
         print("Processing Job")
@@ -292,15 +618,23 @@ class Worker:
                 metrics_data.model_type == TaskType.BINARY_CLASSIFICATION
                 or metrics_data.model_type == TaskType.MULTI_CLASS_CLASSIFICATION
             ):
-                predicted_labels, true_labels = self.convert_to_numeric_classes(
-                    predicted_labels, true_labels
+                predicted_labels, true_labels = await asyncio.to_thread(
+                    self.convert_to_numeric_classes,
+                    batch.job_id,
+                    predicted_labels,
+                    true_labels,
                 )
 
+            input_features, feature_categories = await asyncio.to_thread(
+                self.materialise_features, batch.job_id, dataset_response
+            )
+
             # Construct CalculateRequest
             metrics_request = CalculateRequest(
                 metrics=metrics_data.metrics,
                 batch_size=batch.batch_size,
-                input_features=dataset_response.features,
+                input_features=input_features,
+                feature_categories=feature_categories,
                 true_labels=true_labels,
                 predicted_labels=predicted_labels,
                 confidence_scores=model_response.confidence_scores,
@@ -314,61 +648,26 @@ class Worker:
                 total_sample_size=batch.total_sample_size,
                 regression_flag=metrics_data.model_type == TaskType.REGRESSION,
             )
+            # Only the typed arrays are needed from here on
+            del dataset_response, model_response, input_features
 
-            # Calculate metrics
-            metrics_results = metrics_lib.calculate_metrics(metrics_request)
+            # Calculate metrics off the event loop so that other in-flight batches
+            # can keep fetching data and querying models in the meantime
+            metrics_results = await asyncio.to_thread(
+                metrics_lib.calculate_metrics, metrics_request
+            )
             print(f"Final Results: {metrics_results}")
             # add user_id to the results
             worker_results = WorkerResults(
                 **metrics_results.model_dump(),
                 user_id=batch.job_id,
+                batch_id=batch.batch_id,
                 user_defined_metrics=None,
             )
 
-            # TODO: Add more robustness for server querying e.g. timeouts and retries
-            try:
-                # query the user metric server to get the user-defined metrics
-                user_metrics_server_response = requests.get(
-                    f"{USER_METRIC_SERVER_URL}/inspect-uploaded-functions/{batch.job_id}",
-                )
-
-                user_defined_metrics = []
-                if user_metrics_server_response.status_code == 200:
-                    user_defined_metrics = user_metrics_server_response.json()[
-                        "functions"
-                    ]
-                    print(f"User defined metrics: {user_defined_metrics}")
-                else:
-                    print(
-                        f"SERVER RESPONSE NOT OKAY: {user_metrics_server_response.text}"
-                    )
-            except Exception as e:
-                print(f"Exception occurred while fetching user metrics: {e}")
-                user_defined_metrics = []
-
-            for metric in user_defined_metrics:
-                try:
-                    params_dict = convert_calculate_request_to_dict(metrics_request)
-                    # execute the user-defined metric
-                    exec_response = requests.post(
-                        f"{USER_METRIC_SERVER_URL}/compute-metric",
-                        json={
-                            "user_id": batch.job_id,
-                            "function_name": metric,
-                            "params": params_dict,
-                        },
-                    )
-                    if exec_response.status_code == 200:
-                        result = exec_response.json()["result"]
-                        print(f"User metric {metric} result: {result}")
-                        if worker_results.user_defined_metrics is None:
-                            worker_results.user_defined_metrics = {}
-                        worker_results.user_defined_metrics[metric] = result
-                    else:
-                        print(f"SERVER RESPONSE NOT OKAY: {exec_response.text}")
-
-                except Exception as e:
-                    print(f"ERROR EXECUTING USER METRIC: {e}")
+            worker_results.user_defined_metrics = await asyncio.to_thread(
+                self.compute_user_metrics, batch.job_id, metrics_request
+            )
 
             self.queue_result(worker_results, batch.job_id)
             self.send_status_completed(batch.job_id, batch.batch_id)
@@ -392,27 +691,25 @@ class Worker:
         """
         Function to send a status message to the status queue
         """
-        self._channel = publish_to_queue(
-            self._channel,
+        self._publish(
             STATUS_QUEUE,
             JobStatusMessage(
                 job_id=job_id, batch_id=batch_id, status=JobStatus.COMPLETED
-            ).model_dump_json(),
+            ),
         )
 
     def send_status_error(self, job_id: str, batch_id: str, error):
         """
         Function to send a status message to the status queue
         """
-        self._channel = publish_to_queue(
-            self._channel,
+        self._publish(
             STATUS_QUEUE,
             JobStatusMessage(
                 job_id=job_id,
                 batch_id=batch_id,
                 status=JobStatus.ERRORED,
                 errorMessage=str(error),
-            ).model_dump_json(),
+            ),
         )
 
     def run(self):
@@ -430,29 +727,78 @@ class Worker:
         thread = threading.Thread(target=start_event_loop, args=(loop,), daemon=True)
         thread.start()
 
-        # Use asyncio.run_coroutine_threadsafe()
+        # Use asyncio.run_coroutine_threadsafe() without waiting on the result, so
+        # that up to `max_concurrent_batches` batches are processed concurrently
         def callback(channel, method, properties, body):
             print(" [x] Received %r" % body)
             print("[x] Unpacking batch")
-            batch = self.unpack_batch(body)
+            try:
+                batch = self.unpack_batch(body, properties)
+            except Exception as e:
+                print(f"[x] Discarding malformed batch: {e}")
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
             print("[x] Processing batch...")
-            task = asyncio.run_coroutine_threadsafe(self.process_job(batch), loop)
-            task.result()
-            print("[x] Done processing batch")
+            task = asyncio.run_coroutine_threadsafe(
+                self.process_job_bounded(batch), loop
+            )
+            task.add_done_callback(
+                functools.partial(self._settle_batch, channel, method)
+            )
 
         try:
+            # Never hold more unacknowledged batches than can be processed at once
+            self._channel.basic_qos(prefetch_count=self._max_concurrent_batches)
             self._channel.basic_consume(
-                queue=BATCH_QUEUE, on_message_callback=callback, auto_ack=True
+                queue=BATCH_QUEUE, on_message_callback=callback, auto_ack=False
+            )
+            print(
+                f"Worker started (max concurrent batches: {self._max_concurrent_batches})"
             )
-            print("Worker started")
             # Block on the channel
             self._channel.start_consuming()
         except KeyboardInterrupt:
             self.close()
+            asyncio.run_coroutine_threadsafe(self.close_http_client(), loop).result()
             print("Worker stopped")
 
+    def _settle_batch(self, channel, method, future):
+        """
+        Acknowledge a processed batch once its results and statuses are confirmed (see
+        process_job_bounded). Called on the event loop thread, so the ack is handed back to
+        the connection thread.
+
+        A batch whose results were not confirmed is requeued to be processed again, but only
+        once, so that a batch which can never be confirmed is not requeued forever. If the
+        publisher has stopped for good, nothing more can be published, so the worker stops
+        consuming and the batch is requeued for other workers.
+        """
+        if not (future.cancelled() or future.exception() is not None):
+            self._connection.add_callback_threadsafe(
+                functools.partial(channel.basic_ack, delivery_tag=method.delivery_tag)
+            )
+            print("[x] Done processing batch")
+            return
+
+        if self._publisher is not None and not self._publisher.is_running:
+            print("[x] Publisher has stopped, so the worker stops consuming batches")
+            self._connection.add_callback_threadsafe(
+                functools.partial(channel.basic_nack, delivery_tag=method.delivery_tag, requeue=True)
+            )
+            self._connection.add_callback_threadsafe(channel.stop_consuming)
+            return
+
+        requeue = not method.redelivered
+        self._connection.add_callback_threadsafe(
+            functools.partial(channel.basic_nack, delivery_tag=method.delivery_tag, requeue=requeue)
+        )
+        if requeue:
+            print("[x] Requeued batch whose results were not confirmed")
+        else:
+            print("[x] Discarding redelivered batch whose results were not confirmed")
+
     # TODO: Write a doc explaining error messages and what checking is/isn't supported
-    def _check_model_response(self, predictions, labels):
+    def _check_model_response(self, predictions, labels, validation: str = None):
         """
         PRE: response is received from a deserialised pydantic model and labels and types
         have been enforced according to ModelOutput.
@@ -461,73 +807,117 @@ class Worker:
         Helper function to check the response from the model API and ensure validity compared to data
 
         Checks are ordered in terms of complexity and computational cost, with the most
-        computationally expensive towards the end.
+        computationally expensive towards the end. The shape of the predictions is always
+        checked in full, while how many values have their type checked depends on `validation`
+        (defaulting to the worker's level, set from WORKER_MODEL_RESPONSE_VALIDATION):
+        - "full": every value
+        - "sampled": the values of WORKER_MODEL_RESPONSE_VALIDATION_SAMPLE_SIZE random rows
+        - "shape": only the values of the first row
 
         Params:
-        - response : Response object from the model API
+        - predictions : Predictions from the model, as nested lists or an array
+        - labels : Labels of the data sent to the model
+        - validation : How strictly to check the type of each value
         """
+        validation = validation or self._model_response_validation
+        if validation not in MODEL_RESPONSE_VALIDATION_LEVELS:
+            raise ValueError(f"Unknown model response validation level: {validation}")
+
         if len(predictions) != len(labels):
             raise WorkerException(
                 "Number of model outputs does not match expected number of labels",
                 status_code=400,
             )
+        if len(labels) == 0:
+            return
 
-        if len(labels) >= 0:
-            if len(predictions[0]) != len(labels[0]):
-                raise WorkerException(
-                    "Number of attributes predicted by model does not match number of target attributes",
-                    status_code=400,
-                )
-
-            for col_index in range(len(labels[0])):
-                if not isinstance(
-                    predictions[0][col_index], type(labels[0][col_index])
-                ):
-                    raise WorkerException(
-                        "Model output type does not match target attribute type",
-                        status_code=400,
-                    )
-        """
-        TODO: Evaluate if this check is necessary -> O(n) complexity where n is number
-        of datapoints.
-        (As opposed to O(1) complexity or O(d) complexity for above checks)
-        """
         num_attributes = len(labels[0])
-        for row in predictions[1:]:
-            if len(row) != num_attributes:
+        if len(predictions[0]) != num_attributes:
+            raise WorkerException(
+                "Number of attributes predicted by model does not match number of target attributes",
+                status_code=400,
+            )
+
+        for col_index in range(num_attributes):
+            if not self._matches_label_type(
+                type(predictions[0][col_index]), labels[0][col_index]
+            ):
                 raise WorkerException(
-                    "Inconsistent number of attributes for each datapoint predicted by model",
+                    "Model output type does not match target attribute type",
                     status_code=400,
                 )
 
-        """
-        TODO: Evaluate if this check is necessary -> O(n*d) complexity where n is number
-        of datapoints in batch and d is number of attributes being predicted.
-        (As opposed to O(1) complexity or O(d) complexity for above checks)
-        """
-        for col_index in range(len(predictions[0])):
-            col_type = type(labels[0][col_index])
-            for row_index in range(len(predictions)):
-                if not isinstance(predictions[row_index][col_index], col_type):
+        # Arrays are rectangular with a single type, so checking the first row is enough
+        if isinstance(predictions, np.ndarray) and predictions.dtype != object:
+            return
+
+        row_lengths = np.fromiter(map(len, predictions), dtype=np.intp, count=len(predictions))
+        if np.any(row_lengths != num_attributes):
+            raise WorkerException(
+                "Inconsistent number of attributes for each datapoint predicted by model",
+                status_code=400,
+            )
+
+        if validation == "shape":
+            return
+
+        values = np.empty((len(predictions), num_attributes), dtype=object)
+        values[:] = predictions
+        if validation == "sampled" and len(values) > WORKER_MODEL_RESPONSE_VALIDATION_SAMPLE_SIZE:
+            rows = np.random.default_rng().choice(
+                len(values), WORKER_MODEL_RESPONSE_VALIDATION_SAMPLE_SIZE, replace=False
+            )
+            values = values[rows]
+
+        # Find the types in each column in one pass, then check each distinct type once
+        types = _value_types(values)
+        for col_index in range(num_attributes):
+            label = labels[0][col_index]
+            for value_type in set(types[:, col_index]):
+                if not self._matches_label_type(value_type, label):
                     raise WorkerException(
                         "All columns for an output label should be of the same type",
                         status_code=400,
                     )
 
-        return
+    @staticmethod
+    def _matches_label_type(value_type: type, label) -> bool:
+        """
+        Whether a predicted value of the given type has the type of its label. NumPy values
+        (e.g. decoded from an npz archive) are compared by kind, so that e.g. numpy.int64
+        matches int.
+        """
+        if issubclass(value_type, np.generic) or isinstance(label, np.generic):
+            label_kind = np.asarray(label).dtype.kind
+            try:
+                value_kind = np.dtype(value_type).kind
+            except TypeError:
+                return False
+            return value_kind in _COMPATIBLE_KINDS.get(label_kind, label_kind)
+        return issubclass(value_type, type(label))
 
-    def convert_to_numeric_classes(self, predicted_labels, true_labels):
+    def convert_to_numeric_classes(self, job_id: str, predicted_labels, true_labels):
         """
-        Function to convert labels to numeric classes
+        Function to convert labels to numeric classes, giving each label the same class
+        in every batch of the job
         """
         # flatten the labels
-        predicted_labels = [label for sublist in predicted_labels for label in sublist]
-        true_labels = [label for sublist in true_labels for label in sublist]
-        label_set = set(predicted_labels + true_labels)
+        predicted_labels = _flatten_labels(predicted_labels)
+        true_labels = _flatten_labels(true_labels)
+        try:
+            labels = np.concatenate([predicted_labels, true_labels])
+        except TypeError:
+            # e.g. numeric predictions for string labels
+            labels = np.concatenate([predicted_labels.astype(str), true_labels.astype(str)])
+
+        label_set, label_indices = np.unique(labels, return_inverse=True)
         print(f"Label set is: {label_set}")
-        label_map = {label: i for i, label in enumerate(label_set)}
-        predicted_labels_new = [[label_map[label]] for label in predicted_labels]
-        true_labels_new = [[label_map[label]] for label in true_labels]
+        try:
+            classes = self._label_encoder.encode(job_id, label_set)[label_indices]
+        except redis.RedisError as e:
+            raise WorkerException(f"Could not encode labels: {e}", status_code=503)
+        predicted_labels_new = classes[: len(predicted_labels)].reshape(-1, 1)
+        true_labels_new = classes[len(predicted_labels):].reshape(-1, 1)
         return predicted_labels_new, true_labels_new
 
     def binarize_finbert_output(self, predicted_labels, true_labels):